@@ -2,6 +2,7 @@ import cPickle
 import collections
 from copy import deepcopy
 import ctypes
+import hashlib
 import logging
 import os
 import tempfile
@@ -11,6 +12,7 @@ import numpy.linalg
 
 from smqtk.algorithms import SupervisedClassifier
 from smqtk.representation.descriptor_element import elements_to_matrix
+from smqtk.utils import file_utils
 
 try:
     import svm
@@ -23,6 +25,107 @@ except ImportError:
 __author__ = "paul.tunison@kitware.com"
 
 
+# Layout of libSVM's ``svm_node`` struct, for building node arrays with numpy.
+SVM_NODE_DTYPE = numpy.dtype([('index', numpy.intc), ('value', numpy.double)],
+                             align=True)
+
+
+def linear_kernel(a, b):
+    """
+    :return: Matrix of dot products between rows of ``a`` and ``b``.
+    :rtype: numpy.ndarray
+    """
+    return numpy.dot(a, b.T)
+
+
+def histogram_intersection_kernel(a, b):
+    """
+    :return: Matrix of histogram intersections, i.e. the sums of element-wise
+        minimums, between rows of ``a`` and ``b``.
+    :rtype: numpy.ndarray
+    """
+    k = numpy.empty((a.shape[0], b.shape[0]), dtype=float)
+    if a is b:
+        # Symmetric, so only compute the upper triangle.
+        for i in xrange(a.shape[0]):
+            k[i, i:] = numpy.minimum(a[i], b[i:]).sum(axis=1)
+            k[i:, i] = k[i, i:]
+    else:
+        for i in xrange(a.shape[0]):
+            k[i] = numpy.minimum(a[i], b).sum(axis=1)
+    return k
+
+
+# Kernels available for precomputed kernel training.
+PRECOMPUTED_KERNELS = {
+    'linear': linear_kernel,
+    'histogram_intersection': histogram_intersection_kernel,
+}
+
+
+def _kernel_node_array(k, serials):
+    """
+    Make libSVM precomputed kernel nodes for rows of kernel values: a first
+    node (index 0) with the row's sample serial number, a node per kernel
+    value (index 1 to N) and a terminating node (index -1).
+
+    :param k: Kernel value rows.
+    :type k: numpy.ndarray
+
+    :param serials: Serial number for each row.
+    :type serials: collections.Sequence[int]
+
+    :return: Node array of shape ``(rows, N + 2)``.
+    :rtype: numpy.ndarray
+    """
+    n_rows, n = k.shape
+    nodes = numpy.empty((n_rows, n + 2), dtype=SVM_NODE_DTYPE)
+    nodes['index'][:, 0] = 0
+    nodes['value'][:, 0] = serials
+    nodes['index'][:, 1:-1] = numpy.arange(1, n + 1)
+    nodes['value'][:, 1:-1] = k
+    nodes['index'][:, -1] = -1
+    nodes['value'][:, -1] = 0
+    return nodes
+
+
+def _node_pointer(node_row):
+    """
+    :return: libSVM node pointer to the start of a row of a node array.
+    """
+    return ctypes.cast(node_row.ctypes.data, ctypes.POINTER(svm.svm_node))
+
+
+def _kernel_problem(labels, k):
+    """
+    Make a libSVM problem for a precomputed kernel directly from a kernel
+    matrix, without going through Python lists of node values.
+
+    :param labels: Integer label of each training example.
+    :type labels: collections.Sequence[int]
+
+    :param k: Square training kernel matrix.
+    :type k: numpy.ndarray
+
+    :rtype: svm.svm_problem
+    """
+    l = len(labels)
+    nodes = _kernel_node_array(k, numpy.arange(1, l + 1))
+    y = numpy.ascontiguousarray(labels, dtype=numpy.double)
+    rows = [_node_pointer(r) for r in nodes]
+    x = (ctypes.POINTER(svm.svm_node) * l)(*rows)
+
+    prob = svm.svm_problem.__new__(svm.svm_problem)
+    prob.l = l
+    prob.n = l
+    prob.y = y.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+    prob.x = ctypes.cast(x, ctypes.POINTER(ctypes.POINTER(svm.svm_node)))
+    # Memory referenced by the problem must outlive it.
+    prob.x_space = rows
+    prob._arrays = (nodes, y, x)
+    return prob
+
+
 class LibSvmClassifier (SupervisedClassifier):
     """
     Classifier that uses libSVM for support-vector machine functionality.
@@ -31,6 +134,17 @@ class LibSvmClassifier (SupervisedClassifier):
     implementation will write out temporary files upon pickling and loading.
     This is required because the model instance is not transportable via
     serialization due to libSVM being an external C library.*
+
+    When ``precomputed_kernel`` is set, training computes the kernel matrix of
+    the training examples with NumPy and gives it to libSVM as a precomputed
+    kernel (``-t 4``) instead of having libSVM compute kernel values from
+    vectors. If a ``kernel_cache_dir`` is also set, training kernel matrices
+    are saved there, keyed by the set of training descriptor UUIDs, and
+    training on a subset of a cached kernel's descriptors extracts the
+    sub-matrix instead of computing it. See ``cache_kernel`` for priming the
+    cache for cross-validation. Such models keep their support vectors for
+    classification, saved next to a configured model file as
+    ``<svm_model_fp>.sv.npy``.
     """
 
     @classmethod
@@ -57,6 +171,8 @@ class LibSvmClassifier (SupervisedClassifier):
                      # '-g': 0.0078125,  # initial gamma (1 / 128)
                  },
                  normalize=None,
+                 precomputed_kernel=None,
+                 kernel_cache_dir=None,
                  ):
         """
         Initialize the classifier with an empty or existing model.
@@ -85,6 +201,15 @@ class LibSvmClassifier (SupervisedClassifier):
             for 1D arrays. This is ``None`` by default (no normalization).
         :type normalize: None | int | float | str
 
+        :param precomputed_kernel: Optional name of a kernel in
+            ``PRECOMPUTED_KERNELS`` to train with as a precomputed kernel. When
+            set, the kernel type in ``train_params`` is ignored.
+        :type precomputed_kernel: None | str
+
+        :param kernel_cache_dir: Optional directory to cache precomputed
+            training kernel matrices in.
+        :type kernel_cache_dir: None | str
+
         """
         super(LibSvmClassifier, self).__init__()
 
@@ -95,6 +220,13 @@ class LibSvmClassifier (SupervisedClassifier):
         # Validate normalization parameter by trying it on a random vector
         if normalize is not None:
             self._norm_vector(numpy.random.rand(8))
+        if precomputed_kernel is not None and \
+                precomputed_kernel not in PRECOMPUTED_KERNELS:
+            raise ValueError("Unknown precomputed kernel '%s'. Must be one of "
+                             "%s." % (precomputed_kernel,
+                                      sorted(PRECOMPUTED_KERNELS)))
+        self.precomputed_kernel = precomputed_kernel
+        self.kernel_cache_dir = kernel_cache_dir
 
         # generated parameters
         #: :type: svm.svm_model
@@ -102,6 +234,12 @@ class LibSvmClassifier (SupervisedClassifier):
         # dictionary mapping SVM integer labels to semantic labels
         #: :type: dict[int, collections.Hashable]
         self.svm_label_map = None
+        # Support vectors of a precomputed kernel model, in model order.
+        #: :type: None | numpy.ndarray
+        self.svm_sv_vectors = None
+        # UUID-to-index maps of cached kernel matrices, by kernel file path.
+        #: :type: dict[str, dict[collections.Hashable, int]]
+        self._kernel_cache_index = {}
 
         self._reload_model()
 
@@ -120,6 +258,7 @@ class LibSvmClassifier (SupervisedClassifier):
                 state = self.get_config()
                 state['__LOCAL__'] = True
                 state['__LOCAL_LABELS__'] = self.svm_label_map
+                state['__LOCAL_SV__'] = self.svm_sv_vectors
 
                 svmutil.svm_save_model(fp, self.svm_model)
                 with open(fp, 'rb') as model_f:
@@ -134,6 +273,10 @@ class LibSvmClassifier (SupervisedClassifier):
         self.svm_label_map_fp = state['svm_label_map_fp']
         self.train_params = state['train_params']
         self.normalize = state['normalize']
+        self.precomputed_kernel = state.get('precomputed_kernel', None)
+        self.kernel_cache_dir = state.get('kernel_cache_dir', None)
+        self.svm_sv_vectors = None
+        self._kernel_cache_index = {}
 
         # C libraries/pointers don't survive across processes.
         if '__LOCAL__' in state:
@@ -142,6 +285,7 @@ class LibSvmClassifier (SupervisedClassifier):
                 os.close(fd)
 
                 self.svm_label_map = state['__LOCAL_LABELS__']
+                self.svm_sv_vectors = state.get('__LOCAL_SV__', None)
 
                 # write model binary to file, then load via libSVM
                 with open(fp, 'wb') as model_f:
@@ -164,6 +308,16 @@ class LibSvmClassifier (SupervisedClassifier):
         if self.svm_label_map_fp and os.path.isfile(self.svm_label_map_fp):
             with open(self.svm_label_map_fp, 'rb') as f:
                 self.svm_label_map = cPickle.load(f)
+        if self.precomputed_kernel and self.svm_model_fp and \
+                os.path.isfile(self._sv_vectors_fp()):
+            self.svm_sv_vectors = numpy.load(self._sv_vectors_fp())
+
+    def _sv_vectors_fp(self):
+        """
+        :return: Path of the support vectors file of a precomputed kernel model.
+        :rtype: str
+        """
+        return self.svm_model_fp + '.sv.npy'
 
     @staticmethod
     def _gen_param_string(params):
@@ -209,6 +363,8 @@ class LibSvmClassifier (SupervisedClassifier):
             "svm_label_map_fp": self.svm_label_map_fp,
             "train_params": self.train_params,
             "normalize": self.normalize,
+            "precomputed_kernel": self.precomputed_kernel,
+            "kernel_cache_dir": self.kernel_cache_dir,
         }
 
     def has_model(self):
@@ -217,8 +373,156 @@ class LibSvmClassifier (SupervisedClassifier):
             present, classification of descriptors cannot happen.
         :rtype: bool
         """
+        if self.precomputed_kernel and self.svm_sv_vectors is None:
+            return False
         return None not in (self.svm_model, self.svm_label_map)
 
+    def _kernel_cache_key(self, uuids):
+        """
+        :return: Kernel cache key for the given set of training UUIDs and our
+            kernel configuration.
+        :rtype: str
+        """
+        h = hashlib.sha1(repr((self.precomputed_kernel, self.normalize)))
+        for u in sorted(str(u) for u in uuids):
+            h.update('\0' + u)
+        return h.hexdigest()
+
+    def _cached_kernel_index(self, uuids):
+        """
+        Find the smallest cached kernel matrix that covers the given UUIDs.
+
+        :return: Kernel matrix file path and UUID-to-index map of the cached
+            kernel, or None if no cached kernel covers the given UUIDs.
+        :rtype: None | (str, dict[collections.Hashable, int])
+        """
+        if not self.kernel_cache_dir or \
+                not os.path.isdir(self.kernel_cache_dir):
+            return None
+        best = None
+        for fn in os.listdir(self.kernel_cache_dir):
+            if not fn.endswith('.uuids.pickle'):
+                continue
+            k_fp = os.path.join(self.kernel_cache_dir,
+                                fn[:-len('.uuids.pickle')] + '.kernel.npy')
+            if k_fp not in self._kernel_cache_index:
+                with open(os.path.join(self.kernel_cache_dir, fn), 'rb') as f:
+                    meta = cPickle.load(f)
+                if (meta['kernel'], meta['normalize']) != \
+                        (self.precomputed_kernel, self.normalize) or \
+                        not os.path.isfile(k_fp):
+                    continue
+                self._kernel_cache_index[k_fp] = \
+                    dict((u, i) for i, u in enumerate(meta['uuids']))
+            idx = self._kernel_cache_index[k_fp]
+            if (best is None or len(idx) < len(best[1])) and \
+                    all(u in idx for u in uuids):
+                best = (k_fp, idx)
+        return best
+
+    def _store_kernel(self, uuids, k):
+        """
+        Save a kernel matrix over the given UUIDs to the kernel cache.
+        """
+        file_utils.safe_create_dir(self.kernel_cache_dir)
+        key = self._kernel_cache_key(uuids)
+        k_fp = os.path.join(self.kernel_cache_dir, key + '.kernel.npy')
+        meta_fp = os.path.join(self.kernel_cache_dir, key + '.uuids.pickle')
+        self._log.debug("Caching %s kernel matrix: %s", k.shape, k_fp)
+        # Kernel file first, as entries are discovered by their UUID file.
+        tmp_fp = k_fp + '.tmp.npy'
+        numpy.save(tmp_fp, k)
+        os.rename(tmp_fp, k_fp)
+        with open(meta_fp + '.tmp', 'wb') as f:
+            cPickle.dump({
+                'kernel': self.precomputed_kernel,
+                'normalize': self.normalize,
+                'uuids': list(uuids),
+            }, f, -1)
+        os.rename(meta_fp + '.tmp', meta_fp)
+        self._kernel_cache_index[k_fp] = \
+            dict((u, i) for i, u in enumerate(uuids))
+
+    def _training_kernel(self, uuids, x):
+        """
+        Get the precomputed kernel matrix for training examples, from the
+        kernel cache if possible.
+
+        :param uuids: UUIDs of the training examples.
+        :type uuids: list[collections.Hashable]
+
+        :param x: Matrix of training example vectors, parallel to ``uuids``.
+        :type x: numpy.ndarray
+
+        :return: Square kernel matrix.
+        :rtype: numpy.ndarray
+        """
+        cached = self._cached_kernel_index(uuids)
+        if cached is not None:
+            k_fp, idx = cached
+            self._log.debug("Using cached kernel matrix: %s", k_fp)
+            i = numpy.array([idx[u] for u in uuids])
+            return numpy.load(k_fp, mmap_mode='r')[numpy.ix_(i, i)]
+
+        self._log.debug("Computing %d x %d kernel matrix", len(uuids),
+                        len(uuids))
+        k = PRECOMPUTED_KERNELS[self.precomputed_kernel](x, x)
+        if self.kernel_cache_dir:
+            self._store_kernel(uuids, k)
+        return k
+
+    def cache_kernel(self, descriptors):
+        """
+        Compute and cache the precomputed kernel matrix over the given
+        descriptors, unless a cached kernel already covers them. Training on
+        any subset of these descriptors then extracts its kernel from this
+        matrix, e.g. for each fold of a cross-validation over them.
+
+        :raises ValueError: No precomputed kernel or kernel cache directory
+            configured.
+
+        :param descriptors: Descriptors to compute the kernel matrix over.
+        :type descriptors:
+            collections.Iterable[smqtk.representation.DescriptorElement]
+
+        """
+        if not (self.precomputed_kernel and self.kernel_cache_dir):
+            raise ValueError("Kernel caching requires a precomputed kernel "
+                             "and a kernel cache directory.")
+        descriptors = list(descriptors)
+        uuids = [d.uuid() for d in descriptors]
+        if self._cached_kernel_index(uuids) is None:
+            x = self._norm_vector(elements_to_matrix(descriptors))
+            self._store_kernel(
+                uuids, PRECOMPUTED_KERNELS[self.precomputed_kernel](x, x)
+            )
+
+    def _set_precomputed_model(self, train_vectors):
+        """
+        Finalize a model trained with a precomputed kernel, recording its
+        support vectors. Support vectors are renumbered in model order so that
+        classification only computes kernel values against them, and the
+        model is reloaded so that it no longer references the training problem.
+
+        :param train_vectors: Matrix of training vectors.
+        :type train_vectors: numpy.ndarray
+        """
+        n_sv = self.svm_model.l
+        serials = numpy.empty(n_sv, dtype=int)
+        for j in xrange(n_sv):
+            sv = self.svm_model.SV[j]
+            serials[j] = int(sv[0].value)
+            sv[0].value = j + 1
+        self.svm_sv_vectors = train_vectors[serials - 1]
+
+        fd, fp = tempfile.mkstemp()
+        try:
+            os.close(fd)
+            svmutil.svm_save_model(fp, self.svm_model)
+            self.svm_model = svmutil.svm_load_model(fp)
+        finally:
+            os.remove(fp)
+
     def train(self, class_examples=None, **kwds):
         """
         Train the supervised classifier model.
@@ -264,6 +568,7 @@ class LibSvmClassifier (SupervisedClassifier):
         self._log.debug("Formatting problem input")
         train_labels = []
         train_vectors = []
+        train_uuids = []
         train_group_sizes = []  # number of examples per class
         self.svm_label_map = {}
         # Making SVM label assignment deterministic to alphabetic order
@@ -282,9 +587,16 @@ class LibSvmClassifier (SupervisedClassifier):
             x = elements_to_matrix(g, report_interval=etm_ri)
             x = self._norm_vector(x)
             train_labels.extend([i] * x.shape[0])
-            train_vectors.extend(x.tolist())
+            if self.precomputed_kernel:
+                train_vectors.append(x)
+                train_uuids.extend(d.uuid() for d in g)
+            else:
+                train_vectors.extend(x.tolist())
             del g, x
 
+        if self.precomputed_kernel:
+            train_vectors = numpy.vstack(train_vectors)
+
         assert len(train_labels) == len(train_vectors), \
             "Count miss-match between parallel labels and descriptor vectors" \
             "being sent to libSVM (%d != %d)" \
@@ -294,6 +606,8 @@ class LibSvmClassifier (SupervisedClassifier):
         #: :type: dict
         params = deepcopy(self.train_params)
         params.update(param_debug)
+        if self.precomputed_kernel:
+            params['-t'] = 4
         # Calculating class weights for C-SVC SVM
         if '-s' not in params or int(params['-s']) == 0:
             total_examples = sum(train_group_sizes)
@@ -309,10 +623,18 @@ class LibSvmClassifier (SupervisedClassifier):
         self._log.debug("Making parameters obj")
         svm_params = svmutil.svm_parameter(self._gen_param_string(params))
         self._log.debug("Creating SVM problem")
-        svm_problem = svm.svm_problem(train_labels, train_vectors)
-        del train_vectors
+        if self.precomputed_kernel:
+            svm_problem = _kernel_problem(
+                train_labels, self._training_kernel(train_uuids, train_vectors)
+            )
+        else:
+            svm_problem = svm.svm_problem(train_labels, train_vectors)
+            del train_vectors
         self._log.debug("Training SVM model")
         self.svm_model = svmutil.svm_train(svm_problem, svm_params)
+        if self.precomputed_kernel:
+            self._set_precomputed_model(train_vectors)
+            del svm_problem, train_vectors
         self._log.debug("Training SVM model -- Done")
 
         if self.svm_label_map_fp:
@@ -323,6 +645,8 @@ class LibSvmClassifier (SupervisedClassifier):
         if self.svm_model_fp:
             self._log.debug("saving file -- model -- %s", self.svm_model_fp)
             svmutil.svm_save_model(self.svm_model_fp, self.svm_model)
+            if self.precomputed_kernel:
+                numpy.save(self._sv_vectors_fp(), self.svm_sv_vectors)
 
     def get_labels(self):
         """
@@ -362,7 +686,16 @@ class LibSvmClassifier (SupervisedClassifier):
         # Get and normalize vector
         v = d.vector().astype(float)
         v = self._norm_vector(v)
-        v, idx = svm.gen_svm_nodearray(v.tolist())
+        if self.precomputed_kernel:
+            # Kernel values against the support vectors, which are numbered
+            # in model order.
+            k = PRECOMPUTED_KERNELS[self.precomputed_kernel](
+                v[numpy.newaxis], self.svm_sv_vectors
+            )
+            nodes = _kernel_node_array(k, [0])[0]
+            v = _node_pointer(nodes)
+        else:
+            v, idx = svm.gen_svm_nodearray(v.tolist())
 
         # Effectively reproducing the body of svmutil.svm_predict in order to
         # simplify and get around excessive prints
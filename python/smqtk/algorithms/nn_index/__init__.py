@@ -5,6 +5,8 @@ Interface for generic element-wise nearest-neighbor computation.
 import abc
 import os
 
+import numpy
+
 from smqtk.algorithms import SmqtkAlgorithm
 from smqtk.utils.plugin import get_plugins
 
@@ -71,6 +73,80 @@ class NearestNeighborsIndex (SmqtkAlgorithm):
         elif not self.count():
             raise ValueError("No index currently set to query from!")
 
+    def nn_batch(self, descriptors, n=1):
+        """
+        Return the nearest `N` neighbors for each of the given descriptor
+        elements.
+
+        By default this calls ``nn`` for each descriptor in turn.
+        Implementations that can answer many queries at once more efficiently
+        than one at a time should override this method.
+
+        :param descriptors: Descriptor elements to compute the neighbors of.
+        :type descriptors:
+            collections.Iterable[smqtk.representation.DescriptorElement]
+
+        :param n: Number of nearest neighbors to find for each descriptor.
+        :type n: int
+
+        :return: List of ``nn`` results, i.e. tuples of neighbor
+            DescriptorElement instances and distances, in the same order as the
+            given descriptors.
+        :rtype: list[(tuple[smqtk.representation.DescriptorElement],
+                      tuple[float])]
+
+        """
+        return [self.nn(d, n) for d in descriptors]
+
+
+def uuid_array(uuids):
+    """
+    Create an array of descriptor UUIDs, e.g. indexed by the row of each
+    descriptor in an index's model, for storage with ``numpy.save``.
+
+    UUIDs that are all integers or all strings are stored in a native numpy
+    array so that the saved array may be memory-mapped when loaded. Otherwise
+    an object array is used.
+
+    :param uuids: Sequence of descriptor UUIDs.
+    :type uuids: list[collections.Hashable]
+
+    :return: 1D array of UUIDs.
+    :rtype: numpy.ndarray
+    """
+    try:
+        arr = numpy.array(uuids)
+    except ValueError:
+        arr = None
+    if (arr is None or arr.ndim != 1 or
+            arr.dtype.kind not in 'iuSU' or arr.tolist() != uuids):
+        arr = numpy.empty(len(uuids), dtype=object)
+        arr[:] = uuids
+    return arr
+
+
+def load_uuid_array(filepath):
+    """
+    Load an array of descriptor UUIDs saved from ``uuid_array``,
+    memory-mapping it if it has a native dtype.
+
+    Object arrays are pickled and cannot be memory-mapped, so are read into
+    memory.
+
+    :param filepath: Path to the ``.npy`` file.
+    :type filepath: str
+
+    :return: 1D array of UUIDs.
+    :rtype: numpy.ndarray
+    """
+    with open(filepath, 'rb') as f:
+        version = numpy.lib.format.read_magic(f)
+        # noinspection PyProtectedMember
+        dtype = numpy.lib.format._read_array_header(f, version)[2]
+    if dtype.hasobject:
+        return numpy.load(filepath, allow_pickle=True)
+    return numpy.load(filepath, mmap_mode='r')
+
 
 def get_nn_index_impls(reload_modules=False):
     """
@@ -1,12 +1,15 @@
 import cPickle
 import logging
-import multiprocessing
 import os.path as osp
 
 import numpy
 
-from smqtk.algorithms.nn_index import NearestNeighborsIndex
+from smqtk.algorithms.nn_index import NearestNeighborsIndex, \
+    load_uuid_array, uuid_array
+from smqtk.representation import get_descriptor_index_impls
 from smqtk.representation.descriptor_element import elements_to_matrix
+from smqtk.representation.descriptor_index.memory import MemoryDescriptorIndex
+from smqtk.utils import merge_dict, plugin
 from smqtk.utils.file_utils import safe_create_dir
 
 
@@ -20,6 +23,76 @@ except ImportError:
 __author__ = "paul.tunison@kitware.com"
 
 
+# Approximate number of bytes of intermediate values computed at a time when
+# searching by histogram intersection.
+HIK_QUERY_CHUNK_BYTES = 2**26
+
+
+def hik_top_k(mat, queries, k, chunk_bytes=HIK_QUERY_CHUNK_BYTES):
+    """
+    Exact histogram intersection nearest neighbors of query vectors among the
+    rows of a matrix.
+
+    The matrix is scanned in chunks, keeping only the ``k`` best rows seen per
+    query, so memory use is bounded regardless of the number of rows and the
+    matrix may be memory-mapped.
+
+    :param mat: Matrix of histogram rows to search.
+    :type mat: numpy.ndarray
+
+    :param queries: Matrix of query histogram rows.
+    :type queries: numpy.ndarray
+
+    :param k: Number of neighbors to return per query. This is reduced to the
+        number of rows in ``mat`` if greater.
+    :type k: int
+
+    :param chunk_bytes: Approximate number of bytes of intermediate values to
+        compute at a time.
+    :type chunk_bytes: int
+
+    :return: Matrices of neighbor row indices and histogram intersection
+        distances, of shape ``(len(queries), k)``, in order of increasing
+        distance.
+    :rtype: (numpy.ndarray, numpy.ndarray)
+
+    """
+    n_rows = mat.shape[0]
+    n_q = queries.shape[0]
+    k = min(k, n_rows)
+    chunk_rows = max(1, int(chunk_bytes //
+                            (mat.shape[1] * mat.dtype.itemsize)))
+    best_idx = numpy.empty((n_q, 0), dtype=numpy.intp)
+    best_sim = numpy.empty((n_q, 0), dtype=float)
+    buf = None
+    for start in xrange(0, n_rows, chunk_rows):
+        # Each chunk is read once for all queries.
+        block = numpy.asarray(mat[start:start + chunk_rows])
+        if buf is None or buf.shape != block.shape:
+            buf = numpy.empty(block.shape, numpy.result_type(block, queries))
+        sim = numpy.empty((n_q, block.shape[0]), dtype=float)
+        for i in xrange(n_q):
+            numpy.minimum(block, queries[i], out=buf)
+            buf.sum(axis=1, out=sim[i])
+        idx = numpy.concatenate(
+            [best_idx,
+             numpy.tile(numpy.arange(start, start + block.shape[0]),
+                        (n_q, 1))],
+            axis=1
+        )
+        sim = numpy.concatenate([best_sim, sim], axis=1)
+        if sim.shape[1] > k:
+            top = numpy.argpartition(-sim, k - 1, axis=1)[:, :k]
+            rows = numpy.arange(n_q)[:, numpy.newaxis]
+            idx = idx[rows, top]
+            sim = sim[rows, top]
+        best_idx, best_sim = idx, sim
+    # Stable ordering by decreasing similarity, ties by row index.
+    order = numpy.lexsort((best_idx, -best_sim), axis=1)
+    rows = numpy.arange(n_q)[:, numpy.newaxis]
+    return best_idx[rows, order], 1. - best_sim[rows, order]
+
+
 class FlannNearestNeighborsIndex (NearestNeighborsIndex):
     """
     Nearest-neighbor computation using the FLANN library (pyflann module).
@@ -27,12 +100,27 @@ class FlannNearestNeighborsIndex (NearestNeighborsIndex):
     This implementation uses in-memory data structures, and thus has an index
     size limit based on how much memory the running machine has available.
 
+    Only the UUIDs of indexed descriptors are kept by the index, in the order
+    of the FLANN index's points, with descriptor elements looked up in the
+    configured descriptor set when returned from a query. The descriptor set
+    must persist its elements, e.g. a read-only ``PostgresDescriptorIndex``,
+    for the index to be reloaded from its model files. The matrix of indexed
+    descriptor vectors FLANN searches over is stored next to the UUIDs and
+    memory-mapped when loaded, so it is shared through the page cache by all
+    processes using the same model files.
+
     NOTE ON MULTIPROCESSING
-        Normally, FLANN indices don't play well when multiprocessing due to
-        the underlying index being a C structure, which doesn't auto-magically
-        transfer to forked processes like python structure data does. The
-        serialized FLANN index file is used to restore a built index in separate
-        processes, assuming one has been built.
+        A loaded FLANN index is shared with forked processes. The underlying
+        index is a C structure that is only read when querying, so its memory
+        remains shared copy-on-write between the parent and forked children
+        instead of being reloaded in each child.
+
+    HISTOGRAM INTERSECTION
+        FLANN's tree indices rank by distance, while histogram intersection is
+        a similarity, so FLANN cannot find histogram intersection neighbors
+        without retrieving the whole index. With the "hik" distance method we
+        do not build a FLANN index and instead search exactly with
+        ``hik_top_k`` over the matrix of indexed descriptor vectors.
 
     """
 
@@ -41,21 +129,69 @@ class FlannNearestNeighborsIndex (NearestNeighborsIndex):
         # if underlying library is not found, the import above will error
         return pyflann is not None
 
+    @classmethod
+    def get_default_config(cls):
+        """
+        Generate and return a default configuration dictionary for this class.
+        This will be primarily used for generating what the configuration
+        dictionary would look like for this class without instantiating it.
+
+        :return: Default configuration dictionary for the class.
+        :rtype: dict
+
+        """
+        default = super(FlannNearestNeighborsIndex, cls).get_default_config()
+        default['descriptor_set'] = \
+            plugin.make_config(get_descriptor_index_impls())
+        return default
+
+    @classmethod
+    def from_config(cls, config_dict, merge_default=True):
+        """
+        Instantiate a new instance of this class given the configuration
+        JSON-compliant dictionary encapsulating initialization arguments.
+
+        Configurations without a descriptor set type use an in-memory
+        descriptor set, as when no descriptor set is given to the constructor.
+
+        :param config_dict: JSON compliant dictionary encapsulating
+            a configuration.
+        :type config_dict: dict
+
+        :param merge_default: Merge the given configuration on top of the
+            default provided by ``get_default_config``.
+        :type merge_default: bool
+
+        :return: Constructed instance from the provided config.
+        :rtype: FlannNearestNeighborsIndex
+
+        """
+        if merge_default:
+            cfg = cls.get_default_config()
+            merge_dict(cfg, config_dict)
+        else:
+            cfg = dict(config_dict)
+
+        if cfg.get('descriptor_set') and cfg['descriptor_set'].get('type'):
+            cfg['descriptor_set'] = \
+                plugin.from_plugin_config(cfg['descriptor_set'],
+                                          get_descriptor_index_impls())
+        else:
+            cfg['descriptor_set'] = None
+
+        return super(FlannNearestNeighborsIndex, cls).from_config(cfg, False)
+
     def __init__(self, index_filepath=None, parameters_filepath=None,
                  descriptor_cache_filepath=None,
                  # Parameters for building an index
                  autotune=False, target_precision=0.95, sample_fraction=0.1,
-                 distance_method='hik', random_seed=None):
+                 distance_method='hik', random_seed=None,
+                 descriptor_set=None):
         """
         Initialize FLANN index properties. Does not contain a query-able index
         until one is built via the ``build_index`` method, or loaded from
         existing model files.
 
-        When using this algorithm in a multiprocessing environment, the model
-        file path parameters must be specified due to needing to reload the
-        FLANN index on separate processes. This is because FLANN is in C and its
-        instances are not copied into processes.
-
         Documentation on index building parameters and their meaning can be
         found in the FLANN documentation PDF:
 
@@ -79,7 +215,13 @@ class FlannNearestNeighborsIndex (NearestNeighborsIndex):
         :type parameters_filepath: None | str
 
         :param descriptor_cache_filepath: Optional file location to load/store
-            DescriptorElements in this index.
+            the UUIDs of the descriptors in this index, as a ``.npy`` array.
+            The matrix of indexed descriptor vectors is stored as
+            ``<descriptor_cache_filepath>.npy``. Both are memory-mapped when
+            loaded.
+
+            Files of pickled DescriptorElements, as previously stored here,
+            are still loaded.
 
             If not configured, no model files are written to or loaded from
             disk.
@@ -110,6 +252,16 @@ class FlannNearestNeighborsIndex (NearestNeighborsIndex):
         :param random_seed: Integer to use as the random number generator seed.
         :type random_seed: int
 
+        :param descriptor_set: Index in which DescriptorElements will be
+            stored, and looked up from when returned from queries. If None, an
+            in-memory descriptor set is used, which is only filled when
+            loading a legacy descriptor cache file of pickled elements. This
+            default keeps every indexed descriptor element in each process's
+            memory, so does not give the memory savings of the memory-mapped
+            model files, and does not persist elements for reloading an index
+            built with it.
+        :type descriptor_set: None | smqtk.representation.DescriptorIndex
+
         """
         super(FlannNearestNeighborsIndex, self).__init__()
 
@@ -120,6 +272,15 @@ class FlannNearestNeighborsIndex (NearestNeighborsIndex):
         self._descr_cache_filepath = normpath(descriptor_cache_filepath)
         # Now they're either None or an absolute path
 
+        if descriptor_set is None:
+            self._log.warn("No descriptor set configured. Using an in-memory "
+                           "descriptor set, which holds all indexed "
+                           "descriptors in memory and is not persisted with "
+                           "the model files.")
+            descriptor_set = MemoryDescriptorIndex()
+        #: :type: smqtk.representation.DescriptorIndex
+        self._descriptor_set = descriptor_set
+
         # parameters for building an index
         self._build_autotune = autotune
         self._build_target_precision = float(target_precision)
@@ -127,10 +288,15 @@ class FlannNearestNeighborsIndex (NearestNeighborsIndex):
 
         self._distance_method = str(distance_method)
 
-        # In-order cache of descriptors we're indexing over.
-        # - flann.nn_index will spit out indices to list
-        #: :type: list[smqtk.representation.DescriptorElement] | None
-        self._descr_cache = None
+        # In-order UUIDs of descriptors we're indexing over.
+        # - flann.nn_index will spit out indices to this array
+        #: :type: numpy.ndarray | None
+        self._uuids = None
+        # Matrix of descriptor vectors, parallel to the UUIDs, that the FLANN
+        # index refers to, or that is searched for histogram intersection.
+        # None before index load/build.
+        #: :type: numpy.ndarray | None
+        self._descr_matrix = None
 
         # The flann instance with a built index. None before index load/build.
         #: :type: pyflann.index.FLANN or None
@@ -145,11 +311,6 @@ class FlannNearestNeighborsIndex (NearestNeighborsIndex):
         if random_seed:
             self._rand_seed = int(random_seed)
 
-        # The process ID that the currently set FLANN instance was built/loaded
-        # on. If this differs from the current process ID, the index should be
-        # reloaded from cache.
-        self._pid = None
-
         # Load the index/parameters if one exists
         if self._has_model_files():
             self._log.info("Found existing model files. Loading.")
@@ -165,24 +326,30 @@ class FlannNearestNeighborsIndex (NearestNeighborsIndex):
             "sample_fraction": self._build_sample_frac,
             "distance_method": self._distance_method,
             "random_seed": self._rand_seed,
+            "descriptor_set": plugin.to_plugin_config(self._descriptor_set),
         }
 
     def _has_model_files(self):
         """
         check if configured model files are configured and exist
         """
-        return (self._index_filepath and osp.isfile(self._index_filepath) and
+        # No FLANN index is built for histogram intersection.
+        return ((self._distance_method == 'hik' or
+                 (self._index_filepath and
+                  osp.isfile(self._index_filepath))) and
                 self._index_param_filepath and osp.isfile(self._index_param_filepath) and
                 self._descr_cache_filepath and osp.isfile(self._descr_cache_filepath))
 
-    def _load_flann_model(self):
-        if not self._descr_cache and self._descr_cache_filepath:
-            # Load descriptor cache
-            # - is copied on fork, so only need to load here.
-            self._log.debug("Loading cached descriptors")
-            with open(self._descr_cache_filepath, 'rb') as f:
-                self._descr_cache = cPickle.load(f)
+    def _matrix_filepath(self):
+        """
+        :return: File path of the descriptor vector matrix, or None if no
+            descriptor cache file is configured.
+        :rtype: None | str
+        """
+        return (self._descr_cache_filepath and
+                self._descr_cache_filepath + '.npy')
 
+    def _load_flann_model(self):
         # Params pickle include the build params + our local state params
         if self._index_param_filepath:
             with open(self._index_param_filepath) as f:
@@ -193,38 +360,58 @@ class FlannNearestNeighborsIndex (NearestNeighborsIndex):
             self._distance_method = state['distance_method']
             self._flann_build_params = state['flann_build_params']
 
+        if self._descr_cache_filepath:
+            with open(self._descr_cache_filepath, 'rb') as f:
+                try:
+                    numpy.lib.format.read_magic(f)
+                    is_npy = True
+                except ValueError:
+                    is_npy = False
+            if is_npy:
+                self._log.debug("Loading cached descriptor UUIDs")
+                self._uuids = load_uuid_array(self._descr_cache_filepath)
+                self._descr_matrix = numpy.load(self._matrix_filepath(),
+                                                mmap_mode='r')
+            else:
+                self._load_legacy_descriptor_cache()
+
+        if len(self._uuids) and \
+                not self._descriptor_set.has_descriptor(self._uuids[0]):
+            self._log.warn("Descriptor set does not contain the indexed "
+                           "descriptors. Queries will fail until the index "
+                           "is rebuilt or a descriptor set containing them is "
+                           "configured.")
+
+        if self._distance_method == 'hik':
+            self._flann = None
         # Load the binary index
-        if self._index_filepath:
-            # make numpy matrix of descriptor vectors for FLANN
-            pts_array = [d.vector() for d in self._descr_cache]
-            pts_array = numpy.array(pts_array, dtype=pts_array[0].dtype)
+        elif self._index_filepath:
             pyflann.set_distance_type(self._distance_method)
             self._flann = pyflann.FLANN()
-            self._flann.load_index(self._index_filepath, pts_array)
-            del pts_array
+            self._flann.load_index(self._index_filepath, self._descr_matrix)
 
-        # Set current PID to the current
-        self._pid = multiprocessing.current_process().pid
-
-    def _restore_index(self):
+    def _load_legacy_descriptor_cache(self):
         """
-        If we think we're suppose to have an index, check the recorded PID with
-        the current PID, reloading the index from cache if they differ.
-
-        If there is a loaded index and we're on the same process that created it
-        this does nothing.
+        Load a descriptor cache file of pickled DescriptorElements, adding
+        elements not yet in the descriptor set to it.
         """
-        if bool(self._flann) \
-                and self._has_model_files() \
-                and self._pid != multiprocessing.current_process().pid:
-            self._load_flann_model()
+        self._log.debug("Loading cached descriptors from pickled elements")
+        with open(self._descr_cache_filepath, 'rb') as f:
+            descriptors = cPickle.load(f)
+        self._descriptor_set.add_many_descriptors(
+            d for d in descriptors
+            if not self._descriptor_set.has_descriptor(d.uuid())
+        )
+        self._uuids = uuid_array([d.uuid() for d in descriptors])
+        self._descr_matrix = elements_to_matrix(descriptors,
+                                                report_interval=1.0)
 
     def count(self):
         """
         :return: Number of elements in this index.
         :rtype: int
         """
-        return len(self._descr_cache) if self._descr_cache else 0
+        return len(self._uuids) if self._uuids is not None else 0
 
     def build_index(self, descriptors):
         """
@@ -232,13 +419,6 @@ class FlannNearestNeighborsIndex (NearestNeighborsIndex):
 
         Subsequent calls to this method should rebuild the index, not add to it.
 
-        Implementation Notes:
-            - We keep a cache file serialization around for our index in case
-                sub-processing occurs so as to be able to recover from the
-                underlying C data not being there. This could cause issues if
-                a main or child process rebuild's the index, as we clear the old
-                cache away.
-
         :raises ValueError: No data available in the given iterable.
 
         :param descriptors: Iterable of descriptors elements to build index
@@ -247,21 +427,42 @@ class FlannNearestNeighborsIndex (NearestNeighborsIndex):
             collections.Iterable[smqtk.representation.DescriptorElement]
 
         """
-        # Not caring about restoring the index because we're just making a new
-        # one
         self._log.info("Building new FLANN index")
 
         self._log.debug("Storing descriptors")
-        self._descr_cache = list(descriptors)
-        if not self._descr_cache:
+        descriptors = list(descriptors)
+        if not descriptors:
             raise ValueError("No data provided in given iterable.")
-        # Cache descriptors if we have a path
+        self._descriptor_set.clear()
+        self._descriptor_set.add_many_descriptors(descriptors)
+
+        self._log.debug("Accumulating descriptor vectors into matrix")
+        uuids = uuid_array([d.uuid() for d in descriptors])
+        mat = elements_to_matrix(descriptors, report_interval=1.0)
+        del descriptors
+        # Cache UUIDs and vectors if we have a path
         if self._descr_cache_filepath:
-            self._log.debug("Caching descriptors: %s",
+            self._log.debug("Caching descriptor UUIDs and vectors: %s",
                             self._descr_cache_filepath)
             safe_create_dir(osp.dirname(self._descr_cache_filepath))
+            # Passing a file object keeps numpy from appending ".npy" to the
+            # configured path.
             with open(self._descr_cache_filepath, 'wb') as f:
-                cPickle.dump(self._descr_cache, f, -1)
+                numpy.save(f, uuids)
+            numpy.save(self._matrix_filepath(), mat)
+            del uuids, mat
+            self._uuids = load_uuid_array(self._descr_cache_filepath)
+            self._descr_matrix = numpy.load(self._matrix_filepath(),
+                                            mmap_mode='r')
+        else:
+            self._uuids = uuids
+            self._descr_matrix = mat
+
+        if self._distance_method == 'hik':
+            self._flann = None
+            self._flann_build_params = {}
+            self._save_index_params()
+            return
 
         params = {
             "target_precision": self._build_target_precision,
@@ -276,13 +477,10 @@ class FlannNearestNeighborsIndex (NearestNeighborsIndex):
             params['random_seed'] = self._rand_seed
         pyflann.set_distance_type(self._distance_method)
 
-        self._log.debug("Accumulating descriptor vectors into matrix for FLANN")
-        pts_array = elements_to_matrix(self._descr_cache, report_interval=1.0)
-
         self._log.debug('Building FLANN index')
         self._flann = pyflann.FLANN()
-        self._flann_build_params = self._flann.build_index(pts_array, **params)
-        del pts_array
+        self._flann_build_params = self._flann.build_index(self._descr_matrix,
+                                                           **params)
 
         self._log.debug("Caching index and state: %s, %s",
                         self._index_filepath, self._index_param_filepath)
@@ -290,6 +488,9 @@ class FlannNearestNeighborsIndex (NearestNeighborsIndex):
             self._log.debug("Caching index: %s", self._index_filepath)
             safe_create_dir(osp.dirname(self._index_filepath))
             self._flann.save_index(self._index_filepath)
+        self._save_index_params()
+
+    def _save_index_params(self):
         if self._index_param_filepath:
             self._log.debug("Caching index params: %s",
                             self._index_param_filepath)
@@ -304,7 +505,17 @@ class FlannNearestNeighborsIndex (NearestNeighborsIndex):
             with open(self._index_param_filepath, 'w') as f:
                 cPickle.dump(state, f, -1)
 
-        self._pid = multiprocessing.current_process().pid
+    def _neighbors(self, idxs):
+        """
+        :param idxs: Indices of descriptors in the index.
+        :type idxs: numpy.ndarray
+
+        :return: Descriptor elements at the given indices, in order.
+        :rtype: list[smqtk.representation.DescriptorElement]
+        """
+        return list(self._descriptor_set.get_many_descriptors(
+            self._uuids[idxs].tolist()
+        ))
 
     def nn(self, d, n=1):
         """
@@ -321,25 +532,19 @@ class FlannNearestNeighborsIndex (NearestNeighborsIndex):
         :rtype: (tuple[smqtk.representation.DescriptorElement], tuple[float])
 
         """
-        self._restore_index()
         super(FlannNearestNeighborsIndex, self).nn(d, n)
         vec = d.vector()
 
-        # If the distance method is HIK, we need to treat it special since that
-        # method produces a similarity score, not a distance score.
-        #
-        # FLANN asserts that we query for <= index size, thus the use of min()
+        # Histogram intersection is a similarity, not a distance, so is
+        # searched exactly over the descriptor matrix instead of with FLANN.
         if self._distance_method == 'hik':
-            # This call is different than the else version in that k is the size
-            # of the full data set, so that we can reverse the distances
-            #: :type: numpy.ndarray, numpy.ndarray
-            idxs, dists = self._flann.nn_index(vec, len(self._descr_cache),
-                                               **self._flann_build_params)
-        else:
-            #: :type: numpy.ndarray, numpy.ndarray
-            idxs, dists = self._flann.nn_index(vec,
-                                               min(n, len(self._descr_cache)),
-                                               **self._flann_build_params)
+            idxs, dists = hik_top_k(self._descr_matrix, vec[numpy.newaxis], n)
+            return self._neighbors(idxs[0]), tuple(dists[0])
+
+        # FLANN asserts that we query for <= index size, thus the use of min()
+        #: :type: numpy.ndarray, numpy.ndarray
+        idxs, dists = self._flann.nn_index(vec, min(n, self.count()),
+                                           **self._flann_build_params)
 
         # When N>1, return value is a 2D array. Since this method limits query
         #   to a single descriptor, we reduce to 1D arrays.
@@ -347,15 +552,42 @@ class FlannNearestNeighborsIndex (NearestNeighborsIndex):
             idxs = idxs[0]
             dists = dists[0]
 
-        if self._distance_method == 'hik':
-            # Invert values to stay consistent with other distance value norms
-            dists = [1.0 - d for d in dists]
-            idxs = tuple(reversed(idxs))[:n]
-            dists = tuple(reversed(dists))[:n]
-        else:
-            dists = tuple(dists)
+        return self._neighbors(idxs), tuple(dists)
 
-        return [self._descr_cache[i] for i in idxs], dists
+    def nn_batch(self, descriptors, n=1):
+        """
+        Return the nearest `N` neighbors for each of the given descriptor
+        elements.
+
+        With the "hik" distance method, queries are searched together in one
+        pass over the descriptor matrix.
+
+        :param descriptors: Descriptor elements to compute the neighbors of.
+        :type descriptors:
+            collections.Iterable[smqtk.representation.DescriptorElement]
+
+        :param n: Number of nearest neighbors to find for each descriptor.
+        :type n: int
+
+        :return: List of ``nn`` results, i.e. tuples of neighbor
+            DescriptorElement instances and distances, in the same order as the
+            given descriptors.
+        :rtype: list[(tuple[smqtk.representation.DescriptorElement],
+                      tuple[float])]
+
+        """
+        descriptors = list(descriptors)
+        if self._distance_method != 'hik' or not descriptors:
+            return super(FlannNearestNeighborsIndex, self).nn_batch(
+                descriptors, n
+            )
+        for d in descriptors:
+            super(FlannNearestNeighborsIndex, self).nn(d, n)
+        idxs, dists = hik_top_k(self._descr_matrix,
+                                numpy.array([d.vector() for d in descriptors]),
+                                n)
+        return [(self._neighbors(r_idxs), tuple(r_dists))
+                for r_idxs, r_dists in zip(idxs, dists)]
 
 
 NN_INDEX_CLASS = FlannNearestNeighborsIndex
@@ -0,0 +1,281 @@
+import heapq
+import os
+
+import numpy
+
+from smqtk.algorithms.nn_index.hash_index import HashIndex
+from smqtk.utils.bit_utils import (
+    hamming_distance_words,
+    pack_bit_vectors,
+    unpack_bit_vectors,
+)
+from smqtk.utils.file_utils import safe_create_dir
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+class VPTreeHashIndex (HashIndex):
+    """
+    Hash index using a vantage-point tree over packed hash codes.
+
+    Hash codes are stored packed into 64-bit words, one row per code, and
+    Hamming distances are computed with a vectorized popcount over XOR-ed
+    words. A 256-bit code then takes 32 bytes instead of the 2KB of a float64
+    bit matrix.
+
+    Tree nodes cover contiguous row ranges of the packed code matrix, which is
+    reordered at build time so that each node's codes are adjacent. Internal
+    nodes split the codes after their first row, the vantage point, into those
+    nearer to it than the median distance and the rest. Leaves are searched
+    exhaustively.
+
+    The code matrix and node arrays are saved as raw arrays to the ``.npz``
+    file cache.
+    """
+
+    @classmethod
+    def is_usable(cls):
+        return True
+
+    def __init__(self, file_cache=None, leaf_size=4096, random_seed=None):
+        """
+        Initialize vantage-point tree index for hash codes.
+
+        :param file_cache: Optional path to a file to cache our index to. This
+            must have the `.npz` suffix.
+        :type file_cache: str
+
+        :param leaf_size: Maximum number of codes in a leaf, searched by
+            brute-force. Large leaves amortize the per-node cost of searching
+            the tree in python over vectorized distance computation.
+        :type leaf_size: int
+
+        :param random_seed: Optional random number generator seed for choosing
+            vantage points.
+        :type random_seed: None | int
+
+        """
+        super(VPTreeHashIndex, self).__init__()
+        self.file_cache = file_cache
+        self.leaf_size = int(leaf_size)
+        self.random_seed = random_seed
+
+        if self.file_cache and not self.file_cache.endswith('.npz'):
+            raise ValueError("File cache path given does not specify and npz "
+                             "file.")
+        if self.leaf_size < 1:
+            raise ValueError("Leaf size must be at least 1, given %d"
+                             % self.leaf_size)
+
+        # Number of bits in indexed hash codes.
+        self.bits = 0
+        # Packed hash codes, in tree order.
+        #: :type: numpy.ndarray[numpy.uint64]
+        self.codes = None
+        # Row range of each node in ``codes``.
+        #: :type: numpy.ndarray[numpy.int64]
+        self.node_start = self.node_end = None
+        # Child nodes of internal nodes, or -1 for leaves, for codes nearer to
+        # and further from the node's vantage point.
+        #: :type: numpy.ndarray[numpy.int64]
+        self.node_inner = self.node_outer = None
+        # Maximum distance from the vantage point of codes in the inner child
+        # and minimum distance of codes in the outer child.
+        #: :type: numpy.ndarray[numpy.int64]
+        self.node_inner_max = self.node_outer_min = None
+
+        self.load_model()
+
+    def save_model(self):
+        if self.file_cache and self.codes is not None:
+            self._log.debug("Saving model: %s", self.file_cache)
+            safe_create_dir(os.path.dirname(self.file_cache))
+            # Passing a file object keeps numpy from adding a suffix.
+            with open(self.file_cache, 'wb') as f:
+                numpy.savez(f,
+                            bits=self.bits,
+                            codes=self.codes,
+                            node_start=self.node_start,
+                            node_end=self.node_end,
+                            node_inner=self.node_inner,
+                            node_outer=self.node_outer,
+                            node_inner_max=self.node_inner_max,
+                            node_outer_min=self.node_outer_min)
+            self._log.debug("Saving model: Done")
+
+    def load_model(self):
+        if self.file_cache and os.path.isfile(self.file_cache):
+            self._log.debug("Loading model: %s", self.file_cache)
+            with numpy.load(self.file_cache) as cache:
+                self.bits = int(cache['bits'])
+                self.codes = cache['codes']
+                self.node_start = cache['node_start']
+                self.node_end = cache['node_end']
+                self.node_inner = cache['node_inner']
+                self.node_outer = cache['node_outer']
+                self.node_inner_max = cache['node_inner_max']
+                self.node_outer_min = cache['node_outer_min']
+            self._log.debug("Loading model: Done")
+
+    def get_config(self):
+        return {
+            'file_cache': self.file_cache,
+            'leaf_size': self.leaf_size,
+            'random_seed': self.random_seed,
+        }
+
+    def count(self):
+        return len(self.codes) if self.codes is not None else 0
+
+    def build_index(self, hashes):
+        """
+        Build the index with the give hash codes (bit-vectors).
+
+        Subsequent calls to this method should rebuild the index, not add to
+        it, or raise an exception to as to protect the current index.
+
+        :raises ValueError: No data available in the given iterable.
+
+        :param hashes: Iterable of descriptor elements to build index
+            over.
+        :type hashes: collections.Iterable[numpy.ndarray[bool]]
+
+        """
+        hash_list = list(hashes)
+        if not hash_list:
+            raise ValueError("No hashes given.")
+        bits = len(hash_list[0])
+        self._log.debug("Packing %d hash codes of %d bits",
+                        len(hash_list), bits)
+        codes = pack_bit_vectors(hash_list)
+        del hash_list
+
+        self._log.debug("Building vantage-point tree")
+        rng = numpy.random.RandomState(self.random_seed)
+        # Rows of ``codes`` in tree order, reordered in place as nodes are
+        # split.
+        order = numpy.arange(len(codes))
+        start, end, inner, outer, inner_max, outer_min = \
+            [], [], [], [], [], []
+
+        def add_node(s, e):
+            start.append(s)
+            end.append(e)
+            inner.append(-1)
+            outer.append(-1)
+            inner_max.append(0)
+            outer_min.append(0)
+            return len(start) - 1
+
+        # Stack of nodes to split.
+        stack = [add_node(0, len(codes))]
+        while stack:
+            i = stack.pop()
+            s, e = start[i], end[i]
+            if e - s <= self.leaf_size:
+                continue
+            # Swap a random vantage point to the front of the node.
+            vp = rng.randint(s, e)
+            order[s], order[vp] = order[vp], order[s]
+            rest = order[s+1:e]
+            dists = hamming_distance_words(codes[rest], codes[order[s]])
+            # Inner child takes the nearest half, ties with the median
+            # distance may fall either side.
+            k = (e - s - 1) // 2
+            part = numpy.argpartition(dists, k)
+            order[s+1:e] = rest[part]
+            dists = dists[part]
+            mid = s + 1 + k
+            inner_max[i] = int(dists[:k].max()) if k else 0
+            outer_min[i] = int(dists[k:].min())
+            inner[i] = add_node(s + 1, mid)
+            outer[i] = add_node(mid, e)
+            stack.extend([inner[i], outer[i]])
+
+        self.bits = bits
+        self.codes = codes[order]
+        self.node_start = numpy.array(start, numpy.int64)
+        self.node_end = numpy.array(end, numpy.int64)
+        self.node_inner = numpy.array(inner, numpy.int64)
+        self.node_outer = numpy.array(outer, numpy.int64)
+        self.node_inner_max = numpy.array(inner_max, numpy.int64)
+        self.node_outer_min = numpy.array(outer_min, numpy.int64)
+        self._log.debug("Built tree of %d nodes", len(start))
+        self.save_model()
+
+    def nn(self, h, n=1):
+        """
+        Return the nearest `N` neighbors to the given hash code.
+
+        Distances are in the range [0,1] and are the percent different each
+        neighbor hash is from the query, based on the number of bits contained
+        in the query.
+
+        :param h: Hash code to compute the neighbors of. Should be the same bit
+            length as indexed hash codes.
+        :type h: numpy.ndarray[bool]
+
+        :param n: Number of nearest neighbors to find.
+        :type n: int
+
+        :raises ValueError: No index to query from.
+
+        :return: Tuple of nearest N hash codes and a tuple of the distance
+            values to those neighbors.
+        :rtype: (tuple[numpy.ndarray[bool]], tuple[float])
+
+        """
+        super(VPTreeHashIndex, self).nn(h, n)
+        n = min(n, self.count())
+        q = pack_bit_vectors([h])[0]
+
+        # Max-heap of the nearest rows found so far, as (-distance, -row)
+        # pairs.
+        heap = []
+
+        def add_rows(s, e, dists):
+            rows = numpy.arange(s, e)
+            if len(heap) == n:
+                near = dists < -heap[0][0]
+                rows, dists = rows[near], dists[near]
+            for r, d in zip(rows.tolist(), dists.tolist()):
+                if len(heap) < n:
+                    heapq.heappush(heap, (-d, -r))
+                elif d < -heap[0][0]:
+                    heapq.heapreplace(heap, (-d, -r))
+
+        def tau():
+            return -heap[0][0] if len(heap) == n else numpy.inf
+
+        # Stack of nodes to search, with lower bounds of the distances to
+        # their codes. The bound may have tightened since a node was pushed,
+        # so it is checked again when popped.
+        stack = [(0, 0)]
+        while stack:
+            lb, i = stack.pop()
+            if lb >= tau():
+                continue
+            s, e = self.node_start[i], self.node_end[i]
+            if self.node_inner[i] < 0:
+                add_rows(s, e, hamming_distance_words(self.codes[s:e], q))
+                continue
+            d = int(hamming_distance_words(self.codes[s:s+1], q)[0])
+            add_rows(s, s + 1, numpy.array([d]))
+            # Lower bounds of distances to codes in each child by the triangle
+            # inequality.
+            children = [(max(lb, d - self.node_inner_max[i]),
+                         self.node_inner[i]),
+                        (max(lb, self.node_outer_min[i] - d),
+                         self.node_outer[i])]
+            # Push the further child first so the nearer one is searched
+            # first, tightening the bound before the other is checked.
+            for c_lb, c in sorted(children, reverse=True):
+                if c_lb < tau():
+                    stack.append((c_lb, c))
+
+        nearest = sorted((-d, -r) for d, r in heap)
+        rows = [r for _, r in nearest]
+        neighbors = unpack_bit_vectors(self.codes[rows], self.bits)
+        dists = numpy.array([d for d, _ in nearest], float) / self.bits
+        return neighbors, dists
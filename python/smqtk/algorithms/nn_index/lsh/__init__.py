@@ -23,6 +23,7 @@ from smqtk.utils.bit_utils import bit_vector_to_int_large
 from smqtk.utils import merge_dict
 from smqtk.utils.errors import ReadOnlyError
 from smqtk.utils.file_utils import FileModificationMonitor
+from smqtk.utils.parallel import parallel_map
 
 
 __author__ = "paul.tunison@kitware.com"
@@ -484,6 +485,29 @@ class LSHNearestNeighborIndex (NearestNeighborsIndex):
         self._log.debug('-- slicing top n=%d', n)
         return zip(*(ordered[:n]))
 
+    def nn_batch(self, descriptors, n=1):
+        """
+        Return the nearest `N` neighbors for each of the given descriptor
+        elements, querying concurrently with threads.
+
+        :param descriptors: Descriptor elements to compute the neighbors of.
+        :type descriptors:
+            collections.Iterable[smqtk.representation.DescriptorElement]
+
+        :param n: Number of nearest neighbors to find for each descriptor.
+        :type n: int
+
+        :return: List of ``nn`` results, i.e. tuples of neighbor
+            DescriptorElement instances and distances, in the same order as the
+            given descriptors.
+        :rtype: list[(tuple[smqtk.representation.DescriptorElement],
+                      tuple[float])]
+
+        """
+        return list(parallel_map(lambda d: self.nn(d, n), descriptors,
+                                 ordered=True, use_multiprocessing=False,
+                                 name="LSHNearestNeighborIndex.nn_batch"))
+
 
 # Marking only LSH as the valid impl, otherwise the hash index default would
 #   also be picked up (because it also descends from NearestNeighborsIndex).
@@ -1,7 +1,9 @@
+import itertools
 import logging
 import os.path
 
 import numpy
+import scipy.linalg
 
 from smqtk.algorithms.nn_index.lsh.functors import LshFunctor
 from smqtk.representation.descriptor_element import elements_to_matrix
@@ -37,7 +39,7 @@ class ItqFunctor (LshFunctor):
 
     def __init__(self, mean_vec_filepath=None, rotation_filepath=None,
                  bit_length=8, itq_iterations=50, normalize=None,
-                 random_seed=None):
+                 random_seed=None, convergence_tol=1e-6):
         """
         Initialize IQR functor.
 
@@ -79,6 +81,11 @@ class ItqFunctor (LshFunctor):
         :param random_seed: Integer to use as the random number generator seed.
         :type random_seed: int
 
+        :param convergence_tol: Stop ITQ iterations early when the relative
+            decrease in quantization loss between iterations falls below this
+            value. When 0, all ``itq_iterations`` are always performed.
+        :type convergence_tol: float
+
         """
         super(ItqFunctor, self).__init__()
 
@@ -88,6 +95,7 @@ class ItqFunctor (LshFunctor):
         self.itq_iterations = itq_iterations
         self.normalize = normalize
         self.random_seed = random_seed
+        self.convergence_tol = convergence_tol
 
         # Validate normalization parameter by trying it on a random vector
         if normalize is not None:
@@ -128,6 +136,7 @@ class ItqFunctor (LshFunctor):
             "bit_length": self.bit_length,
             "itq_iterations": self.itq_iterations,
             "random_seed": self.random_seed,
+            "convergence_tol": self.convergence_tol,
         }
 
     def has_model(self):
@@ -164,11 +173,13 @@ class ItqFunctor (LshFunctor):
         :param n_iter: max number of iterations, 50 is usually enough
         :type n_iter: int
 
-        :return: [b, r]
+        :return: [b, r, i]
            b: 2D numpy array, n*c binary matrix,
            r: 2D numpy array, the c*c rotation matrix found by ITQ
+           i: number of rotation updates performed before convergence, at
+              most ``n_iter``
         :rtype: numpy.core.multiarray.ndarray[bool],
-            numpy.core.multiarray.ndarray[float]
+            numpy.core.multiarray.ndarray[float], int
 
         """
         # initialize with an orthogonal random rotation
@@ -179,18 +190,42 @@ class ItqFunctor (LshFunctor):
         u11, s2, v2 = numpy.linalg.svd(r)
         r = u11[:, :bit]
 
+        # Buffers reused across iterations
+        v = numpy.ascontiguousarray(v, dtype=numpy.float64)
+        z = numpy.empty(v.shape, numpy.float64)
+        ux = numpy.empty(v.shape, numpy.float64)
+        b = numpy.empty(v.shape, numpy.bool)
+        prev_loss = None
+
         # ITQ to find optimal rotation
         self._log.debug("ITQ iterations to determine optimal rotation: %d",
                         n_iter)
+        iterations = n_iter
         for i in range(n_iter):
-            self._log.debug("ITQ iter %d", i + 1)
-            # TODO: @numba.jit decorate
-            z = numpy.dot(v, r)
-            ux = numpy.ones(z.shape) * (-1)
-            ux[z >= 0] = 1
+            numpy.dot(v, r, out=z)
+            # ux = sign(z), with 0 mapping to 1
+            numpy.greater_equal(z, 0, out=b)
+            numpy.copyto(ux, b)
+            ux *= 2
+            ux -= 1
+
+            if self.convergence_tol:
+                # Quantization loss ||ux - z||^2 for the current rotation.
+                z -= ux
+                loss = numpy.einsum('ij,ij->', z, z)
+                self._log.debug("ITQ iter %d (loss: %f)", i + 1, loss)
+                if prev_loss is not None and \
+                        prev_loss - loss <= self.convergence_tol * prev_loss:
+                    self._log.debug("ITQ converged after %d iterations", i)
+                    iterations = i
+                    break
+                prev_loss = loss
+            else:
+                self._log.debug("ITQ iter %d", i + 1)
+
             c = numpy.dot(ux.transpose(), v)
             ub, sigma, ua = numpy.linalg.svd(c)
-            r = numpy.dot(ua, ub.transpose())
+            r = numpy.dot(ua.transpose(), ub.transpose())
 
         # Make B binary matrix using final rotation matrix
         #   - original code returned B transformed by second to last rotation
@@ -198,25 +233,174 @@ class ItqFunctor (LshFunctor):
         #   - Recomputing Z here so as to generate up-to-date B for the final
         #       rotation matrix computed.
         # TODO: Could move this step up one level and just return rotation mat?
-        z = numpy.dot(v, r)
-        b = numpy.zeros(z.shape, dtype=numpy.bool)
-        b[z >= 0] = True
+        numpy.dot(v, r, out=z)
+        numpy.greater_equal(z, 0, out=b)
+
+        return b, r, iterations
+
+    def _top_principal_components(self, c):
+        """
+        Get the eigen-vectors of the given covariance matrix with the largest
+        ``bit_length`` eigenvalues.
 
-        return b, r
+        :param c: Covariance matrix.
+        :type c: numpy.ndarray
 
-    def fit(self, descriptors, use_multiprocessing=True):
+        :return: Matrix whose columns are the top eigen-vectors, ordered by
+            descending eigenvalue.
+        :rtype: numpy.ndarray
+
+        """
+        # Covariance matrices are symmetric, so only the top ``bit_length``
+        # eigen-pairs need to be solved for, which is much cheaper than a full
+        # general eigen-decomposition for large dimensionality.
+        d = c.shape[0]
+        k = min(self.bit_length, d)
+        self._log.debug('-- computing top %d eigen-pairs', k)
+        # eigen-vectors are the columns of ``pc``, ordered by ascending
+        # eigenvalue.
+        l, pc = scipy.linalg.eigh(c, eigvals=(d - k, d - 1),
+                                  overwrite_a=False, check_finite=False)
+        # Eigen-vectors of top ``bit_len`` magnitude eigenvalues, descending
+        return pc[:, ::-1]
+
+    def _iter_chunks(self, descriptors, chunk_size, use_multiprocessing,
+                     report_interval):
+        """
+        Iterate over normalized descriptor vector matrices of at most
+        ``chunk_size`` rows each.
+
+        :rtype: __generator[numpy.ndarray]
+        """
+        it = iter(descriptors)
+        while True:
+            chunk = list(itertools.islice(it, chunk_size))
+            if not chunk:
+                return
+            x = elements_to_matrix(chunk, report_interval=report_interval,
+                                   use_multiprocessing=use_multiprocessing)
+            yield self._norm_vector(x)
+
+    def _fit_streaming(self, descriptors, chunk_size, sample_size,
+                       use_multiprocessing, report_interval):
+        """
+        Fit the model while holding at most ``chunk_size`` descriptor vectors in
+        memory at a time. See ``fit``.
+        """
+        if sample_size is None and iter(descriptors) is descriptors:
+            raise ValueError("Streaming fit without a sample size requires a "
+                             "re-iterable collection of descriptors, not a "
+                             "one-shot iterator.")
+
+        # Reservoir sample of rows used to find the rotation
+        rng = numpy.random.RandomState(self.random_seed)
+        sample = None
+
+        # Accumulate the sum and sum of outer products of vectors, shifted by
+        # the mean of the first chunk for numerical stability.
+        self._log.info("Accumulating mean and covariance in chunks of %d",
+                       chunk_size)
+        n = 0
+        shift = s1 = s2 = None
+        for x in self._iter_chunks(descriptors, chunk_size,
+                                   use_multiprocessing, report_interval):
+            if shift is None:
+                shift = x.mean(axis=0)
+                s1 = numpy.zeros(x.shape[1], numpy.float64)
+                s2 = numpy.zeros((x.shape[1], x.shape[1]), numpy.float64)
+                if sample_size is not None:
+                    sample = numpy.empty((sample_size, x.shape[1]), x.dtype)
+            xs = x - shift
+            s1 += xs.sum(axis=0)
+            s2 += numpy.dot(xs.transpose(), xs)
+
+            if sample is not None:
+                # Algorithm R, vectorized over the chunk: row ``i`` replaces a
+                # random sample slot ``j`` in [0, i] if ``j < sample_size``.
+                idx = numpy.arange(n, n + x.shape[0])
+                fill = idx < sample_size
+                sample[idx[fill]] = x[fill]
+                j = (rng.random_sample((~fill).sum()) * (idx[~fill] + 1))\
+                    .astype(numpy.int64)
+                keep = j < sample_size
+                sample[j[keep]] = x[~fill][keep]
+
+            n += x.shape[0]
+            self._log.debug("-- accumulated %d descriptors", n)
+        if n < 2:
+            raise ValueError("Need at least 2 descriptors to fit the model.")
+
+        mean_shifted = s1 / n
+        self.mean_vec = shift + mean_shifted
+        # Equivalent to ``numpy.cov`` of all vectors.
+        c = (s2 - n * numpy.outer(mean_shifted, mean_shifted)) / (n - 1)
+
+        self._log.info("Computing PCA transformation")
+        pc_top = self._top_principal_components(c)
+
+        if sample is not None:
+            self._log.info("Performing ITQ on a sample of %d descriptors",
+                           min(n, sample_size))
+            xx = numpy.dot(sample[:n] - self.mean_vec, pc_top)
+            codes = None
+        else:
+            self._log.info("Projecting descriptors onto principal components")
+            xx = numpy.empty((n, pc_top.shape[1]), numpy.float64)
+            i = 0
+            for x in self._iter_chunks(descriptors, chunk_size,
+                                       use_multiprocessing, report_interval):
+                xx[i:i + x.shape[0]] = numpy.dot(x - self.mean_vec, pc_top)
+                i += x.shape[0]
+            self._log.info("Performing ITQ to find optimal rotation")
+
+        b, self.rotation, _ = self._find_itq_rotation(xx,
+                                                      self.itq_iterations)
+        if sample is None:
+            codes = b
+        # De-adjust rotation with PC vector
+        self.rotation = numpy.dot(pc_top, self.rotation)
+        return codes
+
+    def fit(self, descriptors, use_multiprocessing=True, chunk_size=None,
+            sample_size=None):
         """
         Fit the ITQ model given the input set of descriptors
 
+        By default all descriptor vectors are loaded into a single matrix. If
+        ``chunk_size`` is given, the model is instead fit in streaming mode:
+        the mean and covariance are accumulated over chunks of at most
+        ``chunk_size`` vectors, so that only one chunk of vectors is in memory
+        at a time. The ITQ rotation is then found over the descriptors
+        projected onto the principal components, which requires iterating over
+        the descriptors a second time, or, if ``sample_size`` is given, over a
+        uniform random sample of that many descriptors taken during the first
+        pass.
+
         :param descriptors: Iterable of ``DescriptorElement`` vectors to fit
-            the model to.
+            the model to. When fitting in streaming mode without a
+            ``sample_size``, this must be a re-iterable collection.
         :type descriptors:
             collections.Iterable[smqtk.representation.DescriptorElement]
 
+        :param use_multiprocessing: Use processes instead of threads to extract
+            descriptor vectors.
+        :type use_multiprocessing: bool
+
+        :param chunk_size: Optional number of descriptors to load into memory
+            at a time, enabling streaming mode.
+        :type chunk_size: None | int
+
+        :param sample_size: Optional number of descriptors to sample for
+            finding the ITQ rotation in streaming mode.
+        :type sample_size: None | int
+
         :raises RuntimeError: There is already a model loaded
+        :raises ValueError: Streaming mode without a ``sample_size`` was given a
+            one-shot iterator, or too few descriptors were given.
 
-        :return: Matrix hash codes for provided descriptors in order.
-        :rtype: numpy.ndarray[bool]
+        :return: Matrix hash codes for provided descriptors in order, or None
+            when fitting in streaming mode with a ``sample_size``.
+        :rtype: numpy.ndarray[bool] | None
 
         """
         if self.has_model():
@@ -225,6 +409,14 @@ class ItqFunctor (LshFunctor):
         dbg_report_interval = None
         if self.logger().getEffectiveLevel() <= logging.DEBUG:
             dbg_report_interval = 1.0  # seconds
+
+        if chunk_size is not None:
+            c = self._fit_streaming(descriptors, int(chunk_size),
+                                    sample_size and int(sample_size),
+                                    use_multiprocessing, dbg_report_interval)
+            self.save_model()
+            return c
+
         if not hasattr(descriptors, "__len__"):
             self._log.info("Creating sequence from iterable")
             descriptors_l = []
@@ -251,36 +443,14 @@ class ItqFunctor (LshFunctor):
         # transpose.
         self._log.debug("-- computing covariance")
         c = numpy.cov(x.transpose())
+        pc_top = self._top_principal_components(c)
 
-        # Direct translation from UNC matlab code
-        # - eigen vectors are the columns of ``pc``
-        self._log.debug('-- computing linalg.eig')
-        l, pc = numpy.linalg.eig(c)
-        # ordered by greatest eigenvalue magnitude, keeping top ``bit_len``
-        self._log.debug('-- computing top pairs')
-        top_pairs = sorted(zip(l, pc.transpose()),
-                           key=lambda p: p[0],
-                           reverse=1
-                           )[:self.bit_length]
-
-        # # Harry translation -- Uses singular values / vectors, not eigen
-        # # - singular vectors are the rows of pc
-        # # - I think there is an additional error of not taking the transpose
-        # #   of ``pc`` when computing ``top_pairs``.
-        # pc, l, _ = numpy.linalg.svd(c)
-        # top_pairs = sorted(zip(l, pc),
-        #                    key=lambda p: p[0],
-        #                    reverse=1
-        #                    )[:self.bit_length]
-
-        # Eigen-vectors of top ``bit_len`` magnitude eigenvalues
-        self._log.debug("-- top vector extraction")
-        pc_top = numpy.array([p[1] for p in top_pairs]).transpose()
         self._log.debug("-- transform centered data by PC matrix")
         xx = numpy.dot(x, pc_top)
 
         self._log.info("Performing ITQ to find optimal rotation")
-        c, self.rotation = self._find_itq_rotation(xx, self.itq_iterations)
+        c, self.rotation, _ = self._find_itq_rotation(xx,
+                                                      self.itq_iterations)
         # De-adjust rotation with PC vector
         self.rotation = numpy.dot(pc_top, self.rotation)
 
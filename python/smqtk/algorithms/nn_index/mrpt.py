@@ -5,20 +5,192 @@ from __future__ import print_function, unicode_literals
 # noinspection PyPep8Naming
 from six.moves import range, cPickle as pickle, zip
 
+import copy
+import multiprocessing
 from os import path as osp
 
 import numpy as np
+import time
+import zipfile
 
 from itertools import groupby
 
-from smqtk.utils import plugin, merge_dict
-from smqtk.algorithms.nn_index import NearestNeighborsIndex
+from smqtk.utils import metrics, plugin, merge_dict
+from smqtk.algorithms.nn_index import NearestNeighborsIndex, \
+    load_uuid_array, uuid_array
 from smqtk.representation import get_descriptor_index_impls
 from smqtk.representation.descriptor_element import elements_to_matrix
+from smqtk.representation.descriptor_index.memory import MemoryDescriptorIndex
 from smqtk.utils.errors import ReadOnlyError
 from smqtk.utils.file_utils import safe_create_dir
+from smqtk.utils.parallel import shared_array
 
 CHUNK_SIZE = 5000
+# Minimum average number of rows per node of a tree level for the nodes to be
+# partitioned one at a time rather than sorted together.
+PARTITION_NODE_ROWS = 32
+
+
+def _leaf_arrays(leaves):
+    """
+    Pack the per-leaf row index arrays of a tree into a single row ID array
+    and an array of leaf offsets into it, such that the rows of leaf ``i`` are
+    ``rows[offsets[i]:offsets[i+1]]``.
+
+    :param leaves: Row index arrays for each leaf, in leaf order.
+    :type leaves: list[numpy.ndarray]
+
+    :return: Row ID array and leaf offsets array.
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    """
+    offsets = np.zeros((len(leaves) + 1,), dtype=np.int64)
+    np.cumsum([leaf.size for leaf in leaves], out=offsets[1:])
+    return np.concatenate(leaves), offsets
+
+
+def _partition_level(proj, order, starts, sizes):
+    """
+    Partition the rows of each node of a tree level about the node's median
+    projection with a separate ``argpartition`` per node.
+
+    :param proj: Projections of the dataset for the level.
+    :type proj: np.ndarray (N,)
+
+    :param order: Row IDs, contiguous per node. Reordered in place so that
+        the lower half of each node's rows comes first.
+    :type order: np.ndarray (N,)
+
+    :param starts: Offset of each node's rows into ``order``.
+    :type starts: np.ndarray
+
+    :param sizes: Number of rows of each node.
+    :type sizes: np.ndarray
+
+    :return: Split value of each node.
+    :rtype: np.ndarray
+    """
+    split_vals = np.zeros(sizes.shape, np.float64)
+    for i, (b, m) in enumerate(zip(starts, sizes)):
+        if m < 1:
+            continue
+        node_rows = order[b:b + m]
+        level_proj = proj[node_rows]
+        # Split at the median if even, put median in upper half if not
+        n_split = m // 2
+        if m % 2 == 0:
+            part_indices = np.argpartition(level_proj, (n_split - 1, n_split))
+            split_vals[i] = level_proj[part_indices[n_split - 1]]
+            split_vals[i] = (split_vals[i] +
+                             level_proj[part_indices[n_split]]) / 2.0
+        else:
+            part_indices = np.argpartition(level_proj, n_split)
+            split_vals[i] = level_proj[part_indices[n_split]]
+        order[b:b + m] = node_rows[part_indices]
+    return split_vals
+
+
+def _sort_level(proj, order, starts, sizes):
+    """
+    Partition the rows of each node of a tree level about the node's median
+    projection by sorting the rows of all nodes with a single ``argsort``.
+
+    Sort keys hold the node in the upper 32 bits and the order preserving
+    bits of the single precision projection in the lower 32 bits.
+
+    Parameters and return are as for ``_partition_level``.
+    """
+    node_of = np.repeat(np.arange(sizes.size, dtype=np.uint64), sizes)
+    values = proj[order].astype(np.float32, copy=False)
+    bits = values.view(np.uint32)
+    # Flip all bits of negative values and the sign bit of the rest so the
+    # unsigned integers order as the floats do.
+    bits = np.where(bits >> 31, ~bits, bits | np.uint32(1 << 31))
+    perm = np.argsort((node_of << np.uint64(32)) | bits)
+    order[:] = order[perm]
+    values = values[perm]
+
+    # Split at the median if even, put median in upper half if not
+    upper = starts + sizes // 2
+    filled = sizes > 0
+    split_vals = np.zeros(sizes.shape, np.float64)
+    split_vals[filled] = values[upper[filled]]
+    even = filled & (sizes % 2 == 0)
+    split_vals[even] = (split_vals[even] + values[upper[even] - 1]) / 2.0
+    return split_vals
+
+
+def _build_tree(proj, rows):
+    """
+    Build a single RP tree for fast kNN search, one level at a time.
+
+    The rows of all nodes of a level are split together. While nodes are
+    large, each node is partitioned on its own, as the per node overhead is
+    small next to the cost of sorting. Once nodes are small and numerous, all
+    nodes of a level are sorted at once.
+
+    :param proj: Projections of the dataset for this tree, with one row per
+        level.
+    :type proj: np.ndarray (levels, N)
+
+    :param rows: Output array for the row IDs of the dataset in leaf order.
+    :type rows: np.ndarray (N,)
+
+    :return: (2^depth-1) array of splits (tree, where immediate descendants
+        follow parents; index i's children are 2i+1 and 2i+2) and leaf
+        offsets into ``rows``, such that the rows of leaf ``i`` are
+        ``rows[offsets[i]:offsets[i+1]]``.
+    :rtype: (np.ndarray, np.ndarray)
+    """
+    depth, n = proj.shape
+    splits = np.zeros(((1 << depth) - 1,), np.float64)
+    order = np.arange(n)
+    # Number of rows in each node of the current level, in node order
+    sizes = np.array([n], dtype=np.int64)
+    for level in range(depth):
+        starts = np.cumsum(sizes) - sizes
+        if sizes.size * PARTITION_NODE_ROWS <= n:
+            split_vals = _partition_level(proj[level], order, starts, sizes)
+        else:
+            split_vals = _sort_level(proj[level], order, starts, sizes)
+        splits[(1 << level) - 1:(1 << (level + 1)) - 1] = split_vals
+        # Children of each node are adjacent, the lower half first
+        n_lower = sizes // 2
+        sizes = np.column_stack((n_lower, sizes - n_lower)).ravel()
+
+    rows[:] = order
+    offsets = np.zeros((sizes.size + 1,), dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    return splits, offsets
+
+
+#: Tree construction state of a worker process.
+_tree_state = {}
+
+
+def _init_tree_worker(tree_state):
+    """
+    Initialize tree construction state for the current process.
+
+    :param tree_state: Dictionary of the shared projection and leaf row
+        arrays, as formed in
+        ``MRPTNearestNeighborsIndex._build_multiple_trees``.
+    :type tree_state: dict
+    """
+    _tree_state.clear()
+    _tree_state.update(tree_state)
+
+
+def _build_shared_tree(t):
+    """
+    Build tree ``t`` from the shared projections, writing its leaf rows into
+    the shared leaf row array.
+
+    :return: Tree index, splits and leaf offsets.
+    :rtype: (int, np.ndarray, np.ndarray)
+    """
+    splits, offsets = _build_tree(_tree_state['projs'][t],
+                                  _tree_state['leaf_rows'][t])
+    return t, splits, offsets
 
 
 class MRPTNearestNeighborsIndex (NearestNeighborsIndex):
@@ -36,7 +208,8 @@ class MRPTNearestNeighborsIndex (NearestNeighborsIndex):
 
     On query, the leaf corresponding to the query vector is found in each
     tree. The neighbors are drawn from the set of points that are in the most
-    leaves.
+    leaves: only points found in at least `vote_threshold` of the query's
+    leaves are compared against the query exactly.
 
     The performance will depend on settings for the parameters:
 
@@ -52,6 +225,12 @@ class MRPTNearestNeighborsIndex (NearestNeighborsIndex):
         higher values, but at the cost of using more memory on any particular
         query. As a rule of thumb, for a given value of `k`, num_trees should
         be about `3k/L`.
+    - Raising `vote_threshold` shrinks the set of points compared exactly,
+        lowering query time, at the cost of recall. Higher thresholds need
+        more trees to keep the same recall.
+
+    ``tune_parameters`` searches for the fastest settings of these parameters
+    reaching a target recall on a sample of queries.
     """
 
     @classmethod
@@ -91,7 +270,10 @@ class MRPTNearestNeighborsIndex (NearestNeighborsIndex):
                  # Parameters for building an index
                  num_trees=10, depth=1, random_seed=None,
                  pickle_protocol=pickle.HIGHEST_PROTOCOL,
-                 use_multiprocessing=False):
+                 use_multiprocessing=False, build_processes=None,
+                 distance_method='euclidean',
+                 # Parameters for querying the index
+                 vote_threshold=1):
         """
         Initialize MRPT index properties. Does not contain a queryable index
         until one is built via the ``build_index`` method, or loaded from
@@ -104,6 +286,14 @@ class MRPTNearestNeighborsIndex (NearestNeighborsIndex):
         :param index_filepath: Optional file location to load/store MRPT index
             when initialized and/or built.
 
+            The random bases, splits and leaf offsets of the trees are stored
+            in this file in the ``.npz`` format. The leaf row IDs and the
+            descriptor UUID table are stored in the ``.npy`` files
+            ``<index_filepath>.rows.npy`` and ``<index_filepath>.uuids.npy``,
+            which are memory-mapped when loaded. The descriptor vectors, in
+            row ID order, are stored in ``<index_filepath>.vectors.npy`` and
+            also memory-mapped.
+
             If not configured, no model files are written to or loaded from
             disk.
         :type index_filepath: None | str
@@ -138,11 +328,35 @@ class MRPTNearestNeighborsIndex (NearestNeighborsIndex):
             as the parallelization agent vs python threads.
         :type use_multiprocessing: bool
 
+        :param build_processes: Number of processes to construct trees in
+            concurrently when building an index. If None, we will use all
+            available cores. If 1, trees are constructed in the current
+            process.
+        :type build_processes: None | int
+
+        :param distance_method: String label of distance method to use for
+            ordering candidate neighbors of a query.
+
+            This must one of the following:
+                - "euclidean": Simple euclidean distance between two
+                    descriptors (L2 norm).
+                - "cosine": Cosine angle distance/similarity between two
+                    descriptors. Trees are built over, and queries descend
+                    them as, unit length vectors.
+                - "hik": Histogram intersection distance between two
+                    descriptors.
+        :type distance_method: str
+
+        :param vote_threshold: Minimum number of the query's leaves, across
+            all trees, a descriptor must be in to be a candidate neighbor.
+        :type vote_threshold: int
+
         """
         super(MRPTNearestNeighborsIndex, self).__init__()
 
         self._read_only = read_only
         self._use_multiprocessing = use_multiprocessing
+        self._build_processes = build_processes
         self._descriptor_set = descriptor_set
         self._pickle_protocol = pickle_protocol
 
@@ -160,9 +374,38 @@ class MRPTNearestNeighborsIndex (NearestNeighborsIndex):
         if num_trees < 1:
             raise ValueError("The number of trees must be positive.")
         self._num_trees = num_trees
-
-        # Set the list of trees to an empty list to have a sane value
-        self._trees = []
+        if not 1 <= vote_threshold <= num_trees:
+            raise ValueError("The vote threshold must be between 1 and the "
+                             "number of trees.")
+        self._vote_threshold = vote_threshold
+        self._distance_method = distance_method
+        self._distance_function = self._get_dist_func(distance_method)
+
+        # Stacked tree structure arrays, empty until an index is built or
+        # loaded:
+        # - random bases of all trees, shape (num_trees, dim, depth)
+        #: :type: None | numpy.ndarray
+        self._random_bases = None
+        # - packed splits of all trees, shape (num_trees, 2^depth - 1)
+        #: :type: None | numpy.ndarray
+        self._splits = None
+        # - leaf offsets into the rows of each tree,
+        #   shape (num_trees, 2^depth + 1)
+        #: :type: None | numpy.ndarray
+        self._leaf_offsets = None
+        # - row IDs of each tree in leaf order, shape (num_trees, N)
+        #: :type: None | numpy.ndarray
+        self._leaf_rows = None
+        # - descriptor UUIDs indexed by row ID, shape (N,)
+        #: :type: None | numpy.ndarray
+        self._uuids = None
+        # - descriptor vectors indexed by row ID, shape (N, dim)
+        #: :type: None | numpy.ndarray
+        self._vectors = None
+        # - random bases of all trees side by side, for projecting a query
+        #   onto all trees at once, shape (dim, num_trees * depth)
+        #: :type: None | numpy.ndarray
+        self._basis_matrix = None
 
         #: :type: None | int
         self._rand_seed = None
@@ -183,10 +426,41 @@ class MRPTNearestNeighborsIndex (NearestNeighborsIndex):
             "random_seed": self._rand_seed,
             "pickle_protocol": self._pickle_protocol,
             "use_multiprocessing": self._use_multiprocessing,
+            "build_processes": self._build_processes,
             "depth": self._depth,
             "num_trees": self._num_trees,
+            "distance_method": self._distance_method,
+            "vote_threshold": self._vote_threshold,
         }
 
+    @staticmethod
+    def _get_dist_func(distance_method):
+        """
+        Return appropriate distance function, between each row of a matrix
+        and a vector, given a string label
+        """
+        if distance_method == "euclidean":
+            return metrics.euclidean_distance
+        elif distance_method == "cosine":
+            return metrics.cosine_distance_rows
+        elif distance_method == "hik":
+            return metrics.histogram_intersection_distance
+        else:
+            raise ValueError("Invalid distance method label. Must be one of "
+                             "['euclidean' | 'cosine' | 'hik']")
+
+    def _tree_vectors(self, vectors):
+        """
+        :return: Given vectors as placed in the trees: scaled to unit length
+            for the cosine distance, otherwise as is.
+        :rtype: numpy.ndarray
+        """
+        if self._distance_method != "cosine":
+            return vectors
+        norms = np.sqrt(np.einsum('ij,ij->i', vectors, vectors))
+        norms[norms == 0] = 1
+        return vectors / norms[:, np.newaxis]
+
     @classmethod
     def from_config(cls, config_dict, merge_default=True):
         """
@@ -220,14 +494,28 @@ class MRPTNearestNeighborsIndex (NearestNeighborsIndex):
 
         return super(MRPTNearestNeighborsIndex, cls).from_config(cfg, False)
 
+    def _rows_filepath(self):
+        return self._index_filepath + '.rows.npy'
+
+    def _uuids_filepath(self):
+        return self._index_filepath + '.uuids.npy'
+
+    def _vectors_filepath(self):
+        return self._index_filepath + '.vectors.npy'
+
     def _has_model_files(self):
         """
         check if configured model files are configured and exist
         """
-        return (self._index_filepath and
+        if not (self._index_filepath and
                 osp.isfile(self._index_filepath) and
                 self._index_param_filepath and
-                osp.isfile(self._index_param_filepath))
+                osp.isfile(self._index_param_filepath)):
+            return False
+        # Index files from before the array format are a single pickle file.
+        return (not zipfile.is_zipfile(self._index_filepath) or
+                (osp.isfile(self._rows_filepath()) and
+                 osp.isfile(self._uuids_filepath())))
 
     def build_index(self, descriptors):
         """
@@ -300,117 +588,95 @@ class MRPTNearestNeighborsIndex (NearestNeighborsIndex):
         # (_num_trees * _depth shouldn't really be that high -- if it is,
         # you're a monster)
         random_bases = np.random.randn(self._num_trees, d, self._depth)
-        projs = np.empty((n, self._num_trees, self._depth), dtype=np.float64)
-        # Load the data in chunks (because n * d IS high)
-        pts_array = np.empty((chunk_size, d), sample_v.dtype)
+        self._random_bases = random_bases
+        self._stack_bases()
+        processes = min(self._build_processes or multiprocessing.cpu_count(),
+                        self._num_trees)
+        # Projections are stored per tree and level in single precision, and
+        # shared with tree building processes.
+        projs = shared_array((self._num_trees, self._depth, n), np.float32,
+                              processes > 1)
+        # Descriptor vectors by row ID, gathered from on query. This is
+        # written straight to its model file when one is configured
+        # (because n * d IS high).
+        self._vectors = None
+        if self._index_filepath:
+            safe_create_dir(osp.dirname(self._index_filepath))
+            vectors = np.lib.format.open_memmap(
+                self._vectors_filepath(), mode='w+', dtype=sample_v.dtype,
+                shape=(n, d))
+        else:
+            vectors = np.empty((n, d), sample_v.dtype)
+        # UUIDs in the same order as the vectors, so row IDs index into it.
+        uuids = []
+        # Load the data in chunks
         # Enumerate the descriptors and div the index by the chunk size
         for k, g in groupby(enumerate(self._descriptor_set.iterdescriptors()),
                             lambda pair: pair[0] // chunk_size):
             # Items are still paired so extract the descriptors
             chunk = list(desc for i, desc in g)
+            uuids.extend(desc.uuid() for desc in chunk)
             # Take care of dangling end piece
             k_beg = k * chunk_size
             k_end = min((k+1) * chunk_size, n)
-            k_len = k_end - k_beg
             # Run the descriptors through elements_to_matrix
             elements_to_matrix(
-                chunk, mat=pts_array, report_interval=1.0,
+                chunk, mat=vectors[k_beg:k_end], report_interval=1.0,
                 use_multiprocessing=self._use_multiprocessing)
             # Insert into projection matrix
-            projs[k_beg:k_end] = pts_array[:k_len].dot(random_bases)
-        del pts_array
+            projs[:, :, k_beg:k_end] = \
+                self._tree_vectors(vectors[k_beg:k_end])\
+                .dot(self._basis_matrix).T\
+                .reshape(self._num_trees, self._depth, k_end - k_beg)
+        if isinstance(vectors, np.memmap):
+            vectors.flush()
+            del vectors
+            vectors = np.load(self._vectors_filepath(), mmap_mode='r')
 
         self._log.debug("Constructing trees")
-        desc_ids = list(self._descriptor_set.iterkeys())
-        # Start with no trees
-        self._trees = []
-        for t in range(self._num_trees):
-            # Array of splits is a packed tree
-            splits = np.empty(((1 << self._depth) - 1,), np.float64)
-
-            self._log.debug("Constructing tree #%d", t+1)
-
-            # Build the tree & store it
-            leaves = self._build_single_tree(projs[:, t], splits)
-            leaves = [[desc_ids[idx] for idx in leaf]
-                      for leaf in leaves]
-            self._trees.append({
-                'random_basis': (random_bases[t]),
-                'splits': splits,
-                'leaves': leaves
-            })
-
-    def _build_single_tree(self, proj, splits):
-        """
-        Build a single RP tree for fast kNN search
-
-        :param proj: Projections of the dataset for this tree
-        :type proj: np.ndarray (N, levels)
-
-        :param splits: (2^depth-1) array of splits corresponding to leaves
-                       (tree, where immediate descendants follow parents;
-                       index i's children are 2i+1 and 2i+2
-        :type splits: np.ndarray
-
-        :return: Tree of splits and list of index arrays for each leaf
-        :rtype: list[np.ndarray]
-        """
-        def _build_recursive(indices, level=0, split_index=0):
-            """
-            Descend recursively into tree to build it, setting splits and
-            returning indices for leaves
-
-            :param indices: The current set of indices before partitioning
-            :param level: The level in the tree
-            :param split_index: The index of the split to set
-
-            :return: A list of arrays representing leaf membership
-            :rtype: list[np.ndarray]
-            """
-            # If we're at the bottom, no split, just return the set
-            if level == self._depth:
-                return [indices]
-
-            n = indices.size
-            # If we literally don't have enough to populate the leaf, make it
-            # empty
-            if n < 1:
-                return []
-
-            # Get the random projections for these indices at this level
-            # NB: Recall that the projection matrix has shape (levels, N)
-            level_proj = proj[indices, level]
-
-            # Split at the median if even, put median in upper half if not
-            n_split = n // 2
-            if n % 2 == 0:
-                part_indices = np.argpartition(
-                    level_proj, (n_split - 1, n_split))
-                split_val = level_proj[part_indices[n_split - 1]]
-                split_val += level_proj[part_indices[n_split]]
-                split_val /= 2.0
-            else:
-                part_indices = np.argpartition(level_proj, n_split)
-                split_val = level_proj[part_indices[n_split]]
-
-            splits[split_index] = split_val
-
-            # part_indices is relative to this block of values, recover
-            # main indices
-            left_indices = indices[part_indices[:n_split]]
-            right_indices = indices[part_indices[n_split:]]
-
-            # Descend into each split and get sub-splits
-            left_out = _build_recursive(left_indices, level=level + 1,
-                                        split_index=2 * split_index + 1)
-            right_out = _build_recursive(right_indices, level=level + 1,
-                                         split_index=2 * split_index + 2)
-
-            # Assemble index set
-            left_out.extend(right_out)
-            return left_out
-
-        return _build_recursive(np.arange(proj.shape[0]))
+        uuids = uuid_array(uuids)
+        row_dtype = np.int32 if n < (1 << 31) else np.int64
+        # Arrays of splits are packed trees
+        splits = np.empty((self._num_trees, (1 << self._depth) - 1),
+                          np.float64)
+        leaf_offsets = np.empty((self._num_trees, (1 << self._depth) + 1),
+                                np.int64)
+        leaf_rows = shared_array((self._num_trees, n), row_dtype,
+                                  processes > 1)
+        tree_state = {
+            'projs': projs,
+            'leaf_rows': leaf_rows,
+        }
+        if processes > 1:
+            self._log.debug("Constructing trees in %d processes", processes)
+            # Shared arrays are inherited by the forked workers.
+            pool = multiprocessing.Pool(processes,
+                                        initializer=_init_tree_worker,
+                                        initargs=(tree_state,))
+            try:
+                for t, t_splits, t_offsets in \
+                        pool.imap_unordered(_build_shared_tree,
+                                            range(self._num_trees)):
+                    self._log.debug("Constructed tree #%d", t+1)
+                    splits[t], leaf_offsets[t] = t_splits, t_offsets
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            _init_tree_worker(tree_state)
+            try:
+                for t in range(self._num_trees):
+                    self._log.debug("Constructing tree #%d", t+1)
+                    _, splits[t], leaf_offsets[t] = _build_shared_tree(t)
+            finally:
+                _tree_state.clear()
+        del projs, tree_state
+
+        self._splits = splits
+        self._leaf_offsets = leaf_offsets
+        self._leaf_rows = leaf_rows
+        self._uuids = uuids
+        self._vectors = vectors
 
     def _save_mrpt_model(self):
         self._log.debug("Caching index and parameters: %s, %s",
@@ -420,7 +686,13 @@ class MRPTNearestNeighborsIndex (NearestNeighborsIndex):
             safe_create_dir(osp.dirname(self._index_filepath))
             # noinspection PyTypeChecker
             with open(self._index_filepath, "wb") as f:
-                pickle.dump(self._trees, f, self._pickle_protocol)
+                # Passing a file object keeps numpy from appending ".npz" to
+                # the configured path.
+                np.savez(f, random_bases=self._random_bases,
+                         splits=self._splits,
+                         leaf_offsets=self._leaf_offsets)
+            np.save(self._rows_filepath(), self._leaf_rows)
+            np.save(self._uuids_filepath(), self._uuids)
         if self._index_param_filepath:
             self._log.debug("Caching index params: %s",
                             self._index_param_filepath)
@@ -429,6 +701,7 @@ class MRPTNearestNeighborsIndex (NearestNeighborsIndex):
                 "read_only": self._read_only,
                 "num_trees": self._num_trees,
                 "depth": self._depth,
+                "distance_method": self._distance_method,
             }
             # noinspection PyTypeChecker
             with open(self._index_param_filepath, "w") as f:
@@ -445,13 +718,83 @@ class MRPTNearestNeighborsIndex (NearestNeighborsIndex):
             self._read_only = params['read_only']
             self._num_trees = params['num_trees']
             self._depth = params['depth']
+            # Parameter files from before distance methods were configurable
+            # are of indexes using the euclidean distance.
+            self._distance_method = params.get('distance_method', 'euclidean')
+            self._distance_function = \
+                self._get_dist_func(self._distance_method)
 
         # Load the index
         if self._index_filepath:
             self._log.debug("Loading index: %s", self._index_filepath)
-            # noinspection PyTypeChecker
-            with open(self._index_filepath, "rb") as f:
-                self._trees = pickle.load(f)
+            if zipfile.is_zipfile(self._index_filepath):
+                self._load_mrpt_index()
+            else:
+                self._load_legacy_mrpt_index()
+            self._stack_bases()
+
+    def _load_mrpt_index(self):
+        with np.load(self._index_filepath) as arrays:
+            self._random_bases = arrays['random_bases']
+            self._splits = arrays['splits']
+            self._leaf_offsets = arrays['leaf_offsets']
+        self._leaf_rows = np.load(self._rows_filepath(), mmap_mode='r')
+        self._uuids = load_uuid_array(self._uuids_filepath())
+        if osp.isfile(self._vectors_filepath()):
+            self._vectors = np.load(self._vectors_filepath(), mmap_mode='r')
+        else:
+            self._gather_vectors()
+
+    def _gather_vectors(self):
+        """
+        Gather the descriptor vector matrix from the descriptor set, for
+        indexes stored without one.
+        """
+        self._log.debug("No vector matrix stored with the index. Gathering "
+                        "vectors from the descriptor set.")
+        self._vectors = elements_to_matrix(
+            list(self._descriptor_set.get_many_descriptors(
+                self._uuids.tolist())),
+            use_multiprocessing=self._use_multiprocessing)
+
+    def _stack_bases(self):
+        """
+        Arrange the random bases of all trees side by side so that a single
+        product projects a query onto every tree.
+        """
+        t, d, depth = self._random_bases.shape
+        self._basis_matrix = np.ascontiguousarray(
+            self._random_bases.transpose(1, 0, 2).reshape(d, t * depth))
+
+    def _load_legacy_mrpt_index(self):
+        """
+        Load an index file in the previous format, a pickled list of per-tree
+        dictionaries of random basis, splits and lists of leaf UUIDs, into
+        the stacked array structure.
+        """
+        self._log.debug("Converting index from pickled tree format")
+        # noinspection PyTypeChecker
+        with open(self._index_filepath, "rb") as f:
+            trees = pickle.load(f)
+        n_leaves = 1 << self._depth
+        uuids = [u for leaf in trees[0]['leaves'] for u in leaf]
+        row_of = dict((u, i) for i, u in enumerate(uuids))
+        leaf_offsets = np.empty((len(trees), n_leaves + 1), np.int64)
+        leaf_rows = np.empty((len(trees), len(uuids)), np.int32)
+        for t, tree in enumerate(trees):
+            leaves = [np.array([row_of[u] for u in leaf], dtype=np.int64)
+                      for leaf in tree['leaves']]
+            # Empty leaves were previously dropped from the leaf list. Pad the
+            # end so leaf lookups resolve as they did before.
+            leaves.extend([np.empty((0,), np.int64)] *
+                          (n_leaves - len(leaves)))
+            leaf_rows[t], leaf_offsets[t] = _leaf_arrays(leaves)
+        self._random_bases = np.array([t['random_basis'] for t in trees])
+        self._splits = np.array([t['splits'] for t in trees])
+        self._leaf_offsets = leaf_offsets
+        self._leaf_rows = leaf_rows
+        self._uuids = uuid_array(uuids)
+        self._gather_vectors()
 
     def count(self):
         """
@@ -488,76 +831,267 @@ class MRPTNearestNeighborsIndex (NearestNeighborsIndex):
                 "requested by the query (%d). The query result will be "
                 "deficient.", leaf_size, ntrees, n)
 
-        def _query_single(tree):
-            # Search a single tree for the leaf that matches the query
-            # NB: random_basis has shape (levels, N)
-            random_basis = tree['random_basis']
-            proj_query = d.vector().dot(random_basis)
-            splits = tree['splits']
-            idx = 0
-            for level in range(depth):
-                split_point = splits[idx]
-                # Look at the level'th coordinate of proj_query
-                if proj_query[level] < split_point:
-                    idx = 2 * idx + 1
-                else:
-                    idx = 2 * idx + 2
-
-            # idx will be `2^depth - 1` greater than the position of the leaf
-            # in the list
-            idx -= ((1 << depth) - 1)
-            return tree['leaves'][idx]
-
-        def _exact_query(_uuids):
-            set_size = len(_uuids)
-            self._log.debug("Exact query requested with %d descriptors",
-                            set_size)
-
-            # Assemble the array to query from the descriptors that match
-            d_v = d.vector()
-            pts_array = np.empty((set_size, d_v.size), dtype=d_v.dtype)
-            descriptors = self._descriptor_set.get_many_descriptors(_uuids)
-            for i, desc in enumerate(descriptors):
-                pts_array[i, :] = desc.vector()
-
-            dists = ((pts_array - d_v) ** 2).sum(axis=1)
-
-            if n > dists.shape[0]:
-                self._log.warning(
-                    "There were fewer descriptors (%d) in the set than "
-                    "requested in the query (%d). Returning entire set.",
-                    dists.shape[0], n)
-            if n >= dists.shape[0]:
-                return _uuids, dists
-
-            near_indices = np.argpartition(dists, n - 1)[:n]
-            return ([_uuids[idx] for idx in near_indices],
-                    dists[near_indices])
-
-        # Take union of all tree hits
-        tree_hits = set()
-        for t in self._trees:
-            tree_hits.update(_query_single(t))
-
-        hit_union = len(tree_hits)
+        q = d.vector()
+        leaves = self._query_leaves(q[np.newaxis])[0]
+        rows = self._candidate_rows(leaves)
+
+        n_cand = rows.size
         self._log.debug(
-            "Query (k): %g, Hit union (h): %g, DB (N): %g, "
+            "Query (k): %g, Candidates (h): %g, DB (N): %g, "
             "Leaf size (L = N/2^l): %g, Examined (T*L): %g",
-            n, hit_union, db_size, leaf_size, leaf_size * ntrees)
+            n, n_cand, db_size, leaf_size, leaf_size * ntrees)
         self._log.debug("k/L     = %.3f", n / leaf_size)
-        self._log.debug("h/N     = %.3f", hit_union / db_size)
-        self._log.debug("h/L     = %.3f", hit_union / leaf_size)
-        self._log.debug("h/(T*L) = %.3f", hit_union / (leaf_size * ntrees))
+        self._log.debug("h/N     = %.3f", n_cand / db_size)
+        self._log.debug("h/L     = %.3f", n_cand / leaf_size)
+        self._log.debug("h/(T*L) = %.3f", n_cand / (leaf_size * ntrees))
 
-        uuids, distances = _exact_query(list(tree_hits))
-        order = distances.argsort()
-        uuids, distances = zip(
-            *((uuids[oidx], distances[oidx]) for oidx in order))
+        uuids, distances = self._exact_nn(q, rows, n)
 
         self._log.debug("Returning query result of size %g", len(uuids))
 
         return (tuple(self._descriptor_set.get_many_descriptors(uuids)),
                 tuple(distances))
 
+    def nn_batch(self, descriptors, n=1):
+        """
+        Return the nearest `N` neighbors for each of the given descriptor
+        elements.
+
+        Queries are projected onto, and descend, all trees together.
+
+        :param descriptors: Descriptor elements to compute the neighbors of.
+        :type descriptors:
+            collections.Iterable[smqtk.representation.DescriptorElement]
+
+        :param n: Number of nearest neighbors to find for each descriptor.
+        :type n: int
+
+        :return: List of ``nn`` results, i.e. tuples of neighbor
+            DescriptorElement instances and distances, in the same order as
+            the given descriptors.
+        :rtype: list[(tuple[smqtk.representation.DescriptorElement],
+                      tuple[float])]
+
+        """
+        descriptors = list(descriptors)
+        for d in descriptors:
+            super(MRPTNearestNeighborsIndex, self).nn(d, n)
+        if not descriptors:
+            return []
+        queries = np.array([d.vector() for d in descriptors])
+        results = []
+        for q, leaves in zip(queries, self._query_leaves(queries)):
+            uuids, distances = self._exact_nn(q, self._candidate_rows(leaves),
+                                              n)
+            results.append(
+                (tuple(self._descriptor_set.get_many_descriptors(uuids)),
+                 tuple(distances))
+            )
+        return results
+
+    def _subset_trees(self, num_trees):
+        """
+        Create a view of this index using only its first ``num_trees`` trees.
+
+        Trees are independent of one another, so this is equivalent to an
+        index built with fewer trees from the same random bases.
+
+        :param num_trees: Number of trees to use.
+        :type num_trees: int
+
+        :rtype: MRPTNearestNeighborsIndex
+        """
+        view = copy.copy(self)
+        view._num_trees = num_trees
+        view._vote_threshold = min(self._vote_threshold, num_trees)
+        view._random_bases = self._random_bases[:num_trees]
+        view._splits = self._splits[:num_trees]
+        view._leaf_offsets = self._leaf_offsets[:num_trees]
+        view._leaf_rows = self._leaf_rows[:num_trees]
+        view._stack_bases()
+        return view
+
+    def _query_leaves(self, queries):
+        """
+        Find the leaf each query falls in for every tree, projecting onto all
+        trees with one product and descending all trees together.
+
+        :param queries: Query vectors, shape (Q, dim).
+        :type queries: numpy.ndarray
+
+        :return: Leaf positions, shape (Q, num_trees).
+        :rtype: numpy.ndarray
+        """
+        ntrees, depth = self._splits.shape[0], self._depth
+        projs = self._tree_vectors(queries).dot(self._basis_matrix)\
+            .reshape(-1, ntrees, depth)
+        trees = np.arange(ntrees)
+        idx = np.zeros(projs.shape[:2], dtype=np.int64)
+        for level in range(depth):
+            # Children of node i are 2i+1 (less than the split) and 2i+2
+            idx = 2 * idx + 1 + (projs[:, :, level] >=
+                                 self._splits[trees, idx])
+        # idx will be `2^depth - 1` greater than the position of the leaf
+        return idx - ((1 << depth) - 1)
+
+    def _candidate_rows(self, leaves):
+        """
+        Gather the row IDs of the descriptors in at least ``vote_threshold``
+        of the given leaves.
+
+        :param leaves: Leaf position of a query in each tree.
+        :type leaves: numpy.ndarray
+
+        :return: Ascending candidate row IDs.
+        :rtype: numpy.ndarray
+        """
+        ntrees, n = self._leaf_rows.shape
+        trees = np.arange(ntrees)
+        starts = self._leaf_offsets[trees, leaves]
+        lengths = self._leaf_offsets[trees, leaves + 1] - starts
+        # Positions of the leaves' rows in the flattened row ID array
+        ends = np.cumsum(lengths)
+        pos = (np.arange(ends[-1]) +
+               np.repeat(starts + trees * n - (ends - lengths), lengths))
+        rows = self._leaf_rows.reshape(-1)[pos]
+        if self._vote_threshold <= 1:
+            return np.unique(rows)
+        rows, votes = np.unique(rows, return_counts=True)
+        return rows[votes >= self._vote_threshold]
+
+    def _exact_nn(self, q, rows, n):
+        """
+        Find the nearest `n` of the candidate rows to the query by exact
+        distance.
+
+        :param q: Query vector.
+        :type q: numpy.ndarray
+
+        :param rows: Candidate row IDs.
+        :type rows: numpy.ndarray
+
+        :param n: Number of nearest neighbors to find.
+        :type n: int
+
+        :return: UUIDs of the nearest candidates and the distances to them,
+            in order of increasing distance.
+        :rtype: (list[collections.Hashable], numpy.ndarray)
+        """
+        self._log.debug("Exact query requested with %d descriptors",
+                        rows.size)
+        if n > rows.size:
+            self._log.warning(
+                "There were fewer descriptors (%d) in the set than "
+                "requested in the query (%d). Returning entire set.",
+                rows.size, n)
+        dists = self._distance_function(self._vectors[rows], q)
+        if n < rows.size:
+            # Narrow down by distance before sorting
+            near = np.argpartition(dists, n - 1)[:n]
+            rows, dists = rows[near], dists[near]
+        order = dists.argsort()
+        return self._uuids[rows[order]].tolist(), dists[order]
+
+
+def tune_parameters(descriptors, queries, k, target_recall,
+                    num_trees=(8, 16, 32, 64), depths=(4, 6, 8, 10),
+                    vote_thresholds=(1, 2, 4), distance_method='euclidean',
+                    build_processes=None):
+    """
+    Search for the fastest MRPT index parameters reaching a target recall on
+    a sample of queries.
+
+    For each depth, a single index of the greatest number of trees is built.
+    Fewer trees are evaluated using the first trees of that index, as trees
+    are independent of one another. Recall is the mean fraction of the true
+    ``k`` nearest neighbors of each query, found by exhaustive search, that
+    is returned by the index.
+
+    :param descriptors: Descriptors to build indexes over.
+    :type descriptors:
+        collections.Sequence[smqtk.representation.DescriptorElement]
+
+    :param queries: Sample of query descriptors.
+    :type queries:
+        collections.Sequence[smqtk.representation.DescriptorElement]
+
+    :param k: Number of nearest neighbors to query for.
+    :type k: int
+
+    :param target_recall: Minimum mean recall of a configuration, in the
+        [0, 1] range.
+    :type target_recall: float
+
+    :param num_trees: Numbers of trees to evaluate.
+    :type num_trees: collections.Iterable[int]
+
+    :param depths: Tree depths to evaluate.
+    :type depths: collections.Iterable[int]
+
+    :param vote_thresholds: Vote thresholds to evaluate. Thresholds greater
+        than a number of trees are skipped for that number of trees.
+    :type vote_thresholds: collections.Iterable[int]
+
+    :param distance_method: Distance method of the indexes.
+    :type distance_method: str
+
+    :param build_processes: Number of processes to construct trees in.
+    :type build_processes: None | int
+
+    :return: Parameters of the fastest configuration reaching the target
+        recall, or None if no configuration did, and the results of all
+        evaluated configurations. Each result is a dictionary of the
+        ``num_trees``, ``depth`` and ``vote_threshold`` parameters, the mean
+        ``recall`` and the mean ``query_time`` in seconds.
+    :rtype: (None | dict, list[dict])
+    """
+    num_trees = sorted(set(num_trees))
+    queries = list(queries)
+    results = []
+    truth = None
+    for depth in sorted(set(depths)):
+        index = MRPTNearestNeighborsIndex(
+            MemoryDescriptorIndex(), num_trees=num_trees[-1], depth=depth,
+            distance_method=distance_method, build_processes=build_processes)
+        index.build_index(descriptors)
+
+        if truth is None:
+            # Exact neighbors by distance to all indexed vectors
+            truth = []
+            for q in queries:
+                dists = index._distance_function(index._vectors, q.vector())
+                near = np.argpartition(dists, min(k, dists.size) - 1)[:k]
+                truth.append(set(index._uuids[near].tolist()))
+
+        for t in num_trees:
+            view = index._subset_trees(t)
+            for v in sorted(set(vote_thresholds)):
+                if v > t:
+                    continue
+                view._vote_threshold = v
+                recall = 0.
+                elapsed = 0.
+                for q, q_truth in zip(queries, truth):
+                    s = time.time()
+                    r, _ = view.nn(q, k)
+                    elapsed += time.time() - s
+                    recall += (len(q_truth.intersection(d.uuid() for d in r)) /
+                               len(q_truth))
+                results.append({
+                    "num_trees": t,
+                    "depth": depth,
+                    "vote_threshold": v,
+                    "recall": recall / len(queries),
+                    "query_time": elapsed / len(queries),
+                })
+
+    best = None
+    passing = [r for r in results if r['recall'] >= target_recall]
+    if passing:
+        fastest = min(passing, key=lambda r: r['query_time'])
+        best = dict((p, fastest[p])
+                    for p in ('num_trees', 'depth', 'vote_threshold'))
+    return best, results
+
 
 NN_INDEX_CLASS = MRPTNearestNeighborsIndex
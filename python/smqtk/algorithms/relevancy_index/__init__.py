@@ -43,6 +43,26 @@ class RelevancyIndex (SmqtkAlgorithm):
 
         """
 
+    def update_index(self, descriptors):
+        """
+        Add the given descriptor elements to the current index, without
+        rebuilding it over descriptors already indexed.
+
+        Implementations that can extend their index incrementally should
+        override this method. By default, incremental updates are not
+        supported and ``build_index`` must be used instead.
+
+        :raises NotImplementedError: This implementation does not support
+            incremental updates.
+
+        :param descriptors: Iterable of descriptor elements to add to the
+            index.
+        :type descriptors: collections.Iterable[smqtk.representation.DescriptorElement]
+
+        """
+        raise NotImplementedError("%s does not support incremental index "
+                                  "updates." % self.__class__.__name__)
+
     @abc.abstractmethod
     def rank(self, pos, neg):
         """
@@ -8,8 +8,10 @@ from smqtk.algorithms.relevancy_index import RelevancyIndex
 from smqtk.utils.distance_kernel import (
     compute_distance_matrix
 )
+from smqtk.utils.lru_cache import LruCache
 from smqtk.utils.metrics import histogram_intersection_distance
 from smqtk.utils.parallel import parallel_map
+from smqtk.utils.vector_cache import VectorLruCache
 
 try:
     import svm
@@ -26,6 +28,14 @@ class LibSvmHikRelevancyIndex (RelevancyIndex):
     """
     Uses libSVM python interface, using histogram intersection, to implement
     IQR ranking.
+
+    Trained SVM models are cached by the exact sets of positive and negative
+    descriptor UUIDs given to ``rank``, so ranking again with the same
+    adjudications, e.g. after only the index was updated, does not retrain.
+    Rows of distances between support vectors and the indexed descriptors are
+    cached per descriptor UUID. Since successive IQR adjudications usually
+    share most of their support vectors, only rows for new support vectors,
+    and columns for descriptors added to the index since, are computed.
     """
 
     # Dictionary of parameter/value pairs that will be passed to libSVM during
@@ -53,7 +63,8 @@ class LibSvmHikRelevancyIndex (RelevancyIndex):
         return svm and svmutil
 
     def __init__(self, descr_cache_filepath=None, autoneg_select_ratio=1,
-                 multiprocess_fetch=False, cores=None):
+                 multiprocess_fetch=False, cores=None, model_cache_size=8,
+                 distance_cache_bytes=2**27):
         """
         Initialize a new or existing index.
 
@@ -82,6 +93,16 @@ class LibSvmHikRelevancyIndex (RelevancyIndex):
             of None means to use all available cores.
         :type cores: int | None
 
+        :param model_cache_size: Number of trained SVM models to cache, keyed
+            by the positive and negative descriptors trained on. A value of 0
+            disables model caching.
+        :type model_cache_size: int
+
+        :param distance_cache_bytes: Maximum number of bytes of support vector
+            to index distance rows to cache. A value of 0 disables distance
+            caching.
+        :type distance_cache_bytes: int
+
         """
         super(LibSvmHikRelevancyIndex, self).__init__()
 
@@ -89,6 +110,17 @@ class LibSvmHikRelevancyIndex (RelevancyIndex):
         self.autoneg_select_ratio = int(autoneg_select_ratio)
         self.multiprocess_fetch = multiprocess_fetch
         self.cores = cores
+        self.model_cache_size = int(model_cache_size)
+        self.distance_cache_bytes = int(distance_cache_bytes)
+
+        # Trained (problem, model) pairs keyed by the frozensets of positive
+        # and negative descriptor UUIDs trained on. The problem is retained as
+        # libSVM models reference its vectors.
+        self._model_cache = LruCache(self.model_cache_size)
+        # Distances of descriptors, by UUID, to our indexed descriptors. Rows
+        # may be shorter than the current index when descriptors were added
+        # after their computation.
+        self._distance_cache = VectorLruCache(self.distance_cache_bytes)
 
         # Descriptor elements in this index
         self._descr_cache = []
@@ -129,6 +161,8 @@ class LibSvmHikRelevancyIndex (RelevancyIndex):
             'autoneg_select_ratio': self.autoneg_select_ratio,
             'multiprocess_fetch': self.multiprocess_fetch,
             'cores': self.cores,
+            'model_cache_size': self.model_cache_size,
+            'distance_cache_bytes': self.distance_cache_bytes,
         }
 
     def count(self):
@@ -152,8 +186,36 @@ class LibSvmHikRelevancyIndex (RelevancyIndex):
         # and subsequently in the distance kernel.
         self._descr2index = {}
         # matrix for creating distance kernel
-        self._descr_matrix = []
+        self._descr_matrix = None
+        # Cached distances are relative to the previous index.
+        self._distance_cache.clear()
+
+        self._add_descriptors(descriptors)
+
+        # TODO: (?) For when we optimize SVM SV kernel computation
+        # self._dist_kernel = \
+        #    compute_distance_kernel(self._descr_matrix,
+        #                            histogram_intersection_distance2,
+        #                            row_wise=True)
+
+    def update_index(self, descriptors):
+        """
+        Add the given descriptor elements to the current index. Descriptors
+        already in the index are ignored.
+
+        :param descriptors: Iterable of descriptor elements to add to the
+            index.
+        :type descriptors: collections.Iterable[smqtk.representation.DescriptorElement]
+
+        """
+        known = set(self._descr_cache)
+        self._add_descriptors(d for d in descriptors if d not in known)
 
+    def _add_descriptors(self, descriptors):
+        """
+        Append descriptors, and their vectors, to our cache and matrix, and
+        update the descriptor cache file if one is configured.
+        """
         def get_vector(d):
             return d, d.vector()
 
@@ -163,17 +225,17 @@ class LibSvmHikRelevancyIndex (RelevancyIndex):
                                    cores=self.cores,
                                    ordered=True)
 
-        for i, (d, v) in enumerate(vector_iter):
+        offset = len(self._descr_cache)
+        new_vectors = []
+        for i, (d, v) in enumerate(vector_iter, offset):
             self._descr_cache.append(d)
-            self._descr_matrix.append(v)
+            new_vectors.append(v)
             self._descr2index[tuple(v)] = i
-        self._descr_matrix = numpy.array(self._descr_matrix)
-
-        # TODO: (?) For when we optimize SVM SV kernel computation
-        # self._dist_kernel = \
-        #    compute_distance_kernel(self._descr_matrix,
-        #                            histogram_intersection_distance2,
-        #                            row_wise=True)
+        if self._descr_matrix is None or not len(self._descr_matrix):
+            self._descr_matrix = numpy.array(new_vectors)
+        elif new_vectors:
+            self._descr_matrix = numpy.vstack([self._descr_matrix,
+                                               numpy.array(new_vectors)])
 
         if self.descr_cache_fp:
             with open(self.descr_cache_fp, 'wb') as f:
@@ -207,13 +269,16 @@ class LibSvmHikRelevancyIndex (RelevancyIndex):
         # Copy pos descriptors into a set for repeated iteration
         #: :type: set[smqtk.representation.DescriptorElement]
         pos = set(pos)
-        # Creating training matrix and labels
+        neg = set(neg)
+        # Creating training matrix and labels, and the parallel descriptors
         train_labels = []
         train_vectors = []
+        train_descrs = []
         num_pos = 0
         for d in pos:
             train_labels.append(+1)
             train_vectors.append(d.vector().tolist())
+            train_descrs.append(d)
             num_pos += 1
         self._log.debug("Positives given: %d", num_pos)
 
@@ -251,10 +316,12 @@ class LibSvmHikRelevancyIndex (RelevancyIndex):
         for d in neg:
             train_labels.append(-1)
             train_vectors.append(d.vector().tolist())
+            train_descrs.append(d)
             num_neg += 1
         for d in neg_autoselect:
             train_labels.append(-1)
             train_vectors.append(d.vector().tolist())
+            train_descrs.append(d)
             num_neg += 1
 
         if not num_pos:
@@ -262,14 +329,31 @@ class LibSvmHikRelevancyIndex (RelevancyIndex):
         elif not num_neg:
             raise ValueError("No negative examples provided.")
 
-        # Training SVM model
-        self._log.debug("online model training")
-        svm_problem = svm.svm_problem(train_labels, train_vectors)
-        svm_model = svmutil.svm_train(svm_problem,
-                                      self._gen_svm_parameter_string(num_pos,
-                                                                     num_neg))
-        if svm_model.l == 0:
-            raise RuntimeError("SVM Model learning failed")
+        # Auto-selected negatives depend on the index content, so only models
+        # trained on given negatives are cached.
+        model_key = None
+        if neg:
+            model_key = (frozenset(d.uuid() for d in pos),
+                         frozenset(d.uuid() for d in neg))
+        cached = model_key and self._model_cache.get(model_key)
+        if cached:
+            self._log.debug("using cached model")
+            # Training order may differ from the cached model's, so use the
+            # order it was trained with.
+            svm_problem, svm_model, train_descrs = cached
+            train_vectors = [d.vector().tolist() for d in train_descrs]
+        else:
+            # Training SVM model
+            self._log.debug("online model training")
+            svm_problem = svm.svm_problem(train_labels, train_vectors)
+            svm_model = svmutil.svm_train(
+                svm_problem, self._gen_svm_parameter_string(num_pos, num_neg)
+            )
+            if svm_model.l == 0:
+                raise RuntimeError("SVM Model learning failed")
+            if model_key:
+                self._model_cache.store(model_key,
+                                        (svm_problem, svm_model, train_descrs))
 
         #
         # Platt Scaling for probability rankings
@@ -286,18 +370,18 @@ class LibSvmHikRelevancyIndex (RelevancyIndex):
         for i, nlist in enumerate(svm_model.SV[:svm_SVs.shape[0]]):
             svm_SVs[i, :] = [n.value for n in nlist[:len(train_vectors[0])]]
         # compute matrix of distances from support vectors to index elements
-        # TODO: Optimize this step by caching SV distance vectors
-        #       - It is known that SVs are vectors from the training data, so
-        #           if the same descriptors are given to this function
-        #           repeatedly (which is the case for IQR), this can be faster
-        #           because we're only computing at most a few more distance
-        #           vectors against our indexed descriptor matrix, and the rest
-        #           have already been computed before.
-        #       - At worst, we're effectively doing this call because each SV
-        #           needs to have its distance vector computed.
-        svm_test_k = compute_distance_matrix(svm_SVs, self._descr_matrix,
-                                             histogram_intersection_distance,
-                                             row_wise=True)
+        # - SVs are vectors from the training data, so when their training
+        #   descriptors are known, distance rows are computed via the cache.
+        if hasattr(svm_model, 'get_sv_indices'):
+            # 1-based indices into the training data
+            sv_descrs = [train_descrs[i - 1]
+                         for i in svm_model.get_sv_indices()[:num_SVs]]
+            svm_test_k = self._index_distances(sv_descrs, svm_SVs)
+        else:
+            svm_test_k = compute_distance_matrix(
+                svm_SVs, self._descr_matrix, histogram_intersection_distance,
+                row_wise=True
+            )
 
         self._log.debug("Platt scaling")
         # the actual platt scaling stuff
@@ -333,5 +417,43 @@ class LibSvmHikRelevancyIndex (RelevancyIndex):
         rank_pool = dict(zip(self._descr_cache, probs))
         return rank_pool
 
+    def _index_distances(self, descriptors, vectors):
+        """
+        Get the matrix of distances between the given descriptors and our
+        indexed descriptors, using and updating cached distance rows.
+
+        :param descriptors: Descriptors to get distance rows for.
+        :type descriptors:
+            collections.Sequence[smqtk.representation.DescriptorElement]
+
+        :param vectors: Vectors of the given descriptors, as a matrix.
+        :type vectors: numpy.ndarray
+
+        :return: Distance matrix of shape ``(len(descriptors), count())``.
+        :rtype: numpy.ndarray
+
+        """
+        n = self._descr_matrix.shape[0]
+        k = numpy.empty((len(descriptors), n), dtype=float)
+        num_computed = 0
+        for i, d in enumerate(descriptors):
+            row = self._distance_cache.get(d.uuid())
+            if row is None:
+                row = numpy.empty(0, dtype=float)
+            if row.size < n:
+                # Compute distances to indexed descriptors not yet covered.
+                row = numpy.concatenate([
+                    row,
+                    histogram_intersection_distance(
+                        vectors[i], self._descr_matrix[row.size:]
+                    )
+                ])
+                self._distance_cache.store(d.uuid(), row)
+                num_computed += 1
+            k[i] = row[:n]
+        self._log.debug("Computed %d of %d distance rows", num_computed,
+                        len(descriptors))
+        return k
+
 
 RELEVANCY_INDEX_CLASS = LibSvmHikRelevancyIndex
@@ -0,0 +1,88 @@
+"""
+Benchmark ``ItqFunctor`` model fitting time on random descriptors for a range
+of bit lengths.
+
+Times are reported for the principal component computation and the ITQ
+rotation iterations separately, as well as the number of rotation iterations
+performed before convergence.
+"""
+
+import logging
+import time
+
+import numpy
+
+from smqtk.algorithms.nn_index.lsh.functors.itq import ItqFunctor
+from smqtk.utils.bin_utils import (
+    basic_cli_parser,
+    initialize_logging,
+)
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+def cli_parser():
+    parser = basic_cli_parser(__doc__, configuration_group=False)
+    parser.add_argument('-n', '--num-descriptors', type=int, default=100000,
+                        help='Number of random descriptors to fit on.')
+    parser.add_argument('-d', '--dimensionality', type=int, default=4096,
+                        help='Dimensionality of random descriptors.')
+    parser.add_argument('-b', '--bit-lengths', type=int, nargs='+',
+                        default=[64, 128, 256, 512],
+                        help='Bit lengths to benchmark.')
+    parser.add_argument('-i', '--itq-iterations', type=int, default=50,
+                        help='Maximum number of ITQ rotation iterations.')
+    parser.add_argument('-t', '--convergence-tol', type=float, default=1e-6,
+                        help='ITQ convergence tolerance. 0 disables early '
+                             'stopping.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed.')
+    return parser
+
+
+def benchmark(x, bit_length, itq_iterations, convergence_tol, seed):
+    """
+    Time PCA and ITQ rotation steps of fitting a model to the given data.
+
+    :return: Seconds spent on PCA and on rotation iterations, and the number
+        of rotation iterations performed.
+    :rtype: (float, float, int)
+    """
+    functor = ItqFunctor(bit_length=bit_length, itq_iterations=itq_iterations,
+                         random_seed=seed, convergence_tol=convergence_tol)
+
+    s = time.time()
+    mean_vec = x.mean(axis=0)
+    xc = x - mean_vec
+    pc_top = functor._top_principal_components(numpy.cov(xc.transpose()))
+    xx = numpy.dot(xc, pc_top)
+    t_pca = time.time() - s
+
+    s = time.time()
+    _, _, iterations = functor._find_itq_rotation(xx, itq_iterations)
+    t_itq = time.time() - s
+
+    return t_pca, t_itq, iterations
+
+
+def main():
+    args = cli_parser().parse_args()
+    initialize_logging(logging.getLogger('__main__'),
+                       logging.INFO - (10 * args.verbose))
+    log = logging.getLogger(__name__)
+
+    log.info("Generating %d random descriptors of dimensionality %d",
+             args.num_descriptors, args.dimensionality)
+    rng = numpy.random.RandomState(args.seed)
+    x = rng.rand(args.num_descriptors, args.dimensionality)
+
+    print "%8s %10s %10s %6s" % ('bits', 'pca (s)', 'itq (s)', 'iters')
+    for bit_length in args.bit_lengths:
+        t_pca, t_itq, n_iter = benchmark(x, bit_length, args.itq_iterations,
+                                         args.convergence_tol, args.seed)
+        print "%8d %10.3f %10.3f %6d" % (bit_length, t_pca, t_itq, n_iter)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Benchmark ``MRPTNearestNeighborsIndex`` query recall and latency on random
+descriptors for combinations of the number of trees, tree depth and vote
+threshold.
+
+Recall is the mean fraction of the true ``k`` nearest neighbors of each query,
+found by exhaustive search, that are returned by the index. Latency is the
+mean time of a single ``nn`` query.
+"""
+
+import logging
+import time
+
+import numpy
+
+from smqtk.algorithms.nn_index.mrpt import MRPTNearestNeighborsIndex
+from smqtk.representation.descriptor_element.local_elements import \
+    DescriptorMemoryElement
+from smqtk.representation.descriptor_index.memory import MemoryDescriptorIndex
+from smqtk.utils.bin_utils import (
+    basic_cli_parser,
+    initialize_logging,
+)
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+def cli_parser():
+    parser = basic_cli_parser(__doc__, configuration_group=False)
+    parser.add_argument('-n', '--num-descriptors', type=int, default=100000,
+                        help='Number of random descriptors to index.')
+    parser.add_argument('-d', '--dimensionality', type=int, default=128,
+                        help='Dimensionality of random descriptors.')
+    parser.add_argument('-q', '--num-queries', type=int, default=100,
+                        help='Number of random queries.')
+    parser.add_argument('-k', type=int, default=10,
+                        help='Number of neighbors to query for.')
+    parser.add_argument('-t', '--num-trees', type=int, nargs='+',
+                        default=[10, 50, 100],
+                        help='Numbers of trees to benchmark.')
+    parser.add_argument('-l', '--depths', type=int, nargs='+',
+                        default=[6, 8, 10],
+                        help='Tree depths to benchmark.')
+    parser.add_argument('--vote-thresholds', type=int, nargs='+',
+                        default=[1, 2, 4, 8],
+                        help='Vote thresholds to benchmark. Thresholds '
+                             'greater than the number of trees are skipped.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed.')
+    return parser
+
+
+def true_neighbors(x, queries, k):
+    """
+    :return: Row indices of the exact ``k`` nearest neighbors of each query.
+    :rtype: numpy.ndarray
+    """
+    x_sq = (x ** 2).sum(axis=1)
+    nbrs = []
+    for q in queries:
+        dists = x_sq - 2 * x.dot(q)
+        nbrs.append(numpy.argpartition(dists, k - 1)[:k])
+    return numpy.array(nbrs)
+
+
+def benchmark(index, queries, truth, k):
+    """
+    Query the index with each query, measuring recall against the true
+    neighbor rows.
+
+    :return: Mean recall and mean seconds per query.
+    :rtype: (float, float)
+    """
+    recall = 0.
+    elapsed = 0.
+    for q, t in zip(queries, truth):
+        s = time.time()
+        r, _ = index.nn(q, k)
+        elapsed += time.time() - s
+        recall += len(set(d.uuid() for d in r).intersection(t)) / float(k)
+    return recall / len(queries), elapsed / len(queries)
+
+
+def main():
+    args = cli_parser().parse_args()
+    initialize_logging(logging.getLogger('__main__'),
+                       logging.INFO - (10 * args.verbose))
+    log = logging.getLogger(__name__)
+
+    log.info("Generating %d random descriptors of dimensionality %d",
+             args.num_descriptors, args.dimensionality)
+    rng = numpy.random.RandomState(args.seed)
+    x = rng.rand(args.num_descriptors, args.dimensionality)
+    descriptors = []
+    for i, v in enumerate(x):
+        d = DescriptorMemoryElement('random', i)
+        d.set_vector(v)
+        descriptors.append(d)
+    queries = []
+    for i, v in enumerate(rng.rand(args.num_queries, args.dimensionality)):
+        d = DescriptorMemoryElement('query', i)
+        d.set_vector(v)
+        queries.append(d)
+
+    log.info("Finding true neighbors by exhaustive search")
+    truth = true_neighbors(x, [q.vector() for q in queries], args.k)
+
+    print "%6s %6s %6s %10s %8s %12s" % ('trees', 'depth', 'votes',
+                                        'build (s)', 'recall', 'query (ms)')
+    for num_trees in args.num_trees:
+        for depth in args.depths:
+            numpy.random.seed(args.seed)
+            index = MRPTNearestNeighborsIndex(MemoryDescriptorIndex(),
+                                              num_trees=num_trees,
+                                              depth=depth)
+            s = time.time()
+            index.build_index(descriptors)
+            t_build = time.time() - s
+            for vote_threshold in args.vote_thresholds:
+                if vote_threshold > num_trees:
+                    continue
+                index._vote_threshold = vote_threshold
+                recall, t_query = benchmark(index, queries, truth, args.k)
+                print "%6d %6d %6d %10.3f %8.3f %12.3f" \
+                    % (num_trees, depth, vote_threshold, t_build, recall,
+                       t_query * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -29,7 +29,26 @@ Configuration
 
         - classification_use_multiprocessing
             If we should use multiprocessing (vs threading) when classifying
-            elements.
+            elements. This only applies when folds are run one at a time
+            (``parallel_folds`` of 1), as fold worker processes classify with
+            threads.
+
+        - classification_batch_size
+            Number of test descriptors classified at a time in a fold.
+
+        - parallel_folds
+            Number of folds to run concurrently in separate processes. If None,
+            we use one process per available core.
+
+        - fold_memory_limit_mb
+            Optional per-fold process address space limit in megabytes. This
+            includes the mapping of the shared descriptor matrix. A fold
+            exceeding this fails with a MemoryError.
+
+        - work_directory
+            Directory in which to store the shared, memory-mapped descriptor
+            matrix while validating. If None, we use the system temporary
+            directory.
 
     - pr_curves
         - enabled
@@ -66,7 +85,10 @@ Configuration
 
 import csv
 import logging
+import multiprocessing
 import os
+import resource
+import tempfile
 
 import matplotlib.pyplot as plt
 import numpy
@@ -81,6 +103,9 @@ from smqtk.representation import (
 )
 from smqtk.representation.classification_element.memory import \
     MemoryClassificationElement
+from smqtk.representation.descriptor_element import elements_to_matrix
+from smqtk.representation.descriptor_element.local_elements import \
+    DescriptorMemoryElement
 from smqtk.utils import (
     bin_utils,
     file_utils,
@@ -108,6 +133,10 @@ def default_config():
             "num_folds": 6,
             "random_seed": None,
             "classification_use_multiprocessing": True,
+            "classification_batch_size": 1024,
+            "parallel_folds": None,
+            "fold_memory_limit_mb": None,
+            "work_directory": None,
         },
         "pr_curves": {
             "enabled": True,
@@ -159,13 +188,6 @@ def classifier_kfold_validation():
     #: :type: dict
     classifier_config = config['plugins']['supervised_classifier']
 
-    # Always use in-memory ClassificationElement since we are retraining the
-    # classifier and don't want possible element caching
-    #: :type: ClassificationElementFactory
-    classification_factory = ClassificationElementFactory(
-        MemoryClassificationElement, {}
-    )
-
     log.info("Loading truth data")
     #: :type: list[str]
     uuids = []
@@ -189,9 +211,177 @@ def classifier_kfold_validation():
         random_state=config['cross_validation']['random_seed']
     )
 
+    # Descriptors are loaded once into a memory-mapped matrix that fold
+    # workers share instead of each fetching their descriptors from the index.
+    work_dir = config['cross_validation']['work_directory']
+    if work_dir:
+        file_utils.safe_create_dir(work_dir)
+    fd, matrix_fp = tempfile.mkstemp(suffix='.descriptors.mat', dir=work_dir)
+    os.close(fd)
+    try:
+        log.info("Loading descriptors into shared matrix: %s", matrix_fp)
+        sample = descriptor_index.get_descriptor(uuids[0]).vector()
+        mat = numpy.memmap(matrix_fp, sample.dtype, 'w+',
+                           shape=(len(uuids), sample.size))
+        elements_to_matrix(descriptor_index.get_many_descriptors(uuids),
+                           mat=mat, report_interval=1.0)
+        mat.flush()
+        del mat
+
+        fold_state = {
+            "matrix_fp": matrix_fp,
+            "matrix_dtype": sample.dtype,
+            "matrix_shape": (len(uuids), sample.size),
+            "uuids": uuids,
+            "truth_labels": truth_labels,
+            "classifier_config": classifier_config,
+            "batch_size": config['cross_validation']
+                                ['classification_batch_size'],
+            "use_multiprocessing": use_mp,
+        }
+
+        # A classifier caching precomputed kernel matrices computes the
+        # kernel over all truth descriptors once, with each fold's training
+        # kernel then extracted from it.
+        #: :type: SupervisedClassifier
+        classifier = plugin.from_plugin_config(
+            classifier_config,
+            get_supervised_classifier_impls()
+        )
+        if getattr(classifier, 'precomputed_kernel', None) and \
+                getattr(classifier, 'kernel_cache_dir', None):
+            log.info("Caching precomputed kernel over truth descriptors")
+            _init_fold_worker(fold_state)
+            classifier.cache_kernel(_matrix_descriptors(xrange(len(uuids))))
+            _fold_state.clear()
+        del classifier
+
+        fold_data = run_folds(
+            fold_state, kfolds,
+            config['cross_validation']['parallel_folds'],
+            config['cross_validation']['fold_memory_limit_mb']
+        )
+    finally:
+        os.remove(matrix_fp)
+
+    #
+    # Curve generation
+    #
+    if pr_enabled:
+        make_pr_curves(fold_data, pr_output_dir, pr_file_prefix, pr_show)
+    if roc_enabled:
+        make_roc_curves(fold_data, roc_output_dir, roc_file_prefix, roc_show)
+
+
+#: State shared by folds run in the current process.
+#: :type: dict
+_fold_state = {}
+
+
+def _init_fold_worker(fold_state):
+    """
+    Initialize fold execution state for the current process, opening the
+    shared descriptor matrix.
+
+    :param fold_state: Fold state dictionary as formed in
+        ``classifier_kfold_validation``.
+    :type fold_state: dict
+
+    """
+    _fold_state.clear()
+    _fold_state.update(fold_state)
+    _fold_state['matrix'] = numpy.memmap(
+        fold_state['matrix_fp'], fold_state['matrix_dtype'], 'r',
+        shape=fold_state['matrix_shape']
+    )
+
+
+def _matrix_descriptors(indices):
+    """
+    :return: Descriptor elements for the given rows of the shared matrix.
+    :rtype: list[DescriptorMemoryElement]
+    """
+    mat = _fold_state['matrix']
+    uuids = _fold_state['uuids']
+    elements = []
+    for idx in indices:
+        d = DescriptorMemoryElement('kfold', uuids[idx])
+        d.set_vector(mat[idx])
+        elements.append(d)
+    return elements
+
+
+def _run_fold((i, train, test)):
+    """
+    Train a classifier on a fold's training rows and classify its test rows
+    in batches.
+
+    :return: Fold index and per-label parallel truth and classification
+        probability lists for the fold's test rows.
+    :rtype: (int, dict[str, dict[str, list]])
+    """
+    log = logging.getLogger(__name__)
+    # Limited here rather than in the pool initializer, as initializer
+    # failures would have the pool endlessly replace its workers.
+    if _fold_state.get('memory_limit_mb'):
+        limit = int(_fold_state['memory_limit_mb']) * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    uuids = _fold_state['uuids']
+    truth_labels = _fold_state['truth_labels']
+    batch_size = _fold_state['batch_size']
+    log.info("Fold %d -- %d training examples, %d test examples",
+             i, len(train), len(test))
+
+    #: :type: SupervisedClassifier
+    classifier = plugin.from_plugin_config(
+        _fold_state['classifier_config'],
+        get_supervised_classifier_impls()
+    )
+
+    #: :type: dict[str, list[smqtk.representation.DescriptorElement]]
+    pos_map = {}
+    for label in set(truth_labels[train]):
+        pos_map[label] = \
+            _matrix_descriptors(train[truth_labels[train] == label])
+    log.info("Fold %d -- Training classifier", i)
+    classifier.train(pos_map)
+    del pos_map
+
+    # Always use in-memory ClassificationElement since we are retraining the
+    # classifier and don't want possible element caching
+    classification_factory = ClassificationElementFactory(
+        MemoryClassificationElement, {}
+    )
+    log.info("Fold %d -- Classifying test set", i)
+    uuid2c = {}
+    for b in xrange(0, len(test), batch_size):
+        m = classifier.classify_async(
+            _matrix_descriptors(test[b:b + batch_size]),
+            classification_factory,
+            use_multiprocessing=_fold_state['use_multiprocessing'],
+        )
+        for d, c in m.iteritems():
+            uuid2c[d.uuid()] = c.get_classification()
+        del m
+
+    # Only considering positive labels
+    fold_data = {}
+    for t_label in set(truth_labels[train]):
+        fold_data[t_label] = {
+            "truth": [l == t_label for l in truth_labels[test]],
+            "proba": [uuid2c[uuid][t_label] for uuid in uuids[test]]
+        }
+    log.info("Fold %d -- Done", i)
+    return i, fold_data
+
+
+def run_folds(fold_state, kfolds, parallel_folds=None, memory_limit_mb=None):
     """
-    Truth and classification probability results for test data per fold.
-    Format:
+    Run cross validation folds, concurrently in a pool of processes when
+    ``parallel_folds`` is not 1.
+
+    Returned truth and classification probability results for the test data
+    of each fold are in the format:
         {
             0: {
                 '<label>':  {
@@ -202,62 +392,49 @@ def classifier_kfold_validation():
             },
             ...
         }
-    """
-    fold_data = {}
-
-    i = 0
-    for train, test in kfolds:
-        log.info("Fold %d", i)
-        log.info("-- %d training examples", len(train))
-        log.info("-- %d test examples", len(test))
-        fold_data[i] = {}
-
-        log.info("-- creating classifier")
-        #: :type: SupervisedClassifier
-        classifier = plugin.from_plugin_config(
-            classifier_config,
-            get_supervised_classifier_impls()
-        )
 
-        log.info("-- gathering descriptors")
-        #: :type: dict[str, list[smqtk.representation.DescriptorElement]]
-        pos_map = {}
-        for idx in train:
-            if truth_labels[idx] not in pos_map:
-                pos_map[truth_labels[idx]] = []
-            pos_map[truth_labels[idx]].append(
-                descriptor_index.get_descriptor(uuids[idx])
-            )
+    :param fold_state: Fold state dictionary as formed in
+        ``classifier_kfold_validation``.
+    :type fold_state: dict
 
-        log.info("-- Training classifier")
-        classifier.train(pos_map)
+    :param kfolds: Iterable of (train, test) index arrays for each fold.
+    :type kfolds: collections.Iterable[(numpy.ndarray, numpy.ndarray)]
 
-        log.info("-- Classifying test set")
-        m = classifier.classify_async(
-            (descriptor_index.get_descriptor(uuids[idx]) for idx in test),
-            classification_factory,
-            use_multiprocessing=use_mp, ri=1.0
-        )
-        uuid2c = dict((d.uuid(), c.get_classification())
-                      for d, c in m.iteritems())
+    :param parallel_folds: Number of folds to run concurrently. If None, we
+        use the number of available cores.
+    :type parallel_folds: None | int
 
-        log.info("-- Pairing truth and computed probabilities")
-        # Only considering positive labels
-        for t_label in pos_map:
-            fold_data[i][t_label] = {
-                "truth": [l == t_label for l in truth_labels[test]],
-                "proba": [uuid2c[uuid][t_label] for uuid in uuids[test]]
-            }
+    :param memory_limit_mb: Optional address space limit in megabytes for
+        each fold process.
+    :type memory_limit_mb: None | int
 
-        i += 1
+    :return: Truth and classification probability results per fold.
+    :rtype: dict[int, dict[str, dict[str, list]]]
 
-    #
-    # Curve generation
-    #
-    if pr_enabled:
-        make_pr_curves(fold_data, pr_output_dir, pr_file_prefix, pr_show)
-    if roc_enabled:
-        make_roc_curves(fold_data, roc_output_dir, roc_file_prefix, roc_show)
+    """
+    folds = [(i, train, test) for i, (train, test) in enumerate(kfolds)]
+    parallel_folds = min(parallel_folds or multiprocessing.cpu_count(),
+                         len(folds))
+    if parallel_folds <= 1:
+        # Not limiting our own memory when running in-process.
+        _init_fold_worker(fold_state)
+        try:
+            return dict(_run_fold(f) for f in folds)
+        finally:
+            _fold_state.clear()
+
+    # Threads, not processes, for classification within fold workers as pool
+    # processes may not have children.
+    fold_state = dict(fold_state, use_multiprocessing=False,
+                      memory_limit_mb=memory_limit_mb)
+    # A fresh process per fold so memory is released between folds.
+    pool = multiprocessing.Pool(parallel_folds, _init_fold_worker,
+                                (fold_state,), maxtasksperchild=1)
+    try:
+        return dict(pool.imap_unordered(_run_fold, folds))
+    finally:
+        pool.close()
+        pool.join()
 
 
 def format_plt(title, x_label, y_label):
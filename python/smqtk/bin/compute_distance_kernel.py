@@ -0,0 +1,80 @@
+"""
+Compute the symmetric distance kernel of the descriptors in a configured
+index, such as the histogram intersection kernel used by IQR, in tiles over a
+process pool.
+
+The kernel is written to a memory-mapped ``.npy`` file as it is computed, so
+kernels larger than memory may be computed. The UUIDs of the descriptors, in
+kernel row order, are written one per line to the UUIDs file.
+"""
+
+import logging
+
+from smqtk.representation import get_descriptor_index_impls
+from smqtk.representation.descriptor_element import elements_to_matrix
+from smqtk.utils import (
+    bin_utils,
+    plugin,
+)
+from smqtk.utils.distance_kernel import (
+    KERNEL_TILE_SIZE,
+    compute_distance_matrix_tiled,
+)
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+def default_config():
+    return {
+        "descriptor_index": plugin.make_config(get_descriptor_index_impls()),
+        "kernel": {
+            "distance_method": "hik",
+            "tile_size": KERNEL_TILE_SIZE,
+            "processes": None,
+        },
+    }
+
+
+def cli_parser():
+    parser = bin_utils.basic_cli_parser(__doc__)
+    parser.add_argument('-k', '--kernel-filepath', required=True,
+                        help='Path of the .npy file to write the kernel to.')
+    parser.add_argument('-u', '--uuids-filepath', required=True,
+                        help='Path of the file to write descriptor UUIDs to, '
+                             'in kernel row order.')
+    return parser
+
+
+def main():
+    args = cli_parser().parse_args()
+    config = bin_utils.utility_main_helper(default_config, args)
+    log = logging.getLogger(__name__)
+
+    log.info("Initializing DescriptorIndex [type=%s]",
+             config['descriptor_index']['type'])
+    #: :type: smqtk.representation.DescriptorIndex
+    descriptor_index = plugin.from_plugin_config(
+        config['descriptor_index'],
+        get_descriptor_index_impls(),
+    )
+    descriptors = list(descriptor_index)
+    log.info("Loading %d descriptor vectors", len(descriptors))
+    m = elements_to_matrix(descriptors, report_interval=1.0)
+
+    with open(args.uuids_filepath, 'w') as f:
+        for d in descriptors:
+            f.write("%s\n" % d.uuid())
+    del descriptors
+
+    compute_distance_matrix_tiled(
+        m, distance_method=config['kernel']['distance_method'],
+        tile_size=config['kernel']['tile_size'],
+        output_filepath=args.kernel_filepath,
+        processes=config['kernel']['processes'],
+    )
+    log.info("Wrote kernel: %s", args.kernel_filepath)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Find the fastest ``MRPTNearestNeighborsIndex`` parameters that reach a target
+recall for descriptors in a configured index.
+
+A random sample of the indexed descriptors is used as queries. For each
+combination of the configured numbers of trees, tree depths and vote
+thresholds, the mean recall of the ``k`` nearest neighbors of the sample
+queries, relative to exhaustive search, and the mean query time are reported.
+The parameters of the fastest combination reaching the target recall are
+logged, and written as JSON to the output file if one is given.
+"""
+
+import json
+import logging
+import random
+
+from smqtk.algorithms.nn_index.mrpt import tune_parameters
+from smqtk.representation import get_descriptor_index_impls
+from smqtk.utils import (
+    bin_utils,
+    plugin,
+)
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+def default_config():
+    return {
+        "descriptor_index": plugin.make_config(get_descriptor_index_impls()),
+        "tuning": {
+            "query_sample_size": 100,
+            "k": 10,
+            "target_recall": 0.9,
+            "num_trees": [8, 16, 32, 64],
+            "depths": [4, 6, 8, 10],
+            "vote_thresholds": [1, 2, 4],
+            "distance_method": "euclidean",
+            "build_processes": None,
+            "random_seed": 0,
+        },
+    }
+
+
+def cli_parser():
+    parser = bin_utils.basic_cli_parser(__doc__)
+    parser.add_argument('-o', '--output-filepath',
+                        help='Optional file to write the parameters of the '
+                             'fastest configuration to as JSON.')
+    return parser
+
+
+def main():
+    args = cli_parser().parse_args()
+    config = bin_utils.utility_main_helper(default_config, args)
+    log = logging.getLogger(__name__)
+    tuning = config['tuning']
+
+    log.info("Initializing DescriptorIndex [type=%s]",
+             config['descriptor_index']['type'])
+    #: :type: smqtk.representation.DescriptorIndex
+    descriptor_index = plugin.from_plugin_config(
+        config['descriptor_index'],
+        get_descriptor_index_impls(),
+    )
+    descriptors = list(descriptor_index)
+    rng = random.Random(tuning['random_seed'])
+    queries = rng.sample(descriptors,
+                         min(tuning['query_sample_size'], len(descriptors)))
+    log.info("Tuning over %d descriptors with %d queries",
+             len(descriptors), len(queries))
+
+    best, results = tune_parameters(
+        descriptors, queries, tuning['k'], tuning['target_recall'],
+        num_trees=tuning['num_trees'], depths=tuning['depths'],
+        vote_thresholds=tuning['vote_thresholds'],
+        distance_method=tuning['distance_method'],
+        build_processes=tuning['build_processes'],
+    )
+
+    print "%6s %6s %6s %8s %12s" % ('trees', 'depth', 'votes', 'recall',
+                                    'query (ms)')
+    for r in results:
+        print "%6d %6d %6d %8.3f %12.3f" \
+            % (r['num_trees'], r['depth'], r['vote_threshold'], r['recall'],
+               r['query_time'] * 1000)
+
+    if best is None:
+        log.warning("No configuration reached the target recall of %g",
+                    tuning['target_recall'])
+        return
+    best['distance_method'] = tuning['distance_method']
+    log.info("Fastest configuration reaching recall %g: %s",
+             tuning['target_recall'], best)
+    if args.output_filepath:
+        with open(args.output_filepath, 'w') as f:
+            json.dump(best, f, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
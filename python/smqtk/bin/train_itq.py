@@ -9,6 +9,12 @@ The ``uuids_list_filepath`` configuration property is optional and should
 be used to specify a sub-set of descriptors in the configured index to
 train on. This only works if the stored descriptors' UUID is a type of
 string.
+
+For descriptor sets too large to fit in memory, ``--chunk-size`` fits the model
+in streaming mode, loading at most that many descriptors at a time.
+``--sample-size`` additionally limits the number of descriptors the ITQ
+rotation is learned from to a uniform random sample of that size, avoiding a
+second pass over the descriptors.
 """
 
 import logging
@@ -36,7 +42,15 @@ def default_config():
 
 
 def cli_parser():
-    return bin_utils.basic_cli_parser(__doc__)
+    parser = bin_utils.basic_cli_parser(__doc__)
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help='Fit the model in streaming mode, loading this '
+                             'many descriptors into memory at a time.')
+    parser.add_argument('--sample-size', type=int, default=None,
+                        help='When fitting in streaming mode, learn the ITQ '
+                             'rotation from a random sample of this many '
+                             'descriptors.')
+    return parser
 
 
 def main():
@@ -64,14 +78,20 @@ def main():
                 for l in f:
                     yield l.strip()
         log.info("Loading UUIDs list from file: %s", uuids_list_filepath)
-        d_iter = descriptor_index.get_many_descriptors(uuids_iter())
+
+        class DescriptorsIterable (object):
+            # Re-iterable, as streaming fit may pass over descriptors twice.
+            def __iter__(self):
+                return descriptor_index.get_many_descriptors(uuids_iter())
+        d_iter = DescriptorsIterable()
     else:
         log.info("Using UUIDs from loaded DescriptorIndex (count=%d)",
                  len(descriptor_index))
         d_iter = descriptor_index
 
     log.info("Fitting ITQ model")
-    functor.fit(d_iter)
+    functor.fit(d_iter, chunk_size=args.chunk_size,
+                sample_size=args.sample_size)
     log.info("Done")
 
 
@@ -1,8 +1,10 @@
 import atexit
+import collections
 import threading
 import time
 import uuid
 
+from smqtk.iqr.iqr_session import IqrSession
 from smqtk.utils import SmqtkObject
 
 
@@ -18,10 +20,26 @@ class IqrController (SmqtkObject):
     on the instance while inside the with statement. The lock is reentrant, so
     nested with-statements will not dead-lock.
 
+    Session Store
+    -------------
+    When given an ``IqrSessionStore``, session states are persisted to it so
+    that sessions outlive this process and may be shared with other processes
+    using the same store. The store is then the authority on which sessions
+    exist. Sessions not held in memory by this controller are
+    restored from the store on access, and a held session is restored again if
+    the store has a newer version of its state than the one held. Session
+    modifications are only persisted when ``save_session`` is called, so it
+    should be called after modifying a session.
+
+    If a maximum number of resident descriptors is also given, the least
+    recently accessed sessions are dropped from memory, but kept in the store,
+    when the total size of the working indices of held sessions exceeds it.
+
     """
 
     def __init__(self, expire_enabled=False, expire_check=30,
-                 expire_callback=None):
+                 expire_callback=None, session_store=None,
+                 descriptor_index=None, max_resident_descriptors=0):
         """
         Initialize the controller.
 
@@ -49,10 +67,29 @@ class IqrController (SmqtkObject):
             timeout, this callback function is not used.
         :type expire_callback: (collections.Hashable) -> None
 
+        :param session_store: Optional store to persist session states to and
+            restore sessions from.
+        :type session_store: None | smqtk.iqr.session_store.IqrSessionStore
+
+        :param descriptor_index: Index to retrieve descriptors from by UUID when
+            restoring sessions from the session store. This is required if a
+            session store is given.
+        :type descriptor_index: None | smqtk.representation.DescriptorIndex
+
+        :param max_resident_descriptors: Maximum total number of working index
+            descriptors of sessions to hold in memory when a session store is
+            given. When 0, held sessions are not limited.
+        :type max_resident_descriptors: int
+
         """
-        # Map of uuid to the search state
-        #: :type: dict[collections.Hashable, IqrSession]
-        self._iqr_sessions = {}
+        if session_store is not None and descriptor_index is None:
+            raise ValueError("A descriptor index is required to restore "
+                             "sessions from a session store.")
+
+        # Map of uuid to the search state, in least to most recently accessed
+        # order.
+        #: :type: collections.OrderedDict[collections.Hashable, IqrSession]
+        self._iqr_sessions = collections.OrderedDict()
         # Map of sessions with timeout's enabled and the time out value in
         # seconds
         #: :type
@@ -63,6 +100,14 @@ class IqrController (SmqtkObject):
         # RLock for iqr_session[*] maps.
         self._map_rlock = threading.RLock()
 
+        self._session_store = session_store
+        self._descriptor_index = descriptor_index
+        self._max_resident_descriptors = int(max_resident_descriptors)
+        # Map of held session uuid to the version of its state in the session
+        # store when it was last stored or restored.
+        #: :type: dict[collections.Hashable, int]
+        self._iqr_session_version = {}
+
         self._expire_enabled = expire_enabled
         self._expire_interval = expire_check
         self._expire_thread_stop_event = threading.Event()
@@ -101,9 +146,14 @@ class IqrController (SmqtkObject):
                         self._log.debug("-> Expiring session '%s' "
                                         "(last-access: %s, timeout: %s, "
                                         "now: %s)", sid, la, to, now)
+                        try:
+                            iqrs = self._held_session(sid)
+                        except KeyError:
+                            # Already removed by another process.
+                            continue
                         if hasattr(self._expire_callback, '__call__'):
                             self._log.debug("   - Executing callback")
-                            self._expire_callback(self._iqr_sessions[sid])
+                            self._expire_callback(iqrs)
                         self.remove_session(sid)
 
         self._log.debug("End of expiration handle function")
@@ -142,9 +192,89 @@ class IqrController (SmqtkObject):
                 self._log.debug("Stopping session expiration monitor thread "
                                 "-- Done")
 
+    def _restore_session(self, session_uuid):
+        """
+        Restore a session from the session store, replacing any held copy.
+        ASSUMING the map lock is held.
+
+        :raises KeyError: The session store has no state for the given UUID.
+
+        :rtype: smqtk.iqr.iqr_session.IqrSession
+        """
+        self._log.debug("Restoring session '%s' from store", session_uuid)
+        state, version = self._session_store.get_state(session_uuid)
+        iqrs = IqrSession.from_state(state['session'], self._descriptor_index)
+        self._iqr_sessions.pop(session_uuid, None)
+        self._iqr_sessions[session_uuid] = iqrs
+        self._iqr_session_version[session_uuid] = version
+        if state['timeout'] > 0 and \
+                session_uuid not in self._iqr_session_timeout:
+            self._iqr_session_timeout[session_uuid] = state['timeout']
+            self._iqr_session_last_access[session_uuid] = time.time()
+        return iqrs
+
+    def _held_session(self, session_uuid):
+        """
+        Get a session, restoring it from the session store if it is not held
+        or if the store has a newer version of it. ASSUMING the map lock is
+        held.
+
+        :raises KeyError: No session for the given UUID.
+
+        :rtype: smqtk.iqr.iqr_session.IqrSession
+        """
+        if self._session_store is not None:
+            version = self._session_store.version(session_uuid)
+            if version is None:
+                # Removed from the store, possibly by another process.
+                self._forget_session(session_uuid)
+                raise KeyError(session_uuid)
+            elif version != self._iqr_session_version.get(session_uuid):
+                return self._restore_session(session_uuid)
+        return self._iqr_sessions[session_uuid]
+
+    def _forget_session(self, session_uuid):
+        """
+        Remove any record of a session from this controller's maps. ASSUMING
+        the map lock is held.
+        """
+        self._iqr_sessions.pop(session_uuid, None)
+        self._iqr_session_version.pop(session_uuid, None)
+        self._iqr_session_timeout.pop(session_uuid, None)
+        self._iqr_session_last_access.pop(session_uuid, None)
+
+    def _evict_sessions(self, keep_uuid=None):
+        """
+        Drop least recently accessed sessions from memory until the total
+        resident size of held sessions is within bounds. Only sessions that are
+        not locked by another thread, and are in the session store, are
+        dropped. ASSUMING the map lock is held.
+
+        :param keep_uuid: UUID of a session not to drop.
+        :type keep_uuid: collections.Hashable
+        """
+        if self._session_store is None or self._max_resident_descriptors <= 0:
+            return
+        total = sum(s.resident_size() for s in self._iqr_sessions.itervalues())
+        for sid in list(self._iqr_sessions):
+            if total <= self._max_resident_descriptors:
+                break
+            iqrs = self._iqr_sessions[sid]
+            if sid == keep_uuid or sid not in self._iqr_session_version or \
+                    not iqrs.lock.acquire(False):
+                continue
+            try:
+                self._log.debug("Dropping session '%s' from memory", sid)
+                total -= iqrs.resident_size()
+                del self._iqr_sessions[sid]
+                del self._iqr_session_version[sid]
+            finally:
+                iqrs.lock.release()
+
     def session_uuids(self):
         """
-        Return a tuple of all currently registered IqrSessions.
+        Return a tuple of all currently registered IqrSessions, including
+        those only in the session store.
 
         This does NOT update session last access in regards to session
         expiration.
@@ -154,6 +284,8 @@ class IqrController (SmqtkObject):
 
         """
         with self._map_rlock:
+            if self._session_store is not None:
+                return self._session_store.session_uuids()
             return tuple(self._iqr_sessions)
 
     def has_session_uuid(self, session_uuid):
@@ -175,6 +307,8 @@ class IqrController (SmqtkObject):
 
         """
         with self._map_rlock:
+            if self._session_store is not None:
+                return self._session_store.has_session(session_uuid)
             return session_uuid in self._iqr_sessions
 
     def add_session(self, iqr_session, timeout=0):
@@ -195,7 +329,7 @@ class IqrController (SmqtkObject):
         timeout = float(timeout)
         with self._map_rlock:
             sid = iqr_session.uuid
-            if sid in self._iqr_sessions:
+            if self.has_session_uuid(sid):
                 raise RuntimeError("Cannot use given session as its UUID "
                                    "already exists in the controller session "
                                    "map: %s" % sid)
@@ -204,6 +338,8 @@ class IqrController (SmqtkObject):
             if timeout > 0:
                 self._iqr_session_timeout[sid] = timeout
                 self._iqr_session_last_access[sid] = time.time()
+            self.save_session(iqr_session)
+            self._evict_sessions(sid)
             return sid
 
     def get_session(self, session_uuid):
@@ -220,9 +356,39 @@ class IqrController (SmqtkObject):
 
         """
         with self._map_rlock:
+            iqrs = self._held_session(session_uuid)
+            # Mark as most recently accessed.
+            self._iqr_sessions[session_uuid] = \
+                self._iqr_sessions.pop(session_uuid)
             if session_uuid in self._iqr_session_timeout:
                 self._iqr_session_last_access[session_uuid] = time.time()
-            return self._iqr_sessions[session_uuid]
+            self._evict_sessions(session_uuid)
+            return iqrs
+
+    def save_session(self, iqr_session):
+        """
+        Persist the current state of a session to the session store, if one is
+        configured. Otherwise this method does nothing.
+
+        This should be called after modifying a session. This acquires the
+        session's lock but not this controller's lock, so it may be called
+        while holding the session's lock.
+
+        :param iqr_session: Session to save.
+        :type iqr_session: smqtk.iqr.iqr_session.IqrSession
+
+        """
+        if self._session_store is None:
+            return
+        sid = iqr_session.uuid
+        with iqr_session:
+            state = {
+                'session': iqr_session.get_state(),
+                'timeout': self._iqr_session_timeout.get(sid, 0),
+            }
+            version = self._session_store.store_state(sid, state)
+            # Single item assignment, safe without the map lock.
+            self._iqr_session_version[sid] = version
 
     def remove_session(self, session_uuid):
         """
@@ -235,6 +401,10 @@ class IqrController (SmqtkObject):
 
         """
         with self._map_rlock:
+            if self._session_store is not None:
+                self._forget_session(session_uuid)
+                self._session_store.remove_state(session_uuid)
+                return
             del self._iqr_sessions[session_uuid]
             if session_uuid in self._iqr_session_timeout:
                 del self._iqr_session_timeout[session_uuid]
@@ -2,10 +2,13 @@ import logging
 import threading
 import uuid
 
+import numpy
+
 from smqtk.algorithms.relevancy_index import get_relevancy_index_impls
 from smqtk.representation.descriptor_index.memory import MemoryDescriptorIndex
 from smqtk.utils import SmqtkObject
 from smqtk.utils import plugin
+from smqtk.utils import ReadWriteLock
 
 
 DFLT_REL_INDEX_CONFIG = {
@@ -57,6 +60,18 @@ class IqrSession (SmqtkObject):
     are to be used or modified, it should be within a with-block so race
     conditions do not occur across threads/sub-processes.
 
+    Results are additionally guarded by ``results_lock``, a read/write lock.
+    Modifications of the session hold the session lock, but new results are
+    only swapped in, under a short write lock, once they are fully computed.
+    Readers of results, e.g. ``ordered_results``, only take a read lock, so
+    they do not block behind a long-running refinement and always see a
+    consistent set of results.
+
+    A session's state may be captured compactly, referencing descriptors only
+    by UUID, via ``get_state`` and restored via ``from_state``. Restored
+    sessions load their working index and results from the descriptor index
+    given at restoration when they are first accessed.
+
     """
 
     @property
@@ -105,13 +120,15 @@ class IqrSession (SmqtkObject):
         """
         self.uuid = session_uid or str(uuid.uuid1()).replace('-', '')
         self.lock = threading.RLock()
+        # Guards swapping of ``results``. See class documentation.
+        self.results_lock = ReadWriteLock()
 
         self.pos_seed_neighbors = int(pos_seed_neighbors)
 
         # Local descriptor index for ranking, populated by a query to the
         #   nn_index instance.
         # Added external data/descriptors not added to this index.
-        self.working_index = MemoryDescriptorIndex()
+        self._working_index = MemoryDescriptorIndex()
 
         # Book-keeping set so we know what positive descriptors
         # UUIDs we've used to query the neighbor index with already.
@@ -130,7 +147,24 @@ class IqrSession (SmqtkObject):
         #   recorded positive and negative adjudications.
         # This is None before any initialization or refinement occurs.
         #: :type: None | dict[smqtk.representation.DescriptorElement, float]
-        self.results = None
+        self._results = None
+        # Cache of ``results`` as parallel arrays of descriptors and scores,
+        # and the indices of those arrays in order of descending score. The
+        # order may only cover the top results. Invalidated when results
+        # change.
+        #: :type: None | (list[smqtk.representation.DescriptorElement], numpy.ndarray, numpy.ndarray)
+        self._results_order_cache = None
+
+        # State restored via ``from_state`` whose working index and results
+        # have not yet been loaded from the descriptor index, or None.
+        #: :type: None | dict
+        self._pending_state = None
+        #: :type: None | smqtk.representation.DescriptorIndex
+        self._pending_index = None
+        # Guards loading of pending state. This is separate from the session
+        # lock so that results readers, who may trigger loading, never wait on
+        # a session modification that in turn waits on them for a write lock.
+        self._pending_lock = threading.Lock()
 
         #
         # Algorithm Instances [+Config]
@@ -144,6 +178,146 @@ class IqrSession (SmqtkObject):
         #: :type: None | smqtk.algorithms.relevancy_index.RelevancyIndex
         self.rel_index = None
 
+    @classmethod
+    def from_state(cls, state, descriptor_index):
+        """
+        Restore a session from a state returned by ``get_state``.
+
+        Adjudicated descriptors are retrieved from the given descriptor index
+        immediately, while working index and result descriptors are retrieved
+        when the working index or results are first accessed. All descriptors
+        referenced by the state must be retrievable from the given index.
+
+        :raises KeyError: An adjudicated descriptor UUID is not in the given
+            descriptor index.
+
+        :param state: Session state dictionary.
+        :type state: dict
+
+        :param descriptor_index: Index to retrieve descriptors from by UUID.
+        :type descriptor_index: smqtk.representation.DescriptorIndex
+
+        :return: Restored session.
+        :rtype: IqrSession
+
+        """
+        iqrs = cls(state['pos_seed_neighbors'], state['rel_index_config'],
+                   state['uuid'])
+        iqrs._wi_seeds_used = set(state['wi_seeds_used'])
+        iqrs.positive_descriptors = set(
+            descriptor_index.get_many_descriptors(state['positive_uuids'])
+        )
+        iqrs.negative_descriptors = set(
+            descriptor_index.get_many_descriptors(state['negative_uuids'])
+        )
+        if state['working_index_uuids'] or state['results']:
+            iqrs._pending_state = state
+            iqrs._pending_index = descriptor_index
+        return iqrs
+
+    def get_state(self):
+        """
+        Get a compact, picklable representation of this session's state that
+        references descriptors by UUID.
+
+        The relevancy index is not included and is rebuilt from the working
+        index as needed by a session restored via ``from_state``.
+
+        :return: Session state dictionary.
+        :rtype: dict
+
+        """
+        with self.lock:
+            with self._pending_lock:
+                pending = self._pending_state
+            if pending is not None:
+                # Not yet loaded, so the pending state is still current.
+                wi_uuids = pending['working_index_uuids']
+                results = pending['results']
+            else:
+                wi_uuids = list(self._working_index.iterkeys())
+                results = None
+                if self._results is not None:
+                    results = dict((d.uuid(), p)
+                                   for d, p in self._results.iteritems())
+            return {
+                'uuid': self.uuid,
+                'pos_seed_neighbors': self.pos_seed_neighbors,
+                'rel_index_config': self.rel_index_config,
+                'wi_seeds_used': list(self._wi_seeds_used),
+                'working_index_uuids': list(wi_uuids),
+                'positive_uuids': [d.uuid() for d in
+                                   self.positive_descriptors],
+                'negative_uuids': [d.uuid() for d in
+                                   self.negative_descriptors],
+                'results': results,
+            }
+
+    def _load_pending_state(self):
+        """
+        Load working index and result descriptors of a restored state, if not
+        yet loaded.
+        """
+        if self._pending_state is None:
+            return
+        with self._pending_lock:
+            if self._pending_state is None:
+                return
+            state = self._pending_state
+            self._log.debug("Loading working index of %d descriptors",
+                            len(state['working_index_uuids']))
+            self._working_index.add_many_descriptors(
+                self._pending_index.get_many_descriptors(
+                    state['working_index_uuids']
+                )
+            )
+            self._results_order_cache = None
+            if state['results'] is not None:
+                r_uuids = list(state['results'])
+                self._results = IqrResultsDict(
+                    (d, state['results'][u]) for u, d in
+                    zip(r_uuids,
+                        self._pending_index.get_many_descriptors(r_uuids))
+                )
+            self._pending_state = None
+            self._pending_index = None
+
+    @property
+    def working_index(self):
+        """
+        :rtype: smqtk.representation.descriptor_index.memory.MemoryDescriptorIndex
+        """
+        self._load_pending_state()
+        return self._working_index
+
+    @property
+    def results(self):
+        """
+        :rtype: None | dict[smqtk.representation.DescriptorElement, float]
+        """
+        self._load_pending_state()
+        return self._results
+
+    @results.setter
+    def results(self, r):
+        self._load_pending_state()
+        with self.results_lock.write_lock():
+            self._results = r
+            self._results_order_cache = None
+
+    def resident_size(self):
+        """
+        :return: Number of working index descriptors currently held in memory
+            by this session. This is 0 for a restored session whose working
+            index has not been accessed yet. This does not acquire the session
+            lock, so the value may be approximate while the session is being
+            modified.
+        :rtype: int
+        """
+        if self._pending_state is not None:
+            return 0
+        return self._working_index.count()
+
     def __enter__(self):
         """
         :rtype: IqrSession
@@ -155,20 +329,82 @@ class IqrSession (SmqtkObject):
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.lock.release()
 
-    def ordered_results(self):
+    def _results_order(self, k):
+        """
+        Get results as parallel arrays of descriptors and scores, and the
+        indices of at least the top ``k`` results in order of descending score.
+        Equal scores are ordered by their position in the arrays. ASSUMING a
+        results read lock is held and there are results.
+
+        When ``k`` is less than half the number of results, only the top ``k``
+        are selected via partitioning instead of sorting all results. Computed
+        orders are cached until results change.
+
+        :param k: Number of top results required, or None for all.
+        :type k: None | int
+
+        :rtype: (list[smqtk.representation.DescriptorElement], numpy.ndarray,
+                 numpy.ndarray)
+        """
+        c = self._results_order_cache
+        if c is None:
+            descriptors = self.results.keys()
+            scores = numpy.array([self.results[d] for d in descriptors],
+                                 dtype=float)
+            c = (descriptors, scores, numpy.empty(0, int))
+        descriptors, scores, order = c
+        n = len(scores)
+        if k is None or k > n:
+            k = n
+
+        if len(order) < k:
+            if k * 2 < n:
+                # Top-k selection. Include all scores above the k-th largest,
+                # and the earliest of those equal to it, so that ties resolve
+                # as they would in a full sort.
+                part = numpy.argpartition(-scores, k - 1)[:k]
+                threshold = scores[part].min()
+                above = numpy.flatnonzero(scores > threshold)
+                ties = numpy.flatnonzero(scores == threshold)[:k - len(above)]
+                idx = numpy.concatenate([above, ties])
+                order = idx[numpy.lexsort((idx, -scores[idx]))]
+            else:
+                order = numpy.argsort(-scores, kind='mergesort')
+            c = (descriptors, scores, order)
+            self._results_order_cache = c
+        return c
+
+    def ordered_results(self, start=None, stop=None):
         """
         Return a tuple of the current (id, probability) result pairs in
         order of probability score. If there are no results yet, None is
         returned.
 
+        Optional ``start`` and ``stop`` indices select a slice of the ordered
+        results, as in ``ordered_results()[start:stop]``. Selecting only the
+        first results of many avoids ordering all results.
+
+        This only acquires a results read lock, and so does not wait for an
+        in-progress refinement.
+
+        :param start: Optional index of the first ordered result to return.
+        :type start: None | int
+
+        :param stop: Optional index after the last ordered result to return.
+        :type stop: None | int
+
         :rtype: None | tuple[(smqtk.representation.DescriptorElement, float)]
 
         """
-        with self.lock:
+        with self.results_lock.read_lock():
             if self.results:
-                return tuple(sorted(self.results.iteritems(),
-                                    key=lambda p: p[1],
-                                    reverse=True))
+                k = None
+                if stop is not None and stop >= 0 and \
+                        (start is None or start >= 0):
+                    k = stop
+                descriptors, scores, order = self._results_order(k)
+                return tuple((descriptors[i], float(scores[i]))
+                             for i in order[start:stop])
             return None
 
     def adjudicate(self, new_positives=(), new_negatives=(),
@@ -219,6 +455,11 @@ class IqrSession (SmqtkObject):
         We only query from the index for new positive elements since the last
         update or reset.
 
+        Neighbors of all new positive elements are queried with a single
+        ``nn_batch`` call. The relevancy index is extended with only the
+        descriptors new to the working index when the relevancy index
+        implementation supports incremental updates, and rebuilt otherwise.
+
         :param nn_index: :class:`.NearestNeighborsIndex` to query from.
         :type nn_index: smqtk.algorithms.NearestNeighborsIndex
 
@@ -232,29 +473,53 @@ class IqrSession (SmqtkObject):
 
         # Not clearing working index because this step is intended to be
         # additive.
-        updated = False
-
-        # adding to working index
-        for p in self.positive_descriptors:
-            if p.uuid() not in self._wi_seeds_used:
-                self._log.info("Querying neighbors to: %s", p)
-                self.working_index.add_many_descriptors(
-                    nn_index.nn(p, n=self.pos_seed_neighbors)[0]
-                )
-                self._wi_seeds_used.add(p.uuid())
-                updated = True
-
-        # Make new relevancy index
-        if updated:
-            self._log.info("Creating new relevancy index over working index.")
-            #: :type: smqtk.algorithms.relevancy_index.RelevancyIndex
-            self.rel_index = plugin.from_plugin_config(self.rel_index_config,
-                                                       get_relevancy_index_impls())
-            self.rel_index.build_index(self.working_index.iterdescriptors())
+        new_seeds = [p for p in self.positive_descriptors
+                     if p.uuid() not in self._wi_seeds_used]
+        if not new_seeds:
+            return
+
+        # Query neighbors of all new positives at once, collecting neighbors
+        # not yet in the working index.
+        self._log.info("Querying neighbors to %d new positives",
+                       len(new_seeds))
+        new_descriptors = {}
+        for p, (neighbors, _) in zip(new_seeds, nn_index.nn_batch(
+                new_seeds, n=self.pos_seed_neighbors)):
+            for d in neighbors:
+                if not self.working_index.has_descriptor(d.uuid()):
+                    new_descriptors[d.uuid()] = d
+            self._wi_seeds_used.add(p.uuid())
+        new_descriptors = new_descriptors.values()
+        self._log.info("Adding %d new descriptors to working index",
+                       len(new_descriptors))
+        self.working_index.add_many_descriptors(new_descriptors)
+
+        # Update relevancy index with new descriptors, or make a new one if we
+        # cannot.
+        if self.rel_index is None:
+            self._build_rel_index()
+        elif new_descriptors:
+            try:
+                self._log.info("Updating relevancy index with new "
+                               "descriptors.")
+                self.rel_index.update_index(new_descriptors)
+            except NotImplementedError:
+                self._build_rel_index()
+
+    def _build_rel_index(self):
+        """ Build a new relevancy index over the working index. """
+        self._log.info("Creating new relevancy index over working index.")
+        #: :type: smqtk.algorithms.relevancy_index.RelevancyIndex
+        self.rel_index = plugin.from_plugin_config(self.rel_index_config,
+                                                   get_relevancy_index_impls())
+        self.rel_index.build_index(self.working_index.iterdescriptors())
 
     def refine(self):
         """ Refine current model results based on current adjudication state
 
+        New results are computed while holding only the session lock, and are
+        then swapped in under the results write lock.
+
         :raises RuntimeError: No working index has been initialized.
             :meth:`update_working_index` should have been called after
             adjudicating some positive examples.
@@ -263,6 +528,10 @@ class IqrSession (SmqtkObject):
 
         """
         with self.lock:
+            if not self.rel_index and self._wi_seeds_used:
+                # Restored session, whose relevancy index is not part of its
+                # state.
+                self._build_rel_index()
             if not self.rel_index:
                 raise RuntimeError("No relevancy index yet. Must not have "
                                    "initialized session (no working index).")
@@ -277,20 +546,25 @@ class IqrSession (SmqtkObject):
 
             element_probability_map = self.rel_index.rank(pos, neg)
 
-            if self.results is None:
-                self.results = IqrResultsDict()
-            self.results.update(element_probability_map)
+            # Build on a copy so that readers of the current results are not
+            # affected until the new results are complete.
+            results = IqrResultsDict(self.results or {})
+            results.update(element_probability_map)
 
             # Force adjudicated positives and negatives to be probability 1 and
             # 0, respectively, since we want to control where they show up in
             # our results view.
             # - Not all pos/neg descriptors may be in our working index.
             for d in pos:
-                if d in self.results:
-                    self.results[d] = 1.0
+                if d in results:
+                    results[d] = 1.0
             for d in neg:
-                if d in self.results:
-                    self.results[d] = 0.0
+                if d in results:
+                    results[d] = 0.0
+
+            with self.results_lock.write_lock():
+                self._results = results
+                self._results_order_cache = None
 
     def reset(self):
         """ Reset the IQR Search state
@@ -299,10 +573,15 @@ class IqrSession (SmqtkObject):
 
         """
         with self.lock:
-            self.working_index.clear()
+            with self._pending_lock:
+                self._pending_state = None
+                self._pending_index = None
+            self._working_index.clear()
             self._wi_seeds_used.clear()
             self.positive_descriptors.clear()
             self.negative_descriptors.clear()
 
             self.rel_index = None
-            self.results = None
+            with self.results_lock.write_lock():
+                self._results = None
+                self._results_order_cache = None
@@ -0,0 +1,130 @@
+import abc
+import os.path as osp
+
+from smqtk.utils import Configurable, SmqtkObject
+from smqtk.utils import plugin
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+class IqrSessionStore (SmqtkObject, Configurable, plugin.Pluggable):
+    """
+    Persistent store of compact IQR session states, keyed by session UUID.
+
+    States are JSON-like dictionaries, as returned by
+    ``IqrSession.get_state``, which reference descriptors by UUID only. Stores
+    backed by shared storage allow multiple processes to serve the same
+    sessions.
+
+    Every stored state has a version number that is incremented each time the
+    state for that session is stored. Holders of an in-memory copy of a session
+    can compare versions to detect when their copy is stale.
+
+    """
+
+    @abc.abstractmethod
+    def session_uuids(self):
+        """
+        :return: UUIDs of sessions with stored states.
+        :rtype: tuple[collections.Hashable]
+        """
+
+    @abc.abstractmethod
+    def has_session(self, session_uuid):
+        """
+        :param session_uuid: UUID of the session.
+        :type session_uuid: collections.Hashable
+
+        :return: If a state is stored for the given session UUID.
+        :rtype: bool
+        """
+
+    @abc.abstractmethod
+    def version(self, session_uuid):
+        """
+        :param session_uuid: UUID of the session.
+        :type session_uuid: collections.Hashable
+
+        :return: Version of the state stored for the given session, or None if
+            no state is stored for it.
+        :rtype: None | int
+        """
+
+    @abc.abstractmethod
+    def get_state(self, session_uuid):
+        """
+        Get the state stored for a session.
+
+        :raises KeyError: No state stored for the given session UUID.
+
+        :param session_uuid: UUID of the session.
+        :type session_uuid: collections.Hashable
+
+        :return: Stored state and its version.
+        :rtype: (dict, int)
+        """
+
+    @abc.abstractmethod
+    def store_state(self, session_uuid, state):
+        """
+        Store, or replace, the state for a session.
+
+        :param session_uuid: UUID of the session.
+        :type session_uuid: collections.Hashable
+
+        :param state: Session state to store.
+        :type state: dict
+
+        :return: New version of the stored state.
+        :rtype: int
+        """
+
+    @abc.abstractmethod
+    def remove_state(self, session_uuid):
+        """
+        Remove the state stored for a session.
+
+        :raises KeyError: No state stored for the given session UUID.
+
+        :param session_uuid: UUID of the session.
+        :type session_uuid: collections.Hashable
+        """
+
+
+def get_iqr_session_store_impls(reload_modules=False):
+    """
+    Discover and return discovered ``IqrSessionStore`` classes. Keys in the
+    returned map are the names of the discovered classes, and the paired values
+    are the actual class type objects.
+
+    We search for implementation classes in:
+        - modules next to this file this function is defined in (ones that begin
+          with an alphanumeric character),
+        - python modules listed in the environment variable
+          ``IQR_SESSION_STORE_PATH``
+            - This variable should contain a sequence of python module
+              specifications, separated by the platform specific PATH separator
+              character (``;`` for Windows, ``:`` for unix)
+
+    Within a module we first look for a helper variable by the name
+    ``IQR_SESSION_STORE_CLASS``, which can either be a single class object or an
+    iterable of class objects, to be specifically exported. If the variable is
+    set to None, we skip that module and do not import anything. If the
+    variable is not present, we look at attributes defined in that module for
+    classes that descend from the given base class type. If none of the above
+    are found, or if an exception occurs, the module is skipped.
+
+    :param reload_modules: Explicitly reload discovered modules from source.
+    :type reload_modules: bool
+
+    :return: Map of discovered class object of type ``IqrSessionStore`` whose
+        keys are the string names of the classes.
+    :rtype: dict[str, type]
+
+    """
+    this_dir = osp.abspath(osp.dirname(__file__))
+    env_var = 'IQR_SESSION_STORE_PATH'
+    helper_var = 'IQR_SESSION_STORE_CLASS'
+    return plugin.get_plugins(__name__, this_dir, env_var, helper_var,
+                              IqrSessionStore, reload_modules=reload_modules)
@@ -0,0 +1,65 @@
+import copy
+import threading
+
+from smqtk.iqr.session_store import IqrSessionStore
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+class MemoryIqrSessionStore (IqrSessionStore):
+    """
+    In-memory session state store.
+
+    States are not shared outside of the current process, so this is only
+    useful for bounding the memory used by a single process through session
+    eviction, or for testing.
+    """
+
+    @classmethod
+    def is_usable(cls):
+        # no dependencies
+        return True
+
+    def __init__(self):
+        super(MemoryIqrSessionStore, self).__init__()
+        self._lock = threading.Lock()
+        # Map of session UUID to (state, version)
+        #: :type: dict[collections.Hashable, (dict, int)]
+        self._states = {}
+
+    def get_config(self):
+        return {}
+
+    def session_uuids(self):
+        with self._lock:
+            return tuple(self._states)
+
+    def has_session(self, session_uuid):
+        with self._lock:
+            return session_uuid in self._states
+
+    def version(self, session_uuid):
+        with self._lock:
+            if session_uuid in self._states:
+                return self._states[session_uuid][1]
+            return None
+
+    def get_state(self, session_uuid):
+        with self._lock:
+            state, version = self._states[session_uuid]
+        return copy.deepcopy(state), version
+
+    def store_state(self, session_uuid, state):
+        state = copy.deepcopy(state)
+        with self._lock:
+            version = self._states.get(session_uuid, (None, 0))[1] + 1
+            self._states[session_uuid] = (state, version)
+            return version
+
+    def remove_state(self, session_uuid):
+        with self._lock:
+            del self._states[session_uuid]
+
+
+IQR_SESSION_STORE_CLASS = MemoryIqrSessionStore
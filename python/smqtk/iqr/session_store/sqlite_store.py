@@ -0,0 +1,133 @@
+import cPickle
+import os.path as osp
+import sqlite3
+
+from smqtk.iqr.session_store import IqrSessionStore
+from smqtk.utils import file_utils
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+class SqliteIqrSessionStore (IqrSessionStore):
+    """
+    Session state store backed by a local SQLite database file.
+
+    The database may be shared by multiple processes on the same host, e.g.
+    multiple ``IqrService`` worker processes behind a load balancer. States are
+    stored as pickled BLOBs. A new connection is made for each operation, so
+    instances are safe to use from multiple threads.
+    """
+
+    TABLE_NAME = "iqr_session_state"
+
+    @classmethod
+    def is_usable(cls):
+        # sqlite3 is part of the standard library
+        return True
+
+    def __init__(self, db_filepath, timeout=30.0, pickle_protocol=-1):
+        """
+        :param db_filepath: Path to the SQLite database file. The file and its
+            parent directories are created if they do not exist.
+        :type db_filepath: str
+
+        :param timeout: Seconds to wait for another connection's lock on the
+            database to be released before raising an exception.
+        :type timeout: float
+
+        :param pickle_protocol: Pickling protocol to use when serializing
+            states.
+        :type pickle_protocol: int
+
+        """
+        super(SqliteIqrSessionStore, self).__init__()
+        self.db_filepath = db_filepath
+        self.timeout = float(timeout)
+        self.pickle_protocol = pickle_protocol
+
+        file_utils.safe_create_dir(osp.dirname(osp.abspath(db_filepath)))
+        self._query("CREATE TABLE IF NOT EXISTS %s ("
+                    "  sid TEXT PRIMARY KEY,"
+                    "  version INTEGER NOT NULL,"
+                    "  state BLOB NOT NULL"
+                    ")")
+
+    def get_config(self):
+        return {
+            "db_filepath": self.db_filepath,
+            "timeout": self.timeout,
+            "pickle_protocol": self.pickle_protocol,
+        }
+
+    def _connection(self):
+        """
+        :return: New database connection.
+        :rtype: sqlite3.Connection
+        """
+        return sqlite3.connect(self.db_filepath, timeout=self.timeout)
+
+    def _query(self, sql, params=()):
+        """
+        Execute a single statement in its own transaction, formatting the table
+        name into the given SQL.
+
+        :return: Result rows.
+        :rtype: list[tuple]
+        """
+        conn = self._connection()
+        try:
+            with conn:
+                return conn.execute(sql % self.TABLE_NAME, params).fetchall()
+        finally:
+            conn.close()
+
+    def session_uuids(self):
+        return tuple(r[0] for r in self._query("SELECT sid FROM %s"))
+
+    def has_session(self, session_uuid):
+        return self.version(session_uuid) is not None
+
+    def version(self, session_uuid):
+        r = self._query("SELECT version FROM %s WHERE sid = ?",
+                        (session_uuid,))
+        return r[0][0] if r else None
+
+    def get_state(self, session_uuid):
+        r = self._query("SELECT state, version FROM %s WHERE sid = ?",
+                        (session_uuid,))
+        if not r:
+            raise KeyError(session_uuid)
+        return cPickle.loads(str(r[0][0])), r[0][1]
+
+    def store_state(self, session_uuid, state):
+        b = sqlite3.Binary(cPickle.dumps(state, self.pickle_protocol))
+        conn = self._connection()
+        try:
+            with conn:
+                # Take the write lock up front so that concurrent writers
+                # produce distinct versions.
+                conn.execute("BEGIN IMMEDIATE")
+                r = conn.execute("SELECT version FROM %s WHERE sid = ?"
+                                 % self.TABLE_NAME, (session_uuid,)).fetchall()
+                version = (r[0][0] if r else 0) + 1
+                conn.execute("INSERT OR REPLACE INTO %s (sid, version, state) "
+                             "VALUES (?, ?, ?)" % self.TABLE_NAME,
+                             (session_uuid, version, b))
+            return version
+        finally:
+            conn.close()
+
+    def remove_state(self, session_uuid):
+        conn = self._connection()
+        try:
+            with conn:
+                c = conn.execute("DELETE FROM %s WHERE sid = ?"
+                                 % self.TABLE_NAME, (session_uuid,))
+                if not c.rowcount:
+                    raise KeyError(session_uuid)
+        finally:
+            conn.close()
+
+
+IQR_SESSION_STORE_CLASS = SqliteIqrSessionStore
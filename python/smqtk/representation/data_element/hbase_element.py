@@ -1,3 +1,5 @@
+import threading
+
 from smqtk.representation import DataElement
 
 
@@ -15,16 +17,99 @@ except ImportError:
     tika_detector = None
 
 
+# Number of connections held open per HBase server address by the shared
+# connection pools.
+CONNECTION_POOL_SIZE = 4
+
+# Shared connection pools, keyed by (hbase_address, timeout). Pools are created
+# lazily on first use.
+#: :type: dict[(str, int), happybase.ConnectionPool]
+_CONNECTION_POOLS = {}
+_CONNECTION_POOLS_LOCK = threading.Lock()
+
+
+def get_connection_pool(hbase_address, timeout):
+    """
+    Get the shared connection pool for the given HBase server address and
+    timeout, creating it if this is the first request for it.
+
+    :param hbase_address: Address of the HBase server.
+    :type hbase_address: str
+
+    :param timeout: Connection timeout in milliseconds.
+    :type timeout: int
+
+    :return: Shared connection pool instance.
+    :rtype: happybase.ConnectionPool
+
+    """
+    key = (hbase_address, int(timeout))
+    with _CONNECTION_POOLS_LOCK:
+        if key not in _CONNECTION_POOLS:
+            _CONNECTION_POOLS[key] = happybase.ConnectionPool(
+                CONNECTION_POOL_SIZE, host=hbase_address, timeout=int(timeout)
+            )
+        return _CONNECTION_POOLS[key]
+
+
 class HBaseDataElement (DataElement):
     """
     Wrapper for binary data contained on an HBase server somewhere. Uses Tika
     content type detection to determine content type of served data.
+
+    Connections to the HBase server are drawn from a pool shared between all
+    elements referencing the same server address, and many elements may be
+    fetched with a single multi-row request using ``get_many_bytes``.
     """
 
     @classmethod
     def is_usable(cls):
         return None not in {happybase, tika_detector}
 
+    @classmethod
+    def get_many_bytes(cls, elements):
+        """
+        Fetch the bytes of many HBase data elements, batching elements that
+        share a server, table and column into single multi-row requests.
+
+        Content types for elements whose type has not yet been determined are
+        detected from the fetched bytes and cached on the elements so that a
+        later ``content_type()`` call does not re-fetch the row.
+
+        :raises KeyError: A requested row or column was not found in its
+            table.
+
+        :param elements: Iterable of HBase data elements to fetch bytes for.
+        :type elements: collections.Iterable[HBaseDataElement]
+
+        :return: List of bytes, in the same order as the given elements.
+        :rtype: list[bytes]
+
+        """
+        elements = list(elements)
+
+        # Group element indices by where their data lives.
+        #: :type: dict[(str, int, str, str), list[int]]
+        groups = {}
+        for i, e in enumerate(elements):
+            k = (e.hbase_address, e.timeout, e.hbase_table, e.binary_column)
+            groups.setdefault(k, []).append(i)
+
+        results = [None] * len(elements)
+        for (address, timeout, table_name, column), indices in \
+                groups.iteritems():
+            keys = [elements[i].element_key for i in indices]
+            with get_connection_pool(address, timeout).connection() as conn:
+                rows = dict(conn.table(table_name).rows(keys,
+                                                        columns=[column]))
+            for i in indices:
+                e = elements[i]
+                b = rows[e.element_key][column]
+                if e._binary_ct_cache is None:
+                    e._binary_ct_cache = tika_detector.from_buffer(b)
+                results[i] = b
+        return results
+
     def __init__(self, element_key, binary_column, hbase_address,
                  hbase_table, timeout=10000):
         """
@@ -67,17 +152,19 @@ class HBaseDataElement (DataElement):
 
     def content_type(self):
         if self._binary_ct_cache is None:
-            self._binary_ct_cache = tika_detector.from_buffer(self.get_bytes())
+            # get_bytes fills in the content type cache on fetch.
+            self.get_bytes()
         return self._binary_ct_cache
 
-    def _new_hbase_table_connection(self):
-        return happybase.Connection(self.hbase_address, timeout=self.timeout)\
-            .table(self.hbase_table)
-
     def get_bytes(self):
-        table = self._new_hbase_table_connection()
-        r = table.row(self.element_key, columns=[self.binary_column])
-        return r[self.binary_column]
+        pool = get_connection_pool(self.hbase_address, self.timeout)
+        with pool.connection() as conn:
+            r = conn.table(self.hbase_table)\
+                .row(self.element_key, columns=[self.binary_column])
+        b = r[self.binary_column]
+        if self._binary_ct_cache is None:
+            self._binary_ct_cache = tika_detector.from_buffer(b)
+        return b
 
 
 DATA_ELEMENT_CLASS = HBaseDataElement
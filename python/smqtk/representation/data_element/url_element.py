@@ -1,7 +1,17 @@
+import collections
+import hashlib
 import mimetypes
+import os
+import os.path as osp
+import tempfile
+import threading
+
 import requests
+import requests.adapters
 
 from smqtk.representation import DataElement
+from smqtk.utils import file_utils
+from smqtk.utils.parallel import parallel_map
 
 
 __author__ = "paul.tunison@kitware.com"
@@ -9,10 +19,201 @@ __author__ = "paul.tunison@kitware.com"
 
 MIMETYPES = mimetypes.MimeTypes()
 
+# Maximum number of pooled connections kept per host by the shared session.
+SESSION_POOL_SIZE = 16
+
+
+def _new_session():
+    """
+    :return: New requests session with a connection pool sized for concurrent
+        use by bulk fetches.
+    :rtype: requests.Session
+    """
+    s = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=SESSION_POOL_SIZE,
+                                            pool_maxsize=SESSION_POOL_SIZE)
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+    return s
+
+
+# Session shared by all URL elements in this process so that TCP/TLS
+# connections to the same host are reused between requests.
+SESSION = _new_session()
+
+
+class UrlBytesCache (object):
+    """
+    Bounded, thread-safe LRU cache of URL content keyed on URL and the ETag
+    the server reported for that content.
+
+    Content is kept in memory unless a cache directory is given, in which case
+    content is written to files in that directory and only the index is held in
+    memory. The least recently used entries are evicted once the total size of
+    cached content exceeds ``max_bytes``.
+    """
+
+    def __init__(self, max_bytes, cache_dir=None):
+        """
+        :param max_bytes: Maximum total number of content bytes to cache.
+        :type max_bytes: int
+
+        :param cache_dir: Optional directory to store cached content in. If
+            None, content is cached in memory.
+        :type cache_dir: None | str
+
+        """
+        self.max_bytes = int(max_bytes)
+        self.cache_dir = cache_dir
+        if self.cache_dir:
+            file_utils.safe_create_dir(self.cache_dir)
+
+        self._lock = threading.Lock()
+        # Map of URL to (etag, size, bytes or filepath), in least to most
+        # recently used order.
+        #: :type: collections.OrderedDict[str, (str, int, str)]
+        self._entries = collections.OrderedDict()
+        self._total_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def _entry_filepath(self, url, etag):
+        return osp.join(self.cache_dir,
+                        hashlib.sha1(url + '\0' + etag).hexdigest())
+
+    def _remove(self, url):
+        """ Remove an entry. ASSUMING lock is already held. """
+        _, size, value = self._entries.pop(url)
+        self._total_bytes -= size
+        if self.cache_dir and osp.isfile(value):
+            os.remove(value)
+
+    def etag(self, url):
+        """
+        :param url: URL to get the cached ETag of.
+        :type url: str
+
+        :return: ETag of the content cached for the URL, or None if nothing is
+            cached for it.
+        :rtype: None | str
+        """
+        with self._lock:
+            if url in self._entries:
+                return self._entries[url][0]
+            return None
+
+    def get(self, url, etag):
+        """
+        :param url: URL of the content.
+        :type url: str
+
+        :param etag: ETag the content must have been cached with.
+        :type etag: str
+
+        :return: Cached bytes, or None if there is no entry for the given URL
+            and ETag.
+        :rtype: None | bytes
+        """
+        with self._lock:
+            if url not in self._entries or self._entries[url][0] != etag:
+                return None
+            entry = self._entries.pop(url)
+            self._entries[url] = entry
+            value = entry[2]
+        if self.cache_dir:
+            try:
+                with open(value, 'rb') as f:
+                    return f.read()
+            except IOError:
+                return None
+        return value
+
+    def store(self, url, etag, b):
+        """
+        Cache content for a URL and ETag, replacing any previous entry for the
+        URL. Content larger than the cache bound is not stored.
+
+        :param url: URL of the content.
+        :type url: str
+
+        :param etag: ETag the server reported for the content.
+        :type etag: str
+
+        :param b: Content bytes.
+        :type b: bytes
+        """
+        size = len(b)
+        if size > self.max_bytes:
+            return
+        value = b
+        if self.cache_dir:
+            # Written to a temporary file outside of the lock, then renamed
+            # into place with the index update.
+            value = self._entry_filepath(url, etag)
+            fd, tmp_fp = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(b)
+        with self._lock:
+            if url in self._entries:
+                if self.cache_dir and self._entries[url][2] == value:
+                    # Same file, replaced by the rename below.
+                    self._total_bytes -= self._entries.pop(url)[1]
+                else:
+                    self._remove(url)
+            if self.cache_dir:
+                os.rename(tmp_fp, value)
+            self._entries[url] = (etag, size, value)
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            for url in list(self._entries):
+                self._remove(url)
+
+
+# Optional process-wide content cache used by URL elements. Disabled when None.
+#: :type: None | UrlBytesCache
+BYTES_CACHE = None
+
+
+def set_bytes_cache(max_bytes, cache_dir=None):
+    """
+    Enable (or replace) the content cache shared by all ``DataUrlElement``
+    instances in this process.
+
+    :param max_bytes: Maximum total number of content bytes to cache. If this
+        is 0 or less, caching is disabled.
+    :type max_bytes: int
+
+    :param cache_dir: Optional directory to store cached content in instead of
+        memory.
+    :type cache_dir: None | str
+
+    """
+    global BYTES_CACHE
+    if max_bytes <= 0:
+        BYTES_CACHE = None
+    else:
+        BYTES_CACHE = UrlBytesCache(max_bytes, cache_dir)
+
 
 class DataUrlElement (DataElement):
     """
     Representation of data loadable via a web URL address.
+
+    Requests are issued through a session shared by all URL elements. The
+    content type is determined from the headers of the request made when the
+    element is constructed, so it does not require downloading the content. If
+    a process-wide bytes cache has been enabled via ``set_bytes_cache``, content
+    is validated against the server with a conditional request and only
+    re-downloaded when the server's ETag changes.
     """
 
     @classmethod
@@ -20,7 +221,7 @@ class DataUrlElement (DataElement):
         # have to be able to connect to the internet
         try:
             # using github because that's where this repo has been hosted.
-            r = requests.get('http://github.com')
+            r = SESSION.get('http://github.com')
             _ = r.content
             return True
         except Exception, ex:
@@ -30,10 +231,34 @@ class DataUrlElement (DataElement):
             )
             return False
 
+    @classmethod
+    def get_many_bytes(cls, elements, cores=None):
+        """
+        Fetch the bytes of many URL elements concurrently.
+
+        :raises requests.exceptions.HTTPError: Error during request for data
+            via GET.
+
+        :param elements: Iterable of URL data elements to fetch bytes for.
+        :type elements: collections.Iterable[DataUrlElement]
+
+        :param cores: Number of threads to fetch with. If None, we use the
+            number of cores on this machine.
+        :type cores: None | int
+
+        :return: List of bytes, in the same order as the given elements.
+        :rtype: list[bytes]
+
+        """
+        return list(parallel_map(lambda e: e.get_bytes(), elements,
+                                 cores=cores, ordered=True,
+                                 use_multiprocessing=False,
+                                 name="DataUrlElement.get_many_bytes"))
+
     def __init__(self, url_address):
         """
         :raises requests.exceptions.HTTPError: URL address provided does not
-            resolve into a valid GET request.
+            resolve into a valid request.
 
         :param url_address: Web address of element
         :type url_address: str
@@ -47,8 +272,28 @@ class DataUrlElement (DataElement):
         if not (self._url[:7] == "http://" or self._url[:8] == "https://"):
             self._url = "http://" + self._url
 
-        # Check that the URL is valid, i.e. actually points to something
-        requests.get(self._url).raise_for_status()
+        # Check that the URL is valid, i.e. actually points to something,
+        # recording the content type while we have the headers.
+        self._content_type = self._head().headers.get('content-type')
+
+    def _head(self):
+        """
+        Request headers for our URL without downloading the content. Falls back
+        to a streamed GET, whose content is not read, if the server does not
+        support HEAD requests.
+
+        :raises requests.exceptions.HTTPError: URL does not resolve into a
+            valid request.
+
+        :return: Response object
+        :rtype: requests.Response
+        """
+        r = SESSION.head(self._url, allow_redirects=True)
+        if r.status_code in (405, 501):
+            r = SESSION.get(self._url, stream=True)
+            r.close()
+        r.raise_for_status()
+        return r
 
     def get_config(self):
         return {
@@ -61,7 +306,9 @@ class DataUrlElement (DataElement):
             the content type is unknown.
         :rtype: str or None
         """
-        return requests.get(self._url).headers['content-type']
+        if self._content_type is None:
+            self._content_type = self._head().headers.get('content-type')
+        return self._content_type
 
     def get_bytes(self):
         """
@@ -72,14 +319,31 @@ class DataUrlElement (DataElement):
             via GET.
 
         """
+        cache = BYTES_CACHE
+        headers = {}
+        cached_etag = cache.etag(self._url) if cache is not None else None
+        if cached_etag:
+            headers['If-None-Match'] = cached_etag
+
         # Fetch content from URL, return bytes
-        r = requests.get(self._url)
+        r = SESSION.get(self._url, headers=headers)
+        if r.status_code == 304:
+            b = cache.get(self._url, cached_etag)
+            if b is not None:
+                return b
+            # Cache entry evicted between checks, fetch unconditionally.
+            r = SESSION.get(self._url)
         r.raise_for_status()
-        if r.ok:
-            return r.content
-        else:
+        if not r.ok:
             raise RuntimeError("Request response not OK. Status code returned: "
                                "%d", r.status_code)
 
+        if r.headers.get('content-type'):
+            self._content_type = r.headers['content-type']
+        etag = r.headers.get('etag')
+        if cache is not None and etag:
+            cache.store(self._url, etag, r.content)
+        return r.content
+
 
 DATA_ELEMENT_CLASS = DataUrlElement
@@ -1,4 +1,7 @@
 import cPickle
+import os
+import shutil
+import tempfile
 import unittest
 
 import multiprocessing
@@ -6,7 +9,10 @@ import multiprocessing.pool
 import nose.tools as ntools
 import numpy
 
-from smqtk.algorithms.classifier.libsvm import LibSvmClassifier
+from smqtk.algorithms.classifier.libsvm import \
+    LibSvmClassifier, \
+    histogram_intersection_kernel, \
+    linear_kernel
 from smqtk.representation import \
     ClassificationElementFactory, \
     DescriptorElementFactory
@@ -16,6 +22,25 @@ from smqtk.representation.descriptor_element.local_elements import \
     DescriptorMemoryElement
 
 
+class TestPrecomputedKernels (unittest.TestCase):
+
+    def test_histogram_intersection_kernel(self):
+        a = numpy.array([[1., 0., 2.], [0., 3., 1.]])
+        b = numpy.array([[1., 1., 1.]])
+        numpy.testing.assert_array_equal(
+            histogram_intersection_kernel(a, b), [[2.], [2.]]
+        )
+        numpy.testing.assert_array_equal(
+            histogram_intersection_kernel(a, a), [[3., 1.], [1., 4.]]
+        )
+
+    def test_symmetric_matches_general(self):
+        a = numpy.random.rand(7, 4)
+        numpy.testing.assert_allclose(histogram_intersection_kernel(a, a),
+                                      histogram_intersection_kernel(a, a.copy()))
+        numpy.testing.assert_allclose(linear_kernel(a, a), a.dot(a.T))
+
+
 if LibSvmClassifier.is_usable():
 
     class TestLibSvmClassifier (unittest.TestCase):
@@ -325,3 +350,123 @@ if LibSvmClassifier.is_usable():
             # Closing resources
             p.close()
             p.join()
+
+        def _make_split_descriptors(self, x, start=0):
+            d_factory = DescriptorElementFactory(DescriptorMemoryElement, {})
+            d_pos = []
+            d_neg = []
+            for i, v in enumerate(x, start):
+                d = d_factory.new_descriptor('test', i)
+                d.set_vector(v)
+                if v[1] <= 0.45:
+                    d_pos.append(d)
+                elif v[1] >= 0.55:
+                    d_neg.append(d)
+            return d_pos, d_neg
+
+        def test_invalid_precomputed_kernel(self):
+            ntools.assert_raises(ValueError, LibSvmClassifier,
+                                 precomputed_kernel='not-a-kernel')
+
+        def test_precomputed_kernel_classification(self):
+            N = 500
+            c_factory = ClassificationElementFactory(MemoryClassificationElement, {})
+            classifier = LibSvmClassifier(
+                train_params={'-c': 2, '-q': ''},
+                normalize=None,
+                precomputed_kernel='linear',
+            )
+            d_pos, d_neg = self._make_split_descriptors(numpy.random.rand(N, 2))
+            classifier.train({'positive': d_pos, 'negative': d_neg})
+            ntools.assert_true(classifier.has_model())
+            # Only support vectors are kept.
+            ntools.assert_equal(len(classifier.svm_sv_vectors),
+                                classifier.svm_model.l)
+            ntools.assert_less(len(classifier.svm_sv_vectors),
+                               len(d_pos) + len(d_neg))
+
+            t_pos, t_neg = self._make_split_descriptors(
+                numpy.random.rand(N, 2), N
+            )
+            for label, ds in (('positive', t_pos), ('negative', t_neg)):
+                for d in ds:
+                    c = classifier.classify(d, c_factory)
+                    ntools.assert_equal(c.max_label(), label)
+
+            # Support vectors preserved across pickling.
+            p_state = classifier.__getstate__()
+            ntools.assert_in('__LOCAL_SV__', p_state)
+            classifier2 = cPickle.loads(cPickle.dumps(classifier))
+            for d in t_pos[:10] + t_neg[:10]:
+                ntools.assert_almost_equal(
+                    classifier.classify(d, c_factory)['positive'],
+                    classifier2.classify(d, c_factory)['positive'],
+                    5
+                )
+
+        def test_precomputed_kernel_model_files(self):
+            work_dir = tempfile.mkdtemp()
+            try:
+                config = {
+                    'svm_model_fp': os.path.join(work_dir, 'model'),
+                    'svm_label_map_fp': os.path.join(work_dir, 'labels'),
+                    'train_params': {'-q': ''},
+                    'normalize': None,
+                    'precomputed_kernel': 'histogram_intersection',
+                    'kernel_cache_dir': None,
+                }
+                classifier = LibSvmClassifier(**config)
+                d_pos, d_neg = self._make_split_descriptors(
+                    numpy.random.rand(200, 2)
+                )
+                classifier.train({'positive': d_pos, 'negative': d_neg})
+                ntools.assert_true(
+                    os.path.isfile(os.path.join(work_dir, 'model.sv.npy'))
+                )
+
+                classifier2 = LibSvmClassifier.from_config(config)
+                ntools.assert_true(classifier2.has_model())
+                numpy.testing.assert_array_equal(classifier2.svm_sv_vectors,
+                                                 classifier.svm_sv_vectors)
+            finally:
+                shutil.rmtree(work_dir)
+
+        def test_precomputed_kernel_cache(self):
+            cache_dir = tempfile.mkdtemp()
+            try:
+                classifier = LibSvmClassifier(
+                    train_params={'-q': ''},
+                    normalize=None,
+                    precomputed_kernel='histogram_intersection',
+                    kernel_cache_dir=cache_dir,
+                )
+                d_pos, d_neg = self._make_split_descriptors(
+                    numpy.random.rand(200, 2)
+                )
+                classifier.cache_kernel(d_pos + d_neg)
+                ntools.assert_equal(len(os.listdir(cache_dir)), 2)
+
+                # Training on a subset extracts the sub-matrix from the cached
+                # kernel instead of computing and caching a new one.
+                sub = d_neg[::2] + d_pos[::2]
+                uuids = [d.uuid() for d in sub]
+                x = numpy.array([d.vector() for d in sub])
+                numpy.testing.assert_allclose(
+                    classifier._training_kernel(uuids, x),
+                    histogram_intersection_kernel(x, x)
+                )
+                classifier.train({'positive': d_pos[::2],
+                                  'negative': d_neg[::2]})
+                ntools.assert_equal(len(os.listdir(cache_dir)), 2)
+
+                # A different kernel does not use the cached matrix.
+                classifier2 = LibSvmClassifier(
+                    train_params={'-q': ''},
+                    normalize=None,
+                    precomputed_kernel='linear',
+                    kernel_cache_dir=cache_dir,
+                )
+                classifier2.train({'positive': d_pos, 'negative': d_neg})
+                ntools.assert_equal(len(os.listdir(cache_dir)), 4)
+            finally:
+                shutil.rmtree(cache_dir)
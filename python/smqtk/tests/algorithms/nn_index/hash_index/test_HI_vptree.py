@@ -0,0 +1,102 @@
+import os
+import tempfile
+import unittest
+
+import mock
+import nose.tools
+import numpy
+
+from smqtk.algorithms.nn_index.hash_index.vptree import VPTreeHashIndex
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+class TestVPTreeHashIndex (unittest.TestCase):
+
+    def test_file_cache_type(self):
+        # Requites .npz file
+        nose.tools.assert_raises(
+            ValueError,
+            VPTreeHashIndex,
+            file_cache='some_file.txt'
+        )
+
+        VPTreeHashIndex(file_cache='some_file.npz')
+
+    @mock.patch('smqtk.algorithms.nn_index.hash_index.vptree.numpy.savez')
+    def test_save_model_no_cache(self, m_savez):
+        vpt = VPTreeHashIndex()
+        m = numpy.random.randint(0, 2, 1000 * 256).reshape(1000, 256)
+        vpt.build_index(m)
+        nose.tools.assert_false(m_savez.called)
+
+    def test_matches_exhaustive(self):
+        rng = numpy.random.RandomState(0)
+        m = rng.randint(0, 2, 2000 * 70).reshape(2000, 70).astype(bool)
+        # Small leaves to exercise pruning in a deep tree.
+        vpt = VPTreeHashIndex(leaf_size=8, random_seed=0)
+        vpt.build_index(m)
+        nose.tools.assert_equal(vpt.count(), 2000)
+        nose.tools.assert_equal(vpt.codes.shape, (2000, 2))
+        for q in rng.randint(0, 2, 10 * 70).reshape(10, 70).astype(bool):
+            neighbors, dists = vpt.nn(q, 10)
+            expected = numpy.sort((m != q).sum(axis=1))[:10] / 70.
+            numpy.testing.assert_allclose(dists, expected)
+            numpy.testing.assert_allclose((neighbors != q).sum(axis=1) / 70.,
+                                          dists)
+
+        # Indexed codes are their own nearest neighbors.
+        neighbors, dists = vpt.nn(m[42], 1)
+        numpy.testing.assert_equal(neighbors[0], m[42])
+        nose.tools.assert_equal(dists[0], 0.)
+
+    def test_n_larger_than_count(self):
+        m = numpy.eye(4, dtype=bool)
+        vpt = VPTreeHashIndex(leaf_size=1)
+        vpt.build_index(m)
+        neighbors, dists = vpt.nn(m[2], 10)
+        nose.tools.assert_equal(len(neighbors), 4)
+        numpy.testing.assert_equal(neighbors[0], m[2])
+        numpy.testing.assert_allclose(dists, [0., .5, .5, .5])
+
+    def test_model_reload(self):
+        fd, fp = tempfile.mkstemp('.npz')
+        os.close(fd)
+        os.remove(fp)  # shouldn't exist before construction
+        try:
+            vpt = VPTreeHashIndex(fp, leaf_size=16)
+            m = numpy.random.randint(0, 2, 1000 * 256).reshape(1000, 256)
+            vpt.build_index(m)
+            q = numpy.random.randint(0, 2, 256).astype(bool)
+            vpt_neighbors, vpt_dists = vpt.nn(q, 10)
+
+            vpt2 = VPTreeHashIndex(fp, leaf_size=16)
+            vpt2_neighbors, vpt2_dists = vpt2.nn(q, 10)
+
+            nose.tools.assert_is_not(vpt, vpt2)
+            nose.tools.assert_equal(vpt2.bits, 256)
+            numpy.testing.assert_equal(vpt2.codes, vpt.codes)
+            numpy.testing.assert_equal(vpt2_neighbors, vpt_neighbors)
+            numpy.testing.assert_equal(vpt2_dists, vpt_dists)
+        finally:
+            os.remove(fp)
+
+    def test_invalid_build(self):
+        vpt = VPTreeHashIndex()
+        nose.tools.assert_raises(
+            ValueError,
+            vpt.build_index,
+            []
+        )
+
+    def test_get_config(self):
+        vpt = VPTreeHashIndex()
+        vpt_c = vpt.get_config()
+
+        nose.tools.assert_equal(len(vpt_c), 3)
+        nose.tools.assert_in('file_cache', vpt_c)
+        nose.tools.assert_in('leaf_size', vpt_c)
+        nose.tools.assert_in('random_seed', vpt_c)
+
+        nose.tools.assert_equal(vpt_c['file_cache'], None)
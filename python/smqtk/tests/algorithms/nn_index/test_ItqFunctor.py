@@ -0,0 +1,136 @@
+import unittest
+
+import mock
+import nose.tools as ntools
+import numpy
+
+from smqtk.algorithms.nn_index.lsh.functors.itq import ItqFunctor
+from smqtk.representation.descriptor_element.local_elements import \
+    DescriptorMemoryElement
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+class TestItqFunctorStreamingFit (unittest.TestCase):
+
+    RANDOM_SEED = 0
+
+    @classmethod
+    def setUpClass(cls):
+        numpy.random.seed(cls.RANDOM_SEED)
+        # Correlated data so that principal components are well separated.
+        v = numpy.random.randn(103, 8).dot(numpy.random.randn(8, 8)) + 3.
+        cls.descriptors = []
+        for i, r in enumerate(v):
+            d = DescriptorMemoryElement('test', i)
+            d.set_vector(r)
+            cls.descriptors.append(d)
+
+    def _new_functor(self):
+        return ItqFunctor(bit_length=4, itq_iterations=10,
+                          random_seed=self.RANDOM_SEED)
+
+    def test_streaming_matches_in_memory(self):
+        expected = self._new_functor()
+        expected_codes = expected.fit(self.descriptors,
+                                      use_multiprocessing=False)
+
+        f = self._new_functor()
+        codes = f.fit(self.descriptors, use_multiprocessing=False,
+                      chunk_size=10)
+
+        numpy.testing.assert_allclose(f.mean_vec, expected.mean_vec)
+        numpy.testing.assert_allclose(f.rotation, expected.rotation,
+                                      atol=1e-8)
+        numpy.testing.assert_array_equal(codes, expected_codes)
+
+    def test_streaming_covariance(self):
+        # Covariance accumulated in chunks should equal numpy.cov
+        x = numpy.array([d.vector() for d in self.descriptors])
+        f = self._new_functor()
+        with mock.patch.object(ItqFunctor, '_top_principal_components',
+                               wraps=f._top_principal_components) as m:
+            f.fit(self.descriptors, use_multiprocessing=False, chunk_size=7)
+        numpy.testing.assert_allclose(m.call_args[0][0],
+                                      numpy.cov(f._norm_vector(x).T))
+
+    def test_streaming_sample(self):
+        f = self._new_functor()
+        codes = f.fit(iter(self.descriptors), use_multiprocessing=False,
+                      chunk_size=10, sample_size=20)
+        ntools.assert_is_none(codes)
+        ntools.assert_true(f.has_model())
+        ntools.assert_equal(f.rotation.shape, (8, 4))
+        ntools.assert_equal(f.get_hash(self.descriptors[0].vector()).shape,
+                            (4,))
+
+    def test_streaming_sample_larger_than_data(self):
+        f = self._new_functor()
+        f.fit(self.descriptors, use_multiprocessing=False, chunk_size=10,
+              sample_size=1000)
+        ntools.assert_true(f.has_model())
+
+    def test_streaming_one_shot_iterator(self):
+        # Without a sample, a second pass over the descriptors is needed.
+        f = self._new_functor()
+        ntools.assert_raises(ValueError, f.fit, iter(self.descriptors),
+                             use_multiprocessing=False, chunk_size=10)
+
+
+class TestItqFunctorRotation (unittest.TestCase):
+
+    RANDOM_SEED = 0
+
+    def test_top_principal_components(self):
+        numpy.random.seed(self.RANDOM_SEED)
+        x = numpy.random.randn(50, 10).dot(numpy.random.randn(10, 10))
+        c = numpy.cov(x.T)
+        f = ItqFunctor(bit_length=4)
+        pc = f._top_principal_components(c)
+        ntools.assert_equal(pc.shape, (10, 4))
+
+        l, expected = numpy.linalg.eig(c)
+        expected = expected[:, numpy.argsort(l)[::-1][:4]]
+        # Eigen-vectors are only unique up to sign
+        signs = numpy.sign((pc * expected).sum(axis=0))
+        numpy.testing.assert_allclose(pc, expected * signs, atol=1e-8)
+
+    def test_early_stopping(self):
+        numpy.random.seed(self.RANDOM_SEED)
+        v = numpy.random.randn(200, 8)
+
+        f = ItqFunctor(bit_length=8, random_seed=self.RANDOM_SEED,
+                       convergence_tol=1e-3)
+        with mock.patch('numpy.linalg.svd', wraps=numpy.linalg.svd) as m:
+            b, r, n = f._find_itq_rotation(v, 1000)
+        # One call for the initial random rotation plus one per iteration.
+        ntools.assert_less(m.call_count, 1001)
+        ntools.assert_equal(n, m.call_count - 1)
+        numpy.testing.assert_allclose(r.dot(r.T), numpy.eye(8), atol=1e-8)
+        numpy.testing.assert_array_equal(b, v.dot(r) >= 0)
+
+    def test_no_early_stopping(self):
+        numpy.random.seed(self.RANDOM_SEED)
+        v = numpy.random.randn(200, 8)
+
+        f = ItqFunctor(bit_length=8, random_seed=self.RANDOM_SEED,
+                       convergence_tol=0)
+        with mock.patch('numpy.linalg.svd', wraps=numpy.linalg.svd) as m:
+            _, _, n = f._find_itq_rotation(v, 20)
+        ntools.assert_equal(m.call_count, 21)
+        ntools.assert_equal(n, 20)
+
+    def test_quantization_loss_decreases(self):
+        numpy.random.seed(self.RANDOM_SEED)
+        v = numpy.random.randn(200, 8)
+        f = ItqFunctor(bit_length=8, random_seed=self.RANDOM_SEED,
+                       convergence_tol=0)
+
+        def loss(r):
+            z = v.dot(r)
+            return ((numpy.where(z >= 0, 1., -1.) - z) ** 2).sum()
+
+        _, r1, _ = f._find_itq_rotation(v, 1)
+        _, r20, _ = f._find_itq_rotation(v, 20)
+        ntools.assert_less(loss(r20), loss(r1))
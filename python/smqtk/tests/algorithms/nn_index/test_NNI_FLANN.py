@@ -1,18 +1,53 @@
+import cPickle
 import os
 import random
+import shutil
+import tempfile
 import unittest
 
+import mock
 import nose.tools as ntools
 import numpy
 
 from smqtk.representation.descriptor_element.local_elements import \
     DescriptorMemoryElement
+from smqtk.representation.descriptor_index.memory import \
+    MemoryDescriptorIndex
 from smqtk.algorithms import get_nn_index_impls
-from smqtk.algorithms.nn_index.flann import FlannNearestNeighborsIndex
+from smqtk.algorithms.nn_index.flann import FlannNearestNeighborsIndex, \
+    hik_top_k
+from smqtk.utils.metrics import histogram_intersection_distance
 
 __author__ = "paul.tunison@kitware.com"
 
 
+class TestHikTopK (unittest.TestCase):
+
+    def test_matches_exhaustive(self):
+        numpy.random.seed(0)
+        mat = numpy.random.rand(100, 8)
+        mat /= mat.sum(axis=1)[:, numpy.newaxis]
+        queries = mat[[3, 50, 99]]
+        # Small chunks to exercise merging of per-chunk results.
+        idxs, dists = hik_top_k(mat, queries, 10, chunk_bytes=512)
+        ntools.assert_equal(idxs.shape, (3, 10))
+        for q, q_idxs, q_dists in zip(queries, idxs, dists):
+            expected = histogram_intersection_distance(q, mat)
+            numpy.testing.assert_array_equal(q_idxs,
+                                             numpy.argsort(expected)[:10])
+            numpy.testing.assert_allclose(q_dists, expected[q_idxs])
+        numpy.testing.assert_array_equal(idxs[:, 0], [3, 50, 99])
+
+    def test_k_larger_than_rows(self):
+        mat = numpy.eye(4)
+        idxs, dists = hik_top_k(mat, mat[[2]], 10)
+        ntools.assert_equal(idxs.shape, (1, 4))
+        ntools.assert_equal(idxs[0, 0], 2)
+        numpy.testing.assert_allclose(dists[0], [0., 1., 1., 1.])
+        # Ties ordered by row index.
+        numpy.testing.assert_array_equal(idxs[0, 1:], [0, 1, 3])
+
+
 # Don't bother running tests of the class is not usable
 if FlannNearestNeighborsIndex.is_usable():
 
@@ -124,6 +159,7 @@ if FlannNearestNeighborsIndex.is_usable():
             c['descriptor_cache_filepath'] = descr_cache_fp
             c['distance_method'] = 'hik'
             c['random_seed'] = 42
+            c['descriptor_set']['type'] = 'MemoryDescriptorIndex'
 
             # Build based on configuration
             index = FlannNearestNeighborsIndex.from_config(c)
@@ -133,3 +169,101 @@ if FlannNearestNeighborsIndex.is_usable():
 
             c2 = index.get_config()
             ntools.assert_equal(c, c2)
+
+        def test_hik_persistence(self):
+            tmp_dir = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, tmp_dir)
+            kwds = dict(
+                parameters_filepath=os.path.join(tmp_dir, 'params.pickle'),
+                descriptor_cache_filepath=os.path.join(tmp_dir, 'uuids.npy'),
+                distance_method='hik',
+            )
+            test_descriptors = []
+            for i in xrange(10):
+                d = DescriptorMemoryElement('rand', i)
+                # Histograms, so that each is its own nearest neighbor.
+                v = numpy.random.rand(4)
+                d.set_vector(v / v.sum())
+                test_descriptors.append(d)
+            index = FlannNearestNeighborsIndex(**kwds)
+            index.build_index(test_descriptors)
+            ntools.assert_true(os.path.isfile(kwds['descriptor_cache_filepath']))
+
+            # A new instance loads the stored UUIDs and vectors, looking up
+            # elements in its descriptor set.
+            index2 = FlannNearestNeighborsIndex(
+                descriptor_set=index._descriptor_set, **kwds
+            )
+            ntools.assert_equal(index2.count(), 10)
+            ntools.assert_is_instance(index2._descr_matrix, numpy.memmap)
+            q = test_descriptors[4]
+            ntools.assert_equal(index2.nn(q, 3), index.nn(q, 3))
+            ntools.assert_equal(index2.nn(q, 1)[0][0], q)
+
+        def test_reload_from_config(self):
+            tmp_dir = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, tmp_dir)
+            c = FlannNearestNeighborsIndex.get_default_config()
+            c['parameters_filepath'] = os.path.join(tmp_dir, 'params.pickle')
+            c['descriptor_cache_filepath'] = os.path.join(tmp_dir, 'uuids.npy')
+            c['distance_method'] = 'hik'
+            # Persistent descriptor set, as a PostgresDescriptorIndex would be.
+            c['descriptor_set']['type'] = 'MemoryDescriptorIndex'
+            c['descriptor_set']['MemoryDescriptorIndex']['file_cache'] = \
+                os.path.join(tmp_dir, 'descriptors.pickle')
+            test_descriptors = []
+            for i in xrange(10):
+                d = DescriptorMemoryElement('rand', i)
+                # Histograms, so that each is its own nearest neighbor.
+                v = numpy.random.rand(4)
+                d.set_vector(v / v.sum())
+                test_descriptors.append(d)
+            index = FlannNearestNeighborsIndex.from_config(c)
+            index.build_index(test_descriptors)
+
+            # Descriptors are found by new instances from either the original
+            # or the index's own configuration.
+            q = test_descriptors[4]
+            for cfg in (c, index.get_config()):
+                index2 = FlannNearestNeighborsIndex.from_config(cfg)
+                ntools.assert_equal(index2.count(), 10)
+                ntools.assert_equal(index2.nn(q, 3), index.nn(q, 3))
+
+        def test_legacy_descriptor_cache(self):
+            tmp_dir = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, tmp_dir)
+            kwds = dict(
+                parameters_filepath=os.path.join(tmp_dir, 'params.pickle'),
+                descriptor_cache_filepath=os.path.join(tmp_dir, 'cache'),
+                distance_method='hik',
+            )
+            test_descriptors = []
+            for i in xrange(10):
+                d = DescriptorMemoryElement('rand', i)
+                # Histograms, so that each is its own nearest neighbor.
+                v = numpy.random.rand(4)
+                d.set_vector(v / v.sum())
+                test_descriptors.append(d)
+            index = FlannNearestNeighborsIndex(**kwds)
+            index.build_index(test_descriptors)
+            q = test_descriptors[4]
+            expected = index.nn(q, 3)
+            del index
+            # Replace the cache with pickled elements, as previously stored.
+            with open(kwds['descriptor_cache_filepath'], 'wb') as f:
+                cPickle.dump(test_descriptors, f, -1)
+
+            # The default descriptor set is filled from the legacy cache.
+            index2 = FlannNearestNeighborsIndex(**kwds)
+            ntools.assert_equal(index2._descriptor_set.count(), 10)
+            ntools.assert_equal(index2.nn(q, 3), expected)
+
+        def test_default_descriptor_set_warning(self):
+            with mock.patch.object(FlannNearestNeighborsIndex,
+                                   'logger') as m_logger:
+                index = FlannNearestNeighborsIndex(distance_method='hik')
+                ntools.assert_equal(m_logger().warn.call_count, 1)
+            ntools.assert_is_instance(index._descriptor_set,
+                                      MemoryDescriptorIndex)
+            ntools.assert_equal(index._descriptor_set.count(), 0)
+            ntools.assert_is_none(index._descriptor_set.file_cache)
@@ -1,11 +1,14 @@
 from __future__ import absolute_import, division
 from __future__ import print_function, unicode_literals
 
-from six.moves import range, zip
+from six.moves import range, zip, cPickle as pickle
 
 import random
+import shutil
+import tempfile
 import unittest
 
+import mock
 import nose.tools as ntools
 import numpy as np
 
@@ -14,8 +17,10 @@ import os.path as osp
 from smqtk.representation.descriptor_element.local_elements import \
     DescriptorMemoryElement
 from smqtk.algorithms import get_nn_index_impls
-from smqtk.algorithms.nn_index.mrpt import MRPTNearestNeighborsIndex
+from smqtk.algorithms.nn_index.mrpt import MRPTNearestNeighborsIndex, \
+    _build_tree, tune_parameters
 from smqtk.representation.descriptor_index.memory import MemoryDescriptorIndex
+from smqtk.utils import metrics
 from smqtk.utils.errors import ReadOnlyError
 
 
@@ -215,3 +220,300 @@ class TestMRPTIndex (unittest.TestCase):
 
         c2 = index.get_config()
         ntools.assert_equal(c, c2)
+
+    def _random_descriptors(self, n=1000, dim=16):
+        np.random.seed(0)
+        descriptors = [DescriptorMemoryElement('test', 'uuid-%d' % i)
+                       for i in range(n)]
+        [d.set_vector(np.random.rand(dim)) for d in descriptors]
+        return descriptors
+
+    def test_tree_arrays(self):
+        n, depth, num_trees = 100, 3, 4
+        descriptors = self._random_descriptors(n)
+        index = self._make_inst(depth=depth, num_trees=num_trees)
+        index.build_index(descriptors)
+
+        ntools.assert_equal(index._random_bases.shape, (num_trees, 16, depth))
+        ntools.assert_equal(index._splits.shape, (num_trees, 2**depth - 1))
+        ntools.assert_equal(index._leaf_offsets.shape,
+                            (num_trees, 2**depth + 1))
+        ntools.assert_equal(index._leaf_rows.shape, (num_trees, n))
+        ntools.assert_equal(index._leaf_rows.dtype, np.int32)
+        ntools.assert_equal(sorted(index._uuids.tolist()),
+                            sorted(d.uuid() for d in descriptors))
+        for t in range(num_trees):
+            # Every row appears in exactly one leaf of each tree
+            ntools.assert_equal(sorted(index._leaf_rows[t]), list(range(n)))
+            ntools.assert_equal(index._leaf_offsets[t, 0], 0)
+            ntools.assert_equal(index._leaf_offsets[t, -1], n)
+
+    def test_save_load_memory_mapped(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            index_fp = osp.join(tmp_dir, 'index')
+            param_fp = osp.join(tmp_dir, 'params')
+            descriptors = self._random_descriptors()
+            index = self._make_inst(index_filepath=index_fp,
+                                    parameters_filepath=param_fp,
+                                    depth=3, num_trees=5)
+            index.build_index(descriptors)
+            ntools.assert_true(osp.isfile(index_fp))
+            ntools.assert_true(osp.isfile(index_fp + '.rows.npy'))
+            ntools.assert_true(osp.isfile(index_fp + '.uuids.npy'))
+
+            index2 = MRPTNearestNeighborsIndex(
+                index._descriptor_set, index_filepath=index_fp,
+                parameters_filepath=param_fp)
+            ntools.assert_equal(index2._num_trees, 5)
+            ntools.assert_equal(index2._depth, 3)
+            ntools.assert_is_instance(index2._leaf_rows, np.memmap)
+            ntools.assert_is_instance(index2._uuids, np.memmap)
+            ntools.assert_is_instance(index2._vectors, np.memmap)
+            np.testing.assert_equal(index2._splits, index._splits)
+            np.testing.assert_equal(index2._leaf_offsets,
+                                    index._leaf_offsets)
+            np.testing.assert_equal(index2._leaf_rows, index._leaf_rows)
+
+            q = descriptors[0]
+            r1, d1 = index.nn(q, 10)
+            r2, d2 = index2.nn(q, 10)
+            ntools.assert_equal([d.uuid() for d in r1],
+                                [d.uuid() for d in r2])
+            ntools.assert_equal(r2[0].uuid(), q.uuid())
+            np.testing.assert_allclose(d1, d2)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_load_legacy_pickle_index(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            index_fp = osp.join(tmp_dir, 'index')
+            param_fp = osp.join(tmp_dir, 'params')
+            descriptors = self._random_descriptors()
+            index = self._make_inst(index_filepath=index_fp,
+                                    parameters_filepath=param_fp,
+                                    depth=2, num_trees=3)
+            index.build_index(descriptors)
+
+            # Rewrite the index in the previous pickled tree format
+            trees = []
+            for t in range(3):
+                offsets = index._leaf_offsets[t]
+                trees.append({
+                    'random_basis': index._random_bases[t],
+                    'splits': index._splits[t],
+                    'leaves': [
+                        index._uuids[index._leaf_rows[t, b:e]].tolist()
+                        for b, e in zip(offsets[:-1], offsets[1:])
+                    ],
+                })
+            with open(index_fp, 'wb') as f:
+                pickle.dump(trees, f)
+
+            index2 = MRPTNearestNeighborsIndex(
+                index._descriptor_set, index_filepath=index_fp,
+                parameters_filepath=param_fp)
+            ntools.assert_equal(index2._leaf_rows.shape, (3, 1000))
+            q = descriptors[0]
+            ntools.assert_equal([d.uuid() for d in index.nn(q, 10)[0]],
+                                [d.uuid() for d in index2.nn(q, 10)[0]])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_vote_threshold_invalid(self):
+        ntools.assert_raises(ValueError, self._make_inst, num_trees=5,
+                             vote_threshold=0)
+        ntools.assert_raises(ValueError, self._make_inst, num_trees=5,
+                             vote_threshold=6)
+
+    def test_vote_threshold_candidates(self):
+        descriptors = self._random_descriptors()
+        index = self._make_inst(depth=3, num_trees=8)
+        index.build_index(descriptors)
+        q = descriptors[0]
+        leaves = index._query_leaves(q.vector()[np.newaxis])[0]
+
+        # Brute force vote counts over the leaves the query falls in
+        votes = np.zeros(index.count(), int)
+        for t, leaf in enumerate(leaves):
+            b, e = index._leaf_offsets[t, leaf], index._leaf_offsets[t, leaf+1]
+            votes[index._leaf_rows[t, b:e]] += 1
+
+        for v in (1, 3, 8):
+            index._vote_threshold = v
+            np.testing.assert_equal(index._candidate_rows(leaves),
+                                    np.flatnonzero(votes >= v))
+        # A descriptor is in the query's leaf of every tree when querying
+        # with the descriptor itself
+        r, dists = index.nn(q, 5)
+        ntools.assert_equal(r[0].uuid(), q.uuid())
+        ntools.assert_equal(dists[0], 0.)
+
+    def test_nn_batch(self):
+        descriptors = self._random_descriptors()
+        index = self._make_inst(depth=3, num_trees=6, vote_threshold=2)
+        index.build_index(descriptors)
+        queries = descriptors[:7]
+        batch = index.nn_batch(queries, 4)
+        ntools.assert_equal(len(batch), 7)
+        for q, (r, dists) in zip(queries, batch):
+            r_s, dists_s = index.nn(q, 4)
+            ntools.assert_equal([d.uuid() for d in r],
+                                [d.uuid() for d in r_s])
+            np.testing.assert_allclose(dists, dists_s)
+
+    def _check_tree(self, proj, splits, offsets, rows):
+        depth, n = proj.shape
+        ntools.assert_equal(sorted(rows), list(range(n)))
+        ntools.assert_equal(offsets[-1], n)
+        # Leaves are balanced
+        ntools.assert_less_equal(np.ptp(np.diff(offsets)), depth)
+        # Rows of every leaf are on the correct side of each ancestor split
+        for leaf in range(1 << depth):
+            leaf_rows = rows[offsets[leaf]:offsets[leaf + 1]]
+            node = leaf + (1 << depth) - 1
+            for level in reversed(range(depth)):
+                parent = (node - 1) // 2
+                v = proj[level, leaf_rows]
+                if node == 2 * parent + 2:
+                    ntools.assert_true((v >= splits[parent]).all())
+                else:
+                    ntools.assert_true((v <= splits[parent]).all())
+                node = parent
+
+    def test_build_tree(self):
+        np.random.seed(0)
+        depth = 6
+        for n in (1000, 1001, 40, 3):
+            proj = np.random.randn(depth, n).astype(np.float32)
+            rows = np.empty(n, np.int32)
+            splits, offsets = _build_tree(proj, rows)
+            ntools.assert_equal(splits.shape, (2**depth - 1,))
+            ntools.assert_equal(offsets.shape, (2**depth + 1,))
+            self._check_tree(proj, splits, offsets, rows)
+
+            # Partitioning every node separately or sorting all nodes of each
+            # level together results in the same splits.
+            for node_rows in (0, n + 1):
+                with mock.patch('smqtk.algorithms.nn_index.mrpt'
+                                '.PARTITION_NODE_ROWS', node_rows):
+                    rows2 = np.empty(n, np.int32)
+                    splits2, offsets2 = _build_tree(proj, rows2)
+                np.testing.assert_equal(splits2, splits)
+                np.testing.assert_equal(offsets2, offsets)
+                self._check_tree(proj, splits2, offsets2, rows2)
+
+    def test_build_processes(self):
+        descriptors = self._random_descriptors()
+        indexes = []
+        for processes in (1, 3):
+            np.random.seed(0)
+            index = self._make_inst(depth=4, num_trees=5,
+                                    build_processes=processes)
+            index.build_index(descriptors)
+            indexes.append(index)
+        i1, i3 = indexes
+        np.testing.assert_equal(i1._splits, i3._splits)
+        np.testing.assert_equal(i1._leaf_offsets, i3._leaf_offsets)
+        np.testing.assert_equal(i1._leaf_rows, i3._leaf_rows)
+        ntools.assert_equal(i3.get_config()['build_processes'], 3)
+
+    def test_distance_method_invalid(self):
+        ntools.assert_raises(ValueError, self._make_inst,
+                             distance_method='manhattan')
+
+    def test_distance_methods(self):
+        descriptors = self._random_descriptors(500)
+        q = DescriptorMemoryElement('q', 0)
+        q.set_vector(np.random.rand(16))
+        for method, func in (('euclidean', metrics.euclidean_distance),
+                             ('cosine', metrics.cosine_distance),
+                             ('hik', metrics.histogram_intersection_distance)):
+            index = self._make_inst(depth=2, num_trees=4,
+                                    distance_method=method)
+            index.build_index(descriptors)
+            r, dists = index.nn(q, 10)
+            ntools.assert_equal(len(r), 10)
+            np.testing.assert_allclose(
+                dists, [func(d.vector(), q.vector()) for d in r])
+            ntools.assert_equal(list(dists), sorted(dists))
+
+    def test_cosine_scale_invariant(self):
+        descriptors = self._random_descriptors(500)
+        index = self._make_inst(depth=3, num_trees=4,
+                                distance_method='cosine')
+        index.build_index(descriptors)
+        q = DescriptorMemoryElement('q', 0)
+        q.set_vector(descriptors[0].vector())
+        q_scaled = DescriptorMemoryElement('q', 1)
+        q_scaled.set_vector(descriptors[0].vector() * 10)
+        r1, d1 = index.nn(q, 5)
+        r2, d2 = index.nn(q_scaled, 5)
+        ntools.assert_equal([d.uuid() for d in r1], [d.uuid() for d in r2])
+        np.testing.assert_allclose(d1, d2, atol=1e-7)
+
+    def test_distance_method_persisted(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            index_fp = osp.join(tmp_dir, 'index')
+            param_fp = osp.join(tmp_dir, 'params')
+            index = self._make_inst(index_filepath=index_fp,
+                                    parameters_filepath=param_fp,
+                                    depth=2, num_trees=2,
+                                    distance_method='hik')
+            index.build_index(self._random_descriptors(100))
+            index2 = MRPTNearestNeighborsIndex(
+                index._descriptor_set, index_filepath=index_fp,
+                parameters_filepath=param_fp)
+            ntools.assert_equal(index2._distance_method, 'hik')
+            ntools.assert_equal(index2.get_config()['distance_method'], 'hik')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_subset_trees(self):
+        descriptors = self._random_descriptors()
+        np.random.seed(0)
+        index = self._make_inst(depth=3, num_trees=6, build_processes=1)
+        index.build_index(descriptors)
+        view = index._subset_trees(3)
+        ntools.assert_equal(index._num_trees, 6)
+        ntools.assert_equal(view._leaf_rows.shape[0], 3)
+        # Same as building an index from the first three random bases
+        np.random.seed(0)
+        index3 = self._make_inst(depth=3, num_trees=3, build_processes=1)
+        with mock.patch('numpy.random.randn',
+                        lambda *s: index._random_bases[:3].copy()):
+            index3.build_index(descriptors)
+        np.testing.assert_equal(view._splits, index3._splits)
+        q = descriptors[0]
+        ntools.assert_equal([d.uuid() for d in view.nn(q, 5)[0]],
+                            [d.uuid() for d in index3.nn(q, 5)[0]])
+
+    def test_tune_parameters(self):
+        descriptors = self._random_descriptors(500)
+        queries = descriptors[:10]
+        best, results = tune_parameters(
+            descriptors, queries, 5, 0.5, num_trees=(2, 8), depths=(2, 4),
+            vote_thresholds=(1, 4), build_processes=1)
+        # Vote threshold 4 is skipped for 2 trees
+        ntools.assert_equal(len(results), 6)
+        for r in results:
+            ntools.assert_true(0 <= r['recall'] <= 1)
+            ntools.assert_greater(r['query_time'], 0)
+        # Depth 2, 8 trees without voting examines nearly everything
+        r = [r for r in results if (r['depth'], r['num_trees'],
+                                    r['vote_threshold']) == (2, 8, 1)][0]
+        ntools.assert_equal(r['recall'], 1.)
+        ntools.assert_is_not_none(best)
+        ntools.assert_equal(set(best),
+                            {'num_trees', 'depth', 'vote_threshold'})
+        passing = [r for r in results if r['recall'] >= 0.5]
+        ntools.assert_equal(
+            min(passing, key=lambda r: r['query_time'])['num_trees'],
+            best['num_trees'])
+
+        best, _ = tune_parameters(descriptors, queries, 5, 1.1,
+                                  num_trees=(2,), depths=(2,),
+                                  build_processes=1)
+        ntools.assert_is_none(best)
@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 
 import mock
@@ -6,7 +8,8 @@ import numpy
 
 from smqtk.representation.descriptor_element.local_elements import \
     DescriptorMemoryElement
-from smqtk.algorithms.nn_index import NearestNeighborsIndex, get_nn_index_impls
+from smqtk.algorithms.nn_index import NearestNeighborsIndex, \
+    get_nn_index_impls, load_uuid_array, uuid_array
 
 __author__ = "paul.tunison@kitware.com"
 
@@ -74,3 +77,42 @@ class TestSimilarityIndexAbstract (unittest.TestCase):
         q = DescriptorMemoryElement('q', 0)
         q.set_vector(numpy.random.rand(4))
         ntools.assert_raises(ValueError, index.nn, q)
+
+    @mock.patch.object(DummySI, 'nn')
+    def test_nn_batch_default(self, mock_dsi_nn):
+        index = DummySI()
+        mock_dsi_nn.side_effect = lambda d, n: ((d,), (float(n),))
+
+        qs = [DescriptorMemoryElement('q', i) for i in range(3)]
+        r = index.nn_batch(qs, 2)
+        ntools.assert_equal(r, [((q,), (2.,)) for q in qs])
+
+
+class TestUuidArray (unittest.TestCase):
+
+    def test_uuid_array(self):
+        a = uuid_array([3, 1, 2])
+        ntools.assert_equal(a.dtype.kind, 'i')
+        ntools.assert_equal(a.tolist(), [3, 1, 2])
+        a = uuid_array(['a', 'bc'])
+        ntools.assert_equal(a.dtype.kind, 'S')
+        # Mixed and compound UUIDs fall back to an object array
+        a = uuid_array([1, 'a', (2, 3)])
+        ntools.assert_equal(a.dtype, object)
+        ntools.assert_equal(a.tolist(), [1, 'a', (2, 3)])
+
+    def test_load_uuid_array(self):
+        fd, fp = tempfile.mkstemp(suffix='.npy')
+        os.close(fd)
+        try:
+            numpy.save(fp, uuid_array(['a', 'bc']))
+            a = load_uuid_array(fp)
+            ntools.assert_is_instance(a, numpy.memmap)
+            ntools.assert_equal(a.tolist(), ['a', 'bc'])
+
+            numpy.save(fp, uuid_array([1, 'a']))
+            a = load_uuid_array(fp)
+            ntools.assert_not_is_instance(a, numpy.memmap)
+            ntools.assert_equal(a.tolist(), [1, 'a'])
+        finally:
+            os.remove(fp)
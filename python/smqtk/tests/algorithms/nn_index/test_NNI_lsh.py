@@ -11,6 +11,7 @@ from smqtk.algorithms.nn_index.lsh.functors.itq import ItqFunctor
 from smqtk.algorithms.nn_index.hash_index.linear import LinearHashIndex
 from smqtk.algorithms.nn_index.hash_index.sklearn_balltree import \
     SkLearnBallTreeHashIndex
+from smqtk.algorithms.nn_index.hash_index.vptree import VPTreeHashIndex
 from smqtk.representation.descriptor_element.local_elements import \
     DescriptorMemoryElement
 from smqtk.representation.descriptor_index.memory import MemoryDescriptorIndex
@@ -61,6 +62,9 @@ class TestLshIndex (unittest.TestCase):
     def _make_hi_balltree(self):
         return SkLearnBallTreeHashIndex(random_seed=self.RANDOM_SEED)
 
+    def _make_hi_vptree(self):
+        return VPTreeHashIndex(leaf_size=16, random_seed=self.RANDOM_SEED)
+
     #
     # Test with random vectors
     #
@@ -112,6 +116,11 @@ class TestLshIndex (unittest.TestCase):
         for j in xrange(1, len(dists)):
             ntools.assert_greater(dists[j], dists[j-1])
 
+        # batch queries should match individual queries, in order
+        qs = [q, td[0], td[255]]
+        ntools.assert_equal(index.nn_batch(qs, 10),
+                            [index.nn(d, 10) for d in qs])
+
     def test_random_euclidean__itq__None(self):
         ftor, fit = self._make_ftor_itq()
         self._random_euclidean(ftor, None, fit)
@@ -126,6 +135,11 @@ class TestLshIndex (unittest.TestCase):
         hi = self._make_hi_balltree()
         self._random_euclidean(ftor, hi, fit)
 
+    def test_random_euclidean__itq__vptree(self):
+        ftor, fit = self._make_ftor_itq()
+        hi = self._make_hi_vptree()
+        self._random_euclidean(ftor, hi, fit)
+
     #
     # Test unit vectors
     #
@@ -198,6 +212,11 @@ class TestLshIndex (unittest.TestCase):
         hi = self._make_hi_balltree()
         self._known_unit(ftor, hi, 'hik', fit)
 
+    def test_known_unit__euclidean__itq__vptree(self):
+        ftor, fit = self._make_ftor_itq()
+        hi = self._make_hi_vptree()
+        self._known_unit(ftor, hi, 'euclidean', fit)
+
     #
     # Test with known vectors and euclidean dist
     #
@@ -248,3 +267,8 @@ class TestLshIndex (unittest.TestCase):
         ftor, fit = self._make_ftor_itq(8)
         hi = self._make_hi_balltree()
         self._known_ordered_euclidean(ftor, hi, fit)
+
+    def test_known_ordered_euclidean__itq__vptree(self):
+        ftor, fit = self._make_ftor_itq(8)
+        hi = self._make_hi_vptree()
+        self._known_ordered_euclidean(ftor, hi, fit)
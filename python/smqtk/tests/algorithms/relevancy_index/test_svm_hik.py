@@ -1,11 +1,14 @@
 import unittest
 
+import mock
 import nose.tools as ntools
 import numpy as np
 
 from smqtk.representation.descriptor_element.local_elements import \
     DescriptorMemoryElement
 from smqtk.algorithms.relevancy_index.libsvm_hik import LibSvmHikRelevancyIndex
+from smqtk.utils.distance_kernel import compute_distance_matrix
+from smqtk.utils.metrics import histogram_intersection_distance
 
 
 __author__ = "paul.tunison@kitware.com"
@@ -102,3 +105,77 @@ if LibSvmHikRelevancyIndex.is_usable():
             ntools.assert_equal(rank_ordered[4][0], self.d6)
             ntools.assert_equal(rank_ordered[5][0], self.d3)
             ntools.assert_equal(rank_ordered[6][0], self.d4)
+
+        def test_update_index(self):
+            iqr_index = LibSvmHikRelevancyIndex()
+            iqr_index.build_index(self.index_descriptors[:4])
+            ntools.assert_equal(iqr_index.count(), 4)
+            # Descriptors already indexed are ignored.
+            iqr_index.update_index(self.index_descriptors[2:])
+            ntools.assert_equal(iqr_index.count(), 7)
+
+            full_index = LibSvmHikRelevancyIndex()
+            full_index.build_index(self.index_descriptors)
+            ntools.assert_equal(iqr_index.rank([self.q_pos], [self.q_neg]),
+                                full_index.rank([self.q_pos], [self.q_neg]))
+
+        def test_rank_cached_model(self):
+            iqr_index = LibSvmHikRelevancyIndex()
+            iqr_index.build_index(self.index_descriptors)
+            r1 = iqr_index.rank([self.q_pos], [self.q_neg])
+            with mock.patch('smqtk.algorithms.relevancy_index.libsvm_hik'
+                            '.svmutil.svm_train') as m_train:
+                r2 = iqr_index.rank([self.q_pos], [self.q_neg])
+            ntools.assert_false(m_train.called)
+            ntools.assert_equal(r1, r2)
+
+        def test_rank_cached_distances_after_update(self):
+            # Cached distance rows are extended for descriptors added to the
+            # index after they were computed.
+            iqr_index = LibSvmHikRelevancyIndex()
+            iqr_index.build_index(self.index_descriptors[:4])
+            iqr_index.rank([self.q_pos], [self.q_neg])
+            iqr_index.update_index(self.index_descriptors[4:])
+
+            full_index = LibSvmHikRelevancyIndex(distance_cache_bytes=0)
+            full_index.build_index(self.index_descriptors)
+            r = iqr_index.rank([self.q_pos], [self.q_neg])
+            r_full = full_index.rank([self.q_pos], [self.q_neg])
+            ntools.assert_equal(set(r), set(r_full))
+            for d in r:
+                ntools.assert_almost_equal(r[d], r_full[d])
+
+        def test_index_distances_extended_after_update(self):
+            np.random.seed(0)
+            descriptors = []
+            for i in range(10):
+                d = DescriptorMemoryElement('index', i)
+                d.set_vector(np.random.rand(5))
+                descriptors.append(d)
+            expected = compute_distance_matrix(
+                np.array([d.vector() for d in descriptors[:3]]),
+                np.array([d.vector() for d in descriptors]),
+                histogram_intersection_distance, row_wise=True
+            )
+
+            iqr_index = LibSvmHikRelevancyIndex()
+            iqr_index.build_index(descriptors[:6])
+            q = descriptors[:3]
+            q_vectors = np.array([d.vector() for d in q])
+            k = iqr_index._index_distances(q, q_vectors)
+            np.testing.assert_allclose(k, expected[:, :6])
+
+            iqr_index.update_index(descriptors[6:])
+            with mock.patch('smqtk.algorithms.relevancy_index.libsvm_hik'
+                            '.histogram_intersection_distance',
+                            wraps=histogram_intersection_distance) as m_hid:
+                k = iqr_index._index_distances(q, q_vectors)
+            np.testing.assert_allclose(k, expected)
+            # Only distances to the new descriptors were computed.
+            for c in m_hid.call_args_list:
+                ntools.assert_equal(c[0][1].shape[0], 4)
+
+            # Rebuilding the index invalidates cached rows.
+            iqr_index.build_index(descriptors[:2])
+            ntools.assert_equal(iqr_index._index_distances(q, q_vectors).shape,
+                                (3, 2))
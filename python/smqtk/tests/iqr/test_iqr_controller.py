@@ -0,0 +1,134 @@
+import threading
+import unittest
+
+import mock
+import nose.tools as ntools
+
+from smqtk.iqr import IqrController, IqrSession
+from smqtk.iqr.session_store.memory import MemoryIqrSessionStore
+from smqtk.representation.descriptor_element.local_elements import \
+    DescriptorMemoryElement
+from smqtk.representation.descriptor_index.memory import MemoryDescriptorIndex
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+def new_descriptor(uuid):
+    d = DescriptorMemoryElement('test', uuid)
+    d.set_vector([uuid, 0.])
+    return d
+
+
+class TestIqrControllerSessionStore (unittest.TestCase):
+
+    def setUp(self):
+        self.descriptors = [new_descriptor(i) for i in range(10)]
+        self.index = MemoryDescriptorIndex()
+        self.index.add_many_descriptors(self.descriptors)
+        self.store = MemoryIqrSessionStore()
+
+        # Neighbor index returning the first 4 descriptors.
+        self.nn_index = mock.MagicMock()
+        self.nn_index.nn_batch.side_effect = \
+            lambda ds, n: [(self.descriptors[:4], [0.] * 4)] * len(ds)
+        # Relevancy index construction is not under test here.
+        p = mock.patch.object(IqrSession, '_build_rel_index')
+        p.start()
+        self.addCleanup(p.stop)
+
+    def new_controller(self, **kwds):
+        return IqrController(session_store=self.store,
+                             descriptor_index=self.index, **kwds)
+
+    def new_session(self, sid):
+        iqrs = IqrSession(session_uid=sid)
+        iqrs.adjudicate([self.descriptors[0]], [self.descriptors[9]])
+        iqrs.update_working_index(self.nn_index)
+        iqrs.results = {self.descriptors[1]: 0.25}
+        return iqrs
+
+    def test_requires_descriptor_index(self):
+        ntools.assert_raises(ValueError, IqrController,
+                             session_store=self.store)
+
+    def test_session_state_round_trip(self):
+        iqrs = self.new_session('a')
+        state = iqrs.get_state()
+        ntools.assert_equal(sorted(state['working_index_uuids']), [0, 1, 2, 3])
+        ntools.assert_equal(state['positive_uuids'], [0])
+        ntools.assert_equal(state['negative_uuids'], [9])
+        ntools.assert_equal(state['results'], {1: 0.25})
+
+        restored = IqrSession.from_state(state, self.index)
+        ntools.assert_equal(restored.positive_descriptors,
+                            {self.descriptors[0]})
+        ntools.assert_equal(restored.negative_descriptors,
+                            {self.descriptors[9]})
+        # Working index not loaded until accessed.
+        ntools.assert_equal(restored.resident_size(), 0)
+        ntools.assert_equal(restored.get_state(), state)
+        ntools.assert_equal(restored.working_index.count(), 4)
+        ntools.assert_equal(restored.resident_size(), 4)
+        ntools.assert_equal(restored.results, {self.descriptors[1]: 0.25})
+
+        # Seeds already used are not re-queried.
+        self.nn_index.nn_batch.reset_mock()
+        restored.update_working_index(self.nn_index)
+        ntools.assert_false(self.nn_index.nn_batch.called)
+
+    def test_shared_store(self):
+        c1 = self.new_controller()
+        c2 = self.new_controller()
+        c1.add_session(self.new_session('a'))
+
+        ntools.assert_true(c2.has_session_uuid('a'))
+        ntools.assert_equal(c2.session_uuids(), ('a',))
+        s2 = c2.get_session('a')
+        ntools.assert_equal(s2.working_index.count(), 4)
+
+        # Modification saved by one controller is seen by the other.
+        s1 = c1.get_session('a')
+        s1.adjudicate(new_positives=[self.descriptors[2]])
+        c1.save_session(s1)
+        s2 = c2.get_session('a')
+        ntools.assert_equal(s2.positive_descriptors,
+                            {self.descriptors[0], self.descriptors[2]})
+        # Unchanged state is not restored again.
+        ntools.assert_is(c2.get_session('a'), s2)
+
+        # Removal by one controller is seen by the other.
+        c1.remove_session('a')
+        ntools.assert_false(c2.has_session_uuid('a'))
+        ntools.assert_raises(KeyError, c2.get_session, 'a')
+        ntools.assert_raises(KeyError, c2.remove_session, 'a')
+
+    def test_eviction(self):
+        c = self.new_controller(max_resident_descriptors=6)
+        for sid in ('a', 'b', 'c'):
+            c.add_session(self.new_session(sid))
+        # Each session holds 4 working index descriptors, so only the most
+        # recently accessed one is kept.
+        ntools.assert_equal(list(c._iqr_sessions), ['c'])
+        ntools.assert_equal(set(c.session_uuids()), {'a', 'b', 'c'})
+
+        a = c.get_session('a')
+        ntools.assert_equal(a.working_index.count(), 4)
+        c.get_session('b').working_index.count()
+        c.get_session('c')
+        ntools.assert_equal(list(c._iqr_sessions), ['b', 'c'])
+
+    def test_eviction_skips_locked(self):
+        c = self.new_controller(max_resident_descriptors=1)
+        a = self.new_session('a')
+        c.add_session(a)
+        # Locked by another thread than the one adding a session.
+        a.lock.acquire()
+        try:
+            t = threading.Thread(target=c.add_session,
+                                 args=(self.new_session('b'),))
+            t.start()
+            t.join()
+        finally:
+            a.lock.release()
+        ntools.assert_in('a', c._iqr_sessions)
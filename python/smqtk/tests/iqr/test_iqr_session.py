@@ -0,0 +1,212 @@
+import threading
+import unittest
+
+import mock
+import nose.tools as ntools
+import numpy
+
+from smqtk.algorithms.relevancy_index import RelevancyIndex
+from smqtk.iqr import IqrSession
+from smqtk.iqr.iqr_session import IqrResultsDict
+from smqtk.representation.descriptor_element.local_elements import \
+    DescriptorMemoryElement
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+def new_descriptor(uuid):
+    d = DescriptorMemoryElement('test', uuid)
+    d.set_vector([uuid, 0.])
+    return d
+
+
+class TestIqrSessionUpdateWorkingIndex (unittest.TestCase):
+
+    def setUp(self):
+        self.descriptors = [new_descriptor(i) for i in range(10)]
+        # Neighbor index whose neighbors for descriptor ``i`` are ``i`` through
+        # ``i+3``.
+        self.nn_index = mock.MagicMock()
+        self.nn_index.nn_batch.side_effect = lambda ds, n: [
+            (self.descriptors[d.uuid():d.uuid() + 4], [0.] * 4) for d in ds
+        ]
+        self.rel_index = mock.MagicMock(spec=RelevancyIndex)
+        p = mock.patch('smqtk.iqr.iqr_session.plugin.from_plugin_config',
+                       return_value=self.rel_index)
+        self.m_from_config = p.start()
+        self.addCleanup(p.stop)
+
+    def test_no_positives(self):
+        iqrs = IqrSession()
+        ntools.assert_raises(RuntimeError, iqrs.update_working_index,
+                             self.nn_index)
+
+    def test_batch_query(self):
+        iqrs = IqrSession(pos_seed_neighbors=4)
+        iqrs.adjudicate([self.descriptors[0], self.descriptors[2]])
+        iqrs.update_working_index(self.nn_index)
+
+        ntools.assert_equal(self.nn_index.nn_batch.call_count, 1)
+        ntools.assert_false(self.nn_index.nn.called)
+        ntools.assert_equal(set(self.nn_index.nn_batch.call_args[0][0]),
+                            {self.descriptors[0], self.descriptors[2]})
+        ntools.assert_equal(set(iqrs.working_index.iterkeys()), set(range(6)))
+        ntools.assert_equal(self.m_from_config.call_count, 1)
+        ntools.assert_equal(self.rel_index.build_index.call_count, 1)
+
+        # Only new positives are queried.
+        self.nn_index.nn_batch.reset_mock()
+        iqrs.update_working_index(self.nn_index)
+        ntools.assert_false(self.nn_index.nn_batch.called)
+
+    def test_incremental_rel_index_update(self):
+        iqrs = IqrSession()
+        iqrs.adjudicate([self.descriptors[0]])
+        iqrs.update_working_index(self.nn_index)
+
+        iqrs.adjudicate([self.descriptors[2]])
+        iqrs.update_working_index(self.nn_index)
+        # Not rebuilt, only given the descriptors new to the working index.
+        ntools.assert_equal(self.m_from_config.call_count, 1)
+        ntools.assert_equal(self.rel_index.build_index.call_count, 1)
+        ntools.assert_equal(
+            set(self.rel_index.update_index.call_args[0][0]),
+            {self.descriptors[4], self.descriptors[5]}
+        )
+
+    def test_rel_index_rebuild_fallback(self):
+        self.rel_index.update_index.side_effect = NotImplementedError
+        iqrs = IqrSession()
+        iqrs.adjudicate([self.descriptors[0]])
+        iqrs.update_working_index(self.nn_index)
+        iqrs.adjudicate([self.descriptors[2]])
+        iqrs.update_working_index(self.nn_index)
+
+        ntools.assert_equal(self.m_from_config.call_count, 2)
+        ntools.assert_equal(
+            set(self.rel_index.build_index.call_args[0][0]),
+            set(self.descriptors[:6])
+        )
+
+
+class TestIqrSessionOrderedResults (unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(0)
+        self.descriptors = [new_descriptor(i) for i in range(100)]
+        # Scores with many ties.
+        self.scores = numpy.random.randint(0, 10, 100) / 10.
+        self.iqrs = IqrSession()
+        self.iqrs.results = IqrResultsDict(zip(self.descriptors, self.scores))
+
+    def expected(self):
+        return tuple(sorted(self.iqrs.results.iteritems(),
+                            key=lambda p: p[1], reverse=True))
+
+    def test_no_results(self):
+        ntools.assert_is_none(IqrSession().ordered_results())
+        ntools.assert_is_none(IqrSession().ordered_results(0, 10))
+
+    def test_full_order(self):
+        r = self.iqrs.ordered_results()
+        ntools.assert_equal(len(r), 100)
+        ntools.assert_equal([p for _, p in r], [p for _, p in self.expected()])
+        # Stable with respect to ties
+        ntools.assert_equal(r, self.iqrs.ordered_results())
+
+    def test_pages_consistent_with_full_order(self):
+        # Top-k paths must agree with the full order, including ties.
+        pages = self.iqrs.ordered_results(0, 10) + \
+            self.iqrs.ordered_results(10, 20)
+        self.iqrs._results_order_cache = None
+        pages2 = self.iqrs.ordered_results(0, 20)
+        self.iqrs._results_order_cache = None
+        full = self.iqrs.ordered_results()
+        ntools.assert_equal(pages, full[:20])
+        ntools.assert_equal(pages2, full[:20])
+        ntools.assert_equal(self.iqrs.ordered_results(90, 200), full[90:])
+        ntools.assert_equal(self.iqrs.ordered_results(-5, None), full[-5:])
+        ntools.assert_equal(self.iqrs.ordered_results(5, -5), full[5:-5])
+
+    def test_top_k_does_not_sort_all(self):
+        with mock.patch('smqtk.iqr.iqr_session.numpy.argsort') as m:
+            r = self.iqrs.ordered_results(0, 10)
+        ntools.assert_false(m.called)
+        ntools.assert_equal(len(r), 10)
+
+    def test_invalidated_on_results_change(self):
+        self.iqrs.ordered_results()
+        self.iqrs.results = IqrResultsDict({self.descriptors[0]: 0.5})
+        ntools.assert_equal(self.iqrs.ordered_results(),
+                            ((self.descriptors[0], 0.5),))
+        self.iqrs.reset()
+        ntools.assert_is_none(self.iqrs.ordered_results())
+
+
+class TestIqrSessionResultsLocking (unittest.TestCase):
+
+    def setUp(self):
+        self.descriptors = [new_descriptor(i) for i in range(4)]
+        self.rel_index = mock.MagicMock(spec=RelevancyIndex)
+        self.rel_index.__len__.return_value = len(self.descriptors)
+        self.rel_index.rank.return_value = \
+            dict((d, 0.5) for d in self.descriptors)
+        self.iqrs = IqrSession()
+        self.iqrs.rel_index = self.rel_index
+        self.iqrs.adjudicate([self.descriptors[0]], [self.descriptors[1]])
+
+    def test_refine_replaces_results(self):
+        self.iqrs.refine()
+        r1 = self.iqrs.results
+        ntools.assert_equal(r1, {self.descriptors[0]: 1.0,
+                                 self.descriptors[1]: 0.0,
+                                 self.descriptors[2]: 0.5,
+                                 self.descriptors[3]: 0.5})
+
+        self.rel_index.rank.return_value = \
+            dict((d, 0.25) for d in self.descriptors)
+        self.iqrs.refine()
+        # Previous results are left intact for readers still holding them.
+        ntools.assert_is_not(self.iqrs.results, r1)
+        ntools.assert_equal(r1[self.descriptors[2]], 0.5)
+        ntools.assert_equal(self.iqrs.results[self.descriptors[2]], 0.25)
+
+    def test_read_not_blocked_by_session_lock(self):
+        self.iqrs.refine()
+        locked = threading.Event()
+        done = threading.Event()
+
+        def hold_session():
+            with self.iqrs:
+                locked.set()
+                done.wait(10)
+
+        t = threading.Thread(target=hold_session)
+        t.start()
+        try:
+            locked.wait(10)
+            r = self.iqrs.ordered_results(0, 1)
+            ntools.assert_equal(r, ((self.descriptors[0], 1.0),))
+        finally:
+            done.set()
+            t.join()
+
+    def test_results_swap_waits_for_readers(self):
+        refined = threading.Event()
+
+        def refine():
+            self.iqrs.refine()
+            refined.set()
+
+        self.iqrs.results_lock.acquireRead()
+        t = threading.Thread(target=refine)
+        try:
+            t.start()
+            ntools.assert_false(refined.wait(0.5))
+            ntools.assert_is_none(self.iqrs.results)
+        finally:
+            self.iqrs.results_lock.releaseRead()
+            t.join()
+        ntools.assert_true(refined.is_set())
+        ntools.assert_equal(len(self.iqrs.results), 4)
@@ -0,0 +1,86 @@
+import os.path as osp
+import shutil
+import tempfile
+import unittest
+
+import nose.tools as ntools
+
+from smqtk.iqr.session_store import get_iqr_session_store_impls
+from smqtk.iqr.session_store.memory import MemoryIqrSessionStore
+from smqtk.iqr.session_store.sqlite_store import SqliteIqrSessionStore
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+class SessionStoreTestMixin (object):
+
+    def new_store(self):
+        raise NotImplementedError()
+
+    def test_impl_findable(self):
+        ntools.assert_in(self.new_store().__class__.__name__,
+                         get_iqr_session_store_impls())
+
+    def test_store_get(self):
+        s = self.new_store()
+        ntools.assert_false(s.has_session('a'))
+        ntools.assert_is_none(s.version('a'))
+        ntools.assert_raises(KeyError, s.get_state, 'a')
+
+        state = {'uuids': [1, 2, 3], 'results': {1: 0.5}}
+        ntools.assert_equal(s.store_state('a', state), 1)
+        ntools.assert_true(s.has_session('a'))
+        ntools.assert_equal(s.version('a'), 1)
+        ntools.assert_equal(s.get_state('a'), (state, 1))
+        ntools.assert_equal(s.session_uuids(), ('a',))
+
+    def test_version_increment(self):
+        s = self.new_store()
+        s.store_state('a', {'v': 1})
+        s.store_state('b', {'v': 1})
+        ntools.assert_equal(s.store_state('a', {'v': 2}), 2)
+        ntools.assert_equal(s.get_state('a'), ({'v': 2}, 2))
+        ntools.assert_equal(s.version('b'), 1)
+        ntools.assert_equal(set(s.session_uuids()), {'a', 'b'})
+
+    def test_remove(self):
+        s = self.new_store()
+        s.store_state('a', {})
+        s.remove_state('a')
+        ntools.assert_false(s.has_session('a'))
+        ntools.assert_raises(KeyError, s.remove_state, 'a')
+
+
+class TestMemoryIqrSessionStore (SessionStoreTestMixin, unittest.TestCase):
+
+    def new_store(self):
+        return MemoryIqrSessionStore()
+
+    def test_state_copied(self):
+        s = self.new_store()
+        state = {'uuids': [1]}
+        s.store_state('a', state)
+        state['uuids'].append(2)
+        ntools.assert_equal(s.get_state('a')[0], {'uuids': [1]})
+
+
+class TestSqliteIqrSessionStore (SessionStoreTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_filepath = osp.join(self.tmp_dir, 'sub', 'sessions.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def new_store(self):
+        return SqliteIqrSessionStore(self.db_filepath)
+
+    def test_shared_between_instances(self):
+        s1 = self.new_store()
+        s2 = SqliteIqrSessionStore.from_config(s1.get_config())
+        s1.store_state('a', {'v': 1})
+        ntools.assert_equal(s2.get_state('a'), ({'v': 1}, 1))
+        ntools.assert_equal(s2.store_state('a', {'v': 2}), 2)
+        ntools.assert_equal(s1.version('a'), 2)
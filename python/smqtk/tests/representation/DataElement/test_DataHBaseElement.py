@@ -0,0 +1,146 @@
+import contextlib
+
+import mock
+import nose.tools as ntools
+import unittest
+
+from smqtk.representation.data_element import hbase_element
+from smqtk.representation.data_element.hbase_element import HBaseDataElement
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+class FakeTable (object):
+    """
+    In-process stand-in for a ``happybase.Table`` that records how many
+    requests were made against it.
+    """
+
+    def __init__(self, data):
+        #: :type: dict[str, dict[str, str]]
+        self.data = data
+        self.row_calls = 0
+        self.rows_calls = 0
+
+    def row(self, row, columns=None):
+        self.row_calls += 1
+        return dict((c, self.data[row][c]) for c in columns)
+
+    def rows(self, rows, columns=None):
+        self.rows_calls += 1
+        return [(r, dict((c, self.data[r][c]) for c in columns))
+                for r in rows if r in self.data]
+
+
+class FakeConnectionPool (object):
+    """
+    In-process stand-in for a ``happybase.ConnectionPool``.
+    """
+
+    def __init__(self, size, host=None, timeout=None, tables=None):
+        self.size = size
+        self.host = host
+        self.timeout = timeout
+        self.tables = tables or {}
+        self.connections_made = 0
+
+    @contextlib.contextmanager
+    def connection(self):
+        self.connections_made += 1
+        conn = mock.Mock()
+        conn.table.side_effect = lambda name: self.tables[name]
+        yield conn
+
+
+class TestHBaseDataElement (unittest.TestCase):
+
+    def setUp(self):
+        self.table = FakeTable({
+            'k1': {'f:data': 'bytes one'},
+            'k2': {'f:data': 'bytes two'},
+            'k3': {'f:data': 'bytes three'},
+        })
+        self.pool = FakeConnectionPool(1, tables={'images': self.table})
+        hbase_element._CONNECTION_POOLS.clear()
+        hbase_element._CONNECTION_POOLS[('localhost', 10000)] = self.pool
+
+        # Stand in for the optional dependencies so the implementation is
+        # usable without happybase or a tika server.
+        self.happybase_patcher = mock.patch.object(hbase_element, 'happybase')
+        self.happybase_patcher.start()
+        self.detector_patcher = \
+            mock.patch.object(hbase_element, 'tika_detector')
+        self.mock_detector = self.detector_patcher.start()
+        self.mock_detector.from_buffer.return_value = 'text/plain'
+
+    def tearDown(self):
+        self.detector_patcher.stop()
+        self.happybase_patcher.stop()
+        hbase_element._CONNECTION_POOLS.clear()
+
+    @staticmethod
+    def _new_element(key):
+        return HBaseDataElement(key, 'f:data', 'localhost', 'images')
+
+    def test_configuration(self):
+        default_config = HBaseDataElement.get_default_config()
+        ntools.assert_equal(default_config, {
+            'element_key': None,
+            'binary_column': None,
+            'hbase_address': None,
+            'hbase_table': None,
+            'timeout': 10000,
+        })
+
+        inst1 = self._new_element('k1')
+        inst2 = HBaseDataElement.from_config(inst1.get_config())
+        ntools.assert_equal(inst1.get_config(), inst2.get_config())
+
+    def test_get_bytes(self):
+        e = self._new_element('k2')
+        ntools.assert_equal(e.get_bytes(), 'bytes two')
+        ntools.assert_equal(self.table.row_calls, 1)
+
+    def test_content_type_single_fetch(self):
+        # Fetching bytes and then the content type should only request the
+        # row once.
+        e = self._new_element('k1')
+        e.get_bytes()
+        ntools.assert_equal(e.content_type(), 'text/plain')
+        ntools.assert_equal(e.content_type(), 'text/plain')
+        ntools.assert_equal(self.table.row_calls, 1)
+        ntools.assert_equal(self.mock_detector.from_buffer.call_count, 1)
+
+    def test_shared_pool(self):
+        # Elements referencing the same server should share one pool.
+        self._new_element('k1').get_bytes()
+        self._new_element('k2').get_bytes()
+        ntools.assert_equal(len(hbase_element._CONNECTION_POOLS), 1)
+        ntools.assert_equal(self.pool.connections_made, 2)
+
+    def test_get_connection_pool_new(self):
+        mock_happybase = hbase_element.happybase
+        p1 = hbase_element.get_connection_pool('otherhost', 500)
+        p2 = hbase_element.get_connection_pool('otherhost', 500)
+        ntools.assert_is(p1, p2)
+        mock_happybase.ConnectionPool.assert_called_once_with(
+            hbase_element.CONNECTION_POOL_SIZE, host='otherhost', timeout=500
+        )
+
+    def test_get_many_bytes(self):
+        elements = [self._new_element(k) for k in ('k3', 'k1', 'k2')]
+        b = HBaseDataElement.get_many_bytes(elements)
+        ntools.assert_equal(b, ['bytes three', 'bytes one', 'bytes two'])
+        ntools.assert_equal(self.table.rows_calls, 1)
+        ntools.assert_equal(self.table.row_calls, 0)
+
+        # Content types were cached during the batch fetch.
+        for e in elements:
+            ntools.assert_equal(e.content_type(), 'text/plain')
+        ntools.assert_equal(self.table.row_calls, 0)
+
+    def test_get_many_bytes_missing_row(self):
+        elements = [self._new_element('k1'), self._new_element('no-key')]
+        ntools.assert_raises(KeyError, HBaseDataElement.get_many_bytes,
+                             elements)
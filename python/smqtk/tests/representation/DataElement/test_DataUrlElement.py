@@ -1,8 +1,13 @@
 
+import mock
 import nose.tools as ntools
+import os
 import requests
+import shutil
+import tempfile
 import unittest
 
+from smqtk.representation.data_element import url_element
 from smqtk.representation.data_element.url_element import DataUrlElement
 
 
@@ -44,3 +49,135 @@ if internet_available:
 
             inst2 = DataUrlElement.from_config(inst1.get_config())
             ntools.assert_equal(inst1, inst2)
+
+
+class TestDataUrlElementSession (unittest.TestCase):
+    """
+    Tests against a mocked shared session, not requiring a connection to the
+    internet.
+    """
+
+    TEST_URL = 'http://example.com/image.png'
+
+    @staticmethod
+    def _response(status_code=200, content='', headers=None):
+        r = mock.Mock()
+        r.status_code = status_code
+        r.ok = status_code < 400
+        r.content = content
+        r.headers = headers or {}
+        return r
+
+    def setUp(self):
+        self.usable_patcher = mock.patch.object(DataUrlElement, 'is_usable',
+                                                return_value=True)
+        self.usable_patcher.start()
+        self.session_patcher = mock.patch.object(url_element, 'SESSION')
+        self.mock_session = self.session_patcher.start()
+        self.mock_session.head.return_value = \
+            self._response(headers={'content-type': 'image/png'})
+        self.mock_session.get.return_value = \
+            self._response(content='content',
+                           headers={'content-type': 'image/png',
+                                    'etag': '"v1"'})
+
+    def tearDown(self):
+        self.session_patcher.stop()
+        self.usable_patcher.stop()
+        url_element.set_bytes_cache(0)
+
+    def test_content_type_no_get(self):
+        e = DataUrlElement(self.TEST_URL)
+        ntools.assert_equal(e.content_type(), 'image/png')
+        ntools.assert_equal(self.mock_session.head.call_count, 1)
+        ntools.assert_false(self.mock_session.get.called)
+
+    def test_head_not_allowed_fallback(self):
+        self.mock_session.head.return_value = self._response(405)
+        self.mock_session.get.return_value = \
+            self._response(headers={'content-type': 'image/jpeg'})
+        e = DataUrlElement(self.TEST_URL)
+        ntools.assert_equal(e.content_type(), 'image/jpeg')
+        self.mock_session.get.assert_called_once_with(self.TEST_URL,
+                                                      stream=True)
+
+    def test_get_bytes_no_cache(self):
+        e = DataUrlElement(self.TEST_URL)
+        ntools.assert_equal(e.get_bytes(), 'content')
+        ntools.assert_equal(e.get_bytes(), 'content')
+        ntools.assert_equal(self.mock_session.get.call_count, 2)
+        self.mock_session.get.assert_called_with(self.TEST_URL, headers={})
+
+    def test_get_bytes_cached_not_modified(self):
+        url_element.set_bytes_cache(1024)
+        e = DataUrlElement(self.TEST_URL)
+        ntools.assert_equal(e.get_bytes(), 'content')
+
+        # Server reports content unchanged, cached bytes returned.
+        self.mock_session.get.return_value = self._response(304)
+        ntools.assert_equal(e.get_bytes(), 'content')
+        self.mock_session.get.assert_called_with(
+            self.TEST_URL, headers={'If-None-Match': '"v1"'}
+        )
+
+    def test_get_many_bytes(self):
+        urls = ['http://example.com/%d.png' % i for i in range(5)]
+        self.mock_session.get.side_effect = \
+            lambda url, **kw: self._response(content=url)
+        elements = [DataUrlElement(u) for u in urls]
+        ntools.assert_equal(DataUrlElement.get_many_bytes(elements, cores=2),
+                            urls)
+
+
+class TestUrlBytesCache (unittest.TestCase):
+
+    def test_lru_eviction(self):
+        c = url_element.UrlBytesCache(10)
+        c.store('a', 'e1', '12345')
+        c.store('b', 'e1', '12345')
+        # Touch 'a' so that 'b' is least recently used.
+        ntools.assert_equal(c.get('a', 'e1'), '12345')
+        c.store('c', 'e1', '123')
+        ntools.assert_is_none(c.etag('b'))
+        ntools.assert_equal(c.etag('a'), 'e1')
+        ntools.assert_equal(c.total_bytes, 8)
+
+    def test_etag_mismatch(self):
+        c = url_element.UrlBytesCache(10)
+        c.store('a', 'e1', 'abc')
+        ntools.assert_is_none(c.get('a', 'e2'))
+
+    def test_too_large(self):
+        c = url_element.UrlBytesCache(2)
+        c.store('a', 'e1', 'abc')
+        ntools.assert_equal(len(c), 0)
+
+    def test_disk_cache(self):
+        d = tempfile.mkdtemp()
+        try:
+            c = url_element.UrlBytesCache(4, cache_dir=d)
+            c.store('a', 'e1', 'abc')
+            ntools.assert_equal(len(os.listdir(d)), 1)
+            ntools.assert_equal(c.get('a', 'e1'), 'abc')
+            c.store('b', 'e1', 'abc')
+            ntools.assert_equal(len(os.listdir(d)), 1)
+            ntools.assert_is_none(c.get('a', 'e1'))
+        finally:
+            shutil.rmtree(d)
+
+    def test_disk_cache_store_same_content(self):
+        d = tempfile.mkdtemp()
+        try:
+            c = url_element.UrlBytesCache(4, cache_dir=d)
+            c.store('a', 'e1', 'abc')
+            c.store('a', 'e1', 'abc')
+            ntools.assert_equal(c.get('a', 'e1'), 'abc')
+            ntools.assert_equal(c.total_bytes, 3)
+            ntools.assert_equal(len(os.listdir(d)), 1)
+            # New content for the URL replaces the old file.
+            c.store('a', 'e2', 'de')
+            ntools.assert_equal(c.get('a', 'e2'), 'de')
+            ntools.assert_equal(c.total_bytes, 2)
+            ntools.assert_equal(len(os.listdir(d)), 1)
+        finally:
+            shutil.rmtree(d)
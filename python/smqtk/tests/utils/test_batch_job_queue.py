@@ -0,0 +1,102 @@
+import threading
+import time
+import unittest
+
+import nose.tools as ntools
+
+from smqtk.utils.batch_job_queue import BatchJobQueue, QueueFullError
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+def wait_done(q, job_id, timeout=5.0):
+    s = time.time()
+    while time.time() - s < timeout:
+        st = q.status(job_id)
+        if st['status'] == BatchJobQueue.STATUS_DONE:
+            return st
+        time.sleep(0.01)
+    raise AssertionError("Job did not finish in time")
+
+
+class TestBatchJobQueue (unittest.TestCase):
+
+    def test_submit_results_in_order(self):
+        q = BatchJobQueue(lambda k, items: ([k + str(i) for i in items],
+                                            [None] * len(items)))
+        try:
+            job_id = q.submit([('a', 1), ('b', 2), ('a', 3)])
+            st = wait_done(q, job_id)
+            ntools.assert_equal(st['items'], [('a', 'a1', None),
+                                              ('b', 'b2', None),
+                                              ('a', 'a3', None)])
+        finally:
+            q.stop()
+
+    def test_batches_grouped_by_key(self):
+        batches = []
+        gate = threading.Event()
+
+        def batch_func(k, items):
+            gate.wait()
+            batches.append((k, list(items)))
+            return items, [None] * len(items)
+
+        q = BatchJobQueue(batch_func, num_workers=1, batch_size=3)
+        try:
+            # First job occupies the single worker while the rest queue up.
+            j0 = q.submit([('x', 0)])
+            time.sleep(0.1)
+            jobs = [q.submit([('a', i)]) for i in range(4)] + \
+                [q.submit([('b', 9)])]
+            gate.set()
+            for j in [j0] + jobs:
+                wait_done(q, j)
+        finally:
+            q.stop()
+        ntools.assert_equal(batches, [('x', [0]), ('a', [0, 1, 2]),
+                                      ('a', [3]), ('b', [9])])
+
+    def test_queue_full(self):
+        gate = threading.Event()
+
+        def batch_func(k, items):
+            gate.wait()
+            return items, [None] * len(items)
+
+        q = BatchJobQueue(batch_func, num_workers=1, max_pending=2)
+        try:
+            q.submit([('a', 0)])
+            time.sleep(0.1)
+            q.submit([('a', 1), ('a', 2)])
+            ntools.assert_raises(QueueFullError, q.submit, [('a', 3)])
+            ntools.assert_equal(q.stats()['pending'], 2)
+        finally:
+            gate.set()
+            q.stop()
+
+    def test_batch_failure(self):
+        def batch_func(k, items):
+            raise RuntimeError("broken")
+
+        q = BatchJobQueue(batch_func)
+        try:
+            st = wait_done(q, q.submit([('a', 0)]))
+            ntools.assert_equal(st['items'], [('a', None, 'broken')])
+        finally:
+            q.stop()
+
+    def test_result_expiry(self):
+        q = BatchJobQueue(lambda k, items: (items, [None] * len(items)),
+                          result_ttl=0)
+        try:
+            job_id = q.submit([('a', 0)])
+            time.sleep(0.2)
+            ntools.assert_raises(KeyError, q.status, job_id)
+        finally:
+            q.stop()
+
+    def test_no_items(self):
+        q = BatchJobQueue(lambda k, items: (items, [None] * len(items)))
+        ntools.assert_raises(ValueError, q.submit, [])
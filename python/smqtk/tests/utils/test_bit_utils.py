@@ -0,0 +1,38 @@
+import unittest
+
+import nose.tools as ntools
+import numpy
+
+from smqtk.utils.bit_utils import (
+    hamming_distance_words,
+    pack_bit_vectors,
+    popcount_words,
+    unpack_bit_vectors,
+)
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+class TestPackedBits (unittest.TestCase):
+
+    def test_pack_unpack(self):
+        v = numpy.random.randint(0, 2, 10 * 100).reshape(10, 100)
+        w = pack_bit_vectors(v)
+        ntools.assert_equal(w.dtype, numpy.uint64)
+        ntools.assert_equal(w.shape, (10, 2))
+        numpy.testing.assert_equal(unpack_bit_vectors(w, 100), v.astype(bool))
+
+    def test_pack_not_2d(self):
+        ntools.assert_raises(ValueError, pack_bit_vectors, [1, 0, 1])
+
+    def test_popcount_words(self):
+        w = numpy.array([0, 1, 0xff, 2**64 - 1, 0x8000000000000001],
+                        numpy.uint64)
+        numpy.testing.assert_equal(popcount_words(w), [0, 1, 8, 64, 2])
+
+    def test_hamming_distance_words(self):
+        v = numpy.random.randint(0, 2, 20 * 130).reshape(20, 130).astype(bool)
+        w = pack_bit_vectors(v)
+        numpy.testing.assert_equal(hamming_distance_words(w, w[5]),
+                                   (v != v[5]).sum(axis=1))
@@ -0,0 +1,157 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import nose.tools as ntools
+import numpy
+
+from smqtk.utils.distance_kernel import (
+    DistanceKernel,
+    compute_distance_kernel,
+    compute_distance_matrix,
+    compute_distance_matrix_tiled,
+)
+from smqtk.utils.metrics import (
+    cosine_distance,
+    euclidean_distance,
+    histogram_intersection_distance,
+)
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+class TestTiledDistanceMatrix (unittest.TestCase):
+
+    METHODS = {
+        'hik': histogram_intersection_distance,
+        'euclidean': euclidean_distance,
+        'cosine': cosine_distance,
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        numpy.random.seed(0)
+        cls.m = numpy.random.rand(50, 6)
+        cls.m /= cls.m.sum(axis=1)[:, numpy.newaxis]
+        cls.m2 = numpy.random.rand(13, 6)
+
+    def _expected(self, dist_func, m1, m2):
+        return numpy.array([[dist_func(a, b) for b in m2] for a in m1])
+
+    def test_kernel(self):
+        for method, dist_func in self.METHODS.items():
+            expected = self._expected(dist_func, self.m, self.m)
+            for processes in (1, 2):
+                # Tile size not dividing the rows to exercise edge tiles.
+                k = compute_distance_matrix_tiled(
+                    self.m, distance_method=method, tile_size=16,
+                    dtype=float, processes=processes
+                )
+                numpy.testing.assert_allclose(k, expected, atol=1e-7)
+
+    def test_matrix(self):
+        for method, dist_func in self.METHODS.items():
+            k = compute_distance_matrix_tiled(self.m, self.m2, method,
+                                              tile_size=8, processes=2)
+            ntools.assert_equal(k.dtype, numpy.float32)
+            numpy.testing.assert_allclose(
+                k, self._expected(dist_func, self.m, self.m2), atol=1e-6
+            )
+
+    def test_output_file(self):
+        fd, fp = tempfile.mkstemp('.npy')
+        os.close(fd)
+        try:
+            k = compute_distance_matrix_tiled(self.m, tile_size=16,
+                                              output_filepath=fp, processes=2)
+            ntools.assert_is_instance(k, numpy.memmap)
+            numpy.testing.assert_allclose(
+                numpy.load(fp),
+                self._expected(histogram_intersection_distance,
+                               self.m, self.m),
+                atol=1e-6
+            )
+        finally:
+            os.remove(fp)
+
+    def test_invalid_method(self):
+        ntools.assert_raises(ValueError, compute_distance_matrix_tiled,
+                             self.m, distance_method='foo')
+
+    def test_pairwise_functions_tiled(self):
+        # Known metric functions are computed in tiles, matching other
+        # functions computed pair-wise.
+        def hid(a, b):
+            return histogram_intersection_distance(a, b)
+
+        def ed(a, b):
+            return euclidean_distance(a, b)
+
+        numpy.testing.assert_allclose(
+            compute_distance_kernel(self.m, histogram_intersection_distance),
+            compute_distance_kernel(self.m, hid, row_wise=True),
+            atol=1e-7
+        )
+        numpy.testing.assert_allclose(
+            compute_distance_matrix(self.m, self.m2, euclidean_distance),
+            compute_distance_matrix(self.m, self.m2, ed)
+        )
+
+
+class TestDistanceKernel (unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(0)
+        self.ids = numpy.arange(10, 30)
+        m = numpy.random.rand(20, 4)
+        self.k = compute_distance_matrix_tiled(m, distance_method='euclidean',
+                                               dtype=float, processes=1)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ids_fp = os.path.join(self.tmp_dir, 'ids.txt')
+        self.bg_fp = os.path.join(self.tmp_dir, 'bg.txt')
+        self.k_fp = os.path.join(self.tmp_dir, 'k.npy')
+        numpy.savetxt(self.ids_fp, self.ids)
+        numpy.savetxt(self.bg_fp, self.ids % 5 == 0)
+        numpy.save(self.k_fp, self.k)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_memory_mapped(self):
+        dk = DistanceKernel.construct_symmetric_from_files(
+            self.ids_fp, self.k_fp, self.bg_fp
+        )
+        ntools.assert_is_instance(dk.get_kernel_matrix(), numpy.memmap)
+        ntools.assert_equal(dk.get_background_ids(), {10, 15, 20, 25})
+
+        dk = DistanceKernel.construct_symmetric_from_files(
+            self.ids_fp, self.k_fp, mmap_mode=None
+        )
+        ntools.assert_is_instance(dk.get_kernel_matrix(), numpy.matrix)
+
+    def test_symmetric_submatrix(self):
+        dk = DistanceKernel.construct_symmetric_from_files(
+            self.ids_fp, self.k_fp, self.bg_fp
+        )
+        # Given background ID is considered non-background.
+        cids, is_bg, m = dk.symmetric_submatrix(27, 12, 15)
+        ntools.assert_equal(cids, [10, 12, 15, 20, 25, 27])
+        ntools.assert_equal(is_bg, [True, False, False, True, True, False])
+        rows = (numpy.array(cids) - 10).astype(int)
+        ntools.assert_is_instance(m, numpy.matrix)
+        numpy.testing.assert_equal(m, self.k[rows][:, rows])
+
+        ntools.assert_raises(AssertionError, dk.symmetric_submatrix, 12, 99)
+
+    def test_extract_rows(self):
+        dk = DistanceKernel.construct_asymmetric_from_files(
+            self.ids_fp, self.ids_fp, self.k_fp
+        )
+        row_ids, col_ids, m = dk.extract_rows(22, 11)
+        ntools.assert_equal(row_ids, (11, 22))
+        ntools.assert_equal(col_ids, tuple(self.ids))
+        numpy.testing.assert_equal(m, self.k[[1, 12]])
+
+        ntools.assert_raises(AssertionError, dk.extract_rows, 99)
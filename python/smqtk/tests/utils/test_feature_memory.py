@@ -0,0 +1,213 @@
+import glob
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import mock
+import nose.tools as ntools
+import numpy
+
+from smqtk.utils.feature_memory import FeatureMemory, SharedFeatureMemory
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+class TestFeatureMemory (unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(0)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.features = numpy.random.rand(5, 3)
+        self.files = [os.path.join(self.tmp_dir, n)
+                      for n in ('ids.npy', 'bg.npy', 'f.npy', 'k.npy')]
+        numpy.save(self.files[0], numpy.arange(5))
+        numpy.save(self.files[1], numpy.array([1, 0, 0, 0, 0]))
+        numpy.save(self.files[2], self.features)
+        numpy.save(self.files[3], numpy.eye(5))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_feature(self):
+        fm = FeatureMemory.construct_from_files(*self.files)
+        ntools.assert_equal(fm.get_bg_ids(), {0})
+        f = fm.get_feature(3, 1)
+        ntools.assert_is_instance(f, numpy.matrix)
+        numpy.testing.assert_equal(f, self.features[[3, 1]])
+
+    def test_update_new_id(self):
+        fm = FeatureMemory.construct_from_files(*self.files)
+        fm.update(9, numpy.ones(3), is_background=True)
+        ntools.assert_equal(fm.get_kernel_matrix().shape, (6, 6))
+        numpy.testing.assert_equal(fm.get_feature(9), [[1, 1, 1]])
+        ntools.assert_in(9, fm.get_bg_ids())
+
+    def test_memory_mapped(self):
+        fm = FeatureMemory.construct_from_files(*self.files, mmap_mode='r+')
+        ntools.assert_is_instance(fm.get_feature_matrix(), numpy.memmap)
+        numpy.testing.assert_equal(fm.get_feature(4), self.features[[4]])
+
+        # Existing IDs are updated in place, new IDs cannot be added.
+        fm.update(2, numpy.ones(3))
+        numpy.testing.assert_equal(numpy.load(self.files[2])[2], [1, 1, 1])
+        ntools.assert_raises(RuntimeError, fm.update, 9, numpy.ones(3))
+        numpy.testing.assert_equal(fm.get_ids(), numpy.arange(5))
+
+
+def _shared_get_feature(args):
+    segment_dir, clip_id = args
+    return SharedFeatureMemory(segment_dir).get_feature(clip_id)
+
+
+class TestSharedFeatureMemory (unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(0)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.segment_dir = os.path.join(self.tmp_dir, 'segments')
+        self.features = numpy.random.rand(5, 3)
+        f = self.features
+        self.kernel = numpy.array([
+            [(a + b - numpy.abs(a - b)).sum() * 0.5 for b in f] for a in f
+        ])
+        self.fm = SharedFeatureMemory.create(self.segment_dir,
+                                             numpy.arange(5), {0},
+                                             self.features, self.kernel)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_create_existing(self):
+        ntools.assert_raises(ValueError, SharedFeatureMemory.create,
+                             self.segment_dir, numpy.arange(5), set(),
+                             self.features, self.kernel)
+
+    def test_read_only_attach(self):
+        other = SharedFeatureMemory(self.segment_dir)
+        ntools.assert_equal(other.get_bg_ids(), {0})
+        k = other.get_kernel_matrix()
+        ntools.assert_is_instance(k, numpy.memmap)
+        ntools.assert_false(k.flags.writeable)
+        numpy.testing.assert_almost_equal(k, self.kernel)
+        f = other.get_feature(3, 1)
+        ntools.assert_is_instance(f, numpy.matrix)
+        numpy.testing.assert_equal(f, self.features[[3, 1]])
+        dk = other.get_distance_kernel()
+        numpy.testing.assert_equal(dk.get_background_ids(), {0})
+
+    def test_update_existing_seen_by_other(self):
+        other = SharedFeatureMemory(self.segment_dir)
+        v = other.get_version()
+        self.fm.update(2, numpy.ones(3), is_background=True)
+        ntools.assert_equal(other.get_version(), v + 2)
+        numpy.testing.assert_equal(other.get_feature(2), [[1, 1, 1]])
+        ntools.assert_equal(other.get_bg_ids(), {0, 2})
+        k = other.get_kernel_matrix()
+        expected = numpy.minimum(self.features, 1).sum(axis=1)
+        expected[2] = 3
+        numpy.testing.assert_almost_equal(k[2], expected)
+        numpy.testing.assert_almost_equal(k[:, 2], expected)
+
+    def test_update_new_id_seen_by_other(self):
+        other = SharedFeatureMemory(self.segment_dir)
+        old_kernel = other.get_kernel_matrix()
+        self.fm.update(9, numpy.ones(3))
+        ntools.assert_equal(other.get_kernel_matrix().shape, (6, 6))
+        numpy.testing.assert_equal(other.get_ids(), [0, 1, 2, 3, 4, 9])
+        numpy.testing.assert_equal(other.get_feature(9), [[1, 1, 1]])
+        numpy.testing.assert_almost_equal(other.get_kernel_matrix()[:5, :5],
+                                          self.kernel)
+        # Previously returned segments stay mapped.
+        numpy.testing.assert_almost_equal(old_kernel, self.kernel)
+        ntools.assert_raises(ValueError, self.fm.update, 10)
+
+    def _hik_kernel(self, f):
+        return numpy.array([
+            [(a + b - numpy.abs(a - b)).sum() * 0.5 for b in f] for a in f
+        ])
+
+    def _mark_write_in_progress(self, row):
+        header = numpy.load(os.path.join(self.segment_dir,
+                                         SharedFeatureMemory.HEADER_FILE),
+                            mmap_mode='r+')
+        header[3] = row
+        header[0] += 1
+        header.flush()
+
+    def test_add_new_in_place(self):
+        other = SharedFeatureMemory(self.segment_dir)
+        segments_glob = os.path.join(self.segment_dir, '*.npy')
+        files = sorted(glob.glob(segments_glob))
+        self.fm.update(9, numpy.ones(3), is_background=True)
+        # Spare rows are written without a new generation of segments.
+        ntools.assert_equal(sorted(glob.glob(segments_glob)), files)
+        ntools.assert_equal(other.get_version(), 2)
+        numpy.testing.assert_equal(other.get_ids(), [0, 1, 2, 3, 4, 9])
+        ntools.assert_equal(other.get_bg_ids(), {0, 9})
+        numpy.testing.assert_almost_equal(
+            other.get_kernel_matrix(),
+            self._hik_kernel(numpy.vstack([self.features, numpy.ones(3)]))
+        )
+
+    def test_add_new_full_segments(self):
+        other = SharedFeatureMemory(self.segment_dir)
+        spare = len(other._segments[0]) - 5
+        new_features = numpy.random.rand(spare + 2, 3)
+        with mock.patch.object(SharedFeatureMemory, 'COPY_BLOCK_BYTES', 32):
+            for i, f in enumerate(new_features):
+                self.fm.update(10 + i, f)
+        numpy.testing.assert_equal(other.get_ids(),
+                                   range(5) + range(10, 12 + spare))
+        features = numpy.vstack([self.features, new_features])
+        numpy.testing.assert_almost_equal(other.get_feature_matrix(),
+                                          features)
+        numpy.testing.assert_almost_equal(other.get_kernel_matrix(),
+                                          self._hik_kernel(features))
+        ntools.assert_equal(other.get_bg_ids(), {0})
+        # Superseded segments are removed.
+        ntools.assert_false(os.path.exists(os.path.join(self.segment_dir,
+                                                        'kernel.0.npy')))
+        ntools.assert_true(os.path.exists(os.path.join(self.segment_dir,
+                                                       'kernel.1.npy')))
+
+    def test_read_write_in_progress_timeout(self):
+        other = SharedFeatureMemory(self.segment_dir)
+        self._mark_write_in_progress(-1)
+        with mock.patch.object(SharedFeatureMemory, 'WRITE_WAIT_TIMEOUT',
+                               0.01):
+            ntools.assert_raises(RuntimeError, other.get_ids)
+
+    def test_update_recovers_dead_writer(self):
+        # Writer died while updating row 2.
+        kernel = numpy.load(os.path.join(self.segment_dir, 'kernel.0.npy'),
+                            mmap_mode='r+')
+        kernel[2, :5] = 0
+        kernel.flush()
+        self._mark_write_in_progress(2)
+        stale_fp = os.path.join(self.segment_dir, 'kernel.1.npy')
+        numpy.save(stale_fp, numpy.zeros(1))
+
+        self.fm.update(3, is_background=True)
+        ntools.assert_equal(self.fm.get_version() % 2, 0)
+        ntools.assert_equal(self.fm.get_bg_ids(), {0, 3})
+        numpy.testing.assert_almost_equal(self.fm.get_kernel_matrix(),
+                                          self.kernel)
+        ntools.assert_false(os.path.exists(stale_fp))
+
+    def test_pickle_attaches(self):
+        fm = pickle.loads(pickle.dumps(self.fm))
+        numpy.testing.assert_equal(fm.get_feature(4), self.features[[4]])
+
+    def test_processes_attach(self):
+        p = multiprocessing.Pool(2)
+        try:
+            r = p.map(_shared_get_feature,
+                      [(self.segment_dir, i) for i in range(5)])
+        finally:
+            p.close()
+            p.join()
+        numpy.testing.assert_equal(numpy.vstack(r), self.features)
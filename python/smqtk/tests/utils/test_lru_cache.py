@@ -0,0 +1,73 @@
+import unittest
+
+import mock
+import nose.tools as ntools
+
+from smqtk.utils.lru_cache import LruCache
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+class TestLruCache (unittest.TestCase):
+
+    def test_get_miss_hit(self):
+        c = LruCache(2)
+        ntools.assert_is_none(c.get('a'))
+        ntools.assert_equal(c.get('a', 'default'), 'default')
+        c.store('a', 1)
+        ntools.assert_equal(c.get('a'), 1)
+        s = c.stats()
+        ntools.assert_equal(s['hits'], 1)
+        ntools.assert_equal(s['misses'], 2)
+        ntools.assert_equal(s['entries'], 1)
+
+    def test_lru_eviction(self):
+        c = LruCache(2)
+        c.store('a', 1)
+        c.store('b', 2)
+        c.get('a')
+        c.store('c', 3)
+        ntools.assert_in('a', c)
+        ntools.assert_not_in('b', c)
+        ntools.assert_in('c', c)
+
+    def test_store_replaces(self):
+        c = LruCache(2)
+        c.store('a', 1)
+        c.store('a', 2)
+        ntools.assert_equal(len(c), 1)
+        ntools.assert_equal(c.get('a'), 2)
+
+    def test_disabled(self):
+        c = LruCache(0)
+        c.store('a', 1)
+        ntools.assert_equal(len(c), 0)
+
+    def test_remove_clear(self):
+        c = LruCache(4)
+        c.store('a', 1)
+        c.store('b', 2)
+        c.remove('a')
+        c.remove('missing')
+        ntools.assert_not_in('a', c)
+        c.clear()
+        ntools.assert_equal(len(c), 0)
+
+    @mock.patch('smqtk.utils.lru_cache.time.time')
+    def test_ttl_fixed_expiry(self, m_time):
+        m_time.return_value = 100.
+        c = LruCache(2, ttl=10)
+        c.store('a', 1)
+        m_time.return_value = 109.
+        # Access does not extend the lifetime.
+        ntools.assert_equal(c.get('a'), 1)
+        ntools.assert_in('a', c)
+        m_time.return_value = 110.
+        ntools.assert_not_in('a', c)
+        ntools.assert_is_none(c.get('a'))
+        ntools.assert_equal(len(c), 0)
+        # Storing again resets the expiry.
+        c.store('a', 2)
+        m_time.return_value = 119.
+        ntools.assert_equal(c.get('a'), 2)
@@ -85,6 +85,25 @@ class TestHistogramIntersectionDistance (unittest.TestCase):
                              self.m1, self.m2)
 
 
+class TestCosineDistance (unittest.TestCase):
+
+    def test_rows_match_scalar(self):
+        np.random.seed(0)
+        m = np.random.rand(20, 8)
+        v = np.random.rand(8)
+        for pos in (True, False):
+            expected = [df.cosine_distance(r, v, pos) for r in m]
+            np.testing.assert_allclose(df.cosine_distance_rows(m, v, pos),
+                                       expected)
+
+    def test_rows_known(self):
+        m = np.array([[1., 0.], [0., 1.], [2., 2.], [-1., 0.]])
+        v = np.array([3., 0.])
+        np.testing.assert_allclose(
+            df.cosine_distance_rows(m, v, pos_vectors=False),
+            [0., 0.5, 0.25, 1.], atol=1e-7)
+
+
 class TestHammingDistance (unittest.TestCase):
 
     def test_hd_0(self):
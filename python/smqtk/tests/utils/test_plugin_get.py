@@ -1,9 +1,16 @@
 import abc
+import importlib
+import json
 import os
+import shutil
+import tempfile
 import unittest
 
+import mock
 import nose.tools as ntools
 
+from smqtk.representation import get_classification_element_impls
+from smqtk.utils import plugin
 from smqtk.utils.plugin import Pluggable, get_plugins, OS_ENV_PATH_SEP
 
 
@@ -186,3 +193,124 @@ class TestGetPluginGeneric (unittest.TestCase):
             os.environ[self.ENV_VAR] = env_orig_value
         else:
             del os.environ[self.ENV_VAR]
+
+
+class TestGetPluginCaching (unittest.TestCase):
+
+    get_dummy_plugins = TestGetPluginGeneric.get_dummy_plugins
+    INTERNAL_PLUGIN_DIR = TestGetPluginGeneric.INTERNAL_PLUGIN_DIR
+    INTERNAL_PLUGIN_MOD_PATH = TestGetPluginGeneric.INTERNAL_PLUGIN_MOD_PATH
+    ENV_VAR = TestGetPluginGeneric.ENV_VAR
+    HELP_VAR = TestGetPluginGeneric.HELP_VAR
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.manifest_fp = os.path.join(self.work_dir, 'manifest.json')
+        self.env_orig_value = os.environ.pop(plugin.PLUGIN_MANIFEST_ENV_VAR,
+                                             None)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+        if self.env_orig_value is not None:
+            os.environ[plugin.PLUGIN_MANIFEST_ENV_VAR] = self.env_orig_value
+        else:
+            os.environ.pop(plugin.PLUGIN_MANIFEST_ENV_VAR, None)
+
+    def test_memoized(self):
+        m1 = self.get_dummy_plugins()
+        m2 = self.get_dummy_plugins()
+        # Copies of the same cached map.
+        ntools.assert_is_not(m1, m2)
+        ntools.assert_is(m1._source, m2._source)
+        m3 = get_plugins(self.INTERNAL_PLUGIN_MOD_PATH,
+                         self.INTERNAL_PLUGIN_DIR, self.ENV_VAR,
+                         self.HELP_VAR, DummyInterface, reload_modules=True)
+        ntools.assert_is_not(m1, m3)
+        ntools.assert_equal(sorted(m1), sorted(m3))
+
+    def test_manifest_lazy_import(self):
+        os.environ[plugin.PLUGIN_MANIFEST_ENV_VAR] = self.manifest_fp
+        m = self.get_dummy_plugins()
+        ntools.assert_true(os.path.isfile(self.manifest_fp))
+        with open(self.manifest_fp) as f:
+            manifest = json.load(f)
+        ntools.assert_in(
+            sorted(['ImplFoo', 'ImplBar']),
+            [sorted(e['classes']) for e in manifest.values()]
+        )
+
+        # Discovery in a "new process" takes classes from the manifest without
+        # importing their modules.
+        plugin._PLUGIN_CACHE.clear()
+        with mock.patch('smqtk.utils.plugin.importlib.import_module',
+                        wraps=importlib.import_module) as m_import:
+            m2 = self.get_dummy_plugins()
+            ntools.assert_is_not(m, m2)
+            ntools.assert_equal(sorted(m), sorted(m2))
+            ntools.assert_in('ImplFoo', m2)
+            ntools.assert_equal(m_import.call_count, 0)
+
+            ntools.assert_equal(m2['ImplFoo']().inst_method('a'), 'fooa')
+            ntools.assert_equal(m_import.call_count, 1)
+            m2['ImplFoo']
+            ntools.assert_equal(m_import.call_count, 1)
+            # Other copies share the import.
+            self.get_dummy_plugins()['ImplFoo']
+            ntools.assert_equal(m_import.call_count, 1)
+
+    def test_modify_copy(self):
+        m1 = self.get_dummy_plugins()
+        del m1['ImplFoo']
+        ntools.assert_equal(m1.pop('ImplBar').__name__, 'ImplBar')
+        ntools.assert_not_in('ImplFoo', m1)
+        ntools.assert_not_in('ImplBar', m1)
+        m2 = self.get_dummy_plugins()
+        ntools.assert_in('ImplFoo', m2)
+        ntools.assert_in('ImplBar', m2)
+
+    def test_modify_copy_lazy(self):
+        os.environ[plugin.PLUGIN_MANIFEST_ENV_VAR] = self.manifest_fp
+        self.get_dummy_plugins()
+        plugin._PLUGIN_CACHE.clear()
+        m1 = self.get_dummy_plugins()
+        # Not yet imported classes may be removed.
+        del m1['ImplFoo']
+        ntools.assert_not_in('ImplFoo', m1)
+        ntools.assert_raises(KeyError, m1.__delitem__, 'ImplFoo')
+        ntools.assert_is_none(m1.pop('ImplFoo', None))
+        m2 = self.get_dummy_plugins()
+        ntools.assert_equal(m2['ImplFoo']().inst_method('a'), 'fooa')
+
+    def test_manifest_stale_class(self):
+        os.environ[plugin.PLUGIN_MANIFEST_ENV_VAR] = self.manifest_fp
+        self.get_dummy_plugins()
+        with open(self.manifest_fp) as f:
+            manifest = json.load(f)
+        for e in manifest.values():
+            if 'ImplFoo' in e['classes']:
+                e['classes'].append('ImplGone')
+        with open(self.manifest_fp, 'w') as f:
+            json.dump(manifest, f)
+
+        plugin._PLUGIN_CACHE.clear()
+        m = self.get_dummy_plugins()
+        ntools.assert_in('ImplGone', m)
+        ntools.assert_raises(KeyError, m.__getitem__, 'ImplGone')
+        ntools.assert_not_in('ImplGone', m)
+        ntools.assert_in('ImplFoo', dict(m.items()))
+
+    def test_manifest_default_configs(self):
+        os.environ[plugin.PLUGIN_MANIFEST_ENV_VAR] = self.manifest_fp
+        expected = plugin.make_config(get_classification_element_impls())
+        ntools.assert_in('MemoryClassificationElement', expected)
+        # Default configurations are not recorded, as they may depend on
+        # other plugins available.
+        with open(self.manifest_fp) as f:
+            for e in json.load(f).values():
+                ntools.assert_not_in('default_configs', e)
+
+        plugin._PLUGIN_CACHE.clear()
+        c = plugin.make_config(get_classification_element_impls())
+        ntools.assert_equal(c, expected)
+        for k in c:
+            ntools.assert_is_instance(k, str)
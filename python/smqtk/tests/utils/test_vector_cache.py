@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import nose.tools as ntools
+import numpy
+
+from smqtk.representation.data_element.memory_element import DataMemoryElement
+from smqtk.representation.descriptor_element_factory import \
+    DescriptorElementFactory
+from smqtk.representation.descriptor_element.local_elements import \
+    DescriptorMemoryElement
+from smqtk.utils.vector_cache import (
+    compute_descriptor_cached,
+    config_hash,
+    VectorLruCache,
+)
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+class TestVectorLruCache (unittest.TestCase):
+
+    def test_config_hash_order_independent(self):
+        ntools.assert_equal(config_hash({'a': 1, 'b': [1, 2]}),
+                            config_hash({'b': [1, 2], 'a': 1}))
+        ntools.assert_not_equal(config_hash({'a': 1}), config_hash({'a': 2}))
+
+    def test_get_miss_hit(self):
+        c = VectorLruCache(1024)
+        ntools.assert_is_none(c.get('a'))
+        c.store('a', numpy.arange(4.))
+        numpy.testing.assert_equal(c.get('a'), numpy.arange(4.))
+        s = c.stats()
+        ntools.assert_equal(s['hits'], 1)
+        ntools.assert_equal(s['misses'], 1)
+        ntools.assert_equal(s['hit_rate'], 0.5)
+        ntools.assert_equal(s['bytes'], 32)
+
+    def test_lru_eviction(self):
+        # Room for two 4-element float64 vectors.
+        c = VectorLruCache(64)
+        c.store('a', numpy.zeros(4))
+        c.store('b', numpy.zeros(4))
+        c.get('a')
+        c.store('c', numpy.zeros(4))
+        ntools.assert_in('a', c)
+        ntools.assert_not_in('b', c)
+        ntools.assert_in('c', c)
+        ntools.assert_equal(c.stats()['bytes'], 64)
+
+    def test_too_large(self):
+        c = VectorLruCache(8)
+        c.store('a', numpy.zeros(4))
+        ntools.assert_equal(len(c), 0)
+
+    def test_save_load(self):
+        d = tempfile.mkdtemp()
+        try:
+            fp = os.path.join(d, 'cache.pickle')
+            c = VectorLruCache(1024, fp)
+            c.store('a', numpy.arange(3.))
+            c.save()
+
+            c2 = VectorLruCache(1024, fp)
+            numpy.testing.assert_equal(c2.get('a'), numpy.arange(3.))
+        finally:
+            shutil.rmtree(d)
+
+    def test_compute_descriptor_cached(self):
+        c = VectorLruCache(1024)
+        factory = DescriptorElementFactory(DescriptorMemoryElement, {})
+        gen = mock.Mock()
+        gen.name = 'test'
+
+        def compute(data, f):
+            de = f.new_descriptor('test', data.uuid())
+            de.set_vector(numpy.ones(2))
+            return de
+        gen.compute_descriptor.side_effect = compute
+
+        data = DataMemoryElement('foo', 'text/plain')
+        d1 = compute_descriptor_cached(c, 'k', gen, data, factory)
+        d2 = compute_descriptor_cached(c, 'k', gen, data, factory)
+        ntools.assert_equal(gen.compute_descriptor.call_count, 1)
+        ntools.assert_equal(d2.uuid(), data.uuid())
+        numpy.testing.assert_equal(d1.vector(), d2.vector())
+
+        # Different generator key does not hit.
+        compute_descriptor_cached(c, 'other', gen, data, factory)
+        ntools.assert_equal(gen.compute_descriptor.call_count, 2)
@@ -0,0 +1 @@
+__author__ = "paul.tunison@kitware.com"
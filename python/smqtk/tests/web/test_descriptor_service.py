@@ -0,0 +1,40 @@
+import json
+import unittest
+
+import nose.tools as ntools
+
+from smqtk.web.descriptor_service import DescriptorServiceServer
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+class TestDescriptorService (unittest.TestCase):
+
+    def setUp(self):
+        c = DescriptorServiceServer.get_default_config()
+        c['descriptor_factory']['type'] = 'DescriptorMemoryElement'
+        c['descriptor_generators'] = {}
+        self.config = c
+        self.client = DescriptorServiceServer(c).test_client()
+
+    def test_empty_descriptor_cache_stats(self):
+        r = self.client.get('/descriptor_cache/stats')
+        ntools.assert_equal(r.status_code, 200)
+        r = json.loads(r.data)
+        ntools.assert_true(r['enabled'])
+        ntools.assert_equal(r['stats']['entries'], 0)
+
+    def test_disabled_descriptor_cache_stats(self):
+        self.config['descriptor_vector_cache']['max_bytes'] = 0
+        client = DescriptorServiceServer(self.config).test_client()
+        r = json.loads(client.get('/descriptor_cache/stats').data)
+        ntools.assert_false(r['enabled'])
+        ntools.assert_is_none(r['stats'])
+
+    def test_submit_job_bad_labels(self):
+        uri = '/jobs/compute/base64://YQ==?content_type=text/plain'
+        for labels in ('[not json', '{"a": 1}', '[1]'):
+            r = self.client.post(uri, data={'labels': labels})
+            ntools.assert_equal(r.status_code, 400)
+            ntools.assert_false(json.loads(r.data)['success'])
@@ -0,0 +1,111 @@
+import base64
+import json
+import unittest
+
+import mock
+import nose.tools as ntools
+import numpy
+
+from smqtk.representation.descriptor_element.local_elements import \
+    DescriptorMemoryElement
+from smqtk.web import nearestneighbor_service
+from smqtk.web.nearestneighbor_service import NearestNeighborServiceServer
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+class TestNearestNeighborService (unittest.TestCase):
+
+    def setUp(self):
+        self.neighbors = []
+        for i in range(5):
+            d = DescriptorMemoryElement('test', i)
+            d.set_vector(numpy.array([i]))
+            self.neighbors.append(d)
+
+        def compute(de, factory):
+            d = factory.new_descriptor('test', de.uuid())
+            d.set_vector(numpy.array([len(de.get_bytes())]))
+            return d
+
+        self.generator = mock.MagicMock()
+        self.generator.name = 'test'
+        self.generator.valid_content_types.return_value = {'text/plain'}
+        self.generator.compute_descriptor.side_effect = compute
+        self.generator.compute_descriptor_async.side_effect = \
+            lambda des, factory: dict((de, compute(de, factory))
+                                      for de in des)
+
+        self.nn_index = mock.MagicMock()
+        self.nn_index.nn.side_effect = \
+            lambda d, n: (self.neighbors[:n], range(n))
+        self.nn_index.nn_batch.side_effect = \
+            lambda ds, n: [(self.neighbors[:n], range(n)) for _ in ds]
+
+        c = NearestNeighborServiceServer.get_default_config()
+        c['descriptor_factory']['type'] = 'DescriptorMemoryElement'
+        with mock.patch.object(nearestneighbor_service.plugin,
+                               'from_plugin_config') as m_from_config:
+            m_from_config.side_effect = [self.nn_index, self.generator]
+            self.app = NearestNeighborServiceServer(c)
+        self.client = self.app.test_client()
+
+    def get_json(self, r):
+        ntools.assert_equal(r.status_code, 200)
+        return json.loads(r.data)
+
+    def test_default_result_cache_timeout(self):
+        ntools.assert_equal(self.app.nn_result_cache_timeout, 60)
+        ntools.assert_equal(self.app._nn_result_cache.ttl, 60)
+
+    def test_empty_descriptor_cache_stats(self):
+        r = self.get_json(self.client.get('/descriptor_cache/stats'))
+        ntools.assert_true(r['enabled'])
+        ntools.assert_equal(r['stats']['entries'], 0)
+
+    def test_nn_pages_cached(self):
+        uri = '/nn/n=4/%d:%d/base64://%s?content_type=text/plain'
+        b64 = base64.b64encode('hello')
+        r = self.get_json(self.client.get(uri % (0, 2, b64)))
+        ntools.assert_true(r['success'])
+        ntools.assert_equal(r['neighbors'], [0, 1])
+        r = self.get_json(self.client.get(uri % (2, 4, b64)))
+        ntools.assert_equal(r['message'], "neighbors retrieved from cache")
+        ntools.assert_equal(r['neighbors'], [2, 3])
+        ntools.assert_equal(r['distances'], [2, 3])
+        ntools.assert_equal(self.nn_index.nn.call_count, 1)
+        ntools.assert_equal(self.generator.compute_descriptor.call_count, 1)
+
+    def test_nn_batch(self):
+        form = {
+            'base64': json.dumps([base64.b64encode('a'),
+                                  base64.b64encode('bc'),
+                                  base64.b64encode('a')]),
+            'content_types': json.dumps(['text/plain', 'image/png',
+                                         'text/plain']),
+            'n': 3,
+            'end_i': 2,
+        }
+        r = self.get_json(self.client.post('/nn_batch', data=form))
+        ntools.assert_false(r['success'])
+        ntools.assert_equal([x['success'] for x in r['results']],
+                            [True, False, True])
+        ntools.assert_equal(r['results'][0]['neighbors'], [0, 1])
+        ntools.assert_equal(r['results'][2]['reference'], 'base64[2]')
+        # Duplicate data is computed and queried once.
+        ntools.assert_equal(self.nn_index.nn_batch.call_count, 1)
+        ntools.assert_equal(len(self.nn_index.nn_batch.call_args[0][0]), 1)
+
+        # Other pages of cached results do not query the index again.
+        form['start_i'], form['end_i'] = 2, 3
+        r = self.get_json(self.client.post('/nn_batch', data=form))
+        ntools.assert_equal(r['results'][0]['neighbors'], [2])
+        ntools.assert_equal(self.nn_index.nn_batch.call_count, 1)
+
+    def test_nn_batch_bad_arguments(self):
+        r = self.client.post('/nn_batch', data={'uris': '[not json'})
+        ntools.assert_equal(r.status_code, 400)
+        r = self.client.post('/nn_batch',
+                             data={'base64': json.dumps(['YQ=='])})
+        ntools.assert_equal(r.status_code, 400)
@@ -0,0 +1,254 @@
+import collections
+import threading
+import time
+import uuid
+
+from smqtk.utils import SmqtkObject
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+class QueueFullError (Exception):
+    """
+    Raised when a job is submitted to a queue that already has its maximum
+    number of pending work items.
+    """
+    pass
+
+
+class BatchJobQueue (SmqtkObject):
+    """
+    Job queue serviced by a local pool of worker threads that groups pending
+    work items by a key and processes items sharing a key together in batches.
+
+    A job consists of one or more work items, each a (key, item) pair. Workers
+    take up to ``batch_size`` pending items of the key with the oldest pending
+    item and pass them to the batch function as a list. A job is complete once
+    all of its items have been processed.
+
+    The batch function is called as ``batch_func(key, items)`` and should return
+    a tuple of two lists in the order of the given items: the result for each
+    item and an error message for each item (None when the item succeeded). If
+    the batch function raises an exception, all items in that batch are marked
+    failed with the exception's message.
+
+    The number of pending items is bounded by ``max_pending``; submissions that
+    would exceed it raise ``QueueFullError`` so callers may retry later.
+    Finished jobs are retained for ``result_ttl`` seconds after completion.
+    """
+
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+
+    def __init__(self, batch_func, num_workers=2, batch_size=16,
+                 max_pending=1024, result_ttl=600):
+        """
+        :param batch_func: Function processing a batch of items for a key.
+        :type batch_func: (collections.Hashable, list) -> (list, list[str|None])
+
+        :param num_workers: Number of worker threads.
+        :type num_workers: int
+
+        :param batch_size: Maximum number of items processed in one batch.
+        :type batch_size: int
+
+        :param max_pending: Maximum number of pending (not yet started) items.
+        :type max_pending: int
+
+        :param result_ttl: Seconds finished jobs are retained for.
+        :type result_ttl: float
+
+        """
+        self.batch_func = batch_func
+        self.num_workers = int(num_workers)
+        self.batch_size = int(batch_size)
+        self.max_pending = int(max_pending)
+        self.result_ttl = float(result_ttl)
+
+        self._cond = threading.Condition()
+        # Pending (job_id, item index, item) tuples per key.
+        #: :type: dict[collections.Hashable, collections.deque]
+        self._pending = collections.OrderedDict()
+        self._num_pending = 0
+        # Job records by job ID.
+        #: :type: dict[str, dict]
+        self._jobs = {}
+        self._workers = []
+        self._stopped = False
+
+    def _start_workers(self):
+        """ Start worker threads if not yet started. ASSUMING lock is held. """
+        if not self._workers:
+            for i in range(self.num_workers):
+                t = threading.Thread(target=self._work,
+                                     name="%s-worker-%d"
+                                          % (self.__class__.__name__, i))
+                t.daemon = True
+                t.start()
+                self._workers.append(t)
+
+    def _purge_expired(self):
+        """ Remove expired finished jobs. ASSUMING lock is held. """
+        now = time.time()
+        for job_id in [j for j, r in self._jobs.iteritems()
+                       if r['finished'] is not None
+                       and now - r['finished'] > self.result_ttl]:
+            del self._jobs[job_id]
+
+    def submit(self, work_items):
+        """
+        Submit a new job.
+
+        :raises QueueFullError: Adding the job's items would exceed the maximum
+            number of pending items.
+        :raises ValueError: No work items given.
+
+        :param work_items: Sequence of (key, item) pairs making up the job.
+        :type work_items: collections.Sequence[(collections.Hashable, object)]
+
+        :return: ID of the new job.
+        :rtype: str
+
+        """
+        work_items = list(work_items)
+        if not work_items:
+            raise ValueError("No work items given for job.")
+        job_id = uuid.uuid4().hex
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Queue has been stopped.")
+            if self._num_pending + len(work_items) > self.max_pending:
+                raise QueueFullError("Queue full (%d pending items)"
+                                     % self._num_pending)
+            self._purge_expired()
+            self._jobs[job_id] = {
+                'keys': [k for k, _ in work_items],
+                'results': [None] * len(work_items),
+                'errors': [None] * len(work_items),
+                'remaining': len(work_items),
+                'started': False,
+                'submitted': time.time(),
+                'finished': None,
+            }
+            for i, (k, item) in enumerate(work_items):
+                self._pending.setdefault(k, collections.deque())\
+                    .append((job_id, i, item))
+            self._num_pending += len(work_items)
+            self._start_workers()
+            self._cond.notify_all()
+        return job_id
+
+    def status(self, job_id):
+        """
+        Get the status of a job.
+
+        :raises KeyError: No job by the given ID (it may have expired).
+
+        :param job_id: ID of the job.
+        :type job_id: str
+
+        :return: Dictionary with the job's ``status`` string and, once done,
+            the list of ``(key, result, error)`` tuples for the job's items in
+            submission order.
+        :rtype: dict
+
+        """
+        with self._cond:
+            self._purge_expired()
+            r = self._jobs[job_id]
+            if r['finished'] is not None:
+                status = self.STATUS_DONE
+            elif r['started']:
+                status = self.STATUS_RUNNING
+            else:
+                status = self.STATUS_QUEUED
+            s = {
+                "status": status,
+                "submitted": r['submitted'],
+                "finished": r['finished'],
+            }
+            if status == self.STATUS_DONE:
+                s['items'] = zip(r['keys'], r['results'], r['errors'])
+            return s
+
+    def stats(self):
+        """
+        :return: Number of pending items per key, total pending items and
+            number of jobs known.
+        :rtype: dict
+        """
+        with self._cond:
+            return {
+                "pending": self._num_pending,
+                "pending_by_key": dict((k, len(q))
+                                       for k, q in self._pending.iteritems()),
+                "max_pending": self.max_pending,
+                "jobs": len(self._jobs),
+            }
+
+    def stop(self):
+        """
+        Stop worker threads after their current batch. Pending items are not
+        processed.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for t in self._workers:
+            t.join()
+
+    def _next_batch(self):
+        """
+        Wait for and take the next batch of pending items, choosing the key
+        whose oldest pending item was submitted first.
+
+        :return: Key and list of (job_id, index, item) tuples, or None if
+            stopped.
+        :rtype: None | (collections.Hashable, list)
+        """
+        with self._cond:
+            while not self._stopped and not self._num_pending:
+                self._cond.wait(1.0)
+            if self._stopped:
+                return None
+            # Key with the oldest pending item.
+            key = min(
+                (k for k in self._pending if self._pending[k]),
+                key=lambda k: self._jobs[self._pending[k][0][0]]['submitted']
+            )
+            q = self._pending[key]
+            batch = [q.popleft() for _ in range(min(self.batch_size, len(q)))]
+            if not q:
+                del self._pending[key]
+            self._num_pending -= len(batch)
+            for job_id, _, _ in batch:
+                self._jobs[job_id]['started'] = True
+            return key, batch
+
+    def _work(self):
+        while True:
+            b = self._next_batch()
+            if b is None:
+                return
+            key, batch = b
+            items = [item for _, _, item in batch]
+            try:
+                results, errors = self.batch_func(key, items)
+            except Exception, ex:
+                self._log.warn("Batch for key '%s' failed: %s", key, str(ex))
+                results = [None] * len(items)
+                errors = [str(ex)] * len(items)
+
+            with self._cond:
+                now = time.time()
+                for (job_id, i, _), r, e in zip(batch, results, errors):
+                    j = self._jobs.get(job_id)
+                    if j is None:
+                        continue
+                    j['results'][i] = r
+                    j['errors'][i] = e
+                    j['remaining'] -= 1
+                    if not j['remaining']:
+                        j['finished'] = now
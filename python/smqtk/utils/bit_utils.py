@@ -242,3 +242,95 @@ def popcount(v):
     # truncation as if v were only a tp-bit integer
     # Magic 8 represents bits ina byte
     return ((v * h01) & t) >> ((b-1) * 8)
+
+
+def pack_bit_vectors(vectors):
+    """
+    Pack bit vectors into rows of 64-bit words, eight times smaller than a
+    boolean matrix of the same bits.
+
+    Bits are packed big-endian within each byte, as ``numpy.packbits`` does,
+    with rows zero-padded up to a multiple of 64 bits.
+
+    :param vectors: 2D array, or sequence of 1D arrays, of bits [0 | >0]. All
+        vectors must be the same length.
+    :type vectors: numpy.ndarray | collections.Sequence[numpy.ndarray]
+
+    :return: Matrix of packed words, with ``ceil(bits / 64)`` words per row.
+    :rtype: numpy.ndarray[numpy.uint64]
+
+    """
+    vectors = numpy.asarray(vectors, bool)
+    if vectors.ndim != 2:
+        raise ValueError("Expected a 2D array of bit vectors, got shape %s"
+                         % (vectors.shape,))
+    pad = -vectors.shape[1] % 64
+    if pad:
+        vectors = numpy.hstack([vectors,
+                                numpy.zeros((len(vectors), pad), bool)])
+    return numpy.ascontiguousarray(numpy.packbits(vectors, axis=1))\
+        .view(numpy.uint64)
+
+
+def unpack_bit_vectors(words, bits):
+    """
+    Unpack rows of 64-bit words packed by ``pack_bit_vectors`` into bit
+    vectors.
+
+    :param words: Matrix of packed words.
+    :type words: numpy.ndarray[numpy.uint64]
+
+    :param bits: Number of bits in each vector, dropping padding bits.
+    :type bits: int
+
+    :return: Boolean matrix of bit vectors, one per row of ``words``.
+    :rtype: numpy.ndarray[bool]
+
+    """
+    words = numpy.ascontiguousarray(words, numpy.uint64)
+    return numpy.unpackbits(words.view(numpy.uint8), axis=1)[:, :bits]\
+        .astype(bool)
+
+
+# Masks for the parallel 64-bit popcount below.
+_POP_M1 = numpy.uint64(0x5555555555555555)
+_POP_M2 = numpy.uint64(0x3333333333333333)
+_POP_M4 = numpy.uint64(0x0f0f0f0f0f0f0f0f)
+_POP_H01 = numpy.uint64(0x0101010101010101)
+
+
+def popcount_words(words):
+    """
+    Vectorized count of set bits in each element of an array of 64-bit words.
+
+    see: https://graphics.stanford.edu/~seander/bithacks.html#CountBitsSetParallel
+
+    :param words: Array of words.
+    :type words: numpy.ndarray[numpy.uint64]
+
+    :return: Array of the same shape with the number of bits set in each word.
+    :rtype: numpy.ndarray[numpy.uint64]
+
+    """
+    v = words - ((words >> numpy.uint64(1)) & _POP_M1)
+    v = (v & _POP_M2) + ((v >> numpy.uint64(2)) & _POP_M2)
+    v = (v + (v >> numpy.uint64(4))) & _POP_M4
+    # Multiplication wraps modulo 2^64, leaving the byte sum in the top byte.
+    return (v * _POP_H01) >> numpy.uint64(56)
+
+
+def hamming_distance_words(words, q):
+    """
+    Hamming distance between rows of packed words and a packed query.
+
+    :param words: Matrix of packed words, as from ``pack_bit_vectors``.
+    :type words: numpy.ndarray[numpy.uint64]
+
+    :param q: Packed query words, the same length as rows of ``words``.
+    :type q: numpy.ndarray[numpy.uint64]
+
+    :return: Integer number of differing bits for each row of ``words``.
+    :rtype: numpy.ndarray[numpy.int64]
+
+    """
+    return popcount_words(words ^ q).sum(axis=1).astype(numpy.int64)
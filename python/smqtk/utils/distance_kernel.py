@@ -7,15 +7,297 @@ Kitware, Inc., 28 Corporate Drive, Clifton Park, NY 12065.
 """
 
 import logging
+import multiprocessing
+import os.path as osp
+
 import numpy as np
 from numpy.core.multiarray import ndarray  # for shortening doc strings
 
 from smqtk.utils import ReadWriteLock
 from smqtk.utils import SimpleTimer
-from smqtk.utils.parallel import parallel_map
+from smqtk.utils.file_utils import safe_create_dir
+from smqtk.utils.metrics import (
+    cosine_distance,
+    euclidean_distance,
+    histogram_intersection_distance,
+)
+from smqtk.utils.parallel import parallel_map, shared_array
 from smqtk.utils.bin_utils import report_progress
 
 
+#: Default number of rows and columns of kernel tiles computed at a time.
+KERNEL_TILE_SIZE = 1024
+
+
+def hik_distance_tile(a, b, block_rows=128):
+    """
+    Histogram intersection distances between each row of ``a`` and each row
+    of ``b``.
+
+    Intersections are computed as ``(sum(a) + sum(b) - sum(|a - b|)) / 2``,
+    as in ``smqtk.utils.metrics.histogram_intersection_distance``, since
+    subtraction and absolute value are vectorized by numpy where ``minimum``
+    is not. Rows of ``b`` are taken in blocks that fit in cache.
+
+    :param a: Matrix of histogram rows.
+    :type a: numpy.core.multiarray.ndarray
+
+    :param b: Matrix of histogram rows.
+    :type b: numpy.core.multiarray.ndarray
+
+    :param block_rows: Number of rows of ``b`` to compute with at a time.
+    :type block_rows: int
+
+    :return: Matrix of distances of shape ``(len(a), len(b))``.
+    :rtype: numpy.core.multiarray.ndarray
+
+    """
+    # Loop over the shorter side, vectorizing over the longer.
+    if len(a) > len(b):
+        return hik_distance_tile(b, a, block_rows).T
+    tile = np.empty((len(a), len(b)), dtype=float)
+    for j in xrange(0, len(b), block_rows):
+        b_block = b[j:j+block_rows]
+        buf = np.empty(b_block.shape, np.result_type(a, b))
+        for i in xrange(len(a)):
+            np.subtract(b_block, a[i], out=buf)
+            np.abs(buf, out=buf)
+            buf.sum(axis=1, out=tile[i, j:j+block_rows])
+    # 1 - intersection
+    tile -= a.sum(axis=1)[:, np.newaxis]
+    tile -= b.sum(axis=1)
+    tile *= 0.5
+    tile += 1.
+    return tile
+
+
+def euclidean_distance_tile(a, b):
+    """
+    Euclidean distances between each row of ``a`` and each row of ``b``.
+
+    :param a: Matrix of row vectors.
+    :type a: numpy.core.multiarray.ndarray
+
+    :param b: Matrix of row vectors.
+    :type b: numpy.core.multiarray.ndarray
+
+    :return: Matrix of distances of shape ``(len(a), len(b))``.
+    :rtype: numpy.core.multiarray.ndarray
+
+    """
+    a = np.asarray(a, float)
+    b = np.asarray(b, float)
+    sq = np.einsum('ij,ij->i', a, a)[:, np.newaxis] \
+        + np.einsum('ij,ij->i', b, b) - 2 * a.dot(b.T)
+    return np.sqrt(np.maximum(sq, 0, out=sq), out=sq)
+
+
+def cosine_distance_tile(a, b, pos_vectors=True):
+    """
+    Angular cosine distances between each row of ``a`` and each row of ``b``,
+    as computed by ``smqtk.utils.metrics.cosine_distance``.
+
+    :param a: Matrix of row vectors.
+    :type a: numpy.core.multiarray.ndarray
+
+    :param b: Matrix of row vectors.
+    :type b: numpy.core.multiarray.ndarray
+
+    :param pos_vectors: If we expect vector elements to always be positive.
+    :type pos_vectors: bool
+
+    :return: Matrix of distances of shape ``(len(a), len(b))``.
+    :rtype: numpy.core.multiarray.ndarray
+
+    """
+    a = np.asarray(a, float)
+    b = np.asarray(b, float)
+    a = a / np.sqrt(np.einsum('ij,ij->i', a, a))[:, np.newaxis]
+    b = b / np.sqrt(np.einsum('ij,ij->i', b, b))[:, np.newaxis]
+    sim = np.clip(a.dot(b.T), -1, 1)
+    return (1 + bool(pos_vectors)) * np.arccos(sim) / np.pi
+
+
+#: Tile distance functions by distance method label.
+TILE_DISTANCE_FUNCTIONS = {
+    'hik': hik_distance_tile,
+    'euclidean': euclidean_distance_tile,
+    'cosine': cosine_distance_tile,
+}
+
+# Tile distance functions equivalent to pair-wise distance functions, used by
+# ``compute_distance_kernel`` and ``compute_distance_matrix``.
+_PAIRWISE_TILE_FUNCTIONS = {
+    histogram_intersection_distance: hik_distance_tile,
+    euclidean_distance: euclidean_distance_tile,
+    cosine_distance: cosine_distance_tile,
+}
+
+# Tile computation state, set in the current process or tile worker
+# processes by ``_init_tile_worker``.
+_tile_state = {}
+
+
+def _init_tile_worker(tile_state):
+    """
+    Initialize tile computation state for the current process.
+
+    :param tile_state: Tile distance function, input matrices and output
+        matrix. When passed to forked processes, the output matrix must be
+        backed by shared memory or a shared memory-map.
+    :type tile_state: dict
+
+    """
+    _tile_state.clear()
+    _tile_state.update(tile_state)
+
+
+def _compute_tile(tile):
+    """
+    Compute and write out a tile of distances, and its transpose for
+    symmetric kernels when not on the diagonal.
+
+    :param tile: Row and column offsets of the tile.
+    :type tile: (int, int)
+
+    :return: The given tile offsets.
+    :rtype: (int, int)
+
+    """
+    i, j = tile
+    size = _tile_state['tile_size']
+    m1, m2, out = _tile_state['m1'], _tile_state['m2'], _tile_state['out']
+    d = _tile_state['tile_func'](np.asarray(m1[i:i+size]),
+                                 np.asarray(m2[j:j+size]))
+    out[i:i+size, j:j+size] = d
+    if _tile_state['symmetric'] and i != j:
+        out[j:j+size, i:i+size] = d.T
+    return tile
+
+
+def compute_distance_matrix_tiled(m1, m2=None, distance_method='hik',
+                                  tile_size=KERNEL_TILE_SIZE,
+                                  output_filepath=None, dtype=np.float32,
+                                  processes=None):
+    """
+    Compute the pair-wise distance matrix between two arrays of vectors, or
+    the symmetric distance kernel of one array, in square tiles of vectorized
+    distance computations.
+
+    For a kernel, only tiles on and above the diagonal are computed, each
+    being written along with its transpose. Tiles are computed in a process
+    pool writing into an output matrix in shared memory, or into a
+    memory-mapped ``.npy`` file when an output file path is given so that
+    kernels larger than memory may be computed.
+
+    :param m1: Matrix of row vectors. This may be memory-mapped.
+    :type m1: numpy.core.multiarray.ndarray
+
+    :param m2: Optional second matrix of row vectors, with the same number of
+        columns as ``m1``. If None, the symmetric kernel of ``m1`` is
+        computed.
+    :type m2: None | numpy.core.multiarray.ndarray
+
+    :param distance_method: Label of the distance method, one of the keys of
+        ``TILE_DISTANCE_FUNCTIONS``.
+    :type distance_method: str
+
+    :param tile_size: Number of rows and columns of each tile.
+    :type tile_size: int
+
+    :param output_filepath: Optional path of a ``.npy`` file to write the
+        output matrix to as it is computed.
+    :type output_filepath: None | str
+
+    :param dtype: Data type of the output matrix.
+    :type dtype: numpy.dtype | type
+
+    :param processes: Number of processes to compute tiles with. If None, the
+        number of CPUs is used. With 1, tiles are computed in the current
+        process.
+    :type processes: None | int
+
+    :raises ValueError: Unknown distance method.
+
+    :return: Matrix of distances of shape ``(len(m1), len(m2))``,
+        memory-mapped when an output file path is given.
+    :rtype: numpy.core.multiarray.ndarray
+
+    """
+    if distance_method not in TILE_DISTANCE_FUNCTIONS:
+        raise ValueError("Invalid distance method '%s', must be one of %s"
+                         % (distance_method,
+                            sorted(TILE_DISTANCE_FUNCTIONS)))
+    tile_func = TILE_DISTANCE_FUNCTIONS[distance_method]
+    return _compute_tiled(tile_func, m1, m2, tile_size, output_filepath,
+                          dtype, processes)
+
+
+def _compute_tiled(tile_func, m1, m2, tile_size, output_filepath, dtype,
+                   processes):
+    """
+    Implementation of ``compute_distance_matrix_tiled`` given a tile distance
+    function.
+    """
+    log = logging.getLogger(__name__)
+    symmetric = m2 is None
+    if m1.ndim == 1:
+        m1 = m1[np.newaxis]
+    if symmetric:
+        m2 = m1
+    elif m2.ndim == 1:
+        m2 = m2[np.newaxis]
+    shape = (m1.shape[0], m2.shape[0])
+    tile_size = int(tile_size)
+
+    tiles = [(i, j)
+             for i in xrange(0, shape[0], tile_size)
+             for j in xrange(i if symmetric else 0, shape[1], tile_size)]
+    processes = min(processes or multiprocessing.cpu_count(), len(tiles))
+
+    if output_filepath:
+        safe_create_dir(osp.dirname(osp.abspath(output_filepath)))
+        # Mapped shared, so writes by forked workers are seen here.
+        out = np.lib.format.open_memmap(output_filepath, mode='w+',
+                                        dtype=dtype, shape=shape)
+    else:
+        out = shared_array(shape, dtype, processes > 1)
+
+    log.info("Computing %s distance %s in %d tiles with %d processes",
+             tile_func.__name__, "kernel" if symmetric else "matrix",
+             len(tiles), processes)
+    tile_state = {
+        'tile_func': tile_func,
+        'tile_size': tile_size,
+        'm1': m1,
+        'm2': m2,
+        'out': out,
+        'symmetric': symmetric,
+    }
+    s = [0] * 7
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, initializer=_init_tile_worker,
+                                    initargs=(tile_state,))
+        try:
+            for _ in pool.imap_unordered(_compute_tile, tiles):
+                report_progress(log.debug, s, 1.)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_tile_worker(tile_state)
+        try:
+            for tile in tiles:
+                _compute_tile(tile)
+                report_progress(log.debug, s, 1.)
+        finally:
+            _tile_state.clear()
+
+    if output_filepath:
+        out.flush()
+    return out
+
+
 def compute_distance_kernel(m, dist_func, row_wise=False, parallel=True):
     """
     Method for computing the distance kernel of an array of vectors given a
@@ -24,6 +306,10 @@ def compute_distance_kernel(m, dist_func, row_wise=False, parallel=True):
     For a valid distance function interface, see
     ``smqtk.utils.distance_functions.histogram_intersection_distance2``.
 
+    Distance functions from ``smqtk.utils.metrics`` with a tile equivalent in
+    ``TILE_DISTANCE_FUNCTIONS`` are computed with
+    ``compute_distance_matrix_tiled``.
+
     :param m: An array of vectors to compute the pairwise distance kernel for.
     :type m: numpy.core.multiarray.ndarray
 
@@ -63,6 +349,11 @@ def compute_distance_kernel(m, dist_func, row_wise=False, parallel=True):
     if m.ndim == 1:
         m = m[np.newaxis]
 
+    if dist_func in _PAIRWISE_TILE_FUNCTIONS:
+        return _compute_tiled(_PAIRWISE_TILE_FUNCTIONS[dist_func], m, None,
+                              KERNEL_TILE_SIZE, None, float,
+                              None if parallel else 1)
+
     log.info("Computing distance kernel")
     side = m.shape[0]
     mat = np.ndarray((side, side), dtype=float)
@@ -117,11 +408,18 @@ def compute_distance_matrix(m1, m2, dist_func, row_wise=False):
     """
     Function for computing the pair-wise distance matrix between two arrays of
     vectors. Both matrices must have the same number of columns.
+
+    Distance functions from ``smqtk.utils.metrics`` with a tile equivalent in
+    ``TILE_DISTANCE_FUNCTIONS`` are computed in tiles in the current
+    process.
     """
     if m1.ndim == 1:
         m1 = m1[np.newaxis]
     if m2.ndim == 1:
         m2 = m2[np.newaxis]
+    if dist_func in _PAIRWISE_TILE_FUNCTIONS:
+        return _compute_tiled(_PAIRWISE_TILE_FUNCTIONS[dist_func], m1, m2,
+                              KERNEL_TILE_SIZE, None, float, 1)
     k = np.ndarray((m1.shape[0], m2.shape[0]), dtype=float)
     if row_wise:
         # row wise
@@ -134,6 +432,45 @@ def compute_distance_matrix(m1, m2, dist_func, row_wise=False):
     return k
 
 
+def _id_row_index(ids):
+    """
+    Create an index of the rows of IDs in an ID array for vectorized lookup.
+
+    :param ids: Array of IDs by row.
+    :type ids: numpy.core.multiarray.ndarray
+
+    :return: IDs in sorted order and the rows of the sorted IDs. Repeated IDs
+        are ordered by row.
+    :rtype: (numpy.core.multiarray.ndarray, numpy.core.multiarray.ndarray)
+
+    """
+    order = np.argsort(ids, kind='mergesort')
+    return ids[order], order
+
+
+def _lookup_rows(index, ids):
+    """
+    Look up the rows of IDs in an index from ``_id_row_index``, the first row
+    being returned for repeated IDs.
+
+    :param index: Sorted IDs and their rows.
+    :type index: (numpy.core.multiarray.ndarray, numpy.core.multiarray.ndarray)
+
+    :param ids: Array of IDs to look up.
+    :type ids: numpy.core.multiarray.ndarray
+
+    :return: Rows of the given IDs, and a boolean array of which IDs are in
+        the index. Rows of IDs not in the index are undefined.
+    :rtype: (numpy.core.multiarray.ndarray, numpy.core.multiarray.ndarray)
+
+    """
+    sorted_ids, order = index
+    if not len(sorted_ids):
+        return np.zeros(len(ids), np.intp), np.zeros(len(ids), bool)
+    pos = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+    return order[pos], sorted_ids[pos] == ids
+
+
 class DistanceKernel (object):
     """
     Feature Distance Kernel object.
@@ -141,6 +478,10 @@ class DistanceKernel (object):
     This class allows the kernel to either be symmetric or not. If it is
     symmetric, the ``symmetric_submatrix`` function becomes available.
 
+    Kernels constructed from files are memory-mapped by default, and
+    sub-matrices are extracted with a single vectorized index into the
+    kernel, so only the pages of the requested rows are read.
+
     Intended to be used with ProxyManager proxy objects (given at
     construction)
 
@@ -161,7 +502,7 @@ class DistanceKernel (object):
 
     @classmethod
     def construct_symmetric_from_files(cls, id_vector_file, kernel_mat_file,
-                                       bg_flags_file=None):
+                                       bg_flags_file=None, mmap_mode='r'):
         """
         Construct a symmetric DistanceKernel object, requiring a background
         flags file to denote clip IDs that are to be treated as background
@@ -182,20 +523,20 @@ class DistanceKernel (object):
             to whether or not the associated clip ID should be considered a
             background video or not.
         :type bg_flags_file: str
+        :param mmap_mode: Memory-map mode to load the kernel matrix with, as
+            for ``numpy.load``, or None to load it into memory as a matrix.
+        :type mmap_mode: None | str
         :return: Symmetric DistanceKernel constructed with the data provided in
             the provided files.
         :rtype: DistanceKernel
 
         """
         clip_ids = np.array(np.loadtxt(id_vector_file))
-        # noinspection PyCallingNonCallable
-        kernel_mat = np.matrix(np.load(kernel_mat_file))
+        kernel_mat = cls._load_kernel(kernel_mat_file, mmap_mode)
 
         if bg_flags_file is not None:
             bg_flags = np.array(np.loadtxt(bg_flags_file))
-            bg_clips = np.array([clip_ids[i]
-                                 for i, e in enumerate(bg_flags)
-                                 if e])
+            bg_clips = set(clip_ids[bg_flags.astype(bool)])
         else:
             bg_clips = None
 
@@ -203,7 +544,7 @@ class DistanceKernel (object):
 
     @classmethod
     def construct_asymmetric_from_files(cls, row_ids_file, col_ids_file,
-                                        kernel_mat_file):
+                                        kernel_mat_file, mmap_mode='r'):
         """
         Construct an asymmetric DistanceKernel object, usually used for archive
         searches.
@@ -222,6 +563,9 @@ class DistanceKernel (object):
         :param kernel_mat_file: File containing the kernel matrix as saved by
             numpy.save(...) (saved as an ndarray, converted to matrix on load).
         :type kernel_mat_file: str
+        :param mmap_mode: Memory-map mode to load the kernel matrix with, as
+            for ``numpy.load``, or None to load it into memory as a matrix.
+        :type mmap_mode: None | str
         :return: Asymmetric DistanceKernel constructed with the data provided in
             the provided files.
         :rtype: DistanceKernel
@@ -229,10 +573,20 @@ class DistanceKernel (object):
         """
         row_cids = np.array(np.loadtxt(row_ids_file))
         col_cids = np.array(np.loadtxt(col_ids_file))
-        # noinspection PyCallingNonCallable
-        kernel_mat = np.matrix(np.load(kernel_mat_file))
+        kernel_mat = cls._load_kernel(kernel_mat_file, mmap_mode)
         return DistanceKernel(row_cids, col_cids, kernel_mat)
 
+    @staticmethod
+    def _load_kernel(kernel_mat_file, mmap_mode):
+        """
+        Load a kernel matrix file, memory-mapped if a mode is given, otherwise
+        into memory as a matrix.
+        """
+        if mmap_mode:
+            return np.load(kernel_mat_file, mmap_mode=mmap_mode)
+        # noinspection PyCallingNonCallable
+        return np.matrix(np.load(kernel_mat_file))
+
     @property
     def _log(self):
         return logging.getLogger('.'.join([self.__module__,
@@ -290,6 +644,8 @@ class DistanceKernel (object):
         self._row_id_index_map = row_id_index_map
         self._col_id_index_map = col_id_index_map
         self._kernel = kernel_mat
+        # Sorted row IDs and their rows, for vectorized ID-to-row lookup.
+        self._row_index = _id_row_index(np.asarray(row_id_index_map))
 
         assert ((bg_clip_ids is None)
                 or isinstance(bg_clip_ids, (set, frozenset))), \
@@ -424,7 +780,8 @@ class DistanceKernel (object):
                 except:
                     raise ValueError("Not all clip IDs could be used as ints!")
 
-                id_diff = set(clip_ids).difference(self._row_id_index_map)
+                _, found = _lookup_rows(self._row_index, np.array(clip_ids))
+                id_diff = set(np.array(clip_ids)[~found].tolist())
                 assert not id_diff, \
                     "Not all clip IDs provided are represented in this " \
                     "distance kernel matrix! (difference: %s)" \
@@ -438,26 +795,23 @@ class DistanceKernel (object):
                 else:
                     all_cids = set(clip_ids)
 
-            # Reorder the given clip IDs so that they are in the same relative
-            # order as the kernel matrix edges.
-            focus_indices = []
-            focus_clipids = []
-            for idx, cid in enumerate(self._row_id_index_map):
-                if (cid in all_cids) and (cid not in focus_clipids):
-                    focus_indices.append(idx)
-                    focus_clipids.append(cid)
+            # Rows of the clip IDs, in the same relative order as the kernel
+            # matrix edges.
+            rows, found = _lookup_rows(self._row_index,
+                                       np.array(sorted(all_cids)))
+            focus_indices = np.unique(rows[found])
+            focus_clipids = self._row_id_index_map[focus_indices]
 
             # index-to-isBG map for return
             # -> IDs provided as arguments are to be considered non-background,
             # even if a the ID is in the background set. All other IDs in the
             # union then must be from the background set.
-            focus_id2isbg = []
-            for idx in focus_indices:
-                cid = self._row_id_index_map[idx]
-                focus_id2isbg.append(False if cid in clip_ids else True)
+            focus_id2isbg = ~np.in1d(focus_clipids, clip_ids)
 
-            ret_mat = self._kernel[focus_indices, :][:, focus_indices]
-            return focus_clipids, focus_id2isbg, ret_mat
+            ret_mat = np.asmatrix(
+                self._kernel[np.ix_(focus_indices, focus_indices)]
+            )
+            return focus_clipids.tolist(), focus_id2isbg.tolist(), ret_mat
 
     # noinspection PyPep8Naming
     def extract_rows(self, *clipID_or_IDs):
@@ -489,28 +843,25 @@ class DistanceKernel (object):
                     raise ValueError("Not all clip IDs could be used as ints: "
                                      "%s" % str(ex))
 
-                id_diff = clipID_or_IDs.difference(self._row_id_index_map)
+                ids = np.array(sorted(clipID_or_IDs))
+                _, found = _lookup_rows(self._row_index, ids)
+                id_diff = set(ids[~found].tolist())
                 assert not id_diff, \
                     "Not all clip IDs provided are represented in this " \
                     "distance kernel matrix! (difference: %s)" \
                     % id_diff
                 del id_diff
 
-            # Reorder the given clip IDs so that they are in the same relative
-            # order as the kernel matrix edge order
+            # All rows of the given clip IDs, in kernel matrix edge order
             with SimpleTimer("Creating focus index/cid sequence", self._log.debug):
-                focus_row_indices = []
-                focus_row_clipids = []
-                for idx, cid in enumerate(self._row_id_index_map):
-                    # if ((cid in clipID_or_IDs)
-                    #         and (cid not in focus_row_clipids)):
-                    if cid in clipID_or_IDs:
-                        focus_row_indices.append(idx)
-                        focus_row_clipids.append(cid)
+                focus_row_indices = np.flatnonzero(
+                    np.in1d(self._row_id_index_map, ids)
+                )
+                focus_row_clipids = self._row_id_index_map[focus_row_indices]
 
             with SimpleTimer("Cropping kernel to focus range", self._log.debug):
                 return (
                     tuple(focus_row_clipids),
                     tuple(self._col_id_index_map),
-                    self._kernel[focus_row_indices, :]
+                    np.asmatrix(self._kernel[focus_row_indices, :])
                 )
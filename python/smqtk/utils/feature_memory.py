@@ -6,8 +6,14 @@ KITWARE_LICENSE.TXT for licensing information, or contact General Counsel,
 Kitware, Inc., 28 Corporate Drive, Clifton Park, NY 12065.
 """
 
+import errno
+import fcntl
+import glob
 import logging
 import multiprocessing
+import os
+import time
+
 import numpy as np
 
 from smqtk.utils import ReadWriteLock
@@ -23,7 +29,8 @@ class FeatureMemory (object):
 
     @classmethod
     def construct_from_files(cls, id_vector_file, bg_flags_file,
-                             feature_mat_file, kernel_mat_file, rw_lock=None):
+                             feature_mat_file, kernel_mat_file, rw_lock=None,
+                             mmap_mode=None):
         """ Initialize FeatureMemory object from file sources.
 
         :param id_vector_file: File containing the numpy.savetxt(...) output of
@@ -41,6 +48,14 @@ class FeatureMemory (object):
             to whether or not the associated clip ID should be considered a
             background video or not.
         :type bg_flags_file: str
+        :param rw_lock: Optional ReadWriteLock for the new instance to use.
+        :type rw_lock: None or ReadWriteLock
+        :param mmap_mode: Optional memory-map mode to load the feature and
+            kernel matrices with, as for ``numpy.load``. Memory-mapped
+            matrices are paged in as rows are accessed instead of being
+            loaded whole, but new clip IDs cannot be added to them by
+            ``update``.
+        :type mmap_mode: None | str
         :return: Symmetric FeatureMemory constructed with the data provided in
             the provided files.
         :rtype: FeatureMemory
@@ -48,10 +63,14 @@ class FeatureMemory (object):
         """
         clip_ids = np.array(np.load(id_vector_file))
         bg_flags = np.array(np.load(bg_flags_file))
-        # noinspection PyCallingNonCallable
-        feature_mat = np.matrix(np.load(feature_mat_file))
-        # noinspection PyCallingNonCallable
-        kernel_mat = np.matrix(np.load(kernel_mat_file))
+        if mmap_mode:
+            feature_mat = np.load(feature_mat_file, mmap_mode=mmap_mode)
+            kernel_mat = np.load(kernel_mat_file, mmap_mode=mmap_mode)
+        else:
+            # noinspection PyCallingNonCallable
+            feature_mat = np.matrix(np.load(feature_mat_file))
+            # noinspection PyCallingNonCallable
+            kernel_mat = np.matrix(np.load(kernel_mat_file))
 
         bg_clips = set([clip_ids[i]
                         for i, f in enumerate(bg_flags)
@@ -75,7 +94,9 @@ class FeatureMemory (object):
         NOTE: Arrays and matrices given here must own their data! This is
         currently required in order to resize them later when updating with new
         feature vectors. A ValueError will be thrown if an given array/matrix
-        does not own its data.
+        does not own its data. The feature and kernel matrices may instead be
+        memory-mapped arrays, in which case ``update`` may only update the
+        vectors of existing clip IDs, and only if mapped writable.
 
         TODO: Allow kernel matrix to be optional, causing it to be built from
         the provided feature matrix (not a recommended action).
@@ -113,10 +134,12 @@ class FeatureMemory (object):
         if id_vector.base is not None:
             raise ValueError("Given ``id_vector`` does not own its data! It "
                              "will not be transformable later.")
-        elif feature_mat.base is not None:
+        elif feature_mat.base is not None \
+                and not isinstance(feature_mat, np.memmap):
             raise ValueError("Given ``feature_mat`` does not own its data! It "
                              "will not be transformable later.")
-        elif kernel_mat.base is not None:
+        elif kernel_mat.base is not None \
+                and not isinstance(kernel_mat, np.memmap):
             raise ValueError("Given ``kernel_mat`` does not own its data! It "
                              "will not be transformable later.")
 
@@ -263,17 +286,11 @@ class FeatureMemory (object):
             "Not given an integer or a valid iterable over integers!"
 
         with self._rw_lock.read_lock():
-            # rows = num of IDs given, cols = width of feature matrix
-            with SimpleTimer("Allocating return matrix", self._log.debug):
-                # noinspection PyUnresolvedReferences
-                # -> matrix class DOES have ``dtype`` property...
-                ret_mat = matrix(ndarray((len(clip_id_or_ids),
-                                          self._feature_mat.shape[1]),
-                                         self._feature_mat.dtype))
-            for i, cid in enumerate(clip_id_or_ids):
-                feature_idx = self._cid2idx_map[cid]
-                ret_mat[i, :] = self._feature_mat[feature_idx, :]
-            return ret_mat
+            feature_idxs = [self._cid2idx_map[cid] for cid in clip_id_or_ids]
+            # Single fancy index so only the requested rows are read from a
+            # memory-mapped feature matrix.
+            with SimpleTimer("Gathering feature rows", self._log.debug):
+                return np.asmatrix(self._feature_mat[feature_idxs, :])
 
     # noinspection PyUnresolvedReferences,PyCallingNonCallable
     def update(self, clip_id, feature_vec=None, is_background=False, timeout=None):
@@ -334,6 +351,13 @@ class FeatureMemory (object):
                 if feature_vec is None:
                     raise ValueError("Update given a new clip ID, but no "
                                      "feature vector provided.")
+                # Checked before changing any state, e.g. for memory-mapped
+                # matrices that cannot be resized.
+                # noinspection PyUnresolvedReferences
+                if self._feature_mat.base is not None:
+                    raise RuntimeError("Feature matrix does not own its data")
+                if self._kernel_mat.base is not None:
+                    raise RuntimeError("kernel matrix does not own its data")
 
                 # Update internal feature matrix with added vector
                 self._cid2idx_map[clip_id] = self._id_vector.size
@@ -380,6 +404,556 @@ class FeatureMemory (object):
                 self._kernel_mat[:, -1] = dist_vec.T
 
 
+class SharedFeatureMemory (FeatureMemory):
+    """
+    FeatureMemory whose feature and kernel matrices live in named,
+    memory-mapped segments shared between processes.
+
+    Segments are ``.npy`` files in a segment directory, e.g. under
+    ``/dev/shm`` for a RAM backed store. Any process may attach to the same
+    directory and maps the segments read-only, so matrix accesses read shared
+    pages without copies or round-trips to a server process.
+
+    Updates serialize on this instance's ReadWriteLock, within the process,
+    and on a file lock in the segment directory, between processes. A header
+    segment records a sequence number, odd while a write is in progress, the
+    generation of the current segment files, the number of rows in use and
+    the row being written. Segments are allocated with spare rows, so updates
+    of existing clip IDs and, while spare rows remain, added clip IDs are
+    written in place. Adding a clip ID to full segments writes a new
+    generation of larger segments, copying the current ones block by block,
+    that attached instances switch to on their next access.
+
+    Reads of copied data are retried when the sequence number changed during
+    the read, and fail if a write does not finish within
+    ``WRITE_WAIT_TIMEOUT`` seconds. The next update, holding the file lock,
+    recovers the segments from a writer that died during a write.
+    """
+
+    HEADER_FILE = 'header.npy'
+    LOCK_FILE = 'write.lock'
+    SEGMENT_NAMES = ('ids', 'bg_flags', 'features', 'kernel')
+    # Spare rows segments are allocated with, as a fraction of the rows in
+    # use, and at least ``MIN_SPARE_ROWS``.
+    SPARE_ROWS_FRACTION = 0.25
+    MIN_SPARE_ROWS = 16
+    # Size of the blocks of rows copied into new segments.
+    COPY_BLOCK_BYTES = 1 << 26
+    # Seconds readers wait for a write in progress to finish.
+    WRITE_WAIT_TIMEOUT = 30
+
+    @classmethod
+    def create(cls, segment_dir, id_vector, bg_clip_ids, feature_mat,
+               kernel_mat, rw_lock=None):
+        """ Create shared segments in a directory and attach to them.
+
+        :raise ValueError: The segment directory already contains segments,
+            or the kernel matrix is misshapen.
+
+        :param segment_dir: Directory to create segments in.
+        :type segment_dir: str
+        :param id_vector: Array of clip IDs associated to the rows of the
+            feature and kernel matrices.
+        :type id_vector: ndarray of int
+        :param bg_clip_ids: Set of clip IDs that are to be treated as
+            background clip IDs.
+        :type bg_clip_ids: set of int
+        :param feature_mat: Matrix of features for clip IDs, one row per clip.
+        :type feature_mat: ndarray
+        :param kernel_mat: Square, symmetric kernel matrix between features.
+        :type kernel_mat: ndarray
+        :param rw_lock: Optional ReadWriteLock for the new instance to use.
+        :type rw_lock: None or ReadWriteLock
+        :return: Instance attached to the new segments.
+        :rtype: SharedFeatureMemory
+
+        """
+        id_vector = np.asarray(id_vector)
+        if not (kernel_mat.shape[0] == kernel_mat.shape[1]
+                == feature_mat.shape[0] == len(id_vector)):
+            raise ValueError("The distance kernel matrix provided is either "
+                             "misshapen or conflicts with the dimensions of "
+                             "the provided feature matrix. (kernel matrix "
+                             "shape: %s, num feature vectors: %d"
+                             % (kernel_mat.shape, feature_mat.shape[0]))
+        if not os.path.isdir(segment_dir):
+            os.makedirs(segment_dir)
+        header_fp = os.path.join(segment_dir, cls.HEADER_FILE)
+        if os.path.exists(header_fp):
+            raise ValueError("Segment directory '%s' already contains shared "
+                             "feature memory segments." % segment_dir)
+        bg_flags = np.array([cid in bg_clip_ids for cid in id_vector.tolist()],
+                            dtype=bool)
+        n = len(id_vector)
+        cls._write_segments(segment_dir, 0, cls._capacity(n), id_vector,
+                            bg_flags, np.asarray(feature_mat),
+                            np.asarray(kernel_mat))
+        # The header is written last, marking the segments as complete.
+        header = np.lib.format.open_memmap(header_fp, 'w+', np.int64, (4,))
+        header[:] = [0, 0, n, -1]
+        header.flush()
+        del header
+        return cls(segment_dir, rw_lock)
+
+    @classmethod
+    def create_from_files(cls, segment_dir, id_vector_file, bg_flags_file,
+                          feature_mat_file, kernel_mat_file, rw_lock=None):
+        """ Create shared segments from the files taken by
+        ``FeatureMemory.construct_from_files`` and attach to them.
+
+        The feature and kernel matrix files are memory-mapped while copying,
+        so they are not loaded whole into memory.
+
+        :return: Instance attached to the new segments.
+        :rtype: SharedFeatureMemory
+
+        """
+        clip_ids = np.load(id_vector_file)
+        bg_flags = np.load(bg_flags_file)
+        bg_clips = set(clip_ids[bg_flags.astype(bool)].tolist())
+        return cls.create(segment_dir, clip_ids, bg_clips,
+                          np.load(feature_mat_file, mmap_mode='r'),
+                          np.load(kernel_mat_file, mmap_mode='r'),
+                          rw_lock)
+
+    @classmethod
+    def _segment_filepath(cls, segment_dir, name, generation):
+        return os.path.join(segment_dir, '%s.%d.npy' % (name, generation))
+
+    @classmethod
+    def _capacity(cls, rows):
+        """
+        :return: Number of rows to allocate segments with for the given number
+            of rows in use.
+        :rtype: int
+        """
+        return rows + max(cls.MIN_SPARE_ROWS,
+                          int(rows * cls.SPARE_ROWS_FRACTION))
+
+    @classmethod
+    def _write_segments(cls, segment_dir, generation, capacity, *arrays):
+        """
+        Write arrays to the named segments of a generation, in the order of
+        ``SEGMENT_NAMES``, allocated with ``capacity`` rows, and columns for
+        the kernel.
+
+        Arrays are copied in blocks of rows, so memory-mapped arrays are not
+        loaded whole into memory.
+        """
+        for name, a in zip(cls.SEGMENT_NAMES, arrays):
+            fp = cls._segment_filepath(segment_dir, name, generation)
+            if name == 'kernel':
+                shape = (capacity, capacity)
+            else:
+                shape = (capacity,) + a.shape[1:]
+            m = np.lib.format.open_memmap(fp, 'w+', a.dtype, shape)
+            cols = tuple(slice(0, s) for s in a.shape[1:])
+            row_bytes = a.itemsize * int(np.prod(a.shape[1:]))
+            block = max(1, cls.COPY_BLOCK_BYTES // max(1, row_bytes))
+            for i in xrange(0, len(a), block):
+                rows = a[i:i + block]
+                m[(slice(i, i + len(rows)),) + cols] = rows
+            m.flush()
+            del m
+
+    def __init__(self, segment_dir, rw_lock=None):
+        """ Attach to shared segments created by ``create``.
+
+        :param segment_dir: Directory of the shared segments.
+        :type segment_dir: str
+        :param rw_lock: Optional ReadWriteLock for this instance to use. If not
+            provided, we will create our own.
+        :type rw_lock: None or ReadWriteLock
+
+        """
+        # Intentionally not calling the FeatureMemory constructor, which takes
+        # matrices that are owned by this instance.
+        self._segment_dir = segment_dir
+        if rw_lock:
+            assert isinstance(rw_lock, ReadWriteLock), \
+                "Not given a value ReadWriteLock instance!"
+            self._rw_lock = rw_lock
+        else:
+            self._rw_lock = ReadWriteLock()
+
+        # Sequence number, generation, number of rows in use and the row
+        # being written, or -1.
+        self._header = np.load(os.path.join(segment_dir, self.HEADER_FILE),
+                               mmap_mode='r')
+        # Header sequence number the rows in use and background ID set were
+        # last updated at.
+        self._seq = None
+        self._generation = None
+        self._attach()
+
+    def __getstate__(self):
+        return {'segment_dir': self._segment_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['segment_dir'])
+
+    def _attach(self):
+        """
+        Map the segments of the generation in the header read-only.
+
+        :raise IOError: The segments of the generation have been removed since
+            the header was read.
+        """
+        generation = int(self._header[1])
+        self._segments = tuple(
+            np.load(self._segment_filepath(self._segment_dir, n, generation),
+                    mmap_mode='r')
+            for n in self.SEGMENT_NAMES
+        )
+        self._cid2idx_map = {}
+        self._count = 0
+        self._set_count(0)
+        self._generation = generation
+        self._seq = None
+        self._log.debug("Attached to generation %d segments in %s",
+                        generation, self._segment_dir)
+
+    def _set_count(self, count):
+        """
+        Take views of the rows in use of the mapped segments, mapping the clip
+        IDs of rows added since the last call.
+        """
+        ids, bg_flags, features, kernel = self._segments
+        self._cid2idx_map.update(
+            (cid, idx) for idx, cid
+            in enumerate(ids[self._count:count].tolist(), self._count)
+        )
+        self._id_vector = ids[:count]
+        self._bg_flags = bg_flags[:count]
+        self._feature_mat = features[:count]
+        self._kernel_mat = kernel[:count, :count]
+        self._count = count
+
+    def _read(self, func):
+        """
+        Call ``func`` when no write is in progress, re-attaching to a new
+        generation of segments or refreshing the rows in use and background
+        IDs first if required, and call it again if a write started before it
+        returned.
+
+        :raise RuntimeError: A write in progress did not finish within
+            ``WRITE_WAIT_TIMEOUT`` seconds.
+
+        :param func: Function reading our state.
+        :type func: () -> object
+
+        :return: Return value of ``func``.
+        """
+        expire_time = None
+        while True:
+            seq = int(self._header[0])
+            if seq % 2:
+                # Write in progress.
+                if expire_time is None:
+                    expire_time = time.time() + self.WRITE_WAIT_TIMEOUT
+                elif time.time() >= expire_time:
+                    raise RuntimeError("Timeout expired while waiting for a "
+                                       "write to shared feature memory "
+                                       "segments in '%s' to finish. The "
+                                       "writer may have died, in which case "
+                                       "the next update recovers the "
+                                       "segments." % self._segment_dir)
+                time.sleep(0.001)
+                continue
+            try:
+                if int(self._header[1]) != self._generation:
+                    self._attach()
+                if seq != self._seq:
+                    self._set_count(int(self._header[2]))
+                    self._bg_clip_ids = set(
+                        self._id_vector[self._bg_flags].tolist()
+                    )
+                ret = func()
+            except (IOError, OSError), ex:
+                # Segments superseded and removed before we could attach.
+                if ex.errno != errno.ENOENT:
+                    raise
+                continue
+            if int(self._header[0]) == seq:
+                self._seq = seq
+                return ret
+
+    def get_version(self):
+        """
+        :return: Sequence number of the last write to the shared segments.
+            This increases by 2 for every update.
+        :rtype: int
+
+        """
+        with self._rw_lock.read_lock():
+            return self._read(lambda: int(self._header[0]))
+
+    def get_ids(self):
+        with self._rw_lock.read_lock():
+            return self._read(lambda: self._id_vector)
+
+    def get_bg_ids(self):
+        with self._rw_lock.read_lock():
+            return self._read(lambda: frozenset(self._bg_clip_ids))
+
+    def get_feature_matrix(self):
+        """
+        NOTE: NOT THREAD SAFE. The returned read-only memory-mapped matrix may
+        be updated in place by any process attached to the same segments.
+
+        :return: Matrix recording feature vectors for a feature type. See the
+            id vector for row-wise index-to-clipID association.
+        :rtype: numpy.memmap
+
+        """
+        with self._rw_lock.read_lock():
+            return self._read(lambda: self._feature_mat)
+
+    def get_kernel_matrix(self):
+        """
+        NOTE: NOT THREAD SAFE. The returned read-only memory-mapped matrix may
+        be updated in place by any process attached to the same segments.
+
+        :return: Symmetric matrix detailing the distances between any two clip
+            ID features. Distances are computed via histogram intersection.
+        :rtype: numpy.memmap
+
+        """
+        with self._rw_lock.read_lock():
+            return self._read(lambda: self._kernel_mat)
+
+    def get_distance_kernel(self):
+        with self._rw_lock.read_lock():
+            return self._read(lambda: DistanceKernel(
+                self._id_vector, self._id_vector, self._kernel_mat,
+                set(self._bg_clip_ids), self._rw_lock
+            ))
+
+    def get_feature(self, *clip_id_or_ids):
+        assert all(isinstance(e, int) for e in clip_id_or_ids), \
+            "Not given an integer or a valid iterable over integers!"
+
+        def gather():
+            idxs = [self._cid2idx_map[cid] for cid in clip_id_or_ids]
+            return np.asmatrix(self._feature_mat[idxs, :])
+
+        with self._rw_lock.read_lock():
+            return self._read(gather)
+
+    def _segment_lock(self, timeout=None):
+        """
+        Return an object to be used for ``with`` statements that holds an
+        exclusive lock on the segment directory, shared with other processes.
+
+        :param timeout: Optional timeout on the lock acquire in seconds.
+        :type timeout: None or int or float
+
+        """
+        lock_fp = os.path.join(self._segment_dir, self.LOCK_FILE)
+
+        # noinspection PyMethodParameters
+        class SegmentLock (object):
+
+            def __enter__(_self):
+                _self.f = open(lock_fp, 'a')
+                if timeout is None:
+                    fcntl.flock(_self.f, fcntl.LOCK_EX)
+                    return
+                expire_time = time.time() + timeout
+                while True:
+                    try:
+                        fcntl.flock(_self.f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        return
+                    except IOError, ex:
+                        if ex.errno not in (errno.EAGAIN, errno.EACCES):
+                            raise
+                    if time.time() >= expire_time:
+                        _self.f.close()
+                        raise RuntimeError("Timeout expired while waiting "
+                                           "for segment write lock.")
+                    time.sleep(0.001)
+
+            def __exit__(_self, *args):
+                fcntl.flock(_self.f, fcntl.LOCK_UN)
+                _self.f.close()
+
+        return SegmentLock()
+
+    def update(self, clip_id, feature_vec=None, is_background=False,
+               timeout=None):
+        """
+        Update the shared segments with a feature vector associated with a
+        clip ID, as for ``FeatureMemory.update``.
+
+        :raise ValueError: if the given feature vector is not compatible with
+            our feature vector.
+        :raise RuntimeError: If a timeout is given and the underlying write
+            locks don't acquire in that amount of time.
+
+        """
+        with self._rw_lock.write_lock(timeout):
+            with self._segment_lock(timeout):
+                clip_id = int(clip_id)
+                if int(self._header[0]) % 2:
+                    # Holding the file lock, no other writer is alive.
+                    self._recover()
+                # No writers remain, so this attaches to the latest segments.
+                self._read(lambda: None)
+                if feature_vec is not None and \
+                        not (feature_vec.ndim == 1
+                             and len(feature_vec) == self._feature_mat.shape[1]):
+                    raise ValueError("Given feature vector not compatible "
+                                     "(dimensionality or length does not "
+                                     "match)")
+                if clip_id in self._cid2idx_map:
+                    self._update_existing(self._cid2idx_map[clip_id],
+                                          feature_vec, is_background)
+                elif feature_vec is None:
+                    raise ValueError("Update given a new clip ID, but no "
+                                     "feature vector provided.")
+                else:
+                    self._add_new(clip_id, feature_vec, is_background)
+                self._read(lambda: None)
+
+    @staticmethod
+    def _hik_row(feature_vec, feature_mat):
+        """
+        :return: Histogram intersection of the feature vector with each row
+            of the feature matrix.
+        :rtype: ndarray
+        """
+        feature_mat = np.asarray(feature_mat)
+        return (feature_vec + feature_mat
+                - np.abs(feature_mat - feature_vec)).sum(axis=1) * 0.5
+
+    def _open_writable(self, name, generation=None):
+        """
+        :return: Writable memory-map of the header, or of a named segment of
+            a generation.
+        :rtype: numpy.memmap
+        """
+        if name == 'header':
+            fp = os.path.join(self._segment_dir, self.HEADER_FILE)
+        else:
+            fp = self._segment_filepath(self._segment_dir, name, generation)
+        return np.load(fp, mmap_mode='r+')
+
+    def _write_row(self, generation, idx, count, feature_vec, is_background,
+                   clip_id=None):
+        """
+        Write a row of a generation's segments in place, with ``count`` rows
+        in use including it.
+
+        ASSUMING write locks have already been acquired.
+        """
+        if clip_id is not None:
+            ids = self._open_writable('ids', generation)
+            ids[idx] = clip_id
+            ids.flush()
+        bg_flags = self._open_writable('bg_flags', generation)
+        bg_flags[idx] = is_background
+        bg_flags.flush()
+        if feature_vec is not None:
+            features = self._open_writable('features', generation)
+            kernel = self._open_writable('kernel', generation)
+            features[idx] = feature_vec
+            dist = self._hik_row(feature_vec, features[:count])
+            kernel[idx, :count] = dist
+            kernel[:count, idx] = dist
+            features.flush()
+            kernel.flush()
+
+    def _update_existing(self, idx, feature_vec, is_background):
+        """
+        Update a row of the current generation's segments in place, with the
+        header sequence number odd for the duration.
+
+        ASSUMING write locks have already been acquired.
+        """
+        header = self._open_writable('header')
+        header[3] = idx
+        header[0] += 1
+        try:
+            self._write_row(self._generation, idx, self._count, feature_vec,
+                            is_background)
+        finally:
+            header[3] = -1
+            header[0] += 1
+            header.flush()
+
+    def _add_new(self, clip_id, feature_vec, is_background):
+        """
+        Add a clip ID in the next spare row of the current generation's
+        segments, with the header sequence number odd for the duration.
+
+        If there are no spare rows, write a new generation of segments with
+        the added clip ID and switch the header to it, removing the superseded
+        segments. Processes still mapping removed segments keep them until
+        they re-attach.
+
+        ASSUMING write locks have already been acquired.
+        """
+        g = self._generation
+        n = self._count
+        header = self._open_writable('header')
+        if n < len(self._segments[0]):
+            header[3] = n
+            header[0] += 1
+            try:
+                self._write_row(g, n, n + 1, feature_vec, is_background,
+                                clip_id)
+                header[2] = n + 1
+            finally:
+                header[3] = -1
+                header[0] += 1
+                header.flush()
+            return
+
+        self._write_segments(self._segment_dir, g + 1, self._capacity(n + 1),
+                             self._id_vector, self._bg_flags,
+                             self._feature_mat, self._kernel_mat)
+        self._write_row(g + 1, n, n + 1, feature_vec, is_background, clip_id)
+        header[0] += 1
+        header[1] = g + 1
+        header[2] = n + 1
+        header[0] += 1
+        header.flush()
+        for fp in glob.glob(os.path.join(self._segment_dir, '*.%d.npy' % g)):
+            os.remove(fp)
+
+    def _recover(self):
+        """
+        Finish a write left by a writer that died with the header sequence
+        number odd. The kernel row and column of a row being written are
+        recomputed from its feature vector, which may be partially updated.
+        Segments of other generations than the header's are removed.
+
+        ASSUMING write locks have already been acquired.
+        """
+        header = self._open_writable('header')
+        g, count, idx = [int(v) for v in header[1:]]
+        self._log.warn("Recovering shared feature memory segments in '%s' "
+                       "from an interrupted write (row %d)",
+                       self._segment_dir, idx)
+        if 0 <= idx < count:
+            features = self._open_writable('features', g)
+            kernel = self._open_writable('kernel', g)
+            dist = self._hik_row(features[idx], features[:count])
+            kernel[idx, :count] = dist
+            kernel[:count, idx] = dist
+            kernel.flush()
+        current = set(self._segment_filepath(self._segment_dir, n, g)
+                      for n in self.SEGMENT_NAMES)
+        for n in self.SEGMENT_NAMES:
+            for fp in glob.glob(os.path.join(self._segment_dir,
+                                             '%s.*.npy' % n)):
+                if fp not in current:
+                    os.remove(fp)
+        header[3] = -1
+        header[0] += 1
+        header.flush()
+
+
 class FeatureMemoryMap (object):
     """ Map different feature types to their own FeatureMemory object
     """
@@ -484,6 +1058,31 @@ class FeatureMemoryMap (object):
                                                    kernel_mat_file,
                                                    rw_lock)
 
+    def initialize_shared(self, feature_type, segment_dir, rw_lock=None):
+        """ Initialize a feature type within this map by attaching to the
+        shared segments of a SharedFeatureMemory.
+
+        :raise KeyError: When the given feature_type is already present in the
+            map (requires a removal first).
+
+        :param feature_type: The name assigned to the feature type.
+        :type feature_type: str
+        :param segment_dir: Directory of segments created by
+            ``SharedFeatureMemory.create``.
+        :type segment_dir: str
+        :param rw_lock: Optionally specified ReadWriteLock instance to use with
+            the underlying SharedFeatureMemory.
+        :type rw_lock: ReadWriteLock
+
+        """
+        with self._map_lock:
+            if feature_type in self._feature2memory:
+                raise KeyError("Key '%s' already present in our mapping. "
+                               "Please remove first before initializing."
+                               % feature_type)
+            self._feature2memory[feature_type] = \
+                SharedFeatureMemory(segment_dir, rw_lock)
+
     def remove(self, feature_type):
         """ Removes a feature type from our map, releasing its contents.
 
@@ -0,0 +1,135 @@
+import collections
+import threading
+import time
+
+from smqtk.utils import SmqtkObject
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+class LruCache (SmqtkObject):
+    """
+    Thread-safe, least-recently-used cache of arbitrary objects bounded by the
+    number of entries stored.
+
+    Entries may optionally expire a fixed time after they were stored. Access
+    does not extend an entry's lifetime.
+
+    Hit and miss counts are recorded for reporting via ``stats``.
+    """
+
+    def __init__(self, max_entries, ttl=None):
+        """
+        :param max_entries: Maximum number of entries to hold. If this is 0 or
+            less, nothing is cached.
+        :type max_entries: int
+
+        :param ttl: Optional number of seconds after storage that entries
+            expire. Entries do not expire if this is None.
+        :type ttl: None | int | float
+
+        """
+        self.max_entries = int(max_entries)
+        self.ttl = ttl
+
+        self._lock = threading.RLock()
+        # Mapping of key to value and expiry time (None if not expiring), in
+        # least to most recently used order.
+        #: :type: collections.OrderedDict[collections.Hashable, (object, float)]
+        self._entries = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries and not self._expired(key)
+
+    def _expired(self, key):
+        """ ASSUMING lock is already held and key is present. """
+        expire_time = self._entries[key][1]
+        return expire_time is not None and time.time() >= expire_time
+
+    def get(self, key, default=None):
+        """
+        Get the value cached for the given key, marking it as most recently
+        used.
+
+        :param key: Cache key.
+        :type key: collections.Hashable
+
+        :param default: Value to return if the key is not cached.
+        :type default: object
+
+        :return: Cached value or ``default`` if the key is not cached.
+        :rtype: object
+
+        """
+        with self._lock:
+            if key in self._entries and self._expired(key):
+                del self._entries[key]
+            if key not in self._entries:
+                self._misses += 1
+                return default
+            entry = self._entries.pop(key)
+            self._entries[key] = entry
+            self._hits += 1
+            return entry[0]
+
+    def store(self, key, value):
+        """
+        Cache a value for the given key, evicting the least recently used
+        entries as needed to stay within the entry bound. The entry's expiry
+        time, if any, is reset.
+
+        :param key: Cache key.
+        :type key: collections.Hashable
+
+        :param value: Value to cache.
+        :type value: object
+
+        """
+        if self.max_entries <= 0:
+            return
+        expire_time = None
+        if self.ttl is not None:
+            expire_time = time.time() + self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expire_time)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def remove(self, key):
+        """
+        Remove the entry for the given key, if cached.
+
+        :param key: Cache key.
+        :type key: collections.Hashable
+
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        :return: Dictionary of cache usage statistics: hit and miss counts, hit
+            rate, number of entries and the entry bound.
+        :rtype: dict
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": (float(self._hits) / lookups) if lookups else 0.,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+            }
@@ -154,6 +154,30 @@ def cosine_distance(i, j, pos_vectors=True):
     return (1 + bool(pos_vectors)) * acos(sim) / pi
 
 
+def cosine_distance_rows(m, v, pos_vectors=True):
+    """
+    Cosine similarity converted into angular distance between each row of
+    matrix ``m`` and vector ``v``. This is a vectorized version of
+    ``cosine_distance``.
+
+    :param m: Matrix of row vectors.
+    :type m: numpy.core.multiarray.ndarray
+
+    :param v: Vector v
+    :type v: numpy.core.multiarray.ndarray
+
+    :param pos_vectors: If we expect vector elements to always be positive.
+        Default value is True (common case).
+    :type pos_vectors: bool
+
+    :return: Array of float distances in the [0, 1] range.
+    :rtype: numpy.core.multiarray.ndarray
+
+    """
+    sim = m.dot(v) / (np.sqrt(np.einsum('ij,ij->i', m, m)) * np.sqrt(v.dot(v)))
+    return (1 + bool(pos_vectors)) * np.arccos(np.clip(sim, -1, 1)) / pi
+
+
 def hamming_distance(i, j):
     """
     Return the hamming distance between the two given pythonic integers, or the
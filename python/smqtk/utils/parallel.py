@@ -1,16 +1,20 @@
 import collections
+import ctypes
 import heapq
 import itertools
 import logging
 import multiprocessing
 import multiprocessing.process
 import multiprocessing.queues
+import multiprocessing.sharedctypes
 import multiprocessing.synchronize
 import Queue
 import sys
 import threading
 import traceback
 
+import numpy
+
 from smqtk.utils import SmqtkObject
 
 
@@ -166,6 +170,31 @@ def parallel_map(work_func, *sequences, **kwargs):
                                    queue_results, feeder_thread, workers)
 
 
+def shared_array(shape, dtype, shared=True):
+    """
+    Create an uninitialized array, optionally backed by shared memory that is
+    inherited by forked child processes, e.g. ``multiprocessing.Pool``
+    workers created after the array.
+
+    :param shape: Shape of the array.
+    :type shape: tuple[int]
+
+    :param dtype: Array data type.
+    :type dtype: numpy.dtype | type
+
+    :param shared: If the array should be in shared memory.
+    :type shared: bool
+
+    :rtype: numpy.ndarray
+    """
+    if not shared:
+        return numpy.empty(shape, dtype)
+    dtype = numpy.dtype(dtype)
+    buf = multiprocessing.sharedctypes.RawArray(
+        ctypes.c_byte, int(numpy.prod(shape)) * dtype.itemsize)
+    return numpy.frombuffer(buf, dtype).reshape(shape)
+
+
 class _TerminalPacket (object):
     """
     Signals a terminal message
@@ -22,10 +22,13 @@ Plugin configuration dictionaries take the following general format:
 import abc
 import collections
 import importlib
+import json
 import logging
 import os
+import pkgutil
 import re
 import sys
+import threading
 
 
 # Template for checking validity of sub-module files
@@ -36,6 +39,15 @@ VALUE_ATTRIBUTE_RE = re.compile("^[a-zA-Z]\w*$")
 
 OS_ENV_PATH_SEP = (sys.platform == "win32" and ';') or ':'
 
+# Environment variable that may name a file in which to persist a manifest of
+# the plugin classes discovered in each module. See ``get_plugins``.
+PLUGIN_MANIFEST_ENV_VAR = "SMQTK_PLUGIN_MANIFEST"
+
+# Per-process cache of discovered plugin maps, keyed on discovery parameters.
+#: :type: dict[tuple, PluginMap]
+_PLUGIN_CACHE = {}
+_PLUGIN_CACHE_LOCK = threading.RLock()
+
 
 class NotUsableError (Exception):
     """
@@ -80,6 +92,325 @@ class Pluggable (object):
                                  "usable." % self.__class__.__name__)
 
 
+class PluginMap (dict):
+    """
+    Dictionary of plugin class names to class types, as returned by
+    ``get_plugins``.
+
+    Classes known from a plugin manifest are only imported when first
+    accessed, so checking or listing names does not import plugin modules.
+    Accessing a manifest class that is no longer importable or usable raises
+    a KeyError. Only discovery is recorded in the manifest: getting a class's
+    default configuration (and so ``make_config``) imports its module, as a
+    default configuration may depend on other plugins available.
+
+    Classes not yet imported are only visible through this class's methods,
+    not to operations using the underlying dictionary directly, such as
+    ``dict(m)``. Use ``dict(m.items())`` instead.
+
+    Copies made with ``copy`` may be modified independently of the original,
+    but import classes through it, so each class is imported once for all
+    copies.
+    """
+
+    def __init__(self, baseclass_type, manifest_fp=None):
+        super(PluginMap, self).__init__()
+        self._baseclass_type = baseclass_type
+        self._manifest_fp = manifest_fp
+        # Map this map was copied from, importing classes on our behalf.
+        #: :type: PluginMap | None
+        self._source = None
+        # Not yet imported class names to their module path and helper
+        # variable name.
+        #: :type: dict[str, (str, str)]
+        self._lazy = {}
+        # Class names to their manifest entry key and module source.
+        #: :type: dict[str, (str, (str, float))]
+        self._entries = {}
+        self._lock = threading.RLock()
+
+    def _add_class(self, cls, entry_key=None, source=None):
+        dict.__setitem__(self, cls.__name__, cls)
+        if entry_key:
+            self._entries[cls.__name__] = (entry_key, source)
+
+    def _add_lazy(self, name, module_path, helper_var, entry_key, source):
+        name = str(name)
+        self._lazy[name] = (str(module_path), str(helper_var))
+        self._entries[name] = (entry_key, source)
+
+    def get_default_config(self, name):
+        """
+        Get the default configuration of the named class.
+
+        :raises KeyError: No class by the given name is available.
+
+        :param name: Plugin class name.
+        :type name: str
+
+        :return: Default configuration dictionary of the class.
+        :rtype: dict
+
+        """
+        # noinspection PyUnresolvedReferences
+        return self[name].get_default_config()
+
+    def copy(self):
+        """
+        :return: Copy of this map that may be modified independently of it.
+        :rtype: PluginMap
+        """
+        with self._lock:
+            m = PluginMap(self._baseclass_type, self._manifest_fp)
+            dict.update(m, dict.items(self))
+            m._source = self
+            m._lazy = dict(self._lazy)
+            m._entries = dict(self._entries)
+            return m
+
+    def __delitem__(self, name):
+        with self._lock:
+            if name in self._lazy:
+                del self._lazy[name]
+            else:
+                dict.__delitem__(self, name)
+            self._entries.pop(name, None)
+
+    def pop(self, name, *default):
+        with self._lock:
+            try:
+                v = self[name]
+            except KeyError:
+                if default:
+                    return default[0]
+                raise
+            del self[name]
+            return v
+
+    def __missing__(self, name):
+        """
+        Import a class known from the plugin manifest.
+        """
+        with self._lock:
+            if dict.__contains__(self, name):
+                return dict.__getitem__(self, name)
+            if name not in self._lazy:
+                raise KeyError(name)
+            if self._source is not None:
+                del self._lazy[name]
+                cls = self._source[name]
+                dict.__setitem__(self, name, cls)
+                return cls
+            module_path, helper_var = self._lazy[name]
+            log = logging.getLogger('.'.join([__name__,
+                                              self.__class__.__name__]))
+            log.debug("[%s] Importing plugin class '%s'", module_path, name)
+            try:
+                module = importlib.import_module(module_path)
+                classes = _module_plugin_classes(module, module_path,
+                                                 helper_var,
+                                                 self._baseclass_type, log)
+            except Exception, ex:
+                log.warn("[%s] Failed to import module due to exception: "
+                         "(%s) %s",
+                         module_path, ex.__class__.__name__, str(ex))
+                classes = []
+            del self._lazy[name]
+            for cls in classes:
+                if cls.__name__ == name:
+                    dict.__setitem__(self, name, cls)
+                    return cls
+            msg = "Plugin class '%s' is no longer available from module " \
+                  "'%s'. The plugin manifest may be stale." \
+                  % (name, module_path)
+            log.warn(msg)
+            raise KeyError(msg)
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or name in self._lazy
+
+    has_key = __contains__
+
+    def __iter__(self):
+        with self._lock:
+            return iter(dict.keys(self) + list(self._lazy))
+
+    iterkeys = __iter__
+
+    def keys(self):
+        return list(self)
+
+    def __len__(self):
+        return dict.__len__(self) + len(self._lazy)
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, sorted(self))
+
+    # Item iteration skips manifest classes that turn out to be unavailable
+    # instead of failing part way.
+
+    def iteritems(self):
+        for name in self:
+            try:
+                yield name, self[name]
+            except KeyError:
+                continue
+
+    def itervalues(self):
+        for _, cls in self.iteritems():
+            yield cls
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+
+def _module_plugin_classes(module, module_path, helper_var, baseclass_type,
+                           log):
+    """
+    Find usable plugin classes in an imported module, via its helper variable
+    or by scanning its attributes.
+
+    :raises RuntimeError: The helper variable is set to an invalid value, or
+        a class found is not a ``baseclass_type`` sub-class.
+
+    :return: Usable classes found.
+    :rtype: list[type]
+    """
+    classes = []
+    if hasattr(module, helper_var):
+        # Looking for magic variable for import guidance
+        classes = getattr(module, helper_var)
+        if classes is None:
+            log.debug("[%s] Helper is None-valued, skipping module",
+                      module_path)
+            classes = []
+        elif (isinstance(classes, collections.Iterable) and
+              not isinstance(classes, basestring)):
+            classes = list(classes)
+            log.debug("[%s] Loaded list of %d class types via helper",
+                      module_path, len(classes))
+        elif issubclass(classes, baseclass_type):
+            log.debug("[%s] Loaded class type: %s",
+                      module_path, classes.__name__)
+            classes = [classes]
+        else:
+            raise RuntimeError("[%s] Helper variable set to an invalid "
+                               "value: %s", module_path, classes)
+    else:
+        # Scan module valid attributes for classes that descend from the
+        # given base-class.
+        for attr_name in dir(module):
+            if VALUE_ATTRIBUTE_RE.match(attr_name):
+                log.debug("[%s] Checking attribute '%s'", module_path,
+                          attr_name)
+                attr = getattr(module, attr_name)
+                # If the attribute looks like a class that descends and
+                # implements the interface, add it to the class list
+                # - we require that base is pluggable, so if class descends
+                #   from the given base-class, it will have
+                #   __abstractmethods__ property.
+                if isinstance(attr, type) and \
+                        attr is not baseclass_type and \
+                        issubclass(attr, baseclass_type) and \
+                        not bool(attr.__abstractmethods__):
+                    log.debug("[%s] -- Discovered subclass: %s",
+                              module_path, attr.__name__)
+                    classes.append(attr)
+
+    # Check the validity of the discovered class types
+    usable = []
+    for cls in classes:
+        # check that all class types in iterable are types and
+        # are subclasses of the given base-type and plugin interface
+        if not (isinstance(cls, type) and
+                cls is not baseclass_type and
+                issubclass(cls, baseclass_type)):
+            raise RuntimeError("[%s] Found element in list "
+                               "that is not a class or does "
+                               "not descend from required base "
+                               "class '%s': %s"
+                               % (module_path,
+                                  baseclass_type.__name__,
+                                  cls))
+        # Check if the algorithm reports being usable
+        elif not cls.is_usable():
+            log.debug('[%s] Class type "%s" reported not usable '
+                      '(skipping).',
+                      module_path, cls.__name__)
+        else:
+            usable.append(cls)
+    return usable
+
+
+def _module_source(module_path):
+    """
+    Find the source file of a module without importing it, and its
+    modification time.
+
+    :return: Source file path and modification time, or None if the module
+        could not be located.
+    :rtype: None | (str, float)
+    """
+    try:
+        loader = pkgutil.get_loader(module_path)
+    except Exception:
+        return None
+    fp = loader and getattr(loader, 'filename', None)
+    if not fp:
+        return None
+    if os.path.isdir(fp):
+        fp = os.path.join(fp, '__init__.py')
+    try:
+        return fp, os.path.getmtime(fp)
+    except OSError:
+        return None
+
+
+def _load_manifest(manifest_fp):
+    """
+    :return: Plugin manifest entries from the given file, or an empty
+        dictionary if it does not exist or is not readable.
+    :rtype: dict[str, dict]
+    """
+    try:
+        with open(manifest_fp) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_manifest(manifest_fp, manifest):
+    tmp_fp = "%s.%d.tmp" % (manifest_fp, os.getpid())
+    with open(tmp_fp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(tmp_fp, manifest_fp)
+
+
+def _save_manifest(manifest_fp, entries):
+    """
+    Write plugin manifest entries to the given file, merged with entries
+    currently in the file.
+    """
+    merged = _load_manifest(manifest_fp)
+    merged.update(entries)
+    _write_manifest(manifest_fp, merged)
+
+
 def get_plugins(base_module_str, internal_dir, dir_env_var, helper_var,
                 baseclass_type, warn=True, reload_modules=False):
     """
@@ -101,6 +432,22 @@ def get_plugins(base_module_str, internal_dir, dir_env_var, helper_var,
     the ``Pluggable`` interface defined above. This allows us to check if a
     loaded class ``is_usable``.
 
+    Discovery results are cached for the life of the process, so repeated calls
+    with the same parameters and environment variable value do not repeat
+    discovery. Use ``reload_modules`` to force rediscovery.
+
+    If the environment variable named by ``PLUGIN_MANIFEST_ENV_VAR`` is set to
+    a file path, the classes discovered in each module are also recorded in
+    that file with the module's source file modification time. Later
+    discoveries, including by other processes, take a module's classes from
+    the manifest while the module source is unchanged instead of importing the
+    module. Those classes are only imported when first accessed from the
+    returned map, e.g. when selected by ``from_plugin_config``. Class default
+    configurations are recorded as well when first requested. Because
+    usability and default configurations (which may include those of other
+    plugins) are recorded when discovered, the manifest file should be removed
+    when optional dependencies are installed or removed.
+
     Within a module we first look for a helper variable by the name provided,
     which can either be a single class object or an iterable of class objects,
     to be specifically exported. If the variable is set to None, we skip that
@@ -138,8 +485,9 @@ def get_plugins(base_module_str, internal_dir, dir_env_var, helper_var,
 
     :return: Map of discovered class objects descending from type
         ``baseclass_type`` and ``smqtk.utils.plugin.Pluggable`` whose keys are
-        the string names of the class types.
-    :rtype: dict of (str, type)
+        the string names of the class types. This is a copy of the map cached
+        for the process, so it may be modified by the caller.
+    :rtype: PluginMap
 
     """
     log = logging.getLogger('.'.join([__name__,
@@ -149,6 +497,28 @@ def get_plugins(base_module_str, internal_dir, dir_env_var, helper_var,
         raise ValueError("Required base-class must descend from the Pluggable "
                          "interface!")
 
+    cache_key = (base_module_str, internal_dir, os.environ.get(dir_env_var),
+                 helper_var, baseclass_type,
+                 os.environ.get(PLUGIN_MANIFEST_ENV_VAR))
+    with _PLUGIN_CACHE_LOCK:
+        if not reload_modules and cache_key in _PLUGIN_CACHE:
+            return _PLUGIN_CACHE[cache_key].copy()
+    # Not discovering under the lock as plugin modules are imported.
+    class_map = _discover_plugins(log, base_module_str, internal_dir,
+                                  dir_env_var, helper_var, baseclass_type,
+                                  warn, reload_modules)
+    with _PLUGIN_CACHE_LOCK:
+        _PLUGIN_CACHE[cache_key] = class_map
+    return class_map.copy()
+
+
+def _discover_plugins(log, base_module_str, internal_dir, dir_env_var,
+                      helper_var, baseclass_type, warn, reload_modules):
+    """
+    Plugin discovery for ``get_plugins``, without per-process caching.
+
+    :rtype: PluginMap
+    """
     # List of module paths to check for valid sub-classes.
     #: :type: list[str]
     module_paths = []
@@ -175,12 +545,31 @@ def get_plugins(base_module_str, internal_dir, dir_env_var, helper_var,
     else:
         log.debug("No paths added from environment.")
 
+    manifest_fp = os.environ.get(PLUGIN_MANIFEST_ENV_VAR)
+    manifest = (manifest_fp and _load_manifest(manifest_fp)) or {}
+    manifest_updates = {}
+    baseclass_name = '.'.join([baseclass_type.__module__,
+                               baseclass_type.__name__])
+
     log.debug("Getting plugins for module '%s'", base_module_str)
-    class_map = {}
+    class_map = PluginMap(baseclass_type, manifest_fp)
     for module_path in module_paths:
         log.debug("Examining module: %s", module_path)
+        source = manifest_fp and _module_source(module_path)
+        entry_key = '|'.join([module_path, helper_var, baseclass_name])
+        entry = manifest.get(entry_key)
+        if source and entry and not reload_modules and \
+                [entry['file'], entry['mtime']] == list(source):
+            log.debug("[%s] Using manifest classes: %s", module_path,
+                      entry['classes'])
+            for name in entry['classes']:
+                class_map._add_lazy(name, module_path, helper_var, entry_key,
+                                    source)
+            continue
+
         # We want any exception this might throw to continue up. If a module
         # in the directory is not importable, the user should know.
+        classes = []
         try:
             module = importlib.import_module(module_path)
         except Exception, ex:
@@ -188,78 +577,33 @@ def get_plugins(base_module_str, internal_dir, dir_env_var, helper_var,
                 log.warn("[%s] Failed to import module due to exception: "
                          "(%s) %s",
                          module_path, ex.__class__.__name__, str(ex))
-            continue
-        if reload_modules:
-            # Invoke reload in case the module changed between imports.
-            module = reload(module)
-            if module is None:
-                raise RuntimeError("[%s] Failed to reload"
-                                   % module_path)
-
-        # Find valid classes in the discovered module by:
-        classes = []
-        if hasattr(module, helper_var):
-            # Looking for magic variable for import guidance
-            classes = getattr(module, helper_var)
-            if classes is None:
-                log.debug("[%s] Helper is None-valued, skipping module",
-                          module_path)
-                classes = []
-            elif (isinstance(classes, collections.Iterable) and
-                  not isinstance(classes, basestring)):
-                classes = list(classes)
-                log.debug("[%s] Loaded list of %d class types via helper",
-                          module_path, len(classes))
-            elif issubclass(classes, baseclass_type):
-                log.debug("[%s] Loaded class type: %s",
-                          module_path, classes.__name__)
-                classes = [classes]
-            else:
-                raise RuntimeError("[%s] Helper variable set to an invalid "
-                                   "value: %s", module_path, classes)
         else:
-            # Scan module valid attributes for classes that descend from the
-            # given base-class.
-            for attr_name in dir(module):
-                if VALUE_ATTRIBUTE_RE.match(attr_name):
-                    log.debug("[%s] Checking attribute '%s'", module_path,
-                              attr_name)
-                    attr = getattr(module, attr_name)
-                    # If the attribute looks like a class that descends and
-                    # implements the interface, add it to the class list
-                    # - we require that base is pluggable, so if class descends
-                    #   from the given base-class, it will have
-                    #   __abstractmethods__ property.
-                    if isinstance(attr, type) and \
-                            attr is not baseclass_type and \
-                            issubclass(attr, baseclass_type) and \
-                            not bool(attr.__abstractmethods__):
-                        log.debug("[%s] -- Discovered subclass: %s",
-                                  module_path, attr.__name__)
-                        classes.append(attr)
-
-        # Check the validity of the discovered class types
+            if reload_modules:
+                # Invoke reload in case the module changed between imports.
+                module = reload(module)
+                if module is None:
+                    raise RuntimeError("[%s] Failed to reload"
+                                       % module_path)
+            classes = _module_plugin_classes(module, module_path, helper_var,
+                                             baseclass_type, log)
         for cls in classes:
-            # check that all class types in iterable are types and
-            # are subclasses of the given base-type and plugin interface
-            if not (isinstance(cls, type) and
-                    cls is not baseclass_type and
-                    issubclass(cls, baseclass_type)):
-                raise RuntimeError("[%s] Found element in list "
-                                   "that is not a class or does "
-                                   "not descend from required base "
-                                   "class '%s': %s"
-                                   % (module_path,
-                                      baseclass_type.__name__,
-                                      cls))
-            # Check if the algorithm reports being usable
-            elif not cls.is_usable():
-                log.debug('[%s] Class type "%s" reported not usable '
-                          '(skipping).',
-                          module_path, cls.__name__)
-            else:
-                # Otherwise add it to the output mapping
-                class_map[cls.__name__] = cls
+            class_map._add_class(cls, source and entry_key, source)
+
+        if source:
+            # Modules failing import are recorded as having no classes so that
+            # they are not imported again while unchanged.
+            manifest_updates[entry_key] = {
+                'file': source[0],
+                'mtime': source[1],
+                'classes': [cls.__name__ for cls in classes],
+            }
+
+    if manifest_updates:
+        try:
+            _save_manifest(manifest_fp, manifest_updates)
+        except (IOError, OSError), ex:
+            log.warn("Failed to save plugin manifest '%s': %s",
+                     manifest_fp, str(ex))
 
     return class_map
 
@@ -283,6 +627,14 @@ def make_config(plugin_map):
 
     """
     d = {"type": None}
+    if isinstance(plugin_map, PluginMap):
+        # Skip manifest classes no longer importable or usable.
+        for label in plugin_map:
+            try:
+                d[label] = plugin_map.get_default_config(label)
+            except KeyError:
+                continue
+        return d
     for label, cls in plugin_map.iteritems():
         # noinspection PyUnresolvedReferences
         d[label] = cls.get_default_config()
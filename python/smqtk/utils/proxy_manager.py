@@ -4,6 +4,12 @@ LICENCE
 Copyright 2013 by Kitware, Inc. All Rights Reserved. Please refer to
 KITWARE_LICENSE.TXT for licensing information, or contact General Counsel,
 Kitware, Inc., 28 Corporate Drive, Clifton Park, NY 12065.
+
+Every method call on a proxy below is a round-trip to the manager server that
+pickles arguments and return values, including whole matrices. To share
+feature and kernel matrices between processes without copies, use
+``smqtk.utils.feature_memory.SharedFeatureMemory`` instead, attaching each
+process to the same segment directory.
 """
 # -*- coding: utf-8 -*-
 from multiprocessing import current_process
@@ -11,7 +11,7 @@ import multiprocessing
 import time
 
 from smqtk.utils.distance_kernel import DistanceKernel
-from smqtk.utils.feature_memory import FeatureMemory
+from smqtk.utils.feature_memory import FeatureMemory, SharedFeatureMemory
 
 
 class TimedCache (object):
@@ -99,6 +99,14 @@ class TimedCache (object):
                                                 kernel_mat_file)
         self.store(key, fm, timeout)
 
+    def store_SharedFeatureMemory(self, key, segment_dir, timeout=0):
+        """
+        Store a FeatureMemory attached to the shared segments in the given
+        directory, created with ``SharedFeatureMemory.create``. Every process
+        may store its own instance attached to the same segments.
+        """
+        self.store(key, SharedFeatureMemory(segment_dir), timeout)
+
     def store_DistanceKernel_symmetric(self, key, id_vector_file,
                                        kernel_mat_file, bg_flags_file=None,
                                        timeout=0):
@@ -0,0 +1,211 @@
+import collections
+import cPickle
+import hashlib
+import json
+import os
+import threading
+
+import numpy
+
+from smqtk.utils import SmqtkObject
+from smqtk.utils import file_utils
+
+
+__author__ = "paul.tunison@kitware.com"
+
+
+def config_hash(config):
+    """
+    Stable hash of a JSON-compliant configuration dictionary, suitable for
+    distinguishing vectors produced by differently configured algorithms.
+
+    :param config: JSON-compliant configuration dictionary.
+    :type config: dict
+
+    :return: Hex digest string.
+    :rtype: str
+
+    """
+    return hashlib.sha1(json.dumps(config, sort_keys=True)).hexdigest()
+
+
+class VectorLruCache (SmqtkObject):
+    """
+    Thread-safe, least-recently-used cache of numpy vectors bounded by the
+    total number of bytes of the vectors stored.
+
+    Cache contents may optionally be persisted to, and loaded from, a file.
+    Hit and miss counts are recorded for reporting via ``stats``.
+    """
+
+    def __init__(self, max_bytes, cache_filepath=None):
+        """
+        :param max_bytes: Maximum total number of bytes of vector data to hold.
+        :type max_bytes: int
+
+        :param cache_filepath: Optional path to a file to persist cache contents
+            to when ``save`` is called. If this file exists, cache contents are
+            loaded from it.
+        :type cache_filepath: None | str
+
+        """
+        self.max_bytes = int(max_bytes)
+        self.cache_filepath = cache_filepath
+
+        self._lock = threading.RLock()
+        # Mapping of key to vector, in least to most recently used order.
+        #: :type: collections.OrderedDict[collections.Hashable, numpy.ndarray]
+        self._vectors = collections.OrderedDict()
+        self._total_bytes = 0
+        self._hits = 0
+        self._misses = 0
+
+        if self.cache_filepath and os.path.isfile(self.cache_filepath):
+            self._log.debug("Loading cached vectors from: %s",
+                            self.cache_filepath)
+            with open(self.cache_filepath, 'rb') as f:
+                for k, v in cPickle.load(f):
+                    self.store(k, v)
+
+    def __len__(self):
+        return len(self._vectors)
+
+    def __contains__(self, key):
+        return key in self._vectors
+
+    def _evict(self):
+        """ Evict LRU vectors until within bounds. ASSUMING lock is held. """
+        while self._total_bytes > self.max_bytes:
+            _, v = self._vectors.popitem(last=False)
+            self._total_bytes -= v.nbytes
+
+    def get(self, key):
+        """
+        Get the vector cached for the given key, marking it as most recently
+        used.
+
+        :param key: Cache key.
+        :type key: collections.Hashable
+
+        :return: Cached vector or None if the key is not cached. The returned
+            array should not be modified.
+        :rtype: numpy.ndarray | None
+
+        """
+        with self._lock:
+            v = self._vectors.pop(key, None)
+            if v is None:
+                self._misses += 1
+                return None
+            self._vectors[key] = v
+            self._hits += 1
+            return v
+
+    def store(self, key, vector):
+        """
+        Cache a vector for the given key, evicting least recently used vectors
+        as needed to stay within the byte bound. Vectors larger than the bound
+        are not stored.
+
+        :param key: Cache key.
+        :type key: collections.Hashable
+
+        :param vector: Vector to cache. A copy of the vector is stored.
+        :type vector: numpy.ndarray
+
+        """
+        v = numpy.array(vector, copy=True)
+        if v.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._vectors:
+                self._total_bytes -= self._vectors.pop(key).nbytes
+            self._vectors[key] = v
+            self._total_bytes += v.nbytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._vectors.clear()
+            self._total_bytes = 0
+
+    def save(self):
+        """
+        Write cache contents to the configured cache file, if one was
+        configured.
+        """
+        if not self.cache_filepath:
+            return
+        with self._lock:
+            items = self._vectors.items()
+        file_utils.safe_create_dir(os.path.dirname(
+            os.path.abspath(self.cache_filepath)
+        ))
+        tmp_fp = self.cache_filepath + '.tmp'
+        with open(tmp_fp, 'wb') as f:
+            cPickle.dump(items, f, -1)
+        os.rename(tmp_fp, self.cache_filepath)
+
+    def stats(self):
+        """
+        :return: Dictionary of cache usage statistics: hit and miss counts, hit
+            rate, number of entries, bytes used and the byte bound.
+        :rtype: dict
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": (float(self._hits) / lookups) if lookups else 0.,
+                "entries": len(self._vectors),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+def compute_descriptor_cached(cache, generator_key, generator, data,
+                              descr_factory):
+    """
+    Compute a descriptor via the given generator, using vectors from the given
+    cache when there is one for the generator key and data SHA1 checksum.
+
+    :raises RuntimeError: Descriptor extraction failure of some kind.
+    :raises ValueError: Given data element content was not of a valid type
+        with respect to the descriptor generator.
+
+    :param cache: Vector cache to consult, or None to always compute.
+    :type cache: VectorLruCache | None
+
+    :param generator_key: Key distinguishing the generator's configuration from
+        that of other generators, e.g. the ``config_hash`` of its
+        configuration.
+    :type generator_key: str
+
+    :param generator: Descriptor generator to compute descriptors with.
+    :type generator: smqtk.algorithms.DescriptorGenerator
+
+    :param data: Data element to compute the descriptor of.
+    :type data: smqtk.representation.DataElement
+
+    :param descr_factory: Factory to produce the returned descriptor element.
+    :type descr_factory: smqtk.representation.DescriptorElementFactory
+
+    :return: Descriptor element for the data.
+    :rtype: smqtk.representation.DescriptorElement
+
+    """
+    if cache is None:
+        return generator.compute_descriptor(data, descr_factory)
+
+    key = (generator_key, data.sha1())
+    v = cache.get(key)
+    if v is not None:
+        d = descr_factory.new_descriptor(generator.name, data.uuid())
+        d.set_vector(v)
+        return d
+
+    d = generator.compute_descriptor(data, descr_factory)
+    if d.has_vector():
+        cache.store(key, d.vector())
+    return d
@@ -1,3 +1,5 @@
+import atexit
+import json
 import mimetypes
 import multiprocessing
 import os
@@ -13,6 +15,12 @@ from smqtk.representation.data_element.url_element import DataUrlElement
 from smqtk.utils import SimpleTimer
 from smqtk.utils import plugin
 from smqtk.utils import merge_dict
+from smqtk.utils.batch_job_queue import BatchJobQueue, QueueFullError
+from smqtk.utils.vector_cache import (
+    compute_descriptor_cached,
+    config_hash,
+    VectorLruCache,
+)
 from smqtk.web import SmqtkWebApp
 
 MIMETYPES = mimetypes.MimeTypes()
@@ -44,7 +52,19 @@ class DescriptorServiceServer (SmqtkWebApp):
 
     Additional Configuration
 
+    ``descriptor_vector_cache`` configures a byte-bounded LRU cache of computed
+    descriptor vectors keyed on the generator configuration and the SHA1 of the
+    data, so repeated requests for the same content do not re-run the
+    generator. Setting ``max_bytes`` to 0 disables the cache. If a
+    ``cache_filepath`` is given, cache contents are loaded from it at start-up
+    and saved to it at exit. Cache statistics are available from
+    ``/descriptor_cache/stats``.
 
+    ``job_queue`` configures the worker pool servicing asynchronous compute
+    jobs submitted to ``/jobs/compute/<uri>``. Pending data for the same
+    generator is computed together in batches of up to ``batch_size``, and
+    submissions are rejected with a 503 status while ``max_pending`` items are
+    waiting. Finished job results are kept for ``result_ttl`` seconds.
 
     .. note:: We will look for an environment variable `DescriptorService_CONFIG` for a
               string file path to an additional JSON configuration file to consider.
@@ -71,7 +91,17 @@ class DescriptorServiceServer (SmqtkWebApp):
             "descriptor_factory": DescriptorElementFactory.get_default_config(),
             "descriptor_generators": {
                 "example": plugin.make_config(get_descriptor_generator_impls())
-            }
+            },
+            "descriptor_vector_cache": {
+                "max_bytes": 134217728,
+                "cache_filepath": None,
+            },
+            "job_queue": {
+                "num_workers": 2,
+                "batch_size": 16,
+                "max_pending": 1024,
+                "result_ttl": 600,
+            },
         })
         return c
 
@@ -100,12 +130,186 @@ class DescriptorServiceServer (SmqtkWebApp):
         self.descriptor_cache = {}
         self.descriptor_cache_lock = multiprocessing.RLock()
 
+        # Cache of computed descriptor vectors in front of the generators.
+        vc_config = self.json_config.get('descriptor_vector_cache', {})
+        #: :type: smqtk.utils.vector_cache.VectorLruCache | None
+        self.vector_cache = None
+        if vc_config.get('max_bytes', 0) > 0:
+            self.vector_cache = VectorLruCache(
+                vc_config['max_bytes'], vc_config.get('cache_filepath', None)
+            )
+            atexit.register(self.vector_cache.save)
+
+        # Queue of asynchronous compute jobs. Worker threads are started on
+        # first submission.
+        jq_config = self.json_config['job_queue']
+        self.job_queue = BatchJobQueue(
+            self.generate_descriptors,
+            num_workers=jq_config['num_workers'],
+            batch_size=jq_config['batch_size'],
+            max_pending=jq_config['max_pending'],
+            result_ttl=jq_config['result_ttl'],
+        )
+        atexit.register(self.job_queue.stop)
+
         @self.route("/")
         def list_ingest_labels():
             return flask.jsonify({
                 "labels": sorted(self.generator_label_configs.iterkeys())
             })
 
+        @self.route("/descriptor_cache/stats")
+        def descriptor_cache_stats():
+            """
+            Return usage statistics of the descriptor vector cache, or null
+            statistics if the cache is disabled.
+            """
+            return flask.jsonify({
+                "enabled": self.vector_cache is not None,
+                "stats": (self.vector_cache.stats()
+                          if self.vector_cache is not None else None),
+            })
+
+        @self.route("/jobs/compute/<path:uri>", methods=["POST"])
+        def submit_compute_job(uri):
+            """
+            Submit a job to compute descriptors over the specified content
+            asynchronously, returning the ID of the job to poll for results via
+            ``/jobs/<job_id>``.
+
+            Form args:
+                labels
+                    Optional JSON list of descriptor generator labels to compute
+                    descriptors with. By default, all generators that function
+                    over the data's content type are used.
+
+            JSON Return format::
+
+                {
+                    "success": <bool>
+
+                    "message": <str>
+
+                    "job_id": <str|None>
+
+                    "labels": <list[str]>
+
+                    "reference_uri": <str>
+                }
+
+            Returns status 202 when the job was accepted, 400 for bad input and
+            503 when the job queue is full.
+
+            """
+            def response(code, message, job_id=None, labels=()):
+                return flask.jsonify({
+                    "success": job_id is not None,
+                    "message": message,
+                    "job_id": job_id,
+                    "labels": sorted(labels),
+                    "reference_uri": uri,
+                }), code
+
+            try:
+                data_elem = self.resolve_data_element(uri)
+            except ValueError, ex:
+                return response(400, "Failed URI resolution: %s" % str(ex))
+
+            labels = flask.request.form.get('labels', None)
+            if labels is not None:
+                try:
+                    labels = json.loads(labels)
+                except ValueError, ex:
+                    return response(400, "Invalid labels JSON: %s" % str(ex))
+                if not (isinstance(labels, list)
+                        and all(isinstance(l, basestring) for l in labels)):
+                    return response(400, "Labels must be a JSON list of "
+                                         "strings.")
+                unknown = set(labels) - set(self.generator_label_configs)
+                if unknown:
+                    return response(400, "Unknown descriptor labels: %s"
+                                         % sorted(unknown))
+            else:
+                labels = [
+                    l for l in self.generator_label_configs
+                    if data_elem.content_type()
+                    in self.get_descriptor_inst(l).valid_content_types()
+                ]
+            if not labels:
+                return response(400, "No descriptors can handle URI content "
+                                     "type: %s" % data_elem.content_type())
+
+            try:
+                job_id = self.job_queue.submit([(l, data_elem)
+                                                for l in labels])
+            except QueueFullError, ex:
+                r = response(503, "Job queue full, try again later: %s"
+                                  % str(ex), labels=labels)
+                r[0].headers['Retry-After'] = '1'
+                return r
+            return response(202, "Job submitted", job_id, labels)
+
+        @self.route("/jobs/stats")
+        def job_queue_stats():
+            """
+            Return the current number of pending items in the job queue.
+            """
+            return flask.jsonify(self.job_queue.stats())
+
+        @self.route("/jobs/<string:job_id>")
+        def get_job(job_id):
+            """
+            Get the status of a submitted compute job, and its descriptors once
+            it has finished.
+
+            JSON Return format::
+
+                {
+                    "success": <bool>
+
+                    "message": <str>
+
+                    "job_id": <str>
+
+                    "status": <"queued"|"running"|"done"|None>
+
+                    "descriptors": {  "<label>":  <list[float]|None>, ... }
+
+                    "errors": {  "<label>":  <str>, ... }
+                }
+
+            Returns status 404 if there is no job by the given ID, which may be
+            because its results have expired.
+
+            """
+            try:
+                s = self.job_queue.status(job_id)
+            except KeyError:
+                return flask.jsonify({
+                    "success": False,
+                    "message": "No job with ID '%s'" % job_id,
+                    "job_id": job_id,
+                    "status": None,
+                    "descriptors": {},
+                    "errors": {},
+                }), 404
+
+            descriptors = {}
+            errors = {}
+            for label, vec, err in s.get('items', ()):
+                descriptors[label] = vec
+                if err is not None:
+                    errors[label] = err
+            return flask.jsonify({
+                "success": s['status'] == BatchJobQueue.STATUS_DONE
+                           and not errors,
+                "message": "Job %s" % s['status'],
+                "job_id": job_id,
+                "status": s['status'],
+                "descriptors": descriptors,
+                "errors": errors,
+            })
+
         @self.route("/all/content_types")
         def all_content_types():
             """
@@ -340,9 +544,85 @@ class DescriptorServiceServer (SmqtkWebApp):
         """
         with SimpleTimer("Computing descriptor...", self._log.debug):
             cd = self.get_descriptor_inst(cd_label)
-            descriptor = cd.compute_descriptor(de, self.descr_elem_factory)
+            descriptor = compute_descriptor_cached(
+                self.vector_cache,
+                config_hash(self.generator_label_configs[cd_label]),
+                cd, de, self.descr_elem_factory
+            )
 
         return descriptor
 
+    def generate_descriptors(self, cd_label, data_elements):
+        """
+        Generate descriptors for many data elements using the specified
+        descriptor generator, computing vectors not found in the vector cache
+        together via the generator's asynchronous computation.
+
+        :type cd_label: str
+        :type data_elements: list[smqtk.representation.DataElement]
+
+        :return: List of descriptor vectors, as lists of floats, and list of
+            error messages, in the order of the given data elements. Vectors
+            are None and messages are not None for data that failed.
+        :rtype: (list[list[float]|None], list[str|None])
+
+        """
+        cd = self.get_descriptor_inst(cd_label)
+        gen_key = config_hash(self.generator_label_configs[cd_label])
+        vectors = {}
+        errors = {}
+
+        to_compute = []
+        for de in data_elements:
+            v = None
+            if self.vector_cache is not None:
+                v = self.vector_cache.get((gen_key, de.sha1()))
+            if v is not None:
+                vectors[de.uuid()] = v
+            elif de.content_type() not in cd.valid_content_types():
+                errors[de.uuid()] = "Data content type issue: Cannot " \
+                                    "compute descriptor of content type " \
+                                    "'%s'" % de.content_type()
+            else:
+                to_compute.append(de)
+
+        if to_compute:
+            with SimpleTimer("Computing %d descriptors..." % len(to_compute),
+                             self._log.debug):
+                try:
+                    de2descr = cd.compute_descriptor_async(
+                        to_compute, self.descr_elem_factory
+                    )
+                except (RuntimeError, ValueError), ex:
+                    self._log.warn("Batch descriptor computation failed (%s), "
+                                   "computing individually", str(ex))
+                    de2descr = {}
+                    for de in to_compute:
+                        try:
+                            de2descr[de] = cd.compute_descriptor(
+                                de, self.descr_elem_factory
+                            )
+                        except RuntimeError, ex:
+                            errors[de.uuid()] = \
+                                "Descriptor extraction failure: %s" % str(ex)
+                        except ValueError, ex:
+                            errors[de.uuid()] = \
+                                "Data content type issue: %s" % str(ex)
+            for de, d in de2descr.iteritems():
+                if d.has_vector():
+                    vectors[de.uuid()] = d.vector()
+                    if self.vector_cache is not None:
+                        self.vector_cache.store((gen_key, de.sha1()),
+                                                d.vector())
+                else:
+                    errors[de.uuid()] = "Descriptor extraction failure: " \
+                                        "No descriptor content"
+
+        return (
+            [vectors[de.uuid()].tolist() if de.uuid() in vectors else None
+             for de in data_elements],
+            [errors.get(de.uuid(), None) for de in data_elements]
+        )
+
 
 APPLICATION_CLASS = DescriptorServiceServer
@@ -16,6 +16,7 @@ from smqtk.iqr import (
     iqr_controller,
     iqr_session,
 )
+from smqtk.iqr.session_store import get_iqr_session_store_impls
 from smqtk.representation import (
     ClassificationElementFactory,
     get_descriptor_index_impls,
@@ -24,6 +25,7 @@ from smqtk.utils import (
     merge_dict,
     plugin,
 )
+from smqtk.utils.lru_cache import LruCache
 from smqtk.web import SmqtkWebApp
 
 
@@ -54,6 +56,10 @@ class IqrService (SmqtkWebApp):
     global index and once for the nearest neighbors index. These will probably
     be the set to the same index. In more detail, the global descriptor index
     is used when the "refine" endpoint is given descriptor UUIDs
+
+    ``session_control.classifier_cache_size`` sets the number of classifiers
+    trained for the "classify" endpoint that are kept for reuse. Classifiers
+    are shared between sessions with identical adjudications.
     """
 
     @classmethod
@@ -74,6 +80,8 @@ class IqrService (SmqtkWebApp):
 
                 "session_control": {
                     "positive_seed_neighbors": 500,
+                    "max_resident_descriptors": 0,
+                    "classifier_cache_size": 16,
                     "session_expiration": {
                         "enabled": False,
                         "check_interval_seconds": 30,
@@ -97,6 +105,18 @@ class IqrService (SmqtkWebApp):
                     "neighbor_index":
                         "This is the neighbor index to pull initial near-"
                         "positive descriptors from.",
+                    "session_store":
+                        "Optional store that session states are persisted "
+                        "to. With a store shared between processes, such as "
+                        "the SqliteIqrSessionStore, multiple service "
+                        "processes may serve the same sessions. Restored "
+                        "sessions retrieve descriptors from the configured "
+                        "descriptor_index, so it must contain all "
+                        "descriptors the neighbor_index may return. When a "
+                        "store is configured, session_control."
+                        "max_resident_descriptors may limit the total size of "
+                        "session working indices held in memory (0 for no "
+                        "limit).",
                     "classifier_config":
                         "The configuration to use for training and using "
                         "classifiers for the /classifier endpoint. "
@@ -119,6 +139,8 @@ class IqrService (SmqtkWebApp):
                     ),
                     "neighbor_index":
                         plugin.make_config(get_nn_index_impls()),
+                    "session_store":
+                        plugin.make_config(get_iqr_session_store_impls()),
                     "classifier_config":
                         plugin.make_config(get_classifier_impls()),
                     "classification_factory":
@@ -156,29 +178,33 @@ class IqrService (SmqtkWebApp):
         self.rel_index_config = \
             json_config['iqr_service']['plugins']['relevancy_index_config']
 
-        # Record of trained classifiers for a session. Session classifier
-        # modifications locked under the parent session's global lock.
-        #: :type: dict[collections.Hashable, smqtk.algorithms.SupervisedClassifier | None]
-        self.session_classifiers = {}
-        # Control for knowing when a new classifier should be trained for a
-        # session (True == train new classifier). Modification for specific
-        # sessions under parent session's lock.
-        #: :type: dict[collections.Hashable, bool]
-        self.session_classifier_dirty = {}
-
-        def session_expire_callback(session):
-            """
-            :type session: smqtk.iqr.IqrSession
-            """
-            with session:
-                self._log.debug("Removing session %s classifier", session.uuid)
-                del self.session_classifiers[session.uuid]
-                del self.session_classifier_dirty[session.uuid]
+        # Trained classifiers keyed by the frozensets of positive and negative
+        # descriptor UUIDs they were trained on. A classifier is only trained
+        # when no session has requested classification with the same
+        # adjudications recently, including a session returning to a previous
+        # adjudication state or restored from the session store.
+        #: :type: LruCache
+        self.classifier_cache = LruCache(
+            sc_config.get('classifier_cache_size', 16)
+        )
+
+        #: :type: None | smqtk.iqr.session_store.IqrSessionStore
+        self.session_store = None
+        store_config = json_config['iqr_service']['plugins'].get(
+            'session_store', None
+        )
+        if store_config and store_config['type']:
+            self.session_store = plugin.from_plugin_config(
+                store_config, get_iqr_session_store_impls()
+            )
 
         self.controller = iqr_controller.IqrController(
             sc_config['session_expiration']['enabled'],
             sc_config['session_expiration']['check_interval_seconds'],
-            session_expire_callback
+            session_store=self.session_store,
+            descriptor_index=self.descriptor_index,
+            max_resident_descriptors=sc_config.get('max_resident_descriptors',
+                                                   0),
         )
         self.session_timeout = \
             sc_config['session_expiration']['session_timeout']
@@ -208,10 +234,7 @@ class IqrService (SmqtkWebApp):
                                       self.rel_index_config,
                                       sid)
         with self.controller:
-            with iqrs:  # because classifier maps locked by session
-                self.controller.add_session(iqrs, self.session_timeout)
-                self.session_classifiers[sid] = None
-                self.session_classifier_dirty[sid] = True
+            self.controller.add_session(iqrs, self.session_timeout)
 
         return make_response_json("Created new session with ID '%s'" % sid,
                                   sid=sid), 201  # CREATED
@@ -240,10 +263,11 @@ class IqrService (SmqtkWebApp):
             iqrs = self.controller.get_session(sid)
             iqrs.lock.acquire()  # lock BEFORE releasing controller
 
-        iqrs.reset()
-        self.session_classifiers[sid] = None
-        self.session_classifier_dirty[sid] = True
-        iqrs.lock.release()
+        try:
+            iqrs.reset()
+            self.controller.save_session(iqrs)
+        finally:
+            iqrs.lock.release()
 
         return make_response_json("Reset IQR session '%s'" % sid,
                                   sid=sid), 200
@@ -273,8 +297,6 @@ class IqrService (SmqtkWebApp):
                                           sid=sid), 404
             with self.controller.get_session(sid) as iqrs:
                 iqrs.reset()
-                del self.session_classifiers[sid]
-                del self.session_classifier_dirty[sid]
             self.controller.remove_session(sid)
         return make_response_json("Cleaned session resources for '%s'" % sid,
                                   sid=sid), 200
@@ -322,44 +344,35 @@ class IqrService (SmqtkWebApp):
             iqrs = self.controller.get_session(sid)
             iqrs.lock.acquire()  # lock BEFORE releasing controller
 
-        self._log.debug("Getting the descriptors for UUIDs")
         try:
-            pos_d = set(
-                self.descriptor_index.get_many_descriptors(pos_uuids)
-            )
-            neg_d = set(
-                self.descriptor_index.get_many_descriptors(neg_uuids)
-            )
-            neu_d = set(
-                self.descriptor_index.get_many_descriptors(neu_uuids)
-            )
-        except KeyError, ex:
-            err_uuid = str(ex)
-            self._log.warn(traceback.format_exc())
-            return make_response_json(
-                "Descriptor UUID '%s' cannot be found in the "
-                "configured descriptor index."
-                % err_uuid,
-                sid=sid,
-                uuid=err_uuid,
-            ), 404
-
-        orig_pos = set(iqrs.positive_descriptors)
-        orig_neg = set(iqrs.negative_descriptors)
-
-        self._log.debug("[%s] Adjudicating", sid)
-        iqrs.adjudicate(pos_d, neg_d, neu_d, neu_d)
-
-        # Flag classifier as dirty if change in pos/neg sets
-        diff_pos = \
-            iqrs.positive_descriptors.symmetric_difference(orig_pos)
-        diff_neg = \
-            iqrs.negative_descriptors.symmetric_difference(orig_neg)
-        if diff_pos or diff_neg:
-            self._log.debug("[%s] session Classifier dirty", sid)
-            self.session_classifier_dirty[sid] = True
-
-        iqrs.lock.release()
+            self._log.debug("Getting the descriptors for UUIDs")
+            try:
+                pos_d = set(
+                    self.descriptor_index.get_many_descriptors(pos_uuids)
+                )
+                neg_d = set(
+                    self.descriptor_index.get_many_descriptors(neg_uuids)
+                )
+                neu_d = set(
+                    self.descriptor_index.get_many_descriptors(neu_uuids)
+                )
+            except KeyError, ex:
+                err_uuid = str(ex)
+                self._log.warn(traceback.format_exc())
+                return make_response_json(
+                    "Descriptor UUID '%s' cannot be found in the "
+                    "configured descriptor index."
+                    % err_uuid,
+                    sid=sid,
+                    uuid=err_uuid,
+                ), 404
+
+            self._log.debug("[%s] Adjudicating", sid)
+            iqrs.adjudicate(pos_d, neg_d, neu_d, neu_d)
+
+            self.controller.save_session(iqrs)
+        finally:
+            iqrs.lock.release()
         return make_response_json(
             "Finished adjudication",
             sid=sid,
@@ -402,49 +415,40 @@ class IqrService (SmqtkWebApp):
             iqrs = self.controller.get_session(sid)
             iqrs.lock.acquire()  # lock BEFORE releasing controller
 
-        # Get appropriate descriptor elements from index for
-        # setting new adjudication state.
         try:
-            pos_descrs = set(
-                self.descriptor_index.get_many_descriptors(pos_uuids)
-            )
-            neg_descrs = set(
-                self.descriptor_index.get_many_descriptors(neg_uuids)
-            )
-        except KeyError, ex:
-            err_uuid = str(ex)
-            self._log.warn(traceback.format_exc())
-            return make_response_json(
-                "Descriptor UUID '%s' cannot be found in the "
-                "configured descriptor index."
-                % err_uuid,
-                sid=sid,
-                uuid=err_uuid,
-            ), 404
-
-        # if a new classifier should be made upon the next
-        # classification request.
-        diff_pos = \
-            pos_descrs.symmetric_difference(
-                iqrs.positive_descriptors)
-        diff_neg = \
-            neg_descrs.symmetric_difference(
-                iqrs.negative_descriptors)
-        if diff_pos or diff_neg:
-            self._log.debug("[%s] session Classifier dirty", sid)
-            self.session_classifier_dirty[sid] = True
-
-        self._log.info("[%s] Setting adjudications", sid)
-        iqrs.positive_descriptors = pos_descrs
-        iqrs.negative_descriptors = neg_descrs
-
-        self._log.info("[%s] Updating working index", sid)
-        iqrs.update_working_index(self.neighbor_index)
-
-        self._log.info("[%s] Refining", sid)
-        iqrs.refine()
-
-        iqrs.lock.release()
+            # Get appropriate descriptor elements from index for
+            # setting new adjudication state.
+            try:
+                pos_descrs = set(
+                    self.descriptor_index.get_many_descriptors(pos_uuids)
+                )
+                neg_descrs = set(
+                    self.descriptor_index.get_many_descriptors(neg_uuids)
+                )
+            except KeyError, ex:
+                err_uuid = str(ex)
+                self._log.warn(traceback.format_exc())
+                return make_response_json(
+                    "Descriptor UUID '%s' cannot be found in the "
+                    "configured descriptor index."
+                    % err_uuid,
+                    sid=sid,
+                    uuid=err_uuid,
+                ), 404
+
+            self._log.info("[%s] Setting adjudications", sid)
+            iqrs.positive_descriptors = pos_descrs
+            iqrs.negative_descriptors = neg_descrs
+
+            self._log.info("[%s] Updating working index", sid)
+            iqrs.update_working_index(self.neighbor_index)
+
+            self._log.info("[%s] Refining", sid)
+            iqrs.refine()
+
+            self.controller.save_session(iqrs)
+        finally:
+            iqrs.lock.release()
         return make_response_json("Refine complete", sid=sid), 201
 
     # GET
@@ -467,14 +471,12 @@ class IqrService (SmqtkWebApp):
                 return make_response_json("session id '%s' not found" % sid,
                                           sid=sid), 404
             iqrs = self.controller.get_session(sid)
-            iqrs.lock.acquire()  # lock BEFORE releasing controller
 
-        if iqrs.results:
-            size = len(iqrs.results)
-        else:
-            size = 0
+        # Refinement replaces results instead of modifying them, so current
+        # results may be read without waiting on the session lock.
+        results = iqrs.results
+        size = len(results) if results else 0
 
-        iqrs.lock.release()
         return make_response_json("Currently %d results for session %s"
                                   % (size, sid),
                                   num_results=size,
@@ -514,27 +516,28 @@ class IqrService (SmqtkWebApp):
                 return make_response_json("session id '%s' not found" % sid,
                                           sid=sid), 404
             iqrs = self.controller.get_session(sid)
-            iqrs.lock.acquire()  # lock BEFORE releasing controller
-
-        num_results = (iqrs.results and len(iqrs.results)) or 0
-
-        if i is None:
-            i = 0
-        if j is None:
-            j = num_results
 
         try:
-            i = int(i)
-            j = int(j)
+            i = int(i) if i is not None else None
+            j = int(j) if j is not None else None
         except ValueError:
             return make_response_json("Invalid bounds index value(s)"), 400
 
-        r = []
-        if iqrs.results:
-            r = iqrs.ordered_results()[i:j]
-            r = [[d.uuid(), v] for d, v in r]
+        # Only a results read lock is held, so this does not wait for an
+        # in-progress refinement, while the total and the slice returned are
+        # from the same results.
+        with iqrs.results_lock.read_lock():
+            num_results = (iqrs.results and len(iqrs.results)) or 0
+            if i is None:
+                i = 0
+            if j is None:
+                j = num_results
+
+            r = []
+            if iqrs.results:
+                r = iqrs.ordered_results(i, j)
+                r = [[d.uuid(), v] for d, v in r]
 
-        iqrs.lock.release()
         return make_response_json("Returning result pairs",
                                   i=i, j=j, total_results=num_results,
                                   results=r,
@@ -587,12 +590,21 @@ class IqrService (SmqtkWebApp):
             iqrs = self.controller.get_session(sid)
             iqrs.lock.acquire()  # lock BEFORE releasing controller
 
-        if not iqrs.positive_descriptors:
+        # Snapshot the adjudication state under the session lock. Training
+        # and classification happen outside of the lock so that other requests
+        # for this session are not held up by them.
+        try:
+            pos_descrs = set(iqrs.positive_descriptors)
+            neg_descrs = set(iqrs.negative_descriptors)
+        finally:
+            iqrs.lock.release()
+
+        if not pos_descrs:
             return make_response_json(
                 "No positive labels in current session",
                 sid=sid
             ), 400
-        if not iqrs.negative_descriptors:
+        if not neg_descrs:
             return make_response_json(
                 "No negative labels in current session",
                 sid=sid
@@ -613,11 +625,12 @@ class IqrService (SmqtkWebApp):
                 uuid=err_uuid,
             ), 404
 
-        classifier = self.session_classifiers.get(sid, None)
-
         pos_label = "positive"
         neg_label = "negative"
-        if self.session_classifier_dirty[sid] or classifier is None:
+        cache_key = (frozenset(d.uuid() for d in pos_descrs),
+                     frozenset(d.uuid() for d in neg_descrs))
+        classifier = self.classifier_cache.get(cache_key)
+        if classifier is None:
             self._log.debug("Training new classifier for current "
                             "refine state")
 
@@ -627,12 +640,11 @@ class IqrService (SmqtkWebApp):
                 get_classifier_impls(sub_interface=SupervisedClassifier)
             )
             classifier.train(
-                {pos_label: iqrs.positive_descriptors,
-                 neg_label: iqrs.negative_descriptors}
+                {pos_label: pos_descrs,
+                 neg_label: neg_descrs}
             )
 
-            self.session_classifiers[sid] = classifier
-            self.session_classifier_dirty[sid] = False
+            self.classifier_cache.store(cache_key, classifier)
 
         classifications = classifier.classify_async(
             descriptors, self.classification_factory,
@@ -650,7 +662,6 @@ class IqrService (SmqtkWebApp):
         assert uuids == o_uuids, \
             "Output UUID list is not congruent with INPUT list."
 
-        iqrs.lock.release()
         return make_response_json(
             "Finished classification",
             sid=sid,
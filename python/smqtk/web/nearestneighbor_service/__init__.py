@@ -1,3 +1,5 @@
+import atexit
+import json
 import mimetypes
 import os
 
@@ -17,6 +19,12 @@ from smqtk.representation.data_element.memory_element import DataMemoryElement
 from smqtk.representation.data_element.url_element import DataUrlElement
 from smqtk.utils import plugin
 from smqtk.utils import merge_dict
+from smqtk.utils.lru_cache import LruCache
+from smqtk.utils.vector_cache import (
+    compute_descriptor_cached,
+    config_hash,
+    VectorLruCache,
+)
 from smqtk.web import SmqtkWebApp
 
 MIMETYPES = mimetypes.MimeTypes()
@@ -41,6 +49,21 @@ class NearestNeighborServiceServer (SmqtkWebApp):
         "message": <string>,
         "reference_uri": <uri>
     }
+
+    Many data elements may be queried at once by POSTing to ``/nn_batch``.
+
+    Neighbor query results are cached for ``nn_result_cache_timeout`` seconds
+    after they were computed, keyed on the UUID of the query data and the
+    number of neighbors requested, so paging through the results of a query
+    does not re-compute the descriptor or re-query the index. At most
+    ``nn_result_cache_size`` results are cached, evicting the least recently
+    used.
+
+    Computed descriptor vectors are cached in a byte-bounded LRU cache keyed on
+    the descriptor generator configuration and the SHA1 of the data, as
+    configured by ``descriptor_vector_cache``. If a ``cache_filepath`` is
+    given, cache contents are loaded from it at start-up and saved to it at
+    exit. Cache statistics are available from ``/descriptor_cache/stats``.
     """
 
     @classmethod
@@ -67,6 +90,12 @@ class NearestNeighborServiceServer (SmqtkWebApp):
             "descriptor_index":
                 plugin.make_config(get_descriptor_index_impls()),
             "update_descriptor_index": False,
+            "nn_result_cache_timeout": 60,
+            "nn_result_cache_size": 1024,
+            "descriptor_vector_cache": {
+                "max_bytes": 134217728,
+                "cache_filepath": None,
+            },
         })
         return c
 
@@ -110,6 +139,30 @@ class NearestNeighborServiceServer (SmqtkWebApp):
             get_descriptor_generator_impls()
         )
 
+        # Short-lived cache of neighbor query results, mapping (data UUID, n)
+        # keys to the tuple of neighbor UUIDs and distances. Caching is
+        # disabled if the timeout or size is not positive.
+        self.nn_result_cache_timeout = \
+            json_config.get('nn_result_cache_timeout', 60)
+        nn_result_cache_size = json_config.get('nn_result_cache_size', 1024)
+        if self.nn_result_cache_timeout <= 0:
+            nn_result_cache_size = 0
+        self._nn_result_cache = LruCache(nn_result_cache_size,
+                                         ttl=self.nn_result_cache_timeout)
+
+        # Cache of computed descriptor vectors in front of the generator.
+        # Disabled if the byte bound is not positive.
+        vc_config = json_config.get('descriptor_vector_cache', {})
+        #: :type: smqtk.utils.vector_cache.VectorLruCache | None
+        self.vector_cache = None
+        if vc_config.get('max_bytes', 0) > 0:
+            self.vector_cache = VectorLruCache(
+                vc_config['max_bytes'], vc_config.get('cache_filepath', None)
+            )
+            atexit.register(self.vector_cache.save)
+        self._generator_key = \
+            config_hash(self.json_config['descriptor_generator'])
+
         @self.route("/count", methods=['GET'])
         def count():
             """
@@ -119,6 +172,18 @@ class NearestNeighborServiceServer (SmqtkWebApp):
                 "count": self.nn_index.count(),
             })
 
+        @self.route("/descriptor_cache/stats", methods=['GET'])
+        def descriptor_cache_stats():
+            """
+            Return usage statistics of the descriptor vector cache, or null
+            statistics if the cache is disabled.
+            """
+            return flask.jsonify(
+                enabled=self.vector_cache is not None,
+                stats=(self.vector_cache.stats()
+                       if self.vector_cache is not None else None),
+            )
+
         @self.route("/compute/<path:uri>", methods=["POST"])
         def compute(uri):
             """
@@ -213,38 +278,170 @@ class NearestNeighborServiceServer (SmqtkWebApp):
             :type uri: str
 
             """
-            descriptor = None
+            # Base pagination slicing based on provided start and end indices,
+            # otherwise clamp to beginning/ending of queried neighbor sequence.
+            page_slice = slice(start_i or 0, end_i or n)
+            success = False
+            neighbor_uuids = []
+            dists = []
             try:
-                _, descriptor = self.generate_descriptor_for_uri(uri)
-                message = "descriptor computed"
+                de = self.resolve_data_element(uri)
+                cached = self._get_cached_neighbors(de.uuid(), n)
+                if cached is not None:
+                    neighbor_uuids, dists = cached
+                    success = True
+                    message = "neighbors retrieved from cache"
+                else:
+                    descriptor = self.generate_descriptor(de)
+                    success = True
+                    message = "descriptor computed"
+                    try:
+                        neighbors, dists = self.nn_index.nn(descriptor, n)
+                        neighbor_uuids = [e.uuid() for e in neighbors]
+                        self._cache_neighbors(de.uuid(), n, neighbor_uuids,
+                                              dists)
+                    except ValueError, ex:
+                        message = "Descriptor or index related issue: %s" \
+                                  % str(ex)
             except ValueError, ex:
                 message = "Input data issue: %s" % str(ex)
             except RuntimeError, ex:
                 message = "Descriptor generation failure: %s" % str(ex)
 
-            # Base pagination slicing based on provided start and end indices,
-            # otherwise clamp to beginning/ending of queried neighbor sequence.
-            page_slice = slice(start_i or 0, end_i or n)
-            neighbors = []
-            dists = []
-            if descriptor is not None:
-                try:
-                    neighbors, dists = \
-                        self.nn_index.nn(descriptor, n)
-                except ValueError, ex:
-                    message = "Descriptor or index related issue: %s" % str(ex)
-
             # TODO: Return the optional descriptor vectors for the neighbors
             # noinspection PyTypeChecker
             d = {
-                "success": bool(descriptor is not None),
+                "success": success,
                 "message": message,
-                "neighbors": [n.uuid() for n in neighbors[page_slice]],
-                "distances": dists[page_slice],
+                "neighbors": list(neighbor_uuids[page_slice]),
+                "distances": list(dists[page_slice]),
                 "reference_uri": uri
             }
             return flask.jsonify(d)
 
+        @self.route("/nn_batch", methods=["POST"])
+        def compute_nearest_neighbors_batch():
+            """
+            Compute the nearest neighbors of many data elements at once.
+            Descriptors for the given data are computed together and the index
+            is queried with all computed descriptors in one batch.
+
+            Form args:
+                uris
+                    JSON list of URI strings of the form accepted by the
+                    ``/nn/`` endpoint (``base64://`` URIs are not supported
+                    here, use the ``base64`` argument instead).
+                base64
+                    JSON list of base64 encoded data strings.
+                content_types
+                    JSON list of content type strings, one for each element of
+                    ``base64``.
+                n
+                    Number of neighbors to query for (default 10).
+                start_i
+                    Optional starting index of the neighbors to return for each
+                    query.
+                end_i
+                    Optional ending index of the neighbors to return for each
+                    query.
+
+            JSON Return format
+            ------------------
+                {
+                    "success": <bool>
+
+                    "message": <str>
+
+                    "results": [
+                        {
+                            "success": <bool>,
+                            "message": <str>,
+                            "neighbors": <list[str]>,
+                            "distances": <list[float]>,
+                            "reference": <str>
+                        },
+                        ...
+                    ]
+                }
+
+            Results are in the order of the given URIs followed by the given
+            base64 data, where base64 data references are of the form
+            ``base64[<index>]``.
+
+            """
+            form = flask.request.form
+            try:
+                uris = json.loads(form.get('uris', '[]'))
+                b64_list = json.loads(form.get('base64', '[]'))
+                content_types = json.loads(form.get('content_types', '[]'))
+                n = int(form.get('n', 10))
+                start_i = int(form.get('start_i', 0))
+                end_i = int(form.get('end_i', n))
+            except ValueError, ex:
+                return flask.jsonify(success=False,
+                                     message="Invalid arguments: %s" % str(ex),
+                                     results=[]), 400
+            if len(b64_list) != len(content_types):
+                return flask.jsonify(success=False,
+                                     message="Number of base64 data and "
+                                             "content types given do not "
+                                             "match.",
+                                     results=[]), 400
+
+            references = list(uris)
+            # Resolve data elements, or error messages on failure, for every
+            # input.
+            #: :type: list[smqtk.representation.DataElement | None]
+            elements = []
+            messages = []
+            for uri in uris:
+                try:
+                    if uri[:9] == "base64://":
+                        raise ValueError("base64 URIs not supported in batch "
+                                         "requests")
+                    elements.append(self.resolve_data_element(uri))
+                    messages.append(None)
+                except ValueError, ex:
+                    elements.append(None)
+                    messages.append("Input data issue: %s" % str(ex))
+            for i, (b64, ct) in enumerate(zip(b64_list, content_types)):
+                references.append("base64[%d]" % i)
+                elements.append(DataMemoryElement.from_base64(b64, ct))
+                messages.append(None)
+
+            neighbor_map, error_map = self.batch_neighbors(
+                [e for e in elements if e is not None], n
+            )
+
+            page_slice = slice(start_i, end_i)
+            results = []
+            for ref, de, msg in zip(references, elements, messages):
+                r = {
+                    "success": False,
+                    "message": msg,
+                    "neighbors": [],
+                    "distances": [],
+                    "reference": ref,
+                }
+                if de is not None:
+                    uuid = de.uuid()
+                    if uuid in neighbor_map:
+                        neighbor_uuids, dists = neighbor_map[uuid]
+                        r['success'] = True
+                        r['message'] = "neighbors computed"
+                        r['neighbors'] = list(neighbor_uuids[page_slice])
+                        r['distances'] = list(dists[page_slice])
+                    else:
+                        r['message'] = error_map.get(uuid, "Unknown failure")
+                results.append(r)
+
+            return flask.jsonify(
+                success=all(r['success'] for r in results),
+                message="Computed neighbors for %d of %d inputs"
+                        % (sum(r['success'] for r in results), len(results)),
+                results=results,
+            )
+
     def get_config(self):
         return self.json_config
 
@@ -292,6 +489,45 @@ class NearestNeighborServiceServer (SmqtkWebApp):
 
         return de
 
+    def _get_cached_neighbors(self, uuid, n):
+        """
+        :return: Cached tuple of neighbor UUIDs and distances for the given
+            query data UUID and neighbor count, or None if not cached.
+        :rtype: None | (list[collections.Hashable], list[float])
+        """
+        return self._nn_result_cache.get((uuid, n))
+
+    def _cache_neighbors(self, uuid, n, neighbor_uuids, dists):
+        self._nn_result_cache.store((uuid, n),
+                                    (list(neighbor_uuids), list(dists)))
+
+    def generate_descriptor(self, de):
+        """
+        Compute the descriptor of the given data element, adding it to the
+        configured descriptor index if updating is enabled.
+
+        :raises RuntimeError: Descriptor extraction failure.
+        :raises ValueError: Data element content type not supported by the
+            configured descriptor generator.
+
+        :param de: Data element to compute the descriptor of.
+        :type de: smqtk.representation.DataElement
+
+        :return: Computed descriptor element.
+        :rtype: smqtk.representation.DescriptorElement
+
+        """
+        descriptor = compute_descriptor_cached(
+            self.vector_cache, self._generator_key,
+            self.descriptor_generator_inst, de, self.descr_elem_factory
+        )
+        if self.update_index:
+            self._log.info("Updating index with new descriptor")
+            self.descr_index.add_descriptor(descriptor)
+        if not descriptor.has_vector():
+            raise RuntimeError("No descriptor content")
+        return descriptor
+
     def generate_descriptor_for_uri(self, uri):
         """
         Given the URI to some data, resolve it and compute its descriptor,
@@ -306,15 +542,115 @@ class NearestNeighborServiceServer (SmqtkWebApp):
 
         """
         de = self.resolve_data_element(uri)
-        descriptor = self.descriptor_generator_inst.compute_descriptor(
-            de, self.descr_elem_factory
-        )
-        if self.update_index:
-            self._log.info("Updating index with new descriptor")
-            self.descr_index.add_descriptor(descriptor)
-        if not descriptor.has_vector():
-            raise RuntimeError("No descriptor content")
-        return de, descriptor
+        return de, self.generate_descriptor(de)
+
+    def batch_neighbors(self, data_elements, n):
+        """
+        Compute the nearest neighbors of many data elements, computing
+        descriptors for data not found in the result or descriptor vector
+        caches with a single asynchronous descriptor computation and querying
+        the index with all computed descriptors in one batch.
+
+        :param data_elements: Data elements to query neighbors of.
+        :type data_elements:
+            collections.Iterable[smqtk.representation.DataElement]
+
+        :param n: Number of neighbors to query for each element.
+        :type n: int
+
+        :return: Map of data UUID to the tuple of neighbor UUIDs and
+            distances for queries that succeeded, and map of data UUID to an
+            error message for queries that failed.
+        :rtype: (dict[collections.Hashable,
+                      (list[collections.Hashable], list[float])],
+                 dict[collections.Hashable, str])
+
+        """
+        neighbor_map = {}
+        error_map = {}
+
+        # Unique data elements that need computation, checking content types
+        # up front so one invalid input does not fail the whole batch.
+        valid_types = self.descriptor_generator_inst.valid_content_types()
+        to_compute = {}
+        for de in data_elements:
+            uuid = de.uuid()
+            if uuid in neighbor_map or uuid in to_compute:
+                continue
+            cached = self._get_cached_neighbors(uuid, n)
+            if cached is not None:
+                neighbor_map[uuid] = cached
+            elif de.content_type() not in valid_types:
+                error_map[uuid] = "Input data issue: Cannot compute " \
+                                  "descriptor of content type '%s'" \
+                                  % de.content_type()
+            else:
+                to_compute[uuid] = de
+
+        # Use cached descriptor vectors where available.
+        de2descr = {}
+        if self.vector_cache is not None:
+            for uuid, de in to_compute.items():
+                v = self.vector_cache.get((self._generator_key, de.sha1()))
+                if v is not None:
+                    d = self.descr_elem_factory.new_descriptor(
+                        self.descriptor_generator_inst.name, uuid
+                    )
+                    d.set_vector(v)
+                    de2descr[de] = d
+                    del to_compute[uuid]
+
+        computed = {}
+        try:
+            if to_compute:
+                computed = self.descriptor_generator_inst\
+                    .compute_descriptor_async(to_compute.values(),
+                                              self.descr_elem_factory)
+        except (RuntimeError, ValueError), ex:
+            self._log.warn("Batch descriptor computation failed (%s), "
+                           "computing individually", str(ex))
+            for de in to_compute.itervalues():
+                try:
+                    computed[de] = self.descriptor_generator_inst\
+                        .compute_descriptor(de, self.descr_elem_factory)
+                except (RuntimeError, ValueError), ex:
+                    error_map[de.uuid()] = \
+                        "Descriptor generation failure: %s" % str(ex)
+
+        if self.vector_cache is not None:
+            for de, descriptor in computed.iteritems():
+                if descriptor.has_vector():
+                    self.vector_cache.store((self._generator_key, de.sha1()),
+                                            descriptor.vector())
+        de2descr.update(computed)
+
+        descriptors = []
+        for de, descriptor in de2descr.iteritems():
+            if descriptor.has_vector():
+                descriptors.append(descriptor)
+            else:
+                error_map[de.uuid()] = "Descriptor generation failure: " \
+                                       "No descriptor content"
+        if self.update_index and descriptors:
+            self._log.info("Updating index with %d new descriptors",
+                           len(descriptors))
+            self.descr_index.add_many_descriptors(descriptors)
+        if not descriptors:
+            return neighbor_map, error_map
+
+        try:
+            nn_results = self.nn_index.nn_batch(descriptors, n)
+        except ValueError, ex:
+            for d in descriptors:
+                error_map[d.uuid()] = "Descriptor or index related issue: %s" \
+                                      % str(ex)
+            return neighbor_map, error_map
+
+        for d, (neighbors, dists) in zip(descriptors, nn_results):
+            neighbor_uuids = [e.uuid() for e in neighbors]
+            neighbor_map[d.uuid()] = (neighbor_uuids, list(dists))
+            self._cache_neighbors(d.uuid(), n, neighbor_uuids, dists)
+        return neighbor_map, error_map
 
 
 APPLICATION_CLASS = NearestNeighborServiceServer
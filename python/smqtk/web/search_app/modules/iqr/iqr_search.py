@@ -624,7 +624,7 @@ class IqrSearch (SmqtkObject, flask.Blueprint, Configurable):
                 j = int(flask.request.args.get('j', len(iqrs.results)
                                                if iqrs.results else 0))
                 #: :type: tuple[(smqtk.representation.DescriptorElement, float)]
-                r = (iqrs.ordered_results() or ())[i:j]
+                r = iqrs.ordered_results(i, j) or ()
                 return flask.jsonify({
                     "results": [(d.uuid(), p) for d, p in r]
                 })
@@ -201,7 +201,11 @@ setuptools.setup(
             'summarizePlugins = smqtk.bin.summarizePlugins:main',
             'train_itq = smqtk.bin.train_itq:main',
             'smqtk-nearest-neighbors = smqtk.bin.nearest_neighbors:main',
-            'smqtk-check-images = smqtk.bin.check_images:main'
+            'smqtk-check-images = smqtk.bin.check_images:main',
+            'smqtk-benchmark-itq = smqtk.bin.benchmark_itq:main',
+            'smqtk-benchmark-mrpt = smqtk.bin.benchmark_mrpt:main',
+            'smqtk-mrpt-autotune = smqtk.bin.mrpt_autotune:main',
+            'smqtk-compute-distance-kernel = smqtk.bin.compute_distance_kernel:main'
         ]
     }
 )